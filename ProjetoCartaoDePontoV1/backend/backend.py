@@ -1,25 +1,55 @@
 # -*- coding: utf-8 -*-
-from fastapi import FastAPI, File, UploadFile, Form
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List, Optional
-import pandas as pd
+from typing import Iterator, List, Optional
 import io
 import re
-import base64
+import asyncio
+import codecs
 import os
 import json
+import marshal
+import math
+import multiprocessing
+import pickle
 import time
 import hashlib
+import heapq
+import shutil
+import sqlite3
+import tempfile
+import threading
+import traceback
+import unicodedata
+import uuid
+import zipfile
+from array import array
+from contextlib import contextmanager
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta, date, time as dt_time
+from functools import lru_cache
 from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, Alignment, PatternFill, Border, Side, NamedStyle
+from openpyxl.styles.borders import DEFAULT_BORDER
+from openpyxl.styles.fonts import DEFAULT_FONT
+from openpyxl.worksheet.worksheet import Worksheet
+import numpy as np
 import google.generativeai as genai
-from PIL import Image
+from google.ai import generativelanguage as glm
+from PIL import Image, ImageFilter, ImageOps
 import fitz  # PyMuPDF para processar PDFs
 from dotenv import load_dotenv
 
+try:
+    import fcntl  # Lock entre workers do gunicorn (Linux/macOS)
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
 # Carrega variáveis de ambiente do arquivo .env
 load_dotenv()
 
@@ -43,33 +73,337 @@ app.add_middleware(
 )
 
 # Verificação da API Key do Gemini - SUPORTE A MÚLTIPLAS CHAVES
-GEMINI_API_KEYS = []
 GEMINI_MODELS = []  # Lista de modelos instanciados
+GEMINI_MODELO_NOME = 'gemini-2.5-flash'
+
+# NOVO v7.2: Limite de chamadas simultâneas ao Gemini por chave (por worker)
+GEMINI_MAX_CONCORRENCIA_POR_CHAVE = int(os.getenv("GEMINI_MAX_CONCORRENCIA_POR_CHAVE", "4"))
+
+# NOVO v7.3: Limites de cota por chave (sobrescrevíveis por chave: GEMINI_API_KEY_3_RPM, ...; 0 = sem limite)
+GEMINI_RPM_PADRAO = int(os.getenv("GEMINI_RPM", "10"))
+GEMINI_TPM_PADRAO = int(os.getenv("GEMINI_TPM", "250000"))
+GEMINI_TOKENS_POR_PAGINA = int(os.getenv("GEMINI_TOKENS_POR_PAGINA", "3000"))  # Estimativa (prompt + imagem + resposta)
+GEMINI_ESPERA_MAXIMA_S = float(os.getenv("GEMINI_ESPERA_MAXIMA_S", "120"))  # Espera máxima por uma chave livre
+GEMINI_MAX_TENTATIVAS_429 = int(os.getenv("GEMINI_MAX_TENTATIVAS_429", "6"))
+GEMINI_COOLDOWN_BASE_S = 5.0   # Circuit breaker: 5s, 10s, 20s... por 429 consecutivo
+GEMINI_COOLDOWN_MAX_S = 120.0
+GEMINI_JANELA_429_S = 300.0    # Janela para contar 429 recentes (saúde da chave)
+# A cota é da CHAVE, não do processo: baldes e circuit breaker ficam num arquivo por chave,
+# compartilhado (com flock) entre os workers do gunicorn e os processos da fila de jobs
+GEMINI_COTA_DIR = os.getenv("GEMINI_COTA_DIR", os.path.join(tempfile.gettempdir(), "pontosync_gemini_cota"))
+
+
+class ModeloGeminiChave:
+    """
+    NOVO v7.2: Modelo Gemini preso a UMA chave, com cliente próprio.
+    
+    Substitui genai.configure() (estado GLOBAL do SDK): com várias páginas em
+    paralelo, reconfigurar a chave global faria uma requisição usar a chave de outra.
+    Só usa API pública do SDK: o GenerativeServiceClient recebe a chave via
+    client_options e a requisição/resposta são montadas como no GenerativeModel.
+    """
+    
+    def __init__(self, api_key: str, nome_modelo: str = GEMINI_MODELO_NOME):
+        self.nome_modelo = nome_modelo if nome_modelo.startswith("models/") else f"models/{nome_modelo}"
+        self.cliente = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+    
+    def generate_content(self, conteudo):
+        requisicao = glm.GenerateContentRequest(
+            model=self.nome_modelo,
+            contents=genai.types.content_types.to_contents(conteudo)
+        )
+        return genai.types.GenerateContentResponse.from_response(self.cliente.generate_content(requisicao))
+
+
+def criar_modelo_gemini(api_key: str) -> ModeloGeminiChave:
+    return ModeloGeminiChave(api_key)
+
+
+def carregar_chaves_gemini_env() -> List[tuple]:
+    """
+    NOVO v7.3: Lê GEMINI_API_KEY, GEMINI_API_KEY_2, ..., GEMINI_API_KEY_N do ambiente.
+    
+    Retorna [(numero, api_key), ...] ordenado pelo número (GEMINI_API_KEY = 1).
+    Chaves duplicadas são ignoradas. Duas variáveis com o mesmo número (GEMINI_API_KEY e
+    GEMINI_API_KEY_1) levantam ValueError: os limites _RPM/_TPM ficariam ambíguos.
+    """
+    padrao = re.compile(r'^GEMINI_API_KEY(?:_(\d+))?$')
+    encontradas = []
+    variaveis = {}
+    for nome_var, valor in os.environ.items():
+        match = padrao.match(nome_var)
+        if match and valor.strip():
+            numero = int(match.group(1) or 1)
+            if numero in variaveis:
+                raise ValueError(f"{variaveis[numero]} e {nome_var} configuram a mesma API Key #{numero}: use só uma delas")
+            variaveis[numero] = nome_var
+            encontradas.append((numero, valor.strip()))
+    
+    chaves = []
+    vistas = set()
+    for numero, api_key in sorted(encontradas):
+        if api_key not in vistas:
+            vistas.add(api_key)
+            chaves.append((numero, api_key))
+    return chaves
+
+
+class BaldeTokens:
+    """Token bucket simples: `capacidade` tokens, reabastecido a `taxa` tokens/segundo (capacidade 0 = sem limite)."""
+    
+    def __init__(self, capacidade: float, taxa: float):
+        self.capacidade = float(capacidade)
+        self.taxa = float(taxa)
+        self.tokens = float(capacidade)
+        self.atualizado_em = time.monotonic()
+        self.ilimitado = self.capacidade <= 0 or self.taxa <= 0
+    
+    def _reabastecer(self) -> None:
+        agora = time.monotonic()
+        self.tokens = min(self.capacidade, self.tokens + (agora - self.atualizado_em) * self.taxa)
+        self.atualizado_em = agora
+    
+    def espera_para(self, quantidade: float) -> float:
+        """Segundos até haver `quantidade` tokens (0 se já houver)."""
+        if self.ilimitado:
+            return 0.0
+        self._reabastecer()
+        quantidade = min(quantidade, self.capacidade)
+        if self.tokens >= quantidade:
+            return 0.0
+        return (quantidade - self.tokens) / self.taxa
+    
+    def consumir(self, quantidade: float) -> None:
+        if self.ilimitado:
+            return
+        self._reabastecer()
+        self.tokens -= min(quantidade, self.capacidade)
+    
+    def esvaziar(self) -> None:
+        if self.ilimitado:
+            return
+        self._reabastecer()
+        self.tokens = 0.0
+    
+    def folga(self) -> float:
+        """Fração da capacidade ainda disponível (1.0 se sem limite)."""
+        return 1.0 if self.ilimitado else self.tokens / self.capacidade
+
+
+class ChaveGemini:
+    """
+    NOVO v7.3: Estado de uma chave API no pool.
+    
+    - Baldes de RPM e TPM (cota por minuto)
+    - Chamadas em voo (limite GEMINI_MAX_CONCORRENCIA_POR_CHAVE, por processo)
+    - Saúde: 429 recentes e circuit breaker (cooldown exponencial após 429)
+    
+    Com `arquivo_cota`, baldes e saúde são lidos/gravados nele sob flock a cada operação:
+    todos os processos da máquina que usam a chave dividem a mesma cota. Sem fcntl
+    (Windows) cada processo fica com a cota inteira: divida GEMINI_RPM/GEMINI_TPM
+    pelo nº de processos (workers + JOBS_WORKERS).
+    """
+    
+    def __init__(self, key_index: int, model, rpm: int, tpm: int, arquivo_cota: str = None):
+        self.key_index = key_index
+        self.model = model
+        self.balde_rpm = BaldeTokens(rpm, rpm / 60.0)
+        self.balde_tpm = BaldeTokens(tpm, tpm / 60.0)
+        self.em_voo = 0
+        self.falhas_consecutivas = 0
+        self.bloqueada_ate = 0.0
+        self.historico_429 = deque()
+        self.total_chamadas = 0
+        self.arquivo_cota = arquivo_cota if fcntl is not None else None
+        if self.arquivo_cota:
+            os.makedirs(os.path.dirname(self.arquivo_cota), exist_ok=True)
+    
+    @contextmanager
+    def _cota_compartilhada(self):
+        """Carrega o estado de cota do arquivo (sob flock exclusivo) e grava de volta na saída."""
+        if not self.arquivo_cota:
+            yield
+            return
+        with open(self.arquivo_cota, "a+", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                estado = json.loads(f.read() or "null")
+            except ValueError:
+                estado = None  # Arquivo corrompido: recomeça do estado deste processo
+            if estado:
+                # time.monotonic() é o mesmo relógio para todos os processos da máquina
+                self.balde_rpm.tokens, self.balde_rpm.atualizado_em = estado["rpm"]
+                self.balde_tpm.tokens, self.balde_tpm.atualizado_em = estado["tpm"]
+                self.falhas_consecutivas = estado["falhas_consecutivas"]
+                self.bloqueada_ate = estado["bloqueada_ate"]
+                self.historico_429 = deque(estado["historico_429"])
+            yield
+            f.seek(0)
+            f.truncate()
+            json.dump({
+                "rpm": [self.balde_rpm.tokens, self.balde_rpm.atualizado_em],
+                "tpm": [self.balde_tpm.tokens, self.balde_tpm.atualizado_em],
+                "falhas_consecutivas": self.falhas_consecutivas,
+                "bloqueada_ate": self.bloqueada_ate,
+                "historico_429": list(self.historico_429),
+            }, f)
+            f.flush()  # Antes de soltar o lock (o close solta o flock)
+    
+    def espera(self, tokens: int) -> float:
+        """Segundos até a chave poder receber uma nova chamada."""
+        with self._cota_compartilhada():
+            return self._espera(tokens)
+    
+    def _espera(self, tokens: int) -> float:
+        agora = time.monotonic()
+        if self.bloqueada_ate > agora:
+            return self.bloqueada_ate - agora
+        if self.em_voo >= GEMINI_MAX_CONCORRENCIA_POR_CHAVE:
+            return 0.25  # Aguarda alguma chamada terminar
+        return max(self.balde_rpm.espera_para(1), self.balde_tpm.espera_para(tokens))
+    
+    def carga(self) -> tuple:
+        """Critério de escolha: menos ocupada, menos 429 recentes, mais cota sobrando."""
+        return (
+            self.em_voo / GEMINI_MAX_CONCORRENCIA_POR_CHAVE,
+            self.erros_429_recentes(),
+            -self.balde_rpm.folga(),
+        )
+    
+    def erros_429_recentes(self) -> int:
+        limite = time.monotonic() - GEMINI_JANELA_429_S
+        while self.historico_429 and self.historico_429[0] < limite:
+            self.historico_429.popleft()
+        return len(self.historico_429)
+    
+    def reservar(self, tokens: int) -> bool:
+        """Consome a cota da chamada se ainda houver (outro processo pode ter levado). True = reservada."""
+        with self._cota_compartilhada():
+            if self._espera(tokens) > 0:
+                return False
+            self.balde_rpm.consumir(1)
+            self.balde_tpm.consumir(tokens)
+        self.em_voo += 1
+        self.total_chamadas += 1
+        return True
+    
+    def liberar(self) -> None:
+        self.em_voo -= 1
+    
+    def registrar_sucesso(self) -> None:
+        if not self.falhas_consecutivas:
+            return
+        with self._cota_compartilhada():
+            self.falhas_consecutivas = 0
+    
+    def registrar_429(self) -> float:
+        """Abre o circuito da chave. Retorna o cooldown aplicado (segundos)."""
+        with self._cota_compartilhada():
+            self.falhas_consecutivas += 1
+            self.historico_429.append(time.monotonic())
+            cooldown = min(GEMINI_COOLDOWN_MAX_S, GEMINI_COOLDOWN_BASE_S * 2 ** (self.falhas_consecutivas - 1))
+            self.bloqueada_ate = time.monotonic() + cooldown
+            # A cota do minuto claramente acabou: não confia no balde
+            self.balde_rpm.esvaziar()
+        return cooldown
+    
+    def status(self) -> dict:
+        with self._cota_compartilhada():
+            pass  # Só atualiza a visão local
+        restante = max(0.0, self.bloqueada_ate - time.monotonic())
+        return {
+            "chave": self.key_index,
+            "saudavel": restante == 0,
+            "cooldown_s": round(restante, 1),
+            "em_voo": self.em_voo,
+            "erros_429_recentes": self.erros_429_recentes(),
+            "chamadas": self.total_chamadas,
+        }
+
+
+class PoolChavesGemini:
+    """
+    NOVO v7.3: Escalonador de chaves API (substitui o fallback sequencial).
+    
+    Cada página vai para a chave saudável MENOS CARREGADA que tenha cota livre.
+    Chaves com 429 entram em cooldown (circuit breaker) e as demais seguem atendendo,
+    em vez de a chave #1 consumir 5+12+25s de retries antes da #2 ser usada.
+    """
+    
+    def __init__(self, chaves: List[ChaveGemini]):
+        self.chaves = chaves
+    
+    def __len__(self) -> int:
+        return len(self.chaves)
+    
+    async def adquirir(self, tokens: int, prazo: float) -> ChaveGemini:
+        """
+        Aguarda (sem bloquear o event loop) uma chave livre e a reserva.
+        
+        Levanta TimeoutError se nenhuma chave ficar livre até `prazo` (time.monotonic).
+        """
+        while True:
+            esperas = [(chave.espera(tokens), chave) for chave in self.chaves]
+            livres = [chave for espera, chave in esperas if espera == 0]
+            if livres:
+                chave = min(livres, key=lambda c: c.carga())
+                if chave.reservar(tokens):
+                    return chave
+                continue  # Outro processo levou a cota entre a consulta e a reserva
+            
+            menor_espera = min(espera for espera, _ in esperas)
+            if time.monotonic() + menor_espera > prazo:
+                raise TimeoutError("Nenhuma chave Gemini disponível dentro do prazo")
+            await asyncio.sleep(min(menor_espera, 1.0))
+    
+    def status(self) -> List[dict]:
+        return [chave.status() for chave in self.chaves]
 
-# Carrega chaves do .env (suporta GEMINI_API_KEY e GEMINI_API_KEY_2)
-key1 = os.getenv("GEMINI_API_KEY")
-key2 = os.getenv("GEMINI_API_KEY_2")
 
-if key1:
-    GEMINI_API_KEYS.append(key1)
-if key2:
-    GEMINI_API_KEYS.append(key2)
+# Carrega chaves do .env (GEMINI_API_KEY, GEMINI_API_KEY_2, ..., GEMINI_API_KEY_N)
+chaves_env = carregar_chaves_gemini_env()
+GEMINI_API_KEYS = [api_key for _, api_key in chaves_env]
 
 if not GEMINI_API_KEYS:
     print("    ⚠️ AVISO: Nenhuma GEMINI_API_KEY encontrada no .env - Processamento de PDF/Fotos desabilitado")
 else:
-    # Instancia um modelo para cada chave
-    for idx, api_key in enumerate(GEMINI_API_KEYS, 1):
+    # Instancia um modelo para cada chave (cada um com seu próprio cliente)
+    for idx, api_key in chaves_env:
         try:
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel('gemini-2.5-flash')
+            model = criar_modelo_gemini(api_key)
             GEMINI_MODELS.append({'key': api_key, 'model': model, 'key_index': idx})
             print(f"    ✅ Gemini API Key #{idx} configurada com sucesso")
         except Exception as e:
             print(f"    ❌ Erro ao configurar API Key #{idx}: {e}")
     
     if GEMINI_MODELS:
-        print(f"    🔑 Total de {len(GEMINI_MODELS)} chave(s) API disponível(is) com fallback automático")
+        print(f"    🔑 Total de {len(GEMINI_MODELS)} chave(s) API disponível(is) com escalonamento por cota")
+
+def _limite_chave_env(key_index: int, limite: str, padrao: int) -> int:
+    """Lê GEMINI_API_KEY[_N]_RPM / _TPM, se definido para a chave (0 = sem limite)."""
+    nome_var = "GEMINI_API_KEY" if key_index == 1 else f"GEMINI_API_KEY_{key_index}"
+    valor = int(os.getenv(f"{nome_var}_{limite}", padrao))
+    if valor < 0:
+        raise ValueError(f"Limite {limite} da API Key #{key_index} inválido ({valor}): use 0 (sem limite) ou um valor positivo")
+    return valor
+
+
+def arquivo_cota_chave(api_key: str) -> str:
+    """Arquivo de cota compartilhada da chave (nomeado pelo hash: a chave não vai para o disco)."""
+    return os.path.join(GEMINI_COTA_DIR, hashlib.sha256(api_key.encode()).hexdigest()[:32] + ".json")
+
+
+GEMINI_POOL = PoolChavesGemini([
+    ChaveGemini(
+        m['key_index'],
+        m['model'],
+        _limite_chave_env(m['key_index'], "RPM", GEMINI_RPM_PADRAO),
+        _limite_chave_env(m['key_index'], "TPM", GEMINI_TPM_PADRAO),
+        arquivo_cota_chave(m['key']),
+    )
+    for m in GEMINI_MODELS
+])
 
 DIAS_SEMANA = {
     0: 'Segunda-feira', 1: 'Terça-feira', 2: 'Quarta-feira', 3: 'Quinta-feira',
@@ -177,13 +511,7 @@ CATALOGO_JORNADAS_CLT = {
         'descricao': '5 dias trabalho, 1 dia folga. Meta 8h/dia',
         'meta_semana_minutos': 2400,  # 5 dias × 8h
         'metas_por_dia': {
-            0: 480,   # Seg-Sex: 8h cada
-            1: 480,
-            2: 480,
-            3: 480,
-            4: 480,
-            5: 0,     # Sábado: Folga (variável)
-            6: 0      # Domingo: Folga (variável)
+            'ciclo': [480, 480, 480, 480, 480, 0]  # 5 dias de 8h + 1 folga (a partir do início do ciclo)
         },
         'sabado_util_automatico': False  # Depende do ciclo
     },
@@ -193,7 +521,33 @@ CATALOGO_JORNADAS_CLT = {
         'descricao': 'Plantão 12h (720min) seguido de 36h de folga. Ciclo: 48h',
         'meta_semana_minutos': 2640,
         'metas_por_dia': {
-            'ciclo': [720, 0, 0]
+            'ciclo': [720, 0]  # Dia sim, dia não (48h = 2 dias)
+        },
+        'sabado_util_automatico': False
+    },
+    'clt_24x48': {
+        'nome': '24x48 Plantão',
+        'tipo': 'Cíclico',
+        'descricao': 'Plantão 24h (1440min) seguido de 48h de folga. Ciclo: 72h',
+        'meta_semana_minutos': 3360,
+        'metas_por_dia': {
+            'ciclo': [1440, 0, 0]  # 1 dia de plantão + 2 de folga
+        },
+        'sabado_util_automatico': False
+    },
+    'clt_parcial_30h': {
+        'nome': 'Parcial 30h',
+        'tipo': 'Semanal',
+        'descricao': 'Segunda a sexta: 6h/dia, Sábado/Domingo: Folga',
+        'meta_semana_minutos': 1800,  # 30 horas
+        'metas_por_dia': {
+            0: 360,   # Segunda: 6h
+            1: 360,   # Terça: 6h
+            2: 360,   # Quarta: 6h
+            3: 360,   # Quinta: 6h
+            4: 360,   # Sexta: 6h
+            5: 0,     # Sábado: Folga
+            6: 0      # Domingo: Folga
         },
         'sabado_util_automatico': False
     },
@@ -225,70 +579,114 @@ CATALOGO_JORNADAS_CLT = {
 
 # ===== FUNÇÕES DE CÁLCULO CLT SÊNIOR =====
 
-def calcular_adicional_noturno_estrito(inicio: datetime, fim: datetime) -> int:
+# ===== NOVO v8.5: TABELA DE CLASSIFICAÇÃO POR MINUTO =====
+# Cada minuto do período recebe suas classes (noturno 22:00-05:00; domingo, feriado ou dia comum)
+# e a tabela guarda a SOMA ACUMULADA de cada classe. Os minutos noturnos (ou de domingo/feriado)
+# de um par entrada/saída são acumulado[saída] - acumulado[entrada]: duas consultas, sem
+# ramificação por caso, inclusive quando o par atravessa a meia-noite para um domingo ou feriado.
+
+MINUTOS_DIA = 1440
+NOTURNO_INICIO_MIN = 22 * 60  # 22:00
+NOTURNO_FIM_MIN = 5 * 60      # 05:00
+PRORROGACAO_MAX_MIN = NOTURNO_INICIO_MIN - NOTURNO_FIM_MIN  # 05:00 até as 22:00 seguintes
+
+
+class TabelaMinutos:
+    """
+    Somas acumuladas por minuto do período [data_inicio, data_fim + 1 dia]
+    (o dia seguinte ao fim cobre saídas após a meia-noite).
+    
+    Classes: noturno (22:00-05:00) e, por dia do calendário, domingo, feriado ou comum.
+    Feriado que cai no domingo conta como feriado.
     """
-    NOVO v4.2: Calcula APENAS os minutos que caem na janela [22:00 às 05:00].
+    __slots__ = ('data_inicio', 'total_minutos', 'noturno', 'domingo', 'feriado', 'comum')
     
-    Regra: Interseção entre o horário trabalhado E o período noturno CLT.
+    def __init__(self, data_inicio: date, data_fim: date, feriados: set = None):
+        feriados = feriados or set()
+        n_dias = (data_fim - data_inicio).days + 2
+        self.data_inicio = data_inicio
+        self.total_minutos = n_dias * MINUTOS_DIA
+        
+        minuto_do_dia = np.arange(MINUTOS_DIA)
+        noturno_dia = (minuto_do_dia >= NOTURNO_INICIO_MIN) | (minuto_do_dia < NOTURNO_FIM_MIN)
+        dias = [data_inicio + timedelta(days=i) for i in range(n_dias)]
+        eh_feriado = np.array([d in feriados for d in dias], dtype=bool)
+        eh_domingo = np.array([d.weekday() == 6 for d in dias], dtype=bool) & ~eh_feriado
+        
+        self.noturno = self._acumular(np.tile(noturno_dia, n_dias))
+        self.domingo = self._acumular(np.repeat(eh_domingo, MINUTOS_DIA))
+        self.feriado = self._acumular(np.repeat(eh_feriado, MINUTOS_DIA))
+        self.comum = self._acumular(np.repeat(~(eh_domingo | eh_feriado), MINUTOS_DIA))
+    
+    def _acumular(self, por_minuto) -> array:
+        # acumulado[i] = minutos da classe em [0, i); array('i') = consulta O(1) com int Python
+        acumulado = np.zeros(self.total_minutos + 1, dtype=np.int32)
+        np.cumsum(por_minuto, dtype=np.int32, out=acumulado[1:])
+        return array('i', acumulado.tobytes())
+    
+    def indice(self, momento: datetime) -> int:
+        """Posição do minuto (arredondado pelos segundos) na tabela."""
+        i = ((momento.date() - self.data_inicio).days * MINUTOS_DIA + momento.hour * 60 + momento.minute
+             + (momento.second >= 30))
+        if not 0 <= i <= self.total_minutos:
+            raise ValueError(f"{momento} fora do período da tabela de minutos")
+        return i
     
-    Súmula 155 TST:
-    - SE jornada COMEÇOU à noite (22:00+) E terminou APÓS 05:00 → bônus continua
-    - SE jornada COMEÇOU de dia → bônus para às 05:00
+    def contar(self, entrada: datetime, saida: datetime, inicio_turno: datetime = None) -> tuple:
+        """
+        Classifica o par entrada/saída (saida >= entrada, já com a virada de dia).
+        
+        Args:
+            inicio_turno: primeira entrada do turno do par (padrão: a própria entrada); a
+                prorrogação é medida a partir da noite em que o TURNO começou, então o par
+                depois de uma pausa de madrugada (22:00-02:00 + 03:00-06:00) também prorroga
+        
+        Returns:
+            (minutos_noturnos, minutos_domingo, minutos_feriado, minutos_comuns)
+            Os noturnos já incluem a prorrogação da Súmula 60, II TST.
+        """
+        a = self.indice(entrada)
+        b = self.indice(saida)
+        inicio = a if inicio_turno is None else self.indice(inicio_turno)
+        noturno = self.noturno[b] - self.noturno[a] + self.prorrogacao(a, b, inicio)
+        return (noturno,
+                self.domingo[b] - self.domingo[a],
+                self.feriado[b] - self.feriado[a],
+                self.comum[b] - self.comum[a])
     
-    Retorna: Minutos reais (sem redução) que caem em [22:00-05:00]
+    @staticmethod
+    def prorrogacao(a: int, b: int, inicio: int = None) -> int:
+        """
+        Súmula 60, II TST (antiga regra "Súmula 155" do sistema): jornada iniciada antes da
+        meia-noite que cumpre a noite até as 05:00 e continua -> os minutos prorrogados
+        após as 05:00 também são noturnos. Quem entra de madrugada (00:00-05:00) não prorroga.
+        
+        `inicio` é o minuto em que o turno começou (padrão: a entrada do par).
+        """
+        if inicio is None:
+            inicio = a
+        fim_noite = (inicio // MINUTOS_DIA + 1) * MINUTOS_DIA + NOTURNO_FIM_MIN
+        return max(0, min(b, fim_noite + PRORROGACAO_MAX_MIN) - max(a, fim_noite))
+
+
+def calcular_adicional_noturno_estrito(inicio: datetime, fim: datetime) -> int:
     """
-    PERIODO_NOTURNO_INICIO = 22  # 22:00
-    PERIODO_NOTURNO_FIM = 5      # 05:00
+    REFATORADO v8.5: Minutos reais (sem redução) na janela [22:00 às 05:00] do par,
+    mais a prorrogação da Súmula 60 (ver TabelaMinutos.prorrogacao).
     
-    # Ajusta para cross-day ANTES de calcular horas
+    Para muitos pares do mesmo período, monte uma TabelaMinutos uma vez e use contar().
+    """
     if fim < inicio:
         fim = fim + timedelta(days=1)
-    
-    # Obtém horários em horas decimais
-    inicio_hora = inicio.hour + inicio.minute / 60.0
-    fim_hora = fim.hour + fim.minute / 60.0
-    
-    minutos_noturno = 0.0
-    
-    # CASO 1: Entrada à noite (22:00+)
-    if inicio_hora >= PERIODO_NOTURNO_INICIO:
-        # Calcula da entrada até 05:00 do dia seguinte
-        proxima_05 = inicio.replace(hour=5, minute=0, second=0, microsecond=0)
-        if proxima_05 <= inicio:
-            proxima_05 += timedelta(days=1)
-        
-        # Fim está antes de 05:00?
-        fim_efetivo = min(fim, proxima_05)
-        minutos_noturno = (fim_efetivo - inicio).total_seconds() / 60.0
-    
-    # CASO 2: Entrada de madrugada (00:00-05:00)
-    elif inicio_hora < PERIODO_NOTURNO_FIM and inicio_hora >= 0:
-        # Calcula do início até 05:00
-        proxima_05 = inicio.replace(hour=5, minute=0, second=0, microsecond=0)
-        minutos_noturno = (proxima_05 - inicio).total_seconds() / 60.0
-    
-    # CASO 3: Entrada de dia (05:00-22:00) mas termina à noite/madrugada
-    elif inicio_hora >= PERIODO_NOTURNO_FIM and inicio_hora < PERIODO_NOTURNO_INICIO:
-        # Cruza a janela noturna?
-        if fim_hora >= PERIODO_NOTURNO_INICIO or fim_hora < PERIODO_NOTURNO_FIM:
-            # Sim, cruza - calcular desde 22:00 até fim
-            noite_inicio = inicio.replace(hour=PERIODO_NOTURNO_INICIO, minute=0, second=0, microsecond=0)
-            if noite_inicio <= inicio:
-                noite_inicio += timedelta(days=1)
-            minutos_noturno = (fim - noite_inicio).total_seconds() / 60.0
-    
-    return int(round(minutos_noturno))
+    return TabelaMinutos(inicio.date(), fim.date()).contar(inicio, fim)[0]
 
 def calcular_reducao_hora_noturna(inicio: datetime, fim: datetime, noturno_ativo: bool = False) -> tuple:
     """
-    REFATORADO v4.5 (Enterprise): Cálculo estrito de hora noturna (Art. 73 CLT).
+    REFATORADO v8.5: Hora noturna reduzida (Art. 73 CLT) sobre os minutos da TabelaMinutos.
     
-    Regras de Ouro:
-    1. Janela Noturna: 22:00 às 05:00.
+    Regras:
+    1. Janela Noturna: 22:00 às 05:00 (com prorrogação da Súmula 60).
     2. Redução: 52min30s -> 60min (Fator 1.142857).
-    3. Súmula 155 TST (Prorrogação):
-       - Se jornada COMEÇA no período noturno (>= 22:00) E estende após as 05:00 -> Aplica noturno na prorrogação.
-       - Se jornada COMEÇA de dia/tarde e entra na noite -> Para o noturno às 05:00.
     
     Retorna: (tempo_real_segundos, tempo_reduzido_segundos, minutos_noturno_inteiros)
     """
@@ -296,170 +694,325 @@ def calcular_reducao_hora_noturna(inicio: datetime, fim: datetime, noturno_ativo
         duracao_seg = (fim - inicio).total_seconds()
         return (duracao_seg, duracao_seg, 0)
     
-    PERIODO_NOTURNO_INICIO = 22.0
-    PERIODO_NOTURNO_FIM = 5.0
     FATOR_REDUCAO = 60.0 / 52.5  # 1.142857...
     
-    # Ajusta para cross-day
     fim_ajustado = fim if fim >= inicio else fim + timedelta(days=1)
     duracao_total_seg = (fim_ajustado - inicio).total_seconds()
     
-    # --- Passo 1: Normalização Decimal ---
-    inicio_dec = inicio.hour + (inicio.minute / 60.0)
-    fim_dec = fim_ajustado.hour + (fim_ajustado.minute / 60.0) + (24.0 if fim_ajustado.day > inicio.day else 0)
+    minutos_noturno = calcular_adicional_noturno_estrito(inicio, fim_ajustado)
+    segundos_noturno = min(minutos_noturno * 60.0, duracao_total_seg)
+    segundos_diurnos = duracao_total_seg - segundos_noturno
     
-    # --- Passo 2: Identificar Janela Noturna Relevante ---
-    # A janela noturna padrão é das 22h (22.0) até às 05h do dia seguinte (29.0)
-    JANELA_INICIO = 22.0
-    JANELA_FIM = 29.0 # 05:00 do dia seguinte
+    tempo_reduzido_seg = segundos_diurnos + segundos_noturno * FATOR_REDUCAO
     
-    segundos_noturno = 0.0
+    return (duracao_total_seg, tempo_reduzido_seg, minutos_noturno)
+
+# ===== NOVO v8.6: CALENDÁRIO DE METAS COMPILADO DO CATÁLOGO =====
+# Cada escala do CATALOGO_JORNADAS_CLT vira um array meta-por-data para o período:
+# - Semanal: metas_por_dia {0..6: minutos}, indexado pelo dia da semana
+# - Cíclica: metas_por_dia {'ciclo': [minutos, ...]}, contado a partir da data de início do ciclo
+# Feriados têm meta zero. Nova escala = nova entrada no catálogo (sem código).
+
+# Escala personalizada ou desconhecida: 8h de segunda a sábado, domingo folga
+METAS_ESCALA_PADRAO = {0: 480, 1: 480, 2: 480, 3: 480, 4: 480, 5: 480, 6: 0}
+
+
+def parse_data_inicio_escala(valor) -> Optional[date]:
+    """Data de início do ciclo (DD/MM/YYYY, YYYY-MM-DD, date ou datetime); None se vazia/inválida."""
+    if not valor:
+        return None
+    try:
+        if isinstance(valor, str):
+            if '/' in valor:
+                return datetime.strptime(valor, '%d/%m/%Y').date()
+            return datetime.strptime(valor, '%Y-%m-%d').date()
+        return valor.date() if isinstance(valor, datetime) else valor
+    except Exception as e:
+        print(f"⚠️ Erro ao parsing data_inicio_escala: {e}")
+        return None
+
+
+def escala_eh_ciclica(escala_tipo: str) -> bool:
+    return 'ciclo' in ((CATALOGO_JORNADAS_CLT.get(escala_tipo) or {}).get('metas_por_dia') or {})
+
+
+class CalendarioEscala:
+    """
+    Meta diária (segundos) de cada data do período [data_inicio, data_fim] para uma escala.
     
-    # Verifica se houve trabalho na janela 22:00 - 05:00
-    overlap_inicio = max(inicio_dec, JANELA_INICIO)
-    overlap_fim = min(fim_dec, JANELA_FIM)
+    Use compilar_calendario_escala() (com cache) em vez de instanciar direto.
+    """
+    __slots__ = ('escala_tipo', 'data_inicio', 'metas', '_metas_lista')
     
-    if overlap_fim > overlap_inicio:
-        horas_noturnas = overlap_fim - overlap_inicio
-        segundos_noturno += horas_noturnas * 3600.0
+    def __init__(self, escala_tipo: str, data_inicio: date, data_fim: date,
+                 feriados: frozenset = frozenset(), data_inicio_escala: Optional[date] = None):
+        self.escala_tipo = escala_tipo
+        self.data_inicio = data_inicio
+        n_dias = (data_fim - data_inicio).days + 1
         
-    # --- Passo 3: Súmula 155 (Prorrogação da Noite) ---
-    # Só aplica se a jornada COMEÇOU integralmente dentro ou antes da noite, 
-    # mas a regra clássica é: cumpriu integralmente o horário noturno E prorrogou.
-    # Simplificação Enterprise: Se iniciou >= 22h, prorroga após as 05h.
-    
-    if inicio_dec >= JANELA_INICIO and fim_dec > JANELA_FIM:
-        # Prorrogação: tudo que excede 05:00 (29.0)
-        horas_prorrogacao = fim_dec - JANELA_FIM
-        segundos_noturno += horas_prorrogacao * 3600.0
+        escala_info = CATALOGO_JORNADAS_CLT.get(escala_tipo) or {}
+        metas_por_dia = escala_info.get('metas_por_dia') or METAS_ESCALA_PADRAO
         
-    # --- Passo 4: Cálculos Finais ---
-    segundos_diurnos = max(0, duracao_total_seg - segundos_noturno)
-    segundos_noturno_reduzidos = segundos_noturno * FATOR_REDUCAO
-    
-    tempo_reduzido_seg = segundos_diurnos + segundos_noturno_reduzidos
+        if 'ciclo' in metas_por_dia:
+            ciclo = np.array(metas_por_dia['ciclo'], dtype=np.int64)
+            if data_inicio_escala is None:
+                # Sem data de início: o ciclo começa no primeiro dia do período
+                print(f"⚠️ Escala {escala_tipo} sem data_inicio_escala: ciclo iniciado em {data_inicio}")
+                data_inicio_escala = data_inicio
+            deslocamento = (data_inicio - data_inicio_escala).days
+            metas_minutos = ciclo[(np.arange(n_dias) + deslocamento) % len(ciclo)]
+        else:
+            semana = np.array([metas_por_dia.get(i, 0) for i in range(7)], dtype=np.int64)
+            metas_minutos = semana[(np.arange(n_dias) + data_inicio.weekday()) % 7]
+        
+        for feriado in feriados:
+            i = (feriado - data_inicio).days
+            if 0 <= i < n_dias:
+                metas_minutos[i] = 0
+        
+        self.metas = metas_minutos * 60
+        self.metas.flags.writeable = False  # Compartilhado pelo cache
+        self._metas_lista = self.metas.tolist()
     
-    return (duracao_total_seg, tempo_reduzido_seg, int(round(segundos_noturno / 60.0)))
+    def meta(self, data_atual_obj: date) -> int:
+        """Meta do dia em segundos (uma consulta ao array)."""
+        i = (data_atual_obj - self.data_inicio).days
+        if not 0 <= i < len(self._metas_lista):
+            raise ValueError(f"{data_atual_obj} fora do calendário da escala {self.escala_tipo}")
+        return self._metas_lista[i]
+
+
+@lru_cache(maxsize=64)
+def compilar_calendario_escala(escala_tipo: str, data_inicio: date, data_fim: date,
+                               feriados: frozenset = frozenset(),
+                               data_inicio_escala: Optional[date] = None) -> CalendarioEscala:
+    """Calendário de metas da escala para o período (cache por escala, período, feriados e início do ciclo)."""
+    return CalendarioEscala(escala_tipo, data_inicio, data_fim, feriados, data_inicio_escala)
+
 
 def calcular_meta_dinamica_escala(escala_tipo: str, dia_semana_num: int, data_atual_obj: date, 
                                   data_inicio_escala: Optional[date] = None) -> timedelta:
     """
-    NOVO v3.0: Calcula a meta diária DINAMICAMENTE baseada no tipo de escala.
+    REFATORADO v8.6: Meta diária da escala para UM dia, lida do calendário compilado.
     
-    Resolve o problema dos 40 minutos: 6x1 tem meta de 440 min (7h20), não 480.
+    Para um período inteiro use compilar_calendario_escala() (uma consulta por dia).
     
     Args:
         escala_tipo: 'clt_5x2_padrao', 'clt_6x1_com', 'clt_12x36', etc.
-        dia_semana_num: 0=Seg, ..., 5=Sab, 6=Dom
+        dia_semana_num: 0=Seg, ..., 5=Sab, 6=Dom (mantido por compatibilidade; vem da data)
         data_atual_obj: Data para cálculo (importante para ciclos)
-        data_inicio_escala: Data de início do ciclo (para 12x36)
+        data_inicio_escala: Data de início do ciclo (escalas cíclicas)
     
     Returns:
         timedelta com a meta para o dia
     """
+    inicio_ciclo = parse_data_inicio_escala(data_inicio_escala)
+    if inicio_ciclo is None and escala_eh_ciclica(escala_tipo):
+        inicio_ciclo = data_atual_obj
+    calendario = compilar_calendario_escala(escala_tipo, data_atual_obj, data_atual_obj,
+                                            frozenset(), inicio_ciclo)
+    return timedelta(seconds=calendario.meta(data_atual_obj))
+
+# ===== NOVO v8.8: MOTOR DE FERIADOS (NACIONAIS, MÓVEIS, EMPRESA E MUNICÍPIO) =====
+# Feriados são calculados para TODOS os anos do período (dez/jan e retroativos de vários meses),
+# e não mais só para o ano mais frequente do arquivo. Índice data -> nome em dict (consulta O(1)),
+# em cache por (anos, localidade, listas) e reaproveitado entre requisições no mesmo worker.
+
+FERIADOS_NACIONAIS_PADRAO = os.getenv("FERIADOS_NACIONAIS_PADRAO", "0") not in ("0", "false", "False", "")
+FERIADOS_LOCAIS_ARQUIVO = os.getenv("FERIADOS_LOCAIS_ARQUIVO", "")  # JSON {"municipios": {...}, "empresas": {...}}
+
+FERIADOS_NACIONAIS_FIXOS = {
+    (1, 1): "Confraternização Universal",
+    (4, 21): "Tiradentes",
+    (5, 1): "Dia do Trabalho",
+    (9, 7): "Independência do Brasil",
+    (10, 12): "Nossa Senhora Aparecida",
+    (11, 2): "Finados",
+    (11, 15): "Proclamação da República",
+    (12, 25): "Natal",
+}
+# Feriados nacionais com início de vigência: (mês, dia) -> (nome, primeiro ano)
+FERIADOS_NACIONAIS_DESDE = {
+    (11, 20): ("Dia Nacional de Zumbi e da Consciência Negra", 2024),  # Lei 14.759/2023
+}
+
+# Feriados móveis: deslocamento em dias a partir do Domingo de Páscoa.
+# Também podem ser usados pelo nome nas listas de empresa/município (ex: "CORPUS_CHRISTI").
+FERIADOS_MOVEIS = {
+    'CARNAVAL_SEGUNDA': (-48, "Carnaval (segunda-feira)"),
+    'CARNAVAL': (-47, "Carnaval"),
+    'SEXTA_SANTA': (-2, "Paixão de Cristo"),
+    'PASCOA': (0, "Páscoa"),
+    'CORPUS_CHRISTI': (60, "Corpus Christi"),
+}
+
+# Lista inicial de feriados municipais/estaduais (chave: "cidade_uf" sem acentos).
+# Complementar/sobrescrever via FERIADOS_LOCAIS_ARQUIVO.
+FERIADOS_MUNICIPAIS = {
+    'sao_paulo_sp': ['25/01', '09/07', 'CORPUS_CHRISTI'],
+    'rio_de_janeiro_rj': ['20/01', '23/04', 'CARNAVAL'],
+    'belo_horizonte_mg': ['15/08', '08/12', 'SEXTA_SANTA', 'CORPUS_CHRISTI'],
+    'curitiba_pr': ['08/09'],
+    'porto_alegre_rs': ['02/02', '20/09'],
+    'salvador_ba': ['02/07', '08/12'],
+    'recife_pe': ['06/03', '24/06', '16/07', '08/12'],
+    'fortaleza_ce': ['19/03', '25/03', '15/08'],
+    'brasilia_df': ['30/11'],
+}
+FERIADOS_EMPRESAS = {}  # CNPJ (só dígitos) -> lista; preenchido pelo arquivo
+
+
+def _carregar_feriados_locais() -> None:
+    """Mescla o arquivo FERIADOS_LOCAIS_ARQUIVO nos dicionários de município/empresa."""
+    if not FERIADOS_LOCAIS_ARQUIVO:
+        return
+    try:
+        with open(FERIADOS_LOCAIS_ARQUIVO, encoding='utf-8') as f:
+            dados = json.load(f)
+        for municipio, lista in (dados.get('municipios') or {}).items():
+            FERIADOS_MUNICIPAIS[_chave_localidade(municipio)] = list(lista)
+        for cnpj, lista in (dados.get('empresas') or {}).items():
+            FERIADOS_EMPRESAS[_chave_cnpj(cnpj)] = list(lista)
+        print(f"[FERIADOS] Arquivo local carregado: {len(FERIADOS_MUNICIPAIS)} município(s), {len(FERIADOS_EMPRESAS)} empresa(s)")
+    except Exception as e:
+        print(f"⚠️ Não foi possível carregar {FERIADOS_LOCAIS_ARQUIVO}: {e}")
+
+
+def _chave_localidade(municipio: str) -> str:
+    """'São Paulo/SP' -> 'sao_paulo_sp'"""
+    texto = unicodedata.normalize('NFKD', (municipio or '').lower())
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    return re.sub(r'[^a-z0-9]+', '_', texto).strip('_')
+
+
+def _chave_cnpj(cnpj: str) -> str:
+    return re.sub(r'\D', '', cnpj or '')
+
+
+def calcular_pascoa(ano: int) -> date:
+    """Domingo de Páscoa (calendário gregoriano, algoritmo de Meeus/Jones/Butcher)."""
+    a = ano % 19
+    b, c = divmod(ano, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    mes, dia = divmod(h + l - 7 * m + 114, 31)
+    return date(ano, mes, dia + 1)
+
+
+def _feriados_da_lista(itens, anos: range, origem: str) -> dict:
+    """
+    Converte uma lista de feriados em {date: nome} para os anos informados.
     
-    # Padrão: 5x2
-    if escala_tipo == 'clt_5x2_padrao':
-        if dia_semana_num == 5:  # Sábado
-            return timedelta(hours=4)
-        elif dia_semana_num == 6:  # Domingo
-            return timedelta(hours=0)
-        else:  # Seg-Sex
-            return timedelta(hours=8)
-    
-    # 6x1 Comércio: 440 min (7h20) Seg-Sab, 0 Domingo
-    elif escala_tipo == 'clt_6x1_com':
-        if dia_semana_num == 6:  # Domingo (DSR)
-            return timedelta(minutes=0)
-        else:  # Seg-Sab
-            return timedelta(minutes=440)  # 7h20
-    
-    # 6x1 Padrão: 480 min (8h) Seg-Sex, 240 min (4h) Sab, 0 Domingo
-    elif escala_tipo == 'clt_6x1_padrao':
-        if dia_semana_num == 6:  # Domingo (DSR)
-            return timedelta(minutes=0)
-        elif dia_semana_num == 5:  # Sábado
-            return timedelta(minutes=240)  # 4h
-        else:  # Seg-Sex
-            return timedelta(minutes=480)  # 8h
-    
-    # 5x2 Compensado: 528 min (8h48) Seg-Sex, 0 Sab/Dom
-    elif escala_tipo == 'clt_5x2_comp':
-        if dia_semana_num in [5, 6]:  # Sab/Dom (Folga)
-            return timedelta(minutes=0)
-        else:  # Seg-Sex
-            return timedelta(minutes=528)  # 8h48
-    
-    # 12x36 Plantão: Ciclo de 2 dias (1 trabalha, 1 folga)
-    elif escala_tipo == 'clt_12x36' and data_inicio_escala:
+    Aceita "DD/MM" (todo ano), "DD/MM/YYYY" (só aquele ano) e nomes de FERIADOS_MOVEIS.
+    Itens inválidos são ignorados (mesmo comportamento da lista manual antiga).
+    """
+    datas = {}
+    for item in itens or []:
+        texto = str(item).strip()
+        movel = FERIADOS_MOVEIS.get(texto.upper())
+        if movel:
+            for ano in anos:
+                datas[calcular_pascoa(ano) + timedelta(days=movel[0])] = movel[1]
+            continue
         try:
-            if isinstance(data_inicio_escala, str):
-                if '/' in data_inicio_escala:
-                    data_init = datetime.strptime(data_inicio_escala, '%d/%m/%Y').date()
-                else:
-                    data_init = datetime.strptime(data_inicio_escala, '%Y-%m-%d').date()
-            else:
-                data_init = data_inicio_escala if isinstance(data_inicio_escala, date) else data_inicio_escala.date()
-            
-            # Calcula diferença em dias a partir da data inicial
-            diff_dias = (data_atual_obj - data_init).days
-            
-            # Dia par (0, 2, 4...) = trabalha 12h, dia ímpar = folga
-            if diff_dias % 2 == 0:
-                return timedelta(hours=12)
-            else:
-                return timedelta(hours=0)
-        except:
-            # Fallback se erro no parse
-            return timedelta(hours=8)
-    
-    # Parcial 30h: 6h Seg-Sex, folga Sab/Dom
-    elif escala_tipo == 'clt_parcial_30h':
-        if dia_semana_num in [5, 6]:  # Sab/Dom (Folga)
-            return timedelta(hours=0)
-        else:  # Seg-Sex
-            return timedelta(hours=6)
-    
-    # Personalizada ou desconhecida: padrão 8h
-    else:
-        if dia_semana_num == 6:
-            return timedelta(hours=0)
-        else:
-            return timedelta(hours=8)
+            partes = [int(p) for p in texto.split('/')]
+            if len(partes) == 3:
+                datas[date(partes[2], partes[1], partes[0])] = f"Feriado {origem}"
+                continue
+            dia, mes = partes
+        except (ValueError, TypeError):
+            continue
+        for ano in anos:
+            # Validação por ano: "29/02" vale só nos bissextos do intervalo
+            try:
+                datas[date(ano, mes, dia)] = f"Feriado {origem}"
+            except ValueError:
+                pass
+    return datas
 
-    """
-    Implementa PAREAMENTO INTELIGENTE DE BATIDAS com cross-day logic.
+
+class IndiceFeriados:
+    """Feriados de um intervalo de anos: `data in indice` e `indice.nome(data)` em O(1)."""
+    __slots__ = ('ano_inicio', 'ano_fim', 'nomes', 'datas')
     
-    Regra: Se a saída ocorrer até `max_intervalo_horas` após a entrada,
-    trata-se do mesmo turno, mesmo que cruze a meia-noite.
+    def __init__(self, ano_inicio: int, ano_fim: int, nomes: dict):
+        self.ano_inicio = ano_inicio
+        self.ano_fim = ano_fim
+        self.nomes = nomes
+        self.datas = frozenset(nomes)
     
-    Retorna lista de tuplas: (entrada_datetime, saida_datetime)
-    """
-    if len(horarios) < 2:
-        return []
+    def __contains__(self, data_obj) -> bool:
+        return data_obj in self.nomes
     
-    pares = []
-    i = 0
+    def __len__(self) -> int:
+        return len(self.nomes)
     
-    while i < len(horarios) - 1:
-        entrada = horarios[i]
-        saida = horarios[i + 1]
-        
-        # Se a saída é anterior à entrada (cruzou meia-noite), adiciona 1 dia
-        if saida < entrada:
-            saida = saida + timedelta(days=1)
-        
-        intervalo = saida - entrada
-        
-        # Se o intervalo é razoável (entrada e saída), é um par válido
-        if intervalo <= timedelta(hours=max_intervalo_horas):
-            pares.append((entrada, saida))
-            i += 2  # Salta para o próximo par
-        else:
-            # Entrada sem saída correspondente
-            i += 1
+    def nome(self, data_obj: date) -> Optional[str]:
+        return self.nomes.get(data_obj)
+
+
+@lru_cache(maxsize=128)
+def compilar_feriados(ano_inicio: int, ano_fim: int, nacionais: bool = True, municipio: str = '',
+                      cnpj: str = '', extras: tuple = ()) -> IndiceFeriados:
+    """
+    Índice de feriados para [ano_inicio, ano_fim] (cache por anos, localidade e listas).
     
-    return pares
+    Args:
+        nacionais: inclui fixos nacionais + Carnaval, Paixão, Páscoa e Corpus Christi
+        municipio: chave de FERIADOS_MUNICIPAIS ("cidade_uf")
+        cnpj: chave de FERIADOS_EMPRESAS (só dígitos)
+        extras: lista manual (settings['feriados'])
+    """
+    anos = range(ano_inicio, ano_fim + 1)
+    nomes = {}
+    if nacionais:
+        for ano in anos:
+            for (mes, dia), nome in FERIADOS_NACIONAIS_FIXOS.items():
+                nomes[date(ano, mes, dia)] = nome
+            for (mes, dia), (nome, desde) in FERIADOS_NACIONAIS_DESDE.items():
+                if ano >= desde:
+                    nomes[date(ano, mes, dia)] = nome
+        nomes.update(_feriados_da_lista(list(FERIADOS_MOVEIS), anos, "nacional"))
+    if municipio:
+        if municipio not in FERIADOS_MUNICIPAIS:
+            print(f"⚠️ Município '{municipio}' sem feriados cadastrados")
+        nomes.update(_feriados_da_lista(FERIADOS_MUNICIPAIS.get(municipio), anos, "municipal"))
+    if cnpj:
+        nomes.update(_feriados_da_lista(FERIADOS_EMPRESAS.get(cnpj), anos, "da empresa"))
+    nomes.update(_feriados_da_lista(extras, anos, "manual"))
+    return IndiceFeriados(ano_inicio, ano_fim, nomes)
+
+
+_carregar_feriados_locais()
+
+
+def feriados_do_periodo(settings: dict, data_inicio: date, data_fim: date) -> IndiceFeriados:
+    """
+    Feriados que valem para o período, conforme os settings:
+    - feriados_nacionais (bool): calendário nacional automático (padrão: FERIADOS_NACIONAIS_PADRAO)
+    - municipio ("São Paulo/SP"): lista municipal/estadual
+    - empresa_cnpj: lista da empresa (FERIADOS_LOCAIS_ARQUIVO)
+    - feriados / feriados_empresa: listas manuais ("DD/MM", "DD/MM/YYYY" ou nome de feriado móvel)
+    """
+    extras = tuple(str(f) for f in (settings.get('feriados') or [])) + \
+        tuple(str(f) for f in (settings.get('feriados_empresa') or []))
+    nacionais = settings.get('feriados_nacionais', FERIADOS_NACIONAIS_PADRAO)
+    if isinstance(nacionais, str):
+        # Form/JSON pode mandar texto: mesma leitura das flags de ambiente ("false" -> desligado)
+        nacionais = nacionais.strip() not in ("0", "false", "False", "")
+    return compilar_feriados(
+        data_inicio.year, data_fim.year,
+        bool(nacionais),
+        _chave_localidade(settings.get('municipio')),
+        _chave_cnpj(settings.get('empresa_cnpj')),
+        extras
+    )
+
 
 def aplicar_tolerancia_clt(variacao_total_dia_minutos: float, tolerancia_limite: int = 10) -> tuple:
     """
@@ -520,12 +1073,14 @@ def calcular_extras_semanal(dados_semana: dict, jornada_semanal_minutos: int = 2
         debug: se True, imprime logs detalhados
     
     Returns:
-        (total_extras_50, total_extras_100) como timedelta
+        (total_extras_50, total_extras_100) em segundos inteiros
+    
+    NOVO v8.3: dados_semana em segundos inteiros (antes timedelta)
     """
-    jornada_semanal = timedelta(minutes=jornada_semanal_minutos)
+    jornada_semanal = jornada_semanal_minutos * 60
     
-    total_50 = timedelta(0)
-    total_100 = timedelta(0)
+    total_50 = 0
+    total_100 = 0
     
     for num_semana, dados in dados_semana.items():
         # REGRA COMUM: 100% = todo trabalho em domingo/feriado (prioridade legal)
@@ -534,30 +1089,30 @@ def calcular_extras_semanal(dados_semana: dict, jornada_semanal_minutos: int = 2
         if extra_tipo == 'diaria':
             # MODO DIÁRIO: Usa extras acumuladas por dia (sem compensação)
             # O campo 'extras_50_acumulado' é preenchido durante o processamento diário
-            extras_50_semana = dados.get('extras_50_acumulado', timedelta(0))
+            extras_50_semana = dados.get('extras_50_acumulado', 0)
             
             if debug:
-                total_horas = dados['total'].total_seconds() / 3600
-                dom_fer_horas = dados['horas_dom_fer'].total_seconds() / 3600
-                e50_horas = extras_50_semana.total_seconds() / 3600
-                e100_horas = extras_100_semana.total_seconds() / 3600
+                total_horas = dados['total'] / 3600
+                dom_fer_horas = dados['horas_dom_fer'] / 3600
+                e50_horas = extras_50_semana / 3600
+                e100_horas = extras_100_semana / 3600
                 print(f"  📊 Semana {num_semana} [DIÁRIO]: Total={total_horas:.2f}h | Dom/Fer={dom_fer_horas:.2f}h | 50%={e50_horas:.2f}h | 100%={e100_horas:.2f}h")
         else:
             # MODO SEMANAL (CLT tradicional): Compensa dentro da semana
             # REGRA 2: Excedente real = total trabalhado - 44h
-            excedente = max(timedelta(0), dados['total'] - jornada_semanal)
+            excedente = max(0, dados['total'] - jornada_semanal)
             
             # REGRA 3: 50% = excedente - já contado como 100% (evita dupla contagem)
-            extras_50_semana = max(timedelta(0), excedente - extras_100_semana)
+            extras_50_semana = max(0, excedente - extras_100_semana)
             
             # REGRA 4: Limite - 50% não pode exceder horas úteis trabalhadas
             extras_50_semana = min(extras_50_semana, dados['horas_uteis'])
             
             if debug:
-                total_horas = dados['total'].total_seconds() / 3600
-                dom_fer_horas = dados['horas_dom_fer'].total_seconds() / 3600
-                e50_horas = extras_50_semana.total_seconds() / 3600
-                e100_horas = extras_100_semana.total_seconds() / 3600
+                total_horas = dados['total'] / 3600
+                dom_fer_horas = dados['horas_dom_fer'] / 3600
+                e50_horas = extras_50_semana / 3600
+                e100_horas = extras_100_semana / 3600
                 print(f"  📊 Semana {num_semana} [SEMANAL]: Total={total_horas:.2f}h | Dom/Fer={dom_fer_horas:.2f}h | 50%={e50_horas:.2f}h | 100%={e100_horas:.2f}h")
         
         total_50 += extras_50_semana
@@ -615,7 +1170,10 @@ def normalizar_horario(valor_entrada: str) -> Optional[dt_time]:
 
 def format_td(td):
     """Formata timedelta para string HH:MM (Apenas para o Preview visual)"""
-    total_seconds = td.total_seconds()
+    return format_segundos(td.total_seconds())
+
+def format_segundos(total_seconds) -> str:
+    """NOVO v8.3: format_td para segundos inteiros (núcleo de cálculo sem timedelta)"""
     sign = "-" if total_seconds < 0 else "+"
     total_seconds = abs(total_seconds)
     total_minutes = round(total_seconds / 60)
@@ -633,9 +1191,13 @@ def timedelta_to_excel_time(td: timedelta) -> float:
     Converte timedelta para fração de dia do Excel.
     Excel armazena tempo como float onde 1.0 = 24 horas.
     """
-    if td.total_seconds() < 0:
+    return segundos_to_excel_time(td.total_seconds())
+
+def segundos_to_excel_time(segundos) -> float:
+    """NOVO v8.3: timedelta_to_excel_time para segundos inteiros"""
+    if segundos < 0:
         return 0.0  # Excel não suporta valores negativos de tempo nativamente
-    return td.total_seconds() / 86400.0  # 86400 segundos em um dia
+    return segundos / 86400.0  # 86400 segundos em um dia
 
 def time_to_excel_time(t: dt_time) -> float:
     """
@@ -644,223 +1206,306 @@ def time_to_excel_time(t: dt_time) -> float:
     total_seconds = t.hour * 3600 + t.minute * 60 + t.second
     return total_seconds / 86400.0
 
-def parear_batidas_por_turno(horarios: List[datetime], data_base: date, max_intervalo_horas: int = 12) -> List[tuple]:
+# ===== NOVO v9.1: TURNOS SOBRE O PERÍODO INTEIRO =====
+# Antes o pareamento era por dia com corte fixo às 05:00: a saída 06:00 de um turno
+# 22:00 -> 06:00 caía no dia seguinte e as batidas de madrugada eram reordenadas dia a dia.
+# settings['turno_max_horas'] / settings['descanso_min_horas'] sobrescrevem os padrões.
+
+TURNO_MAX_HORAS = float(os.getenv("TURNO_MAX_HORAS", "20"))  # Duração máxima de um turno (1ª à última batida)
+TURNO_DESCANSO_MIN_HORAS = float(os.getenv("TURNO_DESCANSO_MIN_HORAS", "6"))  # Intervalo que separa dois turnos
+
+
+def montar_turnos(batidas_por_dia: dict, turno_max_horas: float = TURNO_MAX_HORAS,
+                  descanso_min_horas: float = TURNO_DESCANSO_MIN_HORAS) -> dict:
     """
-    REFATORAÇÃO CIRÚRGICA v5.0: Pareamento com JANELA DE CORTE.
+    NOVO v9.1: Monta os turnos de UM funcionário numa única varredura linear.
+    
+    As batidas do período são ordenadas uma vez (O(n log n)). Um turno novo começa quando
+    o descanso desde a última SAÍDA (turno com nº par de batidas) é >= descanso_min_horas
+    ou quando a batida ficaria a mais de turno_max_horas do início do turno. Dentro do
+    turno: pares consecutivos (entrada -> saída), batida final ímpar descartada como no
+    pareamento antigo.
     
-    REGRA CRÍTICA: Batidas entre 00:00-05:00 são SAÍDAS do dia anterior,
-    não entradas do dia atual. Devem ser empurradas para o final.
+    Cada turno pertence à data em que COMEÇOU (22:00 -> 06:00 fica no dia das 22:00).
     
-    Exemplo: [04:01, 10:30, 14:00, 15:00] → [10:30, 14:00, 15:00, 04:01]
-    Pareamento correto: (10:30→14:00), (15:00→04:01+1dia)
+    Returns:
+        {data_inicio: [entrada, saída, entrada, saída, ...]} com datetimes reais.
+        Data sem nenhum par: as batidas avulsas (mesmo retorno do pareamento antigo).
     """
-    if len(horarios) < 2:
-        return []
+    batidas = sorted(
+        datetime.combine(data_reg, hora) for data_reg, horas in batidas_por_dia.items() for hora in horas
+    )
+    descanso_min = timedelta(hours=descanso_min_horas)
+    turno_max = timedelta(hours=turno_max_horas)
+    
+    pares_por_data = {}
+    avulsas_por_data = {}
+    turno = []
+    for batida in batidas + [None]:
+        if turno and (
+            batida is None
+            or batida - turno[0] > turno_max
+            or (len(turno) % 2 == 0 and batida - turno[-1] >= descanso_min)
+        ):
+            data_inicio = turno[0].date()
+            if len(turno) >= 2:
+                pares_por_data.setdefault(data_inicio, []).extend(turno[:len(turno) // 2 * 2])
+            else:
+                avulsas_por_data.setdefault(data_inicio, []).extend(turno)
+            turno = []
+        turno.append(batida)
     
-    # JANELA DE CORTE: Separa batidas de madrugada (00:00-05:00)
-    HORA_CORTE = 5  # Batidas antes das 05:00 são saídas do dia anterior
+    return {
+        data_inicio: pares_por_data.get(data_inicio) or avulsas_por_data[data_inicio]
+        for data_inicio in sorted(pares_por_data.keys() | avulsas_por_data.keys())
+    }
+
+
+# ===== NOVO v9.0: ARMAZÉM COLUNAR DE BATIDAS =====
+
+class RegistrosPonto:
+    """
+    NOVO v9.0: Batidas em colunas (substitui a lista de dicts {"nome", "data", "hora"}).
     
-    batidas_madrugada = []
-    batidas_normais = []
+    Uma batida ocupa ~11 bytes: funcionário (id do nome internado, int32), dia
+    (date.toordinal, int32), minuto do dia (int16), segundos (int8 - o REP grava HH:MM:SS)
+    e origem (arquivo/página/edição internados, int16).
     
-    for h in horarios:
-        if h.hour < HORA_CORTE:
-            batidas_madrugada.append(h)
-        else:
-            batidas_normais.append(h)
+    Todos os leitores (TXT, Gemini/camada de texto do PDF, /recalcular) gravam aqui e o
+    cálculo indexa direto das colunas (indexar). Iterar devolve os dicts do formato antigo
+    (compatibilidade/depuração). O pickle leva só as colunas (pool de processos).
+    """
+    __slots__ = ('nomes', 'origens', 'funcionario', 'dia', 'minuto', 'segundo', 'origem',
+                 '_id_nomes', '_id_origens')
     
-    # Ordena apenas as normais por hora, madrugada vai para o final
-    batidas_normais_sorted = sorted(batidas_normais, key=lambda x: x.time())
+    def __init__(self):
+        self.nomes = []
+        self.origens = []
+        self.funcionario = array('i')
+        self.dia = array('i')
+        self.minuto = array('h')
+        self.segundo = array('b')
+        self.origem = array('h')
+        self._id_nomes = {}
+        self._id_origens = {}
     
-    # Combina: primeiro as diurnas/vespertinas, depois as de madrugada
-    horarios_reordenados = batidas_normais_sorted + batidas_madrugada
+    def id_nome(self, nome) -> int:
+        id_nome = self._id_nomes.get(nome)
+        if id_nome is None:
+            id_nome = self._id_nomes[nome] = len(self.nomes)
+            self.nomes.append(nome)
+        return id_nome
     
-    # Agora pareia: Entrada→Saída→Entrada→Saída
-    pares = []
-    i = 0
+    def id_origem(self, origem: str) -> int:
+        id_origem = self._id_origens.get(origem)
+        if id_origem is None:
+            id_origem = self._id_origens[origem] = len(self.origens)
+            self.origens.append(origem)
+        return id_origem
     
-    while i < len(horarios_reordenados) - 1:
-        entrada = horarios_reordenados[i]
-        saida = horarios_reordenados[i + 1]
-        
-        # Se a saída é de madrugada (hora < 5), adiciona 1 dia para cálculo correto
-        if saida.hour < HORA_CORTE and entrada.hour >= HORA_CORTE:
-            saida = saida + timedelta(days=1)
-        
-        intervalo = saida - entrada
-        
-        # Intervalo válido (até 16h para jornadas noturnas longas)
-        if timedelta(0) < intervalo <= timedelta(hours=16):
-            pares.append((entrada, saida))
-            i += 2
-        else:
-            # Batida órfã - pula
-            i += 1
+    def anexar(self, id_nome: int, dia: int, minuto: int, segundo: int, id_origem: int) -> None:
+        """Caminho rápido dos leitores (ids já internados, dia/minuto já convertidos)"""
+        self.funcionario.append(id_nome)
+        self.dia.append(dia)
+        self.minuto.append(minuto)
+        self.segundo.append(segundo)
+        self.origem.append(id_origem)
     
-    return pares
-
-
-def ajustar_horarios_jornada_noturna(horarios: List[datetime], data_base: date, noturno_ativo: bool = False) -> List[datetime]:
-    """
-    REFATORAÇÃO CIRÚRGICA v5.0: Reorganiza batidas para pareamento correto.
+    def adicionar(self, nome, data_reg, hora, origem: str = '') -> None:
+        if isinstance(data_reg, datetime):
+            data_reg = data_reg.date()
+        self.anexar(self.id_nome(nome), data_reg.toordinal(), hora.hour * 60 + hora.minute,
+                    hora.second, self.id_origem(origem))
     
-    PROIBIDO usar sorted() direto! Isso quebra jornadas noturnas.
+    @classmethod
+    def de_registros(cls, dados: List[dict], origem: str = '') -> 'RegistrosPonto':
+        """Lista de dicts {"nome", "data", "hora"} (formato antigo) -> RegistrosPonto"""
+        registros = cls()
+        for registro in dados:
+            registros.adicionar(registro["nome"], registro["data"], registro["hora"], origem)
+        return registros
     
-    Usa a Janela de Corte implementada em parear_batidas_por_turno.
+    def estender(self, outro: 'RegistrosPonto') -> None:
+        """Acrescenta as batidas de outro armazém (ids de nome/origem remapeados)"""
+        mapa_nomes = [self.id_nome(nome) for nome in outro.nomes]
+        mapa_origens = [self.id_origem(origem) for origem in outro.origens]
+        self.funcionario.extend(map(mapa_nomes.__getitem__, outro.funcionario))
+        self.dia.extend(outro.dia)
+        self.minuto.extend(outro.minuto)
+        self.segundo.extend(outro.segundo)
+        self.origem.extend(map(mapa_origens.__getitem__, outro.origem))
     
-    Retorna lista na ordem correta: Entrada1, Saída1, Entrada2, Saída2
-    """
-    if len(horarios) < 2:
-        return horarios
+    def __len__(self) -> int:
+        return len(self.dia)
     
-    # Usa pareamento inteligente com Janela de Corte
-    pares = parear_batidas_por_turno(horarios, data_base)
+    def __iter__(self) -> Iterator[dict]:
+        cache_datas, cache_horas = {}, {}
+        for id_nome, dia, minuto, segundo in zip(self.funcionario, self.dia, self.minuto, self.segundo):
+            data_obj = cache_datas.get(dia)
+            if data_obj is None:
+                data_obj = cache_datas[dia] = date.fromordinal(dia)
+            hora_obj = cache_horas.get((minuto, segundo))
+            if hora_obj is None:
+                hora_obj = cache_horas[(minuto, segundo)] = dt_time(minuto // 60, minuto % 60, segundo)
+            yield {"nome": self.nomes[id_nome], "data": data_obj, "hora": hora_obj}
     
-    if not pares:
-        # Sem pares válidos - retorna na ordem original
-        return horarios
+    def contagem_por_origem(self) -> dict:
+        contagem = [0] * len(self.origens)
+        for id_origem in self.origem:
+            contagem[id_origem] += 1
+        return {origem: n for origem, n in zip(self.origens, contagem) if n}
     
-    # Reconstrói lista a partir dos pares
-    horarios_ajustados = []
-    for entrada, saida in pares:
-        horarios_ajustados.append(entrada)
-        # Remove o +1 dia adicionado para cálculo (mantém hora original)
-        saida_original = saida
-        if saida.date() > entrada.date():
-            # Saída foi ajustada, volta para a hora original (sem mudar data do registro)
-            saida_original = datetime.combine(data_base, saida.time())
-        horarios_ajustados.append(saida_original)
+    def __getstate__(self):
+        return self.nomes, self.origens, self.funcionario, self.dia, self.minuto, self.segundo, self.origem
     
-    return horarios_ajustados
-
-def processar_txt(conteudo: str) -> List[dict]:
-    """Processa arquivo TXT e retorna lista de registros"""
-    dados = []
-    padrao_data_hora = re.compile(r'(\d{2}[./-]\d{2}[./-]\d{4})\s+(\d{2}:\d{2}:\d{2})')
+    def __setstate__(self, estado):
+        (self.nomes, self.origens, self.funcionario, self.dia,
+         self.minuto, self.segundo, self.origem) = estado
+        self._id_nomes = {nome: i for i, nome in enumerate(self.nomes)}
+        self._id_origens = {origem: i for i, origem in enumerate(self.origens)}
     
-    for linha in conteudo.splitlines():
-        match = padrao_data_hora.search(linha)
-        if match:
-            try:
-                data_str, hora_str = match.groups()
-                data_str_norm = data_str.replace('/', '.').replace('-', '.')
-                
-                info_inicial = linha[:match.start()].split()
-                nome = info_inicial[1] if len(info_inicial) > 1 else 'N/A'
-                
-                dados.append({
-                    "nome": nome,
-                    "data": datetime.strptime(data_str_norm, "%d.%m.%Y").date(),
-                    "hora": datetime.strptime(hora_str, "%H:%M:%S").time()
-                })
-            except (ValueError, IndexError):
+    def indexar(self) -> tuple:
+        """
+        Agrupa por (funcionário, data) direto das colunas. Mesma semântica de indexar_batidas:
+        duplicatas exatas removidas (primeira vence), funcionários na ordem de aparição,
+        batidas do dia na ordem do arquivo e ano = moda das datas (empate: a menor).
+        
+        Returns:
+            (indice, ano_detectado) onde indice = {funcionario: {data: [hora, ...]}}
+        """
+        indice = {}
+        por_id = [None] * len(self.nomes)
+        vistos = set()
+        contagem_dias = {}
+        cache_datas, cache_horas = {}, {}
+        
+        for id_nome, dia, minuto, segundo in zip(self.funcionario, self.dia, self.minuto, self.segundo):
+            segundos = minuto * 60 + segundo
+            chave = (id_nome * 4_000_000 + dia) * 86400 + segundos
+            if chave in vistos:
                 continue
-    
-    return dados
+            vistos.add(chave)
+            contagem_dias[dia] = contagem_dias.get(dia, 0) + 1
+            
+            dias_funcionario = por_id[id_nome]
+            if dias_funcionario is None:
+                dias_funcionario = por_id[id_nome] = indice[self.nomes[id_nome]] = {}
+            data_obj = cache_datas.get(dia)
+            if data_obj is None:
+                data_obj = cache_datas[dia] = date.fromordinal(dia)
+            hora_obj = cache_horas.get(segundos)
+            if hora_obj is None:
+                hora_obj = cache_horas[segundos] = dt_time(minuto // 60, minuto % 60, segundo)
+            
+            horas_dia = dias_funcionario.get(data_obj)
+            if horas_dia is None:
+                dias_funcionario[data_obj] = [hora_obj]
+            else:
+                horas_dia.append(hora_obj)
+        
+        if not indice:
+            return indice, datetime.now().year
+        
+        maior_contagem = max(contagem_dias.values())
+        dia_moda = min(dia for dia, n in contagem_dias.items() if n == maior_contagem)
+        return indice, date.fromordinal(dia_moda).year
+
+
+# ===== NOVO v7.0: PARSER TXT EM STREAMING (EXPORTAÇÕES REP GRANDES) =====
+
+TXT_CHUNK_BYTES = 1024 * 1024  # Lê o upload em blocos de 1 MiB (memória de pico limitada)
+PADRAO_DATA_HORA_TXT = re.compile(r'(\d{2}[./-]\d{2}[./-]\d{4})\s+(\d{2}:\d{2}:\d{2})')
 
-def call_gemini_safe(prompt, img):
+
+def iterar_linhas_txt(fonte, chunk_bytes: int = TXT_CHUNK_BYTES) -> Iterator[str]:
     """
-    Encapsulamento seguro para chamadas Gemini com retry exponencial E FALLBACK DE MÚLTIPLAS CHAVES.
+    NOVO v7.0: Itera as linhas de um TXT sem carregar o arquivo inteiro na memória.
     
-    Implementa:
-    - Retry com backoff exponencial: [5, 12, 25] segundos
-    - Tratamento de erro 429 (quota excedida)
-    - NOVO: Fallback automático entre múltiplas chaves API
-    - Tratamento de filtros de segurança (Safety filters)
+    Aceita str (legado), bytes ou um objeto arquivo binário (ex: UploadFile.file).
+    O arquivo é lido em blocos de `chunk_bytes` e decodificado incrementalmente em UTF-8,
+    então uma linha nunca é quebrada no meio, mesmo que o bloco termine no meio dela.
+    """
+    if isinstance(fonte, str):
+        yield from fonte.splitlines()
+        return
+    if isinstance(fonte, (bytes, bytearray)):
+        fonte = io.BytesIO(fonte)
     
-    Args:
-        prompt: Texto do prompt
-        img: Imagem para análise
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    resto = ""
     
-    Returns:
-        Response da API Gemini
-        
-    Raises:
-        HTTPException: Em caso de quota excedida em TODAS as chaves ou bloqueio de segurança
-    """
-    from fastapi import HTTPException
+    while True:
+        bloco = fonte.read(chunk_bytes)
+        if not bloco:
+            break
+        linhas = (resto + decoder.decode(bloco)).splitlines(True)
+        # A última linha só está completa se terminar com quebra de linha
+        resto = linhas.pop() if linhas and linhas[-1].splitlines() == [linhas[-1]] else ""
+        yield from linhas
     
-    if not GEMINI_MODELS:
-        raise HTTPException(
-            status_code=503,
-            detail="Nenhuma API Key do Gemini configurada. Configure GEMINI_API_KEY no arquivo .env"
-        )
+    resto += decoder.decode(b"", final=True)
+    if resto:
+        yield resto
+
+
+def carregar_txt(fonte, registros: Optional[RegistrosPonto] = None, origem: str = 'txt',
+                 chunk_bytes: int = TXT_CHUNK_BYTES) -> RegistrosPonto:
+    """
+    NOVO v7.0: Parser em streaming do TXT do REP.
+    NOVO v9.0: Grava direto nas colunas de um RegistrosPonto (sem um dict por batida).
     
-    retries = [5, 12, 25]  # Intervalos de espera em segundos
+    Formato esperado: "... NOME ... DD.MM.YYYY HH:MM:SS" (separador de data: . / -)
     
-    # NOVO: Tenta cada chave API disponível
-    for model_info in GEMINI_MODELS:
-        model = model_info['model']
-        key_index = model_info['key_index']
-        
-        print(f"🔑 Tentando API Key #{key_index}...")
-        
-        for i, wait_time in enumerate(retries + [0]):
-            try:
-                # Reconfigura a API com a chave atual antes de cada tentativa
-                genai.configure(api_key=model_info['key'])
-                response = model.generate_content([prompt, img])
-                
-                # Sucesso!
-                print(f"✅ Sucesso com API Key #{key_index}")
-                return response
-                
-            except Exception as e:
-                err_msg = str(e).lower()
-                
-                # Tratamento: Erro 429 - Quota excedida
-                if ("429" in err_msg or "quota" in err_msg or "resource" in err_msg):
-                    if i < len(retries):
-                        print(f"⏳ Erro 429 na Key #{key_index}. Aguardando {wait_time}s antes da tentativa {i+2}/{len(retries)+1}...")
-                        time.sleep(wait_time)
-                        continue
-                    else:
-                        # Esgotou tentativas nesta chave, tenta a próxima
-                        print(f"❌ API Key #{key_index} esgotada após {len(retries)+1} tentativas. Tentando próxima chave...")
-                        break  # Sai do loop de retries e vai para a próxima chave
-                
-                # Tratamento: Filtros de segurança da IA
-                if "safety" in err_msg or "blocked" in err_msg or "policy" in err_msg:
-                    print(f"❌ ERRO CRÍTICO: Conteúdo bloqueado pelos filtros de segurança da IA")
-                    raise HTTPException(
-                        status_code=400,
-                        detail="O arquivo foi bloqueado pelos filtros de segurança da IA. Verifique o conteúdo do documento."
-                    )
-                
-                # Outras exceções: relança sem retry
-                print(f"❌ ERRO na Key #{key_index}: {e}")
-                raise
+    Otimizações (arquivos de centenas de MB):
+    - Leitura em blocos via iterar_linhas_txt (sem decode/splitlines do arquivo inteiro)
+    - Data e hora convertidas por fatiamento em posições fixas (sem strptime)
+    - Datas e horários repetidos são memoizados (poucos dias distintos por arquivo)
+    """
+    if registros is None:
+        registros = RegistrosPonto()
+    id_origem = registros.id_origem(origem)
+    cache_datas = {}  # "DD.MM.YYYY" -> dia ordinal
+    cache_horas = {}  # "HH:MM:SS" -> (minuto do dia, segundos)
     
-    # Se chegou aqui, todas as chaves falharam
-    print(f"❌ ERRO CRÍTICO: Todas as {len(GEMINI_MODELS)} chave(s) API excederam a cota")
-    raise HTTPException(
-        status_code=429,
-        detail=f"Cota de processamento excedida em todas as {len(GEMINI_MODELS)} chave(s) API. Por favor, aguarde alguns minutos e tente novamente."
-    )
-
-def processar_pdf_com_gemini(pdf_bytes: bytes, filename: str) -> List[dict]:
-    """Processa PDF usando Gemini Vision para extrair dados do cartão de ponto"""
-    if not GEMINI_MODELS:
-        raise ValueError("Nenhuma GEMINI_API_KEY configurada. Configure no arquivo .env")
-    
-    try:
-        pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
-        dados = []
-        
-        for page_num in range(len(pdf_document)):
-            page = pdf_document[page_num]
-            pix = page.get_pixmap()  # Original resolution
-            img_bytes = pix.tobytes("png")
+    for linha in iterar_linhas_txt(fonte, chunk_bytes):
+        match = PADRAO_DATA_HORA_TXT.search(linha)
+        if not match:
+            continue
+        try:
+            data_str, hora_str = match.groups()
             
-            # Free pixmap memory immediately
-            del pix
+            dia = cache_datas.get(data_str)
+            if dia is None:
+                # DD?MM?YYYY - o separador é ignorado pelas posições fixas
+                dia = date(int(data_str[6:10]), int(data_str[3:5]), int(data_str[0:2])).toordinal()
+                cache_datas[data_str] = dia
             
-            img = Image.open(io.BytesIO(img_bytes))
+            hora = cache_horas.get(hora_str)
+            if hora is None:
+                # HH:MM:SS (dt_time valida os limites)
+                hora_obj = dt_time(int(hora_str[0:2]), int(hora_str[3:5]), int(hora_str[6:8]))
+                hora = cache_horas[hora_str] = (hora_obj.hour * 60 + hora_obj.minute, hora_obj.second)
             
-            # Free raw bytes after creating PIL image
-            del img_bytes
+            info_inicial = linha[:match.start()].split()
+            nome = info_inicial[1] if len(info_inicial) > 1 else 'N/A'
             
-            prompt = """Analise este cartão de ponto e extraia TODOS os registros visíveis.
+            registros.anexar(registros.id_nome(nome), dia, hora[0], hora[1], id_origem)
+        except (ValueError, IndexError):
+            continue
+    
+    return registros
+
+
+def processar_txt(conteudo) -> RegistrosPonto:
+    """Processa arquivo TXT (str, bytes ou arquivo binário) e retorna as batidas em colunas"""
+    return carregar_txt(conteudo)
+
+# ===== NOVO v7.1: PROMPTS E CACHE DE EXTRAÇÃO GEMINI (DISCO, COMPARTILHADO) =====
+
+# Incrementar sempre que o prompt ou o formato do JSON mudar de forma incompatível
+GEMINI_PROMPT_VERSAO = "v1"
+
+PROMPT_CARTAO_PDF = """Analise este cartão de ponto e extraia TODOS os registros visíveis.
 
 INSTRUÇÕES CRÍTICAS PARA DATAS:
 1. O cartão de ponto tem mês/ano no cabeçalho - ENCONTRE E USE essas informações
@@ -898,47 +1543,7 @@ IMPORTANTE:
 - Sem explicações
 - SEMPRE complete as datas com mês/ano do cabeçalho"""
 
-            print(f"📄 Processando página {page_num + 1} com gemini-1.5-flash...")
-            response = call_gemini_safe(prompt, img)
-            print(f"✅ Sucesso com gemini-1.5-flash")
-            
-            # Free PIL image after API call
-            img.close()
-            del img
-            
-            if not response:
-                continue
-            
-            texto_resposta = response.text.strip()
-            texto_resposta = texto_resposta.replace('```json', '').replace('```', '').strip()
-            
-            try:
-                json_data = json.loads(texto_resposta)
-                print(f"[DOC] JSON recebido (página {page_num + 1}): {json_data.get('funcionario', 'N/A')}")
-                dados.extend(converter_json_gemini_para_registros(json_data))
-            except json.JSONDecodeError as e:
-                print(f"[AVISO] Erro ao parsear JSON (página {page_num + 1}): {e}")
-                continue
-            
-            # Force garbage collection after each page
-            import gc
-            gc.collect()
-        
-        pdf_document.close()
-        return dados
-        
-    except Exception as e:
-        raise ValueError(f"Erro ao processar PDF: {str(e)}")
-
-def processar_imagem_com_gemini(img_bytes: bytes, filename: str) -> List[dict]:
-    """Processa imagem (JPG/PNG) usando Gemini Vision"""
-    if not GEMINI_MODELS:
-        raise ValueError("Nenhuma GEMINI_API_KEY configurada. Configure no arquivo .env")
-    
-    try:
-        img = Image.open(io.BytesIO(img_bytes))
-        
-        prompt = """Analise este cartão de ponto e extraia TODOS os registros visíveis.
+PROMPT_CARTAO_IMAGEM = """Analise este cartão de ponto e extraia TODOS os registros visíveis.
 
 INSTRUÇÕES CRÍTICAS PARA DATAS:
 1. O cartão de ponto tem mês/ano no cabeçalho - ENCONTRE E USE essas informações
@@ -971,1189 +1576,3791 @@ FORMATO DE RESPOSTA (JSON puro, sem markdown):
 
 IMPORTANTE: Retorne APENAS o JSON, sem texto adicional"""
 
-        tempos_espera = [5, 10, 20]
-        max_tentativas = len(tempos_espera) + 1
-        
-        print(f"[PROCESS] Processando imagem com gemini-2.5-flash...")
-        response = call_gemini_safe(prompt, img)
-        print(f"[OK] Sucesso com gemini-2.5-flash")
-        
-        if not response:
-            raise ValueError("Não foi possível obter resposta do Gemini")
-        
-        texto_resposta = response.text.strip()
-        texto_resposta = texto_resposta.replace('```json', '').replace('```', '').strip()
-        
-        try:
-            json_data = json.loads(texto_resposta)
-            print(f"[IMG] JSON recebido: {json_data.get('funcionario', 'N/A')}")
-            return converter_json_gemini_para_registros(json_data)
-        except json.JSONDecodeError as e:
-            print(f"[ERRO] Erro ao parsear JSON: {e}")
-            raise ValueError(f"Erro ao parsear JSON: {e}")
-        
-    except Exception as e:
-        raise ValueError(f"Erro ao processar imagem: {str(e)}")
+# NOVO v7.7: Várias páginas numa única requisição (as imagens seguem o prompt, na ordem)
+PROMPT_CARTAO_PDF_LOTE = """Você receberá {n} imagens, cada uma é UMA PÁGINA de cartão de ponto, na ordem (página 1 a {n}).
+Analise CADA página separadamente e extraia TODOS os registros visíveis de cada uma.
 
-def converter_json_gemini_para_registros(json_data: dict) -> List[dict]:
-    """Converte JSON do Gemini para o formato esperado pelo sistema"""
-    dados = []
-    funcionario = json_data.get("funcionario", "N/A")
+INSTRUÇÕES CRÍTICAS PARA DATAS:
+1. Cada página tem mês/ano no cabeçalho - ENCONTRE E USE essas informações (podem variar entre páginas)
+2. Cada linha tem apenas o DIA (1, 2, 3...) - você DEVE adicionar mês/ano
+3. Se o cabeçalho diz "NOVEMBRO/2024", então dia "5" vira "05/11/2024"
+4. NUNCA retorne apenas o dia - SEMPRE retorne data completa DD/MM/YYYY
+
+INSTRUÇÕES PARA HORÁRIOS:
+1. Ignore completamente a última coluna (assinaturas)
+2. Extraia APENAS: Entrada, Saída Almoço, Retorno Almoço, Saída
+3. Converta TODOS os horários para formato HH:MM:SS
+4. Se um horário estiver ilegível, use null
+5. O nome do funcionário está no topo de cada página (páginas diferentes podem ser de funcionários diferentes)
+
+FORMATO DE RESPOSTA (JSON puro, sem markdown) - UM item em "paginas" para CADA imagem:
+{{
+  "paginas": [
+    {{
+      "pagina": 1,
+      "mes": "11",
+      "ano": "2024",
+      "funcionario": "NOME COMPLETO DO FUNCIONARIO",
+      "registros": [
+        {{
+          "data": "01/11/2024",
+          "entrada": "07:30:00",
+          "saida_almoco": "12:00:00",
+          "retorno_almoco": "13:00:00",
+          "saida": "17:30:00"
+        }}
+      ]
+    }}
+  ]
+}}
+
+IMPORTANTE:
+- Retorne APENAS o JSON
+- Sem texto adicional
+- Sem ```json
+- Exatamente {n} itens em "paginas", com "pagina" de 1 a {n}"""
+
+# Cache em disco: chave = SHA-256(bytes da imagem + versão do prompt + modelo + prompt)
+# Compartilhado entre workers do gunicorn (gravação atômica via os.replace)
+GEMINI_CACHE_DIR = os.getenv("GEMINI_CACHE_DIR", os.path.join(tempfile.gettempdir(), "pontosync_gemini_cache"))
+GEMINI_CACHE_ATIVO = os.getenv("GEMINI_CACHE_ATIVO", "1") not in ("0", "false", "False", "")
+GEMINI_CACHE_MAX_MB = float(os.getenv("GEMINI_CACHE_MAX_MB", "256"))
+GEMINI_CACHE_RETENCAO_H = float(os.getenv("GEMINI_CACHE_RETENCAO_H", "24"))  # LGPD: mesmo prazo dos jobs/resultados (desde o último uso)
+GEMINI_CACHE_INTERVALO_LIMPEZA = 300  # Segundos entre varreduras de eviction (por worker)
+_cache_gemini_ultima_limpeza = 0.0
+
+
+def cache_gemini_chave(img_bytes, prompt: str, contexto: str = "") -> str:
+    """
+    Calcula a chave de conteúdo (SHA-256) de uma página para o cache de extração.
     
-    mes_json = json_data.get("mes")
-    ano_json = json_data.get("ano")
-    mes_ano = None
+    A mesma imagem com o mesmo prompt/modelo sempre gera a mesma chave,
+    independente do nome do arquivo ou do usuário que fez o upload.
+    `contexto` descreve bytes crus (ex: "1654x2339:L" para pixels de uma página PDF).
+    """
+    h = hashlib.sha256()
+    h.update(img_bytes)
+    h.update(f"|{contexto}|{GEMINI_PROMPT_VERSAO}|{GEMINI_MODELO_NOME}|".encode("utf-8"))
+    h.update(prompt.encode("utf-8"))
+    return h.hexdigest()
+
+
+def _cache_gemini_caminho(chave: str) -> str:
+    # Subdiretório por prefixo evita milhares de arquivos numa única pasta
+    return os.path.join(GEMINI_CACHE_DIR, chave[:2], f"{chave}.json")
+
+
+def cache_gemini_ler(chave: str) -> Optional[dict]:
+    """
+    Retorna o JSON já extraído para a chave, ou None (miss, expirado ou corrompido).
     
-    if mes_json and ano_json:
-        try:
-            mes_ano = (int(mes_json), int(ano_json))
-            print(f"[DATA] Mês/Ano detectado: {mes_ano[0]:02d}/{mes_ano[1]}")
-        except (ValueError, TypeError):
-            pass
+    Um hit renova o mtime do arquivo, que serve de "último uso" para a eviction.
+    """
+    if not GEMINI_CACHE_ATIVO:
+        return None
     
-    print(f"\n{'='*70}")
-    print(f"[USER] Funcionário: {funcionario}")
-    print(f"[LIST] Processando {len(json_data.get('registros', []))} registros")
-    print(f"{'='*70}\n")
+    caminho = _cache_gemini_caminho(chave)
+    try:
+        idade = time.time() - os.path.getmtime(caminho)
+        if idade > GEMINI_CACHE_RETENCAO_H * 3600:
+            os.remove(caminho)
+            return None
+        with open(caminho, "r", encoding="utf-8") as f:
+            json_data = json.load(f)
+        os.utime(caminho, None)
+        return json_data
+    except (OSError, ValueError):
+        # Miss, removido por outro worker ou arquivo inválido
+        return None
+
+
+def cache_gemini_gravar(chave: str, json_data: dict) -> None:
+    """
+    Grava o JSON extraído no cache de forma atômica.
     
-    for idx, registro in enumerate(json_data.get('registros', []), 1):
+    Escreve num arquivo temporário no mesmo diretório e usa os.replace,
+    então outro worker nunca lê um arquivo pela metade.
+    """
+    if not GEMINI_CACHE_ATIVO:
+        return
+    
+    caminho = _cache_gemini_caminho(chave)
+    try:
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+        fd, caminho_tmp = tempfile.mkstemp(dir=os.path.dirname(caminho), suffix=".tmp")
         try:
-            data_str = registro.get("data")
-            if not data_str:
-                continue
-            
-            print(f"Registro #{idx}: data='{data_str}'")
-            
-            data_obj = None
-            
-            if '/' in data_str or '-' in data_str:
-                separador = '/' if '/' in data_str else '-'
-                partes = data_str.split(separador)
-                
-                if len(partes) == 3:
-                    try:
-                        dia, mes, ano = int(partes[0]), int(partes[1]), int(partes[2])
-                        data_obj = date(ano, mes, dia)
-                        if not mes_ano:
-                            mes_ano = (mes, ano)
-                    except (ValueError, IndexError):
-                        pass
-            
-            if not data_obj and data_str.strip().isdigit():
-                dia = int(data_str.strip())
-                
-                if mes_ano:
-                    try:
-                        data_obj = date(mes_ano[1], mes_ano[0], dia)
-                        print(f"   [DATA] Data completada: {dia:02d} -> {data_obj.strftime('%d/%m/%Y')}")
-                    except ValueError as e:
-                        print(f"   [AVISO] Data inválida: {e}")
-                        continue
-                else:
-                    print(f"   [AVISO] Mês/Ano não identificado")
-                    continue
-            
-            if not data_obj:
-                print(f"   [AVISO] Formato não reconhecido: '{data_str}'")
-                continue
-            
-            horarios_encontrados = []
-            for campo in ["entrada", "saida_almoco", "retorno_almoco", "saida"]:
-                hora_str = registro.get(campo)
-                if hora_str and hora_str != "null" and str(hora_str).strip():
-                    hora_str = str(hora_str).strip()
-                    try:
-                        if len(hora_str.split(':')) == 2:
-                            hora_str += ":00"
-                        hora_obj = datetime.strptime(hora_str, "%H:%M:%S").time()
-                        horarios_encontrados.append((campo, hora_obj))
-                    except ValueError as e:
-                        print(f"   [AVISO] Erro no horário '{campo}={hora_str}': {e}")
-                        continue
-            
-            if horarios_encontrados:
-                print(f"   [HORA] Horários: {', '.join([f'{c}={h.strftime('%H:%M')}' for c, h in horarios_encontrados])}")
-                
-                for campo, hora in horarios_encontrados:
-                    dados.append({
-                        "nome": funcionario,
-                        "data": data_obj,
-                        "hora": hora
-                    })
-            else:
-                print(f"   [AVISO] Nenhum horário válido")
-                
-        except (ValueError, KeyError) as e:
-            print(f"   [ERRO] Erro: {e}")
-            continue
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(json_data, f, ensure_ascii=False)
+            os.replace(caminho_tmp, caminho)
+        except BaseException:
+            try:
+                os.remove(caminho_tmp)
+            except OSError:
+                pass
+            raise
+    except OSError as e:
+        # Cache é otimização: falha de disco nunca derruba o processamento
+        print(f"[CACHE] Aviso: não foi possível gravar no cache: {e}")
+        return
     
-    print(f"\n[OK] Total de {len(dados)} registros criados\n")
-    return dados
+    cache_gemini_limpar()
 
-# ===== FUNÇÃO REFATORADA: LÓGICA DE CÁLCULO COM BATIDAS SEPARADAS =====
-def calcular_relatorio(dados_brutos: List[dict], settings: dict, status_overrides: dict = None):
+
+def cache_gemini_limpar(forcar: bool = False) -> None:
     """
-    REFATORADO v4.0 (PontoSync Critical Fix)
-    
-    ===========================================
-    RESPONSABILIDADES (FONTE ÚNICA DE VERDADE):
-    ===========================================
-    - Calcular tempo trabalhado em minutos/horas
-    - Aplicar tolerância CLT (Art. 58)
-    - Aplicar redução de hora noturna (Art. 73)
-    - Gerar dados para preview e Excel
-    
-    ===========================================
-    NÃO FAZ (deixado para o contador):
-    ===========================================
-    - Calcular valor financeiro de extras
-    - Decidir sobre compensação de banco de horas
-    - Interpretar regras de convenção coletiva
-    - Decidir juridicamente sobre DSR
+    Eviction por idade e tamanho total do cache.
     
-    ===========================================
-    TRADE-OFFS ACEITOS (v4.0):
-    ===========================================
-    - Saldo é informativo apenas (banco_horas_informativo=True)
-    - Percentuais de extra são fixos (50%/100%) e ocultados da UI
-    - Frontend não recalcula - apenas renderiza
+    1. Remove entradas sem uso há mais de GEMINI_CACHE_RETENCAO_H
+    2. Se o total passar de GEMINI_CACHE_MAX_MB, remove as menos usadas recentemente (LRU por mtime)
     
-    Defaults quando sem configuração:
-    - jornada_minutos: 480 (8h)
-    - tolerancia: 10 minutos
-    - escala_tipo: clt_5x2_padrao
+    Roda no máximo a cada GEMINI_CACHE_INTERVALO_LIMPEZA segundos por worker e,
+    entre workers, apenas um varre por vez (flock não bloqueante).
     """
-    if status_overrides is None:
-        status_overrides = {}
+    global _cache_gemini_ultima_limpeza
     
-    warnings_sistema = []  # Rastreia alertas de risco trabalhista
-        
-    # Extrai configurações com validação segura
-    jornada_minutos = settings.get('jornada_minutos', 480)
+    agora = time.time()
+    if not forcar and agora - _cache_gemini_ultima_limpeza < GEMINI_CACHE_INTERVALO_LIMPEZA:
+        return
+    _cache_gemini_ultima_limpeza = agora
     
-    # Validação: garante que jornada_minutos é um número válido
     try:
-        jornada_minutos = int(jornada_minutos) if jornada_minutos else 480
-        if jornada_minutos <= 0 or jornada_minutos > 1440:  # Máximo 24h
-            jornada_minutos = 480
-    except (ValueError, TypeError):
-        jornada_minutos = 480  # Fallback para padrão
+        os.makedirs(GEMINI_CACHE_DIR, exist_ok=True)
+        lock_file = open(os.path.join(GEMINI_CACHE_DIR, ".limpeza.lock"), "w")
+    except OSError:
+        return
     
-    tolerancia = settings.get('tolerancia', 10)
     try:
-        tolerancia = int(tolerancia) if tolerancia else 10
-        if tolerancia < 0 or tolerancia > 60:
-            tolerancia = 10
-    except (ValueError, TypeError):
-        tolerancia = 10
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return  # Outro worker já está limpando
+        
+        entradas = []
+        for raiz, _, arquivos in os.walk(GEMINI_CACHE_DIR):
+            for nome in arquivos:
+                if not (nome.endswith(".json") or nome.endswith(".tmp")):
+                    continue
+                caminho = os.path.join(raiz, nome)
+                try:
+                    st = os.stat(caminho)
+                except OSError:
+                    continue
+                entradas.append((st.st_mtime, st.st_size, caminho))
+        
+        limite_idade = agora - GEMINI_CACHE_RETENCAO_H * 3600
+        limite_bytes = GEMINI_CACHE_MAX_MB * 1024 * 1024
+        total_bytes = sum(tamanho for _, tamanho, _ in entradas)
+        removidos = 0
+        
+        # Mais antigos primeiro: expirados sempre saem, os demais só enquanto exceder o tamanho
+        for mtime, tamanho, caminho in sorted(entradas):
+            if mtime >= limite_idade and total_bytes <= limite_bytes:
+                break
+            try:
+                os.remove(caminho)
+                removidos += 1
+                total_bytes -= tamanho
+            except OSError:
+                continue
+        
+        if removidos:
+            print(f"[CACHE] Limpeza: {removidos} entrada(s) removida(s), {total_bytes / 1048576:.1f} MB em uso")
+    finally:
+        lock_file.close()
+
+
+async def extrair_json_gemini(prompt: str, img, conteudo, descricao: str, contexto: str = "",
+                              tokens_estimados: Optional[int] = None) -> Optional[dict]:
+    """
+    NOVO v7.1: Extrai o JSON de uma página via Gemini, consultando o cache antes.
     
-    intervalo_auto = settings.get('intervalo_auto', False)
-    intervalo_minutos = settings.get('intervalo_minutos', 60)
-    try:
-        intervalo_minutos = int(intervalo_minutos) if intervalo_minutos else 60
-        if intervalo_minutos < 0 or intervalo_minutos > 480:
-            intervalo_minutos = 60
-    except (ValueError, TypeError):
-        intervalo_minutos = 60
-    sabado_util = settings.get('sabado_util', True)
-    domingo_util = settings.get('domingo_util', False)
-    noturno_ativo = settings.get('noturno_ativo', False)
-    feriados_str = settings.get('feriados', [])
-    escala_tipo = settings.get('escala_tipo', 'clt_5x2_padrao')  # Para ciclos
-    data_inicio_escala = settings.get('data_inicio_escala')  # Para clt_12x36
+    Em caso de hit, a chamada ao Gemini (cota + 5-30s) é evitada por completo.
     
-    # NOTA v6.2: ano_detectado e feriados_set são inicializados APÓS carregar os dados
-    # para usar o ano correto do arquivo, não o ano atual do sistema
-    feriados_str = settings.get('feriados', [])  # Guardamos para processar depois
-            
-    # Conversões de timedelta
-    JORNADA_PADRAO = timedelta(minutes=jornada_minutos)
+    Args:
+        img: imagem enviada ao Gemini (PIL.Image ou blob {"mime_type", "data"})
+        conteudo: bytes que identificam a imagem no cache (arquivo original ou pixels crus)
+        contexto: metadados dos bytes crus (dimensões/modo), entram na chave do cache
+        tokens_estimados: custo estimado da chamada (reserva no balde TPM da chave)
     
-    # LÓGICA CICLO 12x36 v4.1: Calcula meta dinamicamente
-    if escala_tipo == 'clt_12x36' and data_inicio_escala:
-        try:
-            # Parse data_inicio_escala (formato: DD/MM/YYYY ou YYYY-MM-DD)
-            if isinstance(data_inicio_escala, str):
-                if '/' in data_inicio_escala:
-                    data_init = datetime.strptime(data_inicio_escala, '%d/%m/%Y').date()
-                else:
-                    data_init = datetime.strptime(data_inicio_escala, '%Y-%m-%d').date()
-            else:
-                data_init = data_inicio_escala if isinstance(data_inicio_escala, date) else data_inicio_escala.date()
-            
-            # Nota: A meta por dia será ajustada no loop principal para cada data_atual_obj
-            ciclo_12x36_ativo = True
-        except Exception as e:
-            print(f"⚠️ Erro ao parsing data_inicio_escala: {e}")
-            ciclo_12x36_ativo = False
-    else:
-        ciclo_12x36_ativo = False
+    Retorna None se a resposta não for um JSON válido.
+    """
+    chave = cache_gemini_chave(conteudo, prompt, contexto)
+    json_data = cache_gemini_ler(chave)
+    if json_data is not None:
+        print(f"[CACHE] Hit para {descricao} ({chave[:12]}) - Gemini não chamado")
+        return json_data
     
-    JORNADA_SABADO = timedelta(hours=4) if sabado_util else timedelta(0)
-    TOLERANCIA = timedelta(minutes=tolerancia)
+    response = await call_gemini_safe(prompt, img, tokens_estimados)
+    json_data = parsear_resposta_gemini(response, descricao)
+    if json_data is None:
+        return None
     
-    df_raw = pd.DataFrame(dados_brutos)
-    if df_raw.empty:
-        return None, []
+    cache_gemini_gravar(chave, json_data)
+    return json_data
+
+
+def parsear_resposta_gemini(response, descricao: str) -> Optional[dict]:
+    """Extrai o JSON do texto da resposta (remove cercas ```json). None se inválido."""
+    if not response:
+        return None
     
-    df_raw.drop_duplicates(inplace=True)
-    df_raw['data'] = pd.to_datetime(df_raw['data'])
+    texto_resposta = response.text.strip()
+    texto_resposta = texto_resposta.replace('```json', '').replace('```', '').strip()
     
-    # NOVO v6.2: Detecta ano a partir dos DADOS DO ARQUIVO, não do sistema
-    # Isso corrige o bug onde feriados de dezembro/2025 viravam janeiro/2026
-    ano_detectado = df_raw['data'].mode().iloc[0].year if not df_raw.empty else datetime.now().year
-    print(f"[DATA] Ano detectado dos dados: {ano_detectado}")
+    try:
+        json_data = json.loads(texto_resposta)
+    except json.JSONDecodeError as e:
+        print(f"[AVISO] Erro ao parsear JSON ({descricao}): {e}")
+        return None
     
-    # Converte feriados DD/MM para datas completas usando o ano dos dados
-    feriados_set = set()
-    for feriado_str in feriados_str:
-        try:
-            dia, mes = map(int, feriado_str.split('/'))
-            feriados_set.add(date(ano_detectado, mes, dia))
-        except:
-            pass
+    if not isinstance(json_data, dict):
+        print(f"[AVISO] JSON inesperado ({descricao}): {type(json_data).__name__}")
+        return None
+    return json_data
+
+async def call_gemini_safe(prompt, img, tokens_estimados: Optional[int] = None):
+    """
+    Encapsulamento seguro para chamadas Gemini com retry E ESCALONAMENTO ENTRE MÚLTIPLAS CHAVES.
     
-    if feriados_set:
-        print(f"[FERIADOS] {len(feriados_set)} feriado(s) configurado(s) para {ano_detectado}")
+    Implementa:
+    - NOVO v7.3: Cada tentativa vai para a chave menos carregada com cota livre (GEMINI_POOL)
+    - Tratamento de erro 429 (quota excedida): a chave entra em cooldown e a próxima
+      tentativa vai para outra chave saudável (sem esperar o backoff da chave atual)
+    - Tratamento de filtros de segurança (Safety filters)
+    - NOVO v7.2: Não bloqueia o event loop (chamada em thread + espera assíncrona)
     
-    # --- SOBRESCRITA DE META PELA ESCALA (Enterprise Fix) ---
-    meta_sobrescrita = False
-    if escala_tipo in CATALOGO_JORNADAS_CLT:
-        escala_info = CATALOGO_JORNADAS_CLT[escala_tipo]
-        if escala_tipo == 'clt_6x1_com':
-            jornada_minutos = 440
-            meta_sobrescrita = True
-        elif escala_tipo == 'clt_5x2_padrao':
-            jornada_minutos = 480
-            meta_sobrescrita = True
-        print(f"[ESCALA] Escala Ativa: {escala_info['nome']} | Meta: {jornada_minutos}min {'(AUTO)' if meta_sobrescrita else ''}")
-
-    if noturno_ativo:
-        print(f"[NOTURNO] Adicional Noturno: ATIVO (redução Art. 73 aplicada)")
+    Args:
+        prompt: Texto do prompt
+        img: Imagem para análise (ou lista de imagens, NOVO v7.7: lote de páginas)
+        tokens_estimados: Custo estimado (default GEMINI_TOKENS_POR_PAGINA)
     
-    relatorio_diario = []
-    todos_funcionarios = df_raw['nome'].unique()
-    resumo_preview = []
+    Returns:
+        Response da API Gemini
+        
+    Raises:
+        HTTPException: Em caso de quota excedida em TODAS as chaves ou bloqueio de segurança
+    """
+    from fastapi import HTTPException
     
-    # NOVO v6.1: Dicionário para armazenar totais semanais por funcionário
-    # Será usado pelo gerar_excel() para códigos contábeis 150/200
-    totais_semanais = {}
+    if not GEMINI_POOL:
+        raise HTTPException(
+            status_code=503,
+            detail="Nenhuma API Key do Gemini configurada. Configure GEMINI_API_KEY no arquivo .env"
+        )
     
-    for funcionario in todos_funcionarios:
-        df_funcionario_raw = df_raw[df_raw['nome'] == funcionario]
-        if df_funcionario_raw.empty: continue
-        
-        min_date = df_funcionario_raw['data'].min().date()
-        max_date = df_funcionario_raw['data'].max().date()
-        periodo_completo = pd.date_range(start=min_date, end=max_date)
-        
-        dias_preview = []
-        horas_trabalhadas_semana = {}  # Rastreador semanal para warning 44h
-        
-        # NOVO v6.0: Estrutura para apuração semanal de extras
-        dados_semana = {}  # {num_semana: {'horas_uteis': td, 'horas_dom_fer': td, 'total': td}}
+    prazo = time.monotonic() + GEMINI_ESPERA_MAXIMA_S
+    partes = [prompt] + (list(img) if isinstance(img, (list, tuple)) else [img])
+    tokens = tokens_estimados or GEMINI_TOKENS_POR_PAGINA
+    
+    for tentativa in range(1, GEMINI_MAX_TENTATIVAS_429 + 1):
+        try:
+            chave = await GEMINI_POOL.adquirir(tokens, prazo)
+        except TimeoutError:
+            break
         
-        for data_atual in periodo_completo:
-            data_atual_obj = data_atual.date()
-            dia_semana_num = data_atual_obj.weekday()
-            num_semana = data_atual_obj.isocalendar()[1]
-            
-            # Chave para override
-            override_key = f"{funcionario}|{data_atual_obj.isoformat()}"
-            status_forcado = status_overrides.get(override_key)
+        try:
+            response = await asyncio.to_thread(chave.model.generate_content, partes)
+            chave.registrar_sucesso()
+            print(f"✅ Sucesso com API Key #{chave.key_index}")
+            return response
             
-            grupo = df_funcionario_raw[df_funcionario_raw['data'].dt.date == data_atual_obj]
+        except Exception as e:
+            err_msg = str(e).lower()
             
-            # Variáveis de cálculo
-            normais = timedelta(0)
-            a_dever = timedelta(0)
-            extras_comuns = timedelta(0)
-            extras_100 = timedelta(0)
-            total_trabalhado = timedelta(0)
-            adicional_noturno = timedelta(0)  # NOVO: Tracking de hora noturna
-            noturno_base_minutos = 0  # NOVO v3.5: Minutos reais noturno para resumo
+            # Tratamento: Erro 429 - Quota excedida
+            if ("429" in err_msg or "quota" in err_msg or "resource" in err_msg):
+                cooldown = chave.registrar_429()
+                print(f"⏳ Erro 429 na Key #{chave.key_index} (cooldown {cooldown:.0f}s). Tentativa {tentativa}/{GEMINI_MAX_TENTATIVAS_429}...")
+                continue
             
-            # Batidas Separadas
-            entrada_1 = None
-            saida_1 = None
-            entrada_2 = None
-            saida_2 = None
+            # Tratamento: Filtros de segurança da IA
+            if "safety" in err_msg or "blocked" in err_msg or "policy" in err_msg:
+                print(f"❌ ERRO CRÍTICO: Conteúdo bloqueado pelos filtros de segurança da IA")
+                raise HTTPException(
+                    status_code=400,
+                    detail="O arquivo foi bloqueado pelos filtros de segurança da IA. Verifique o conteúdo do documento."
+                )
             
-            batidas_lista = []
-            batidas_str = ""
-            alerta = False
-            status = "Normal"
-            ocorrencias = ""
+            # Outras exceções: relança sem retry
+            print(f"❌ ERRO na Key #{chave.key_index}: {e}")
+            raise
+        finally:
+            chave.liberar()
+    
+    # Se chegou aqui, todas as chaves falharam
+    print(f"❌ ERRO CRÍTICO: Todas as {len(GEMINI_POOL)} chave(s) API excederam a cota")
+    raise HTTPException(
+        status_code=429,
+        detail=f"Cota de processamento excedida em todas as {len(GEMINI_POOL)} chave(s) API. Por favor, aguarde alguns minutos e tente novamente."
+    )
+
+# ===== NOVO v7.4: EXTRAÇÃO PELA CAMADA DE TEXTO (PDF DIGITAL, SEM GEMINI) =====
+
+PDF_CAMADA_TEXTO_ATIVA = os.getenv("PDF_CAMADA_TEXTO_ATIVA", "1") not in ("0", "false", "False", "")
+PDF_TEXTO_MIN_LINHAS = 3  # Mínimo de linhas com data + batida para aceitar a página
+
+MESES_PT = {
+    'janeiro': 1, 'fevereiro': 2, 'marco': 3, 'abril': 4, 'maio': 5, 'junho': 6,
+    'julho': 7, 'agosto': 8, 'setembro': 9, 'outubro': 10, 'novembro': 11, 'dezembro': 12
+}
+RE_TOKEN_HORA = re.compile(r'^(\d{1,2}):(\d{2})(?::(\d{2}))?$')
+RE_TOKEN_DATA = re.compile(r'^(\d{1,2})/(\d{1,2})(?:/(\d{2,4}))?$')
+RE_TOKEN_DIA = re.compile(r'^\d{1,2}$')
+RE_CABECALHO_BATIDA = re.compile(r'^(ent(rada)?|sai(da)?|e[1-4]|s[1-4]|retorno|volta|inicio|fim)\.?[1-4]?$')
+RE_PERIODO_DATAS = re.compile(r'(\d{2})/(\d{2})/(\d{4})\s*(?:a|até|ate|-)\s*\d{2}/(\d{2})/(\d{4})')
+RE_MES_ANO_NOME = re.compile(r'(' + '|'.join(MESES_PT) + r')\s*(?:/|de|-)?\s*(\d{4})')
+RE_MES_ANO_NUM = re.compile(r'\b(\d{2})/(\d{4})\b')
+ROTULOS_NOME = ('nome', 'funcionario', 'empregado', 'colaborador', 'servidor')
+
+
+def _normalizar_rotulo(texto: str) -> str:
+    """Minúsculas sem acentos e sem pontuação final (ex: 'Saída:' -> 'saida')."""
+    texto = unicodedata.normalize('NFKD', texto.lower())
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    return texto.strip(':.;,')
+
+
+def _agrupar_linhas_pdf(palavras: list, tolerancia: float = 3.0) -> List[list]:
+    """Agrupa as palavras do PyMuPDF em linhas visuais (mesma altura), da esquerda para a direita."""
+    linhas = []
+    for palavra in sorted(palavras, key=lambda w: ((w[1] + w[3]) / 2, w[0])):
+        centro_y = (palavra[1] + palavra[3]) / 2
+        if linhas and abs(linhas[-1][0] - centro_y) <= tolerancia:
+            linhas[-1][1].append(palavra)
+        else:
+            linhas.append([centro_y, [palavra]])
+    return [sorted(ws, key=lambda w: w[0]) for _, ws in linhas]
+
+
+def _extrair_nome_funcionario(linhas: List[list]) -> Optional[str]:
+    """Procura 'Nome:'/'Funcionário:' e devolve o texto seguinte na mesma linha."""
+    for linha in linhas:
+        for idx, palavra in enumerate(linha):
+            tem_dois_pontos = palavra[4].endswith(':') or (idx + 1 < len(linha) and linha[idx + 1][4] == ':')
+            if not tem_dois_pontos or _normalizar_rotulo(palavra[4]) not in ROTULOS_NOME:
+                continue
+            partes = []
+            x_anterior = palavra[2]
+            for seguinte in linha[idx + 1:]:
+                if seguinte[4] == ':':
+                    x_anterior = seguinte[2]
+                    continue
+                # Para no próximo rótulo (ex: "CPF:") ou num salto grande de coluna
+                if seguinte[4].endswith(':') or seguinte[0] - x_anterior > 30:
+                    break
+                partes.append(seguinte[4])
+                x_anterior = seguinte[2]
+            if partes:
+                return ' '.join(partes)
+    return None
+
+
+def _extrair_periodo(texto: str) -> Optional[tuple]:
+    """
+    Detecta o período do cabeçalho: 'Período: 21/10/2024 a 20/11/2024', 'NOVEMBRO/2024' ou '11/2024'.
+    
+    Returns:
+        (dia_inicio, (mes, ano) do início, (mes, ano) do fim); mês fechado = (1, (m, a), (m, a))
+    """
+    match = RE_PERIODO_DATAS.search(texto)
+    if match:
+        return (int(match.group(1)), (int(match.group(2)), int(match.group(3))),
+                (int(match.group(4)), int(match.group(5))))
+    match = RE_MES_ANO_NOME.search(_normalizar_rotulo(texto))
+    if match:
+        mes_ano = (MESES_PT[match.group(1)], int(match.group(2)))
+        return 1, mes_ano, mes_ano
+    match = RE_MES_ANO_NUM.search(texto)
+    if match and 1 <= int(match.group(1)) <= 12:
+        mes_ano = (int(match.group(1)), int(match.group(2)))
+        return 1, mes_ano, mes_ano
+    return None
+
+
+def _mes_ano_do_dia(dia: int, periodo: tuple) -> tuple:
+    """Mês/ano de um dia do espelho: em 21/10 a 20/11, o dia 5 é de novembro e o 25 de outubro."""
+    dia_inicio, mes_ano_inicio, mes_ano_fim = periodo
+    return mes_ano_fim if dia < dia_inicio else mes_ano_inicio
+
+
+def extrair_pagina_camada_texto(page) -> Optional[dict]:
+    """
+    NOVO v7.4: Lê um espelho de ponto tabular direto da camada de texto do PDF.
+    
+    PDFs gerados por software de REP já têm o texto: não há por que rasterizar e
+    mandar para a IA. Usa get_text("words") (posições) para:
+    1. Achar a linha de cabeçalho com as colunas de batida (Entrada/Saída/Ent.1/Sai.1...)
+    2. Em cada linha que começa com uma data, ligar cada HH:MM à coluna de batida mais próxima
+       (colunas de totais, extras e faltas são ignoradas)
+    3. Ler nome do funcionário e mês/ano do cabeçalho
+    
+    Retorna o MESMO formato do JSON do Gemini (para converter_json_gemini_para_registros)
+    ou None se a página não tiver um layout reconhecível (cai para o Gemini).
+    """
+    palavras = page.get_text("words")
+    if len(palavras) < 10:
+        return None  # Página escaneada (sem camada de texto)
+    
+    linhas = _agrupar_linhas_pdf(palavras)
+    
+    # 1. Cabeçalho da tabela: linha com >= 2 rótulos de batida
+    colunas_batida = None
+    idx_cabecalho = None
+    for idx, linha in enumerate(linhas):
+        rotulos = [w for w in linha if RE_CABECALHO_BATIDA.match(_normalizar_rotulo(w[4]))]
+        if len(rotulos) >= 2:
+            colunas_batida = [(w[0] + w[2]) / 2 for w in rotulos]
+            idx_cabecalho = idx
+            break
+    if colunas_batida is None:
+        return None
+    
+    colunas_batida = colunas_batida[:4]
+    espacamento = min((b - a for a, b in zip(colunas_batida, colunas_batida[1:])), default=80.0)
+    tolerancia_x = max(espacamento / 2, 8.0)
+    campos = ["entrada", "saida_almoco", "retorno_almoco", "saida"]
+    if len(colunas_batida) == 2:
+        campos = ["entrada", "saida"]
+    elif len(colunas_batida) == 3:
+        campos = ["entrada", "saida_almoco", "retorno_almoco"]
+    
+    texto_pagina = ' '.join(w[4] for w in palavras)
+    periodo = _extrair_periodo(texto_pagina)
+    
+    # 2. Linhas de dados
+    registros = []
+    for linha in linhas[idx_cabecalho + 1:]:
+        inicio_batidas = colunas_batida[0] - tolerancia_x
+        data_str = None
+        for palavra in linha:
+            if palavra[0] >= inicio_batidas:
+                break
+            match = RE_TOKEN_DATA.match(palavra[4])
+            if match:
+                dia, mes, ano = match.group(1), match.group(2), match.group(3)
+                if ano is None:
+                    if not periodo:
+                        break
+                    # Período que vira o ano (dez -> jan): o ano vem da ponta com esse mês
+                    ano = str(periodo[2][1] if int(mes) == periodo[2][0] else periodo[1][1])
+                elif len(ano) == 2:
+                    ano = f"20{ano}"
+                data_str = f"{int(dia):02d}/{int(mes):02d}/{ano}"
+                break
+            if RE_TOKEN_DIA.match(palavra[4]) and periodo:
+                mes, ano = _mes_ano_do_dia(int(palavra[4]), periodo)
+                data_str = f"{int(palavra[4]):02d}/{mes:02d}/{ano}"
+                break
+        if data_str is None:
+            continue
+        
+        registro = {"data": data_str}
+        for palavra in linha:
+            match = RE_TOKEN_HORA.match(palavra[4])
+            if not match:
+                continue
+            centro_x = (palavra[0] + palavra[2]) / 2
+            distancias = [abs(centro_x - c) for c in colunas_batida]
+            coluna = distancias.index(min(distancias))
+            if distancias[coluna] <= tolerancia_x and coluna < len(campos) and campos[coluna] not in registro:
+                registro[campos[coluna]] = f"{int(match.group(1)):02d}:{match.group(2)}:{match.group(3) or '00'}"
+        
+        if len(registro) > 1:
+            registros.append(registro)
+    
+    if len(registros) < PDF_TEXTO_MIN_LINHAS:
+        return None
+    
+    funcionario = _extrair_nome_funcionario(linhas[:idx_cabecalho])
+    if not funcionario:
+        return None
+    
+    if periodo:
+        mes_ano = periodo[1]
+    else:
+        _, mes, ano = registros[0]["data"].split('/')
+        mes_ano = (int(mes), int(ano))
+    
+    return {
+        "mes": f"{mes_ano[0]:02d}",
+        "ano": str(mes_ano[1]),
+        "funcionario": funcionario,
+        "registros": registros,
+        "origem": "camada_texto"
+    }
+
+
+# ===== NOVO v7.5: RASTERIZAÇÃO SEM CÓPIAS (PIXMAP -> PIL) COM DPI POR PÁGINA =====
+
+RASTER_LADO_MAX_PX = int(os.getenv("RASTER_LADO_MAX_PX", "2000"))  # Lado maior da imagem enviada
+RASTER_DPI_MIN = 72
+RASTER_DPI_MAX = 200
+RASTER_ESCALA_CINZA = os.getenv("RASTER_ESCALA_CINZA", "1") not in ("0", "false", "False", "")
+
+
+def _dpi_imagem_embutida(page) -> Optional[float]:
+    """
+    Resolução efetiva (DPI) do scan embutido na página, se ela for uma página escaneada.
+    
+    Renderizar acima dessa resolução só interpola pixels (mais bytes, nenhum detalhe a mais).
+    """
+    area_pagina = page.rect.width * page.rect.height
+    melhor = None
+    for info in page.get_images(full=True):
+        xref, largura_px = info[0], info[2]
+        for rect in page.get_image_rects(xref):
+            # Só imagens que cobrem boa parte da página (ignora logos e carimbos)
+            if rect.width <= 0 or rect.width * rect.height < 0.5 * area_pagina:
+                continue
+            dpi = largura_px / (rect.width / 72.0)
+            melhor = dpi if melhor is None else max(melhor, dpi)
+    return melhor
+
+
+def escolher_dpi_pagina(page) -> int:
+    """
+    DPI de renderização da página: o suficiente para o lado maior ter RASTER_LADO_MAX_PX,
+    limitado à resolução do scan embutido (se houver) e a [RASTER_DPI_MIN, RASTER_DPI_MAX].
+    """
+    lado_pt = max(page.rect.width, page.rect.height) or 842.0
+    dpi = RASTER_LADO_MAX_PX * 72.0 / lado_pt
+    
+    try:
+        dpi_nativo = _dpi_imagem_embutida(page)
+    except Exception:
+        dpi_nativo = None
+    if dpi_nativo:
+        dpi = min(dpi, dpi_nativo)
+    
+    return int(max(RASTER_DPI_MIN, min(RASTER_DPI_MAX, dpi)))
+
+
+def rasterizar_pagina_pdf(page) -> tuple:
+    """
+    Renderiza a página direto para um PIL.Image, sem ida e volta por PNG.
+    
+    Os pixels do pixmap são copiados UMA vez para `bytes` e o PIL usa esse mesmo buffer
+    (Image.frombuffer, sem cópia). O pixmap é liberado antes de retornar.
+    
+    Retorna (img, pixels, contexto): pixels e contexto ("LxA:modo") identificam a página no cache.
+    """
+    dpi = escolher_dpi_pagina(page)
+    colorspace = fitz.csGRAY if RASTER_ESCALA_CINZA else fitz.csRGB
+    modo = "L" if RASTER_ESCALA_CINZA else "RGB"
+    
+    pix = page.get_pixmap(dpi=dpi, colorspace=colorspace, alpha=False)
+    largura, altura, stride = pix.width, pix.height, pix.stride
+    pixels = pix.samples
+    # Libera o pixmap (memória nativa do MuPDF) imediatamente
+    pix = None
+    
+    img = Image.frombuffer(modo, (largura, altura), pixels, "raw", modo, stride, 1)
+    return img, pixels, f"{largura}x{altura}:{modo}:{dpi}"
+
+
+class DocumentoPDF:
+    """
+    Documento PyMuPDF compartilhado pelas tarefas de página de um mesmo upload.
+    
+    O fitz.Document não é thread-safe: todo acesso (classificação, renderização,
+    fechamento) passa pelo mesmo lock, e nenhuma renderização roda após o fechamento.
+    """
+    
+    def __init__(self, pdf_bytes: bytes):
+        self._doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        self._lock = threading.Lock()
+    
+    def classificar_paginas(self) -> List[Optional[dict]]:
+        """Para cada página: JSON lido pela camada de texto, ou None (precisa do Gemini)."""
+        with self._lock:
+            resultado = []
+            for page in self._doc:
+                json_texto = None
+                if PDF_CAMADA_TEXTO_ATIVA:
+                    try:
+                        json_texto = extrair_pagina_camada_texto(page)
+                    except Exception as e:
+                        print(f"[AVISO] Falha na camada de texto (página {page.number + 1}): {e}")
+                resultado.append(json_texto)
+            return resultado
+    
+    def estimar_tokens(self, page_num: int) -> int:
+        """Tokens estimados da página renderizada (imagem + resposta), sem renderizar."""
+        with self._lock:
+            page = self._doc[page_num]
+            escala = escolher_dpi_pagina(page) / 72.0
+            return estimar_tokens_pagina(page.rect.width * escala, page.rect.height * escala)
+    
+    def rasterizar(self, page_num: int) -> tuple:
+        with self._lock:
+            if self._doc.is_closed:
+                raise ValueError("Documento PDF já foi fechado")
+            return rasterizar_pagina_pdf(self._doc[page_num])
+    
+    def fechar(self) -> None:
+        with self._lock:
+            self._doc.close()
+
+
+# ===== NOVO v7.7: LOTES DE PÁGINAS NUMA ÚNICA REQUISIÇÃO =====
+
+# 1 = desligado (uma requisição por página). Ex: 8 = até 8 páginas por requisição
+GEMINI_LOTE_MAX_PAGINAS = int(os.getenv("GEMINI_LOTE_MAX_PAGINAS", "1"))
+GEMINI_LOTE_MAX_TOKENS = int(os.getenv("GEMINI_LOTE_MAX_TOKENS", "32000"))  # Orçamento por requisição
+GEMINI_TOKENS_PROMPT = 600              # Prompt (enviado uma vez por requisição)
+GEMINI_TOKENS_SAIDA_POR_PAGINA = 1500   # JSON de ~31 dias por página
+GEMINI_TOKENS_POR_BLOCO_IMAGEM = 258    # Gemini: 258 tokens por bloco de 768x768 px
+
+
+def estimar_tokens_pagina(largura_px: float, altura_px: float) -> int:
+    """Tokens de uma página: blocos de 768x768 da imagem + JSON de resposta."""
+    blocos = math.ceil(largura_px / 768) * math.ceil(altura_px / 768)
+    return blocos * GEMINI_TOKENS_POR_BLOCO_IMAGEM + GEMINI_TOKENS_SAIDA_POR_PAGINA
+
+
+def planejar_lotes(paginas_tokens: List[tuple]) -> List[List[int]]:
+    """
+    Agrupa páginas consecutivas em lotes de até GEMINI_LOTE_MAX_PAGINAS páginas
+    e GEMINI_LOTE_MAX_TOKENS tokens (prompt incluído). Uma página nunca fica sem lote.
+    
+    Args:
+        paginas_tokens: [(page_num, tokens_estimados), ...]
+    """
+    lotes = []
+    atual, tokens_atual = [], GEMINI_TOKENS_PROMPT
+    for page_num, tokens in paginas_tokens:
+        cabe = len(atual) < GEMINI_LOTE_MAX_PAGINAS and tokens_atual + tokens <= GEMINI_LOTE_MAX_TOKENS
+        if atual and not cabe:
+            lotes.append(atual)
+            atual, tokens_atual = [], GEMINI_TOKENS_PROMPT
+        atual.append(page_num)
+        tokens_atual += tokens
+    if atual:
+        lotes.append(atual)
+    return lotes
+
+
+def separar_resposta_lote(json_lote: Optional[dict], quantidade: int) -> List[Optional[dict]]:
+    """
+    Divide a resposta de um lote em um JSON por página (mesmo formato da extração unitária).
+    
+    Só aceita itens com "pagina" válido (1..N). Página ausente, com "pagina" repetido ou
+    item sem "pagina" válido fica None (será reprocessada sozinha): atribuir pela ordem da
+    lista poderia gravar as batidas de um funcionário na página de outro.
+    """
+    resultado = [None] * quantidade
+    itens = (json_lote or {}).get("paginas")
+    if not isinstance(itens, list):
+        return resultado
+    
+    repetidas = set()
+    for item in itens:
+        if not isinstance(item, dict):
+            continue
+        try:
+            indice = int(item.get("pagina")) - 1
+        except (TypeError, ValueError):
+            continue
+        if not 0 <= indice < quantidade:
+            continue
+        if resultado[indice] is not None:
+            repetidas.add(indice)
+        resultado[indice] = item
+    
+    for indice in repetidas:
+        resultado[indice] = None
+    return resultado
+
+
+async def _extrair_lote_pdf(documento: DocumentoPDF, page_nums: List[int],
+                            limite_lotes: asyncio.Semaphore) -> dict:
+    """
+    Extrai um lote de páginas. Retorna {page_num: json_data ou None}.
+    
+    Páginas já no cache não são reenviadas; se o Gemini omitir alguma página do lote (ou
+    devolvê-la sem "pagina" válido/repetida), ela é extraída individualmente (nenhuma
+    página se perde por causa do lote).
+    """
+    resultados = {}
+    # Só renderiza quando há vaga: no máximo `limite_lotes` lotes em memória por PDF
+    async with limite_lotes:
+        renderizadas = []
+        try:
+            for page_num in page_nums:
+                img, pixels, contexto = await asyncio.to_thread(documento.rasterizar, page_num)
+                renderizadas.append((page_num, img, pixels, contexto))
             
-            # 1. Processamento Matemático das Batidas
-            if not grupo.empty:
-                horarios = [datetime.combine(data_atual_obj, h) for h in grupo["hora"]]
-                horarios = ajustar_horarios_jornada_noturna(horarios, data_atual_obj, noturno_ativo=noturno_ativo)
-                batidas_lista = horarios
-                batidas_str = " → ".join([h.strftime("%H:%M") for h in horarios])
-                
-                # Validação: Batidas ímpares
-                if len(horarios) % 2 != 0:
-                    warning_msg = f"⚠️ {funcionario} em {data_atual_obj}: Batida ímpar ({len(horarios)} registros)"
-                    warnings_sistema.append(warning_msg)
-                
-                # Intervalo Automático - CRÍTICO v4.6: SÓ APLICA SE EXATAMENTE 2 BATIDAS
-                # NUNCA sobrescreve quando já existem 4 batidas reais!
-                num_batidas_original = len(horarios)
-                
-                if num_batidas_original == 2 and intervalo_auto:
-                    entrada, saida = horarios[0], horarios[1]
-                    meio_dia = datetime.combine(data_atual_obj, dt_time(12, 0))
-                    
-                    # Só aplica se a jornada cruza o meio-dia
-                    if entrada < meio_dia < saida:
-                        fim_almoco = meio_dia + timedelta(minutes=intervalo_minutos)
-                        horarios = [entrada, meio_dia, fim_almoco, saida]
-                        print(f"   ⚙️ Intervalo automático aplicado: {meio_dia.strftime('%H:%M')}-{fim_almoco.strftime('%H:%M')}")
-                
-                # Se já tem 4+ batidas, NUNCA modifica (prioridade aos dados reais)
-                elif num_batidas_original >= 4:
-                    print(f"   ✅ Preservando {num_batidas_original} batidas reais (intervalo automático desabilitado)")
-                
-                # DISTRIBUIÇÃO DAS BATIDAS
-                num_batidas = len(horarios)
-                
-                if num_batidas == 2:
-                    entrada_1 = horarios[0].time()
-                    saida_2 = horarios[1].time()
-                    
-                elif num_batidas == 3:
-                    entrada_1 = horarios[0].time()
-                    saida_1 = horarios[1].time()
-                    entrada_2 = horarios[2].time()
-                    ocorrencias = "BATIDA INCOMPLETA"
-                    alerta = True
-                    
-                elif num_batidas >= 4:
-                    entrada_1 = horarios[0].time()
-                    saida_1 = horarios[1].time()
-                    entrada_2 = horarios[2].time()
-                    saida_2 = horarios[3].time()
-                    
-                    if num_batidas > 4:
-                        ocorrencias = f"BATIDAS EXTRAS ({num_batidas})"
-                
-                # CÁLCULO DE HORAS REFATORADO v3.5: BASE INTEGRAL NOTURNA
-                # ========================================================
-                # INOVAÇÃO: A coluna "Adicional Noturno" agora exibe a BASE INTEGRAL
-                # (horas reais noturnas * 1.142857) e não apenas o bônus.
-                # 
-                # Exemplo: 2h reais noturnas = 2 * 1.142857 = 2.285714h = 02:17:08
-                
-                total_segundos_clock = 0.0              # Relógio puro (sem nenhuma redução)
-                base_integral_noturna_segundos = 0.0   # BASE INTEGRAL (horas * 1.142857)
-                minutos_noturno_reais = 0.0            # Rastreamento de minutos reais
-                
-                # Processa pares sequencialmente
-                for i in range(0, len(horarios) - 1, 2):
-                    entrada_par = horarios[i]
-                    saida_par = horarios[i + 1]
-                    
-                    # Calcula o tempo REAL do relógio (nunca negativo)
-                    if saida_par < entrada_par:
-                        saida_par = saida_par + timedelta(days=1)
-                    
-                    tempo_real_par = (saida_par - entrada_par).total_seconds()
-                    total_segundos_clock += tempo_real_par
-                    
-                    # Se noturno ativo, calcula APENAS os minutos na janela [22:00-05:00]
-                    if noturno_ativo:
-                        # NOVO v4.2: Usa calcular_adicional_noturno_estrito para interseção precisa
-                        minutos_noturno_inteiros = calcular_adicional_noturno_estrito(entrada_par, saida_par)
-                        
-                        if minutos_noturno_inteiros > 0:
-                            minutos_noturno_reais += minutos_noturno_inteiros
-                            
-                            # Converte minutos reais em segundos reduzidos via fator 1.142857
-                            # BASE INTEGRAL = minutos_reais * 60 * 1.142857
-                            FATOR_REDUCAO_EXATO = 1.142857142857143
-                            seg_reduzido = minutos_noturno_inteiros * 60 * FATOR_REDUCAO_EXATO
-                            base_integral_noturna_segundos += seg_reduzido
-                
-                # Total Trabalhado é APENAS o relógio real (PROIBIDO somar ganho noturno)
-                total_trabalhado = timedelta(seconds=total_segundos_clock)
-                
-                # HOTFIX v6.0: Adicional Noturno é o tempo REAL (relógio), NÃO reduzido
-                # O sistema de folha do contador é que aplica o fator 1.1428
-                # Isso bate com o Fechamento Exemplar que mostra 2:03 em vez de 2:19
-                if noturno_ativo and minutos_noturno_reais > 0:
-                    adicional_noturno = timedelta(minutes=minutos_noturno_reais)  # REAL
+            pendentes = []
+            for page_num, img, pixels, contexto in renderizadas:
+                # Resposta de lote tem chave própria: a chave do prompt unitário só guarda
+                # extrações de uma página sozinha
+                chave_lote = cache_gemini_chave(pixels, PROMPT_CARTAO_PDF_LOTE, contexto)
+                for chave in (cache_gemini_chave(pixels, PROMPT_CARTAO_PDF, contexto), chave_lote):
+                    json_data = cache_gemini_ler(chave)
+                    if json_data is not None:
+                        print(f"[CACHE] Hit para página {page_num + 1} ({chave[:12]}) - Gemini não chamado")
+                        resultados[page_num] = json_data
+                        break
                 else:
-                    adicional_noturno = timedelta(0)
-                
-                # Rastreamento para o frontend (minutos reais noturno para cálculo de resumo)
-                noturno_base_minutos = minutos_noturno_reais
-                
-                # INICIALIZAÇÃO CRÍTICA v4.0: meta_dia deve estar disponível em TODOS os caminhos
-                meta_dia = calcular_meta_dinamica_escala(
-                    escala_tipo, 
-                    dia_semana_num, 
-                    data_atual_obj,
-                    date.fromisoformat(data_init) if ciclo_12x36_ativo and isinstance(data_init, date) else None
+                    pendentes.append((page_num, img, pixels, contexto, chave_lote))
+            
+            if len(pendentes) > 1:
+                nums = ", ".join(str(p[0] + 1) for p in pendentes)
+                tokens = GEMINI_TOKENS_PROMPT + sum(estimar_tokens_pagina(*p[1].size) for p in pendentes)
+                print(f"📄 Processando páginas {nums} em UMA requisição ({tokens} tokens estimados)...")
+                response = await call_gemini_safe(
+                    PROMPT_CARTAO_PDF_LOTE.format(n=len(pendentes)),
+                    [p[1] for p in pendentes],
+                    tokens
                 )
-                
-                # Validação: Intervalo intrajornada < 1h (Art. 71 CLT)
-                if len(horarios) >= 4:
-                    intervalo = horarios[2] - horarios[1]
-                    if intervalo < timedelta(hours=1):
-                        warning_msg = f"⚠️ {funcionario} em {data_atual_obj}: Intervalo < 1h ({intervalo.total_seconds()/60:.0f}min) - Risco Art. 71"
-                        warnings_sistema.append(warning_msg)
-                
-                # Classificação Automática
-                eh_feriado = data_atual_obj in feriados_set
-                eh_domingo = dia_semana_num == 6
-                eh_sabado = dia_semana_num == 5
-                
-                # CRÍTICO v4.7: Ajusta meta_dia para ZERO em dias não úteis
-                # Isso evita que a fórmula Excel calcule faltas em domingos/feriados
-                if eh_feriado or (eh_domingo and not domingo_util):
-                    print(f"   🎄 FERIADO DETECTADO: {data_atual_obj} | extras_100={total_trabalhado}")
-                    meta_dia = timedelta(0)  # ZERO meta em feriados/domingos não úteis
-                    extras_100 = total_trabalhado
-                    extras_comuns = timedelta(0)  # BUGFIX v6.3: Zera explicitamente extras_comuns
-                    normais = timedelta(0)  # BUGFIX v6.3: Zera explicitamente normais
-                    status = "Extra 100%" if total_trabalhado > timedelta(0) else "Feriado"
-                elif eh_sabado:
-                    # HOTFIX v6.0: Sábado USA a meta da escala (7h20 para 6x1), NÃO 4h fixo
-                    # meta_dia já foi calculada corretamente por calcular_meta_dinamica_escala
-                    # Apenas zera se sabado_util=False E escala 5x2
-                    if not sabado_util and escala_tipo == 'clt_5x2_padrao':
-                        meta_dia = timedelta(0)
-                        extras_100 = total_trabalhado
-                        extras_comuns = timedelta(0)  # BUGFIX v6.3: Zera explicitamente
-                        normais = timedelta(0)  # BUGFIX v6.3: Zera explicitamente
-                        status = "Extra 100%" if total_trabalhado > timedelta(0) else "Folga"
-                    else:
-                        # Sábado útil: usa meta_dia da escala (ex: 440min para 6x1)
-                        normais = min(total_trabalhado, meta_dia)
-                        if total_trabalhado > meta_dia:
-                            extras_comuns = total_trabalhado - meta_dia
-                            status = "Extra"
-                        else:
-                            a_dever = meta_dia - total_trabalhado
-                            status = "Incompleto" if a_dever > timedelta(0) else "Normal"
-                else:
-                    # Ajusta meta dinamicamente baseada no tipo de escala (já inicializado acima)
-                    # meta_dia já foi calculada na inicialização crítica v4.0
-                    
-                    normais = min(total_trabalhado, meta_dia)
-                    if total_trabalhado > meta_dia:
-                        extras_comuns = total_trabalhado - meta_dia
-                        status = "Extra"
-                    else:
-                        a_dever = meta_dia - total_trabalhado
-                        status = "Incompleto" if a_dever > TOLERANCIA else "Normal"
-                        alerta = a_dever > TOLERANCIA
-                    
-                    # INTEGRAÇÃO v4.1: Aplica tolerância Art. 58 §1º (VTD)
-                    vtd_minutos = (total_trabalhado.total_seconds() - meta_dia.total_seconds()) / 60.0
-                    minutos_abonados, minutos_descontados, obs_vtd = aplicar_tolerancia_clt(vtd_minutos)
-                    
-                    if minutos_descontados > 0:
-                        # VTD positivo e > 10min: desconta integral
-                        status = "Incompleto"
-                        alerta = True
-                    elif minutos_abonados > 0:
-                        # VTD negativo e < -10min: abona integral
-                        status = "Extra"
-                        alerta = False
-                    elif abs(vtd_minutos) <= 10:
-                        # VTD dentro da tolerância: normal
-                        status = "Normal" if status != "Incompleto" else "Incompleto"
-                        alerta = False
-
-            else:
-                # Sem batidas - INICIALIZA meta_dia para garantir que está definida
-                meta_dia = calcular_meta_dinamica_escala(
-                    escala_tipo, 
-                    dia_semana_num, 
-                    data_atual_obj,
-                    date.fromisoformat(data_init) if ciclo_12x36_ativo and isinstance(data_init, date) else None
+                por_pagina = separar_resposta_lote(parsear_resposta_gemini(response, f"lote {nums}"), len(pendentes))
+                restantes = []
+                for pendente, json_data in zip(pendentes, por_pagina):
+                    if json_data is None:
+                        restantes.append(pendente)
+                        continue
+                    json_data = {k: v for k, v in json_data.items() if k != "pagina"}
+                    cache_gemini_gravar(pendente[4], json_data)
+                    resultados[pendente[0]] = json_data
+                if restantes:
+                    print(f"[AVISO] Lote sem resposta válida para {len(restantes)} página(s): extraindo individualmente")
+                pendentes = restantes
+            
+            for page_num, img, pixels, contexto, _ in pendentes:
+                print(f"📄 Processando página {page_num + 1} ({contexto}) com {GEMINI_MODELO_NOME}...")
+                resultados[page_num] = await extrair_json_gemini(
+                    PROMPT_CARTAO_PDF, img, pixels, f"página {page_num + 1}", contexto,
+                    estimar_tokens_pagina(*img.size) + GEMINI_TOKENS_PROMPT
                 )
-                
-                if data_atual_obj in feriados_set or dia_semana_num == 6:
-                    status = "Folga"
-                    meta_dia = timedelta(0)  # Zera meta em feriados/domingos
-                    ocorrencias = "DSR/FERIADO"
-                elif dia_semana_num == 5 and not sabado_util:
-                    status = "Folga"
-                    meta_dia = timedelta(0)
-                    ocorrencias = "DSR"
+        finally:
+            for _, img, _, _ in renderizadas:
+                img.close()
+            del renderizadas
+    
+    return resultados
+
+
+async def processar_pdf_com_gemini(pdf_bytes: bytes, filename: str, progresso=None) -> RegistrosPonto:
+    """
+    Processa PDF usando Gemini Vision para extrair dados do cartão de ponto
+    
+    NOVO v7.2: Páginas extraídas em PARALELO (limitado por chave). Um PDF de 20 páginas
+    leva aproximadamente o tempo da página mais lenta, não a soma de todas.
+    Os registros continuam na ordem das páginas.
+    
+    NOVO v7.4: Páginas com camada de texto reconhecível não vão para o Gemini.
+    NOVO v7.5: Páginas renderizadas sob demanda (DPI/escala de cinza por página),
+    com no máximo um lote por chamada em voo na memória.
+    NOVO v7.7: Com GEMINI_LOTE_MAX_PAGINAS > 1, várias páginas vão numa só requisição.
+    NOVO v8.0: `progresso` (ProgressoArquivoJob) registra cada página concluída; páginas
+    já concluídas numa execução anterior do job não são extraídas de novo.
+    """
+    try:
+        documento = await asyncio.to_thread(DocumentoPDF, pdf_bytes)
+        try:
+            paginas = await asyncio.to_thread(documento.classificar_paginas)
+            prontas = progresso.paginas_prontas() if progresso else {}
+            if prontas:
+                print(f"📄 {len(prontas)} página(s) de {filename} retomadas do checkpoint")
+            paginas_gemini = [
+                page_num for page_num, json_texto in enumerate(paginas)
+                if json_texto is None and page_num not in prontas
+            ]
+            
+            if not GEMINI_MODELS and paginas_gemini:
+                raise ValueError("Nenhuma GEMINI_API_KEY configurada. Configure no arquivo .env")
+            
+            if progresso:
+                progresso.definir_total(len(paginas))
+            for page_num, json_texto in enumerate(paginas):
+                if page_num in prontas:
+                    paginas[page_num] = prontas[page_num]
+                elif json_texto is not None:
+                    print(f"📄 Página {page_num + 1} lida pela camada de texto (sem Gemini)")
+                    if progresso:
+                        progresso.pagina_concluida(page_num, json_texto)
+            
+            if GEMINI_LOTE_MAX_PAGINAS > 1:
+                tokens = [(n, await asyncio.to_thread(documento.estimar_tokens, n)) for n in paginas_gemini]
+                lotes = planejar_lotes(tokens)
+            else:
+                lotes = [[page_num] for page_num in paginas_gemini]
+            
+            limite_lotes = asyncio.Semaphore(max(1, len(GEMINI_POOL) * GEMINI_MAX_CONCORRENCIA_POR_CHAVE))
+            tarefas = [asyncio.create_task(_extrair_lote_pdf(documento, lote, limite_lotes)) for lote in lotes]
+            
+            try:
+                # Lotes na ordem em que terminam (progresso página a página); a saída
+                # continua ordenada porque cada resultado vai para o índice da sua página
+                for proximo in asyncio.as_completed(tarefas):
+                    for page_num, json_data in (await proximo).items():
+                        paginas[page_num] = json_data
+                        if progresso:
+                            progresso.pagina_concluida(page_num, json_data)
+            except BaseException:
+                # Uma página falhou (ex: cota esgotada em todas as chaves): cancela as demais
+                for tarefa in tarefas:
+                    tarefa.cancel()
+                raise
+        finally:
+            await asyncio.to_thread(documento.fechar)
+        
+        # Registros sempre na ordem das páginas (e, dentro da página, por funcionário/dia)
+        dados = RegistrosPonto()
+        for page_num, json_data in enumerate(paginas):
+            if json_data is None:
+                continue
+            print(f"[DOC] JSON recebido (página {page_num + 1}): {json_data.get('funcionario', 'N/A')}")
+            converter_json_gemini_para_registros(json_data, dados, origem=f"{filename} p.{page_num + 1}")
+        return dados
+        
+    except Exception as e:
+        raise ValueError(f"Erro ao processar PDF: {str(e)}")
+
+# ===== NOVO v7.6: PRÉ-PROCESSAMENTO DE FOTOS (JPG/PNG) =====
+
+FOTO_LADO_MAX_PX = int(os.getenv("FOTO_LADO_MAX_PX", "1600"))  # Lado maior após redução
+FOTO_FORMATO = os.getenv("FOTO_FORMATO", "JPEG").upper()      # JPEG ou WEBP
+FOTO_QUALIDADE = int(os.getenv("FOTO_QUALIDADE", "85"))
+FOTO_RECORTE_MARGEM = 0.02  # Margem (fração do lado) mantida ao redor do cartão
+
+
+def _limiar_otsu(histograma: List[int]) -> int:
+    """Limiar de Otsu sobre um histograma de 256 níveis de cinza."""
+    total = sum(histograma)
+    soma_total = sum(i * h for i, h in enumerate(histograma))
+    soma_fundo = peso_fundo = 0
+    melhor_limiar, melhor_variancia = 127, -1.0
+    for nivel, quantidade in enumerate(histograma):
+        peso_fundo += quantidade
+        if peso_fundo == 0:
+            continue
+        peso_frente = total - peso_fundo
+        if peso_frente == 0:
+            break
+        soma_fundo += nivel * quantidade
+        media_fundo = soma_fundo / peso_fundo
+        media_frente = (soma_total - soma_fundo) / peso_frente
+        variancia = peso_fundo * peso_frente * (media_fundo - media_frente) ** 2
+        if variancia > melhor_variancia:
+            melhor_limiar, melhor_variancia = nivel, variancia
+    return melhor_limiar
+
+
+def _caixa_cartao(img: Image.Image) -> Optional[tuple]:
+    """
+    Estima a caixa do cartão (papel claro) sobre o fundo (mesa, mão...).
+    
+    Trabalha numa miniatura de 256px: binariza por Otsu, remove ruído com filtro de
+    mediana e pega o retângulo envolvente da região clara. Retorna None se o resultado
+    não parecer um cartão (muito pequeno ou praticamente a foto inteira).
+    """
+    mini = img.copy()
+    mini.thumbnail((256, 256))
+    limiar = _limiar_otsu(mini.histogram())
+    mascara = mini.point(lambda v: 255 if v > limiar else 0).filter(ImageFilter.MedianFilter(5))
+    caixa = mascara.getbbox()
+    mini.close()
+    if not caixa:
+        return None
+    
+    fracao_area = ((caixa[2] - caixa[0]) * (caixa[3] - caixa[1])) / float(mascara.width * mascara.height)
+    if fracao_area < 0.2 or fracao_area > 0.95:
+        return None
+    
+    escala_x = img.width / mascara.width
+    escala_y = img.height / mascara.height
+    margem_x = int(img.width * FOTO_RECORTE_MARGEM)
+    margem_y = int(img.height * FOTO_RECORTE_MARGEM)
+    return (
+        max(0, int(caixa[0] * escala_x) - margem_x),
+        max(0, int(caixa[1] * escala_y) - margem_y),
+        min(img.width, int(caixa[2] * escala_x) + margem_x),
+        min(img.height, int(caixa[3] * escala_y) + margem_y),
+    )
+
+
+def preprocessar_foto_cartao(img_bytes: bytes) -> tuple:
+    """
+    NOVO v7.6: Prepara a foto do cartão antes do Gemini.
+    
+    1. Decodifica já reduzida (draft JPEG: escala DCT, sem decodificar os 12 MP inteiros)
+    2. Aplica a rotação EXIF (fotos de celular)
+    3. Converte para escala de cinza
+    4. Recorta na caixa do cartão (auto-crop)
+    5. Reduz para FOTO_LADO_MAX_PX no lado maior
+    6. Codifica em JPEG/WebP compacto
+    
+    Retorna (blob, estatisticas): blob = {"mime_type", "data"} pronto para o Gemini.
+    """
+    img = Image.open(io.BytesIO(img_bytes))
+    largura_original, altura_original = img.size
+    
+    # JPEG: pede ao decodificador a menor escala DCT que ainda cubra o tamanho final
+    img.draft("L", (FOTO_LADO_MAX_PX, FOTO_LADO_MAX_PX))
+    
+    img_rotacionada = ImageOps.exif_transpose(img)
+    if img_rotacionada is not img:
+        img.close()
+    img = img_rotacionada
+    
+    if img.mode != "L":
+        img_cinza = img.convert("L")
+        img.close()
+        img = img_cinza
+    
+    caixa = _caixa_cartao(img)
+    if caixa:
+        img_recortada = img.crop(caixa)
+        img.close()
+        img = img_recortada
+    
+    img.thumbnail((FOTO_LADO_MAX_PX, FOTO_LADO_MAX_PX), Image.LANCZOS)
+    
+    saida = io.BytesIO()
+    if FOTO_FORMATO == "WEBP":
+        img.save(saida, format="WEBP", quality=FOTO_QUALIDADE, method=4)
+        mime_type = "image/webp"
+    else:
+        img.save(saida, format="JPEG", quality=FOTO_QUALIDADE, optimize=True)
+        mime_type = "image/jpeg"
+    largura_final, altura_final = img.size
+    img.close()
+    
+    dados = saida.getvalue()
+    estatisticas = {
+        "bytes_original": len(img_bytes),
+        "bytes_final": len(dados),
+        "bytes_economizados": len(img_bytes) - len(dados),
+        "pixels_original": largura_original * altura_original,
+        "pixels_final": largura_final * altura_final,
+        "pixels_economizados": largura_original * altura_original - largura_final * altura_final,
+        "recortado": caixa is not None,
+        "dimensoes": f"{largura_final}x{altura_final}",
+    }
+    return {"mime_type": mime_type, "data": dados}, estatisticas
+
+
+async def processar_imagem_com_gemini(img_bytes: bytes, filename: str, progresso=None) -> RegistrosPonto:
+    """
+    Processa imagem (JPG/PNG) usando Gemini Vision
+    
+    NOVO v7.6: A foto é pré-processada (EXIF, cinza, recorte, redução) e enviada
+    como JPEG/WebP compacto em vez do arquivo original.
+    NOVO v8.0: Com `progresso`, a imagem conta como página 0 do checkpoint do job.
+    """
+    prontas = progresso.paginas_prontas() if progresso else {}
+    if prontas.get(0) is not None:
+        print(f"[IMG] {filename} retomada do checkpoint")
+        return converter_json_gemini_para_registros(prontas[0], origem=filename)
+    
+    if not GEMINI_MODELS:
+        raise ValueError("Nenhuma GEMINI_API_KEY configurada. Configure no arquivo .env")
+    
+    if progresso:
+        progresso.definir_total(1)
+    
+    try:
+        blob, estatisticas = await asyncio.to_thread(preprocessar_foto_cartao, img_bytes)
+        print(
+            f"[IMG] Pré-processamento {filename}: "
+            f"{estatisticas['bytes_original'] / 1024:.0f} KB -> {estatisticas['bytes_final'] / 1024:.0f} KB "
+            f"(-{estatisticas['bytes_economizados'] / 1024:.0f} KB), "
+            f"{estatisticas['pixels_original'] / 1e6:.1f} MP -> {estatisticas['pixels_final'] / 1e6:.1f} MP "
+            f"({estatisticas['dimensoes']}{', recortada' if estatisticas['recortado'] else ''})"
+        )
+        
+        print(f"[PROCESS] Processando imagem com {GEMINI_MODELO_NOME}...")
+        json_data = await extrair_json_gemini(PROMPT_CARTAO_IMAGEM, blob, blob["data"], filename, blob["mime_type"])
+        
+        if json_data is None:
+            raise ValueError("Não foi possível obter um JSON válido do Gemini")
+        
+        if progresso:
+            progresso.pagina_concluida(0, json_data)
+        print(f"[IMG] JSON recebido: {json_data.get('funcionario', 'N/A')}")
+        return converter_json_gemini_para_registros(json_data, origem=filename)
+        
+    except Exception as e:
+        raise ValueError(f"Erro ao processar imagem: {str(e)}")
+
+def converter_json_gemini_para_registros(json_data: dict, registros: Optional[RegistrosPonto] = None,
+                                         origem: str = 'gemini') -> RegistrosPonto:
+    """
+    Converte JSON do Gemini para o formato esperado pelo sistema
+    
+    NOVO v9.0: As batidas são gravadas em `registros` (ou num RegistrosPonto novo).
+    """
+    if registros is None:
+        registros = RegistrosPonto()
+    id_origem = registros.id_origem(origem)
+    criados = 0
+    funcionario = json_data.get("funcionario", "N/A")
+    
+    mes_json = json_data.get("mes")
+    ano_json = json_data.get("ano")
+    mes_ano = None
+    
+    if mes_json and ano_json:
+        try:
+            mes_ano = (int(mes_json), int(ano_json))
+            print(f"[DATA] Mês/Ano detectado: {mes_ano[0]:02d}/{mes_ano[1]}")
+        except (ValueError, TypeError):
+            pass
+    
+    print(f"\n{'='*70}")
+    print(f"[USER] Funcionário: {funcionario}")
+    print(f"[LIST] Processando {len(json_data.get('registros', []))} registros")
+    print(f"{'='*70}\n")
+    
+    for idx, registro in enumerate(json_data.get('registros', []), 1):
+        try:
+            data_str = registro.get("data")
+            if not data_str:
+                continue
+            
+            print(f"Registro #{idx}: data='{data_str}'")
+            
+            data_obj = None
+            
+            if '/' in data_str or '-' in data_str:
+                separador = '/' if '/' in data_str else '-'
+                partes = data_str.split(separador)
+                
+                if len(partes) == 3:
+                    try:
+                        dia, mes, ano = int(partes[0]), int(partes[1]), int(partes[2])
+                        data_obj = date(ano, mes, dia)
+                        if not mes_ano:
+                            mes_ano = (mes, ano)
+                    except (ValueError, IndexError):
+                        pass
+            
+            if not data_obj and data_str.strip().isdigit():
+                dia = int(data_str.strip())
+                
+                if mes_ano:
+                    try:
+                        data_obj = date(mes_ano[1], mes_ano[0], dia)
+                        print(f"   [DATA] Data completada: {dia:02d} -> {data_obj.strftime('%d/%m/%Y')}")
+                    except ValueError as e:
+                        print(f"   [AVISO] Data inválida: {e}")
+                        continue
                 else:
-                    status = "Falta"
-                    a_dever = JORNADA_SABADO if (dia_semana_num == 5) else JORNADA_PADRAO
-                    alerta = True
-                    batidas_str = "Falta"
-                    ocorrencias = "FALTA NÃO JUSTIFICADA"
+                    print(f"   [AVISO] Mês/Ano não identificado")
+                    continue
+            
+            if not data_obj:
+                print(f"   [AVISO] Formato não reconhecido: '{data_str}'")
+                continue
+            
+            horarios_encontrados = []
+            for campo in ["entrada", "saida_almoco", "retorno_almoco", "saida"]:
+                hora_str = registro.get(campo)
+                if hora_str and hora_str != "null" and str(hora_str).strip():
+                    hora_str = str(hora_str).strip()
+                    try:
+                        if len(hora_str.split(':')) == 2:
+                            hora_str += ":00"
+                        hora_obj = datetime.strptime(hora_str, "%H:%M:%S").time()
+                        horarios_encontrados.append((campo, hora_obj))
+                    except ValueError as e:
+                        print(f"   [AVISO] Erro no horário '{campo}={hora_str}': {e}")
+                        continue
+            
+            if horarios_encontrados:
+                print(f"   [HORA] Horários: {', '.join([f'{c}={h:%H:%M}' for c, h in horarios_encontrados])}")
+                
+                id_nome = registros.id_nome(funcionario)
+                for campo, hora in horarios_encontrados:
+                    registros.anexar(id_nome, data_obj.toordinal(), hora.hour * 60 + hora.minute,
+                                     hora.second, id_origem)
+                criados += len(horarios_encontrados)
+            else:
+                print(f"   [AVISO] Nenhum horário válido")
+                
+        except (ValueError, KeyError) as e:
+            print(f"   [ERRO] Erro: {e}")
+            continue
+    
+    print(f"\n[OK] Total de {criados} registros criados\n")
+    return registros
+
+# ===== FUNÇÃO REFATORADA: LÓGICA DE CÁLCULO COM BATIDAS SEPARADAS =====
+class DiaApurado:
+    """
+    NOVO v8.3: Linha do relatório diário em formato compacto (__slots__, segundos inteiros).
+    
+    Substitui o dict de 15 chaves com timedelta por dia. As durações só viram
+    timedelta/texto na saída (format_segundos, gerar_excel). O acesso por nome de
+    coluna (dia["Horas Normais"], dia.get(...)) continua funcionando e devolve timedelta.
+    """
+    __slots__ = (
+        'data', 'funcionario', 'dia_semana', 'entrada_1', 'saida_1', 'entrada_2', 'saida_2',
+        'meta_s', 'total_s', 'noturno_s', 'normais_s', 'a_dever_s', 'extras_comuns_s', 'extras_100_s',
+        'ocorrencias'
+    )
+    
+    # Nome de coluna (formato antigo) -> (atributo, é duração em segundos)
+    COLUNAS = {
+        "Data": ('data', False),
+        "Funcionário": ('funcionario', False),
+        "Dia da Semana": ('dia_semana', False),
+        "Entrada 1": ('entrada_1', False),
+        "Saída 1": ('saida_1', False),
+        "Entrada 2": ('entrada_2', False),
+        "Saída 2": ('saida_2', False),
+        "Meta": ('meta_s', True),
+        "Total Trabalhado": ('total_s', True),
+        "Adicional Noturno": ('noturno_s', True),
+        "Horas Normais": ('normais_s', True),
+        "Horas a Dever": ('a_dever_s', True),
+        "Horas Extras (Comum)": ('extras_comuns_s', True),
+        "Horas Extras (100%)": ('extras_100_s', True),
+        "Ocorrências": ('ocorrencias', False),
+    }
+    
+    def __init__(self, data, funcionario, dia_semana, entrada_1, saida_1, entrada_2, saida_2,
+                 meta_s, total_s, noturno_s, normais_s, a_dever_s, extras_comuns_s, extras_100_s,
+                 ocorrencias):
+        self.data = data
+        self.funcionario = funcionario
+        self.dia_semana = dia_semana
+        self.entrada_1 = entrada_1
+        self.saida_1 = saida_1
+        self.entrada_2 = entrada_2
+        self.saida_2 = saida_2
+        self.meta_s = meta_s
+        self.total_s = total_s
+        self.noturno_s = noturno_s
+        self.normais_s = normais_s
+        self.a_dever_s = a_dever_s
+        self.extras_comuns_s = extras_comuns_s
+        self.extras_100_s = extras_100_s
+        self.ocorrencias = ocorrencias
+    
+    def __getitem__(self, coluna: str):
+        atributo, duracao = self.COLUNAS[coluna]
+        valor = getattr(self, atributo)
+        return timedelta(seconds=valor) if duracao else valor
+    
+    def get(self, coluna: str, padrao=None):
+        return self[coluna] if coluna in self.COLUNAS else padrao
+    
+    def para_dict(self) -> dict:
+        """Formato antigo (dict com timedelta), para depuração/exportações externas"""
+        return {coluna: self[coluna] for coluna in self.COLUNAS}
+
+
+def indexar_batidas(dados_brutos) -> tuple:
+    """
+    NOVO v8.2: Agrupa as batidas UMA vez por (funcionário, data).
+    NOVO v9.0: Lê direto das colunas do RegistrosPonto (lista de dicts é convertida antes).
+    
+    Substitui o filtro de DataFrame por dia (O(dias x batidas) por funcionário).
+    Mantém a semântica anterior: duplicatas exatas removidas (primeira ocorrência vence),
+    funcionários na ordem em que aparecem e batidas do dia na ordem do arquivo.
+    
+    Returns:
+        (indice, ano_detectado) onde indice = {funcionario: {data: [hora, ...]}}
+        (indice vazio se não houver batidas)
+    """
+    if not isinstance(dados_brutos, RegistrosPonto):
+        dados_brutos = RegistrosPonto.de_registros(dados_brutos)
+    return dados_brutos.indexar()
+
+
+UM_SEGUNDO = timedelta(seconds=1)  # (td // UM_SEGUNDO) -> segundos inteiros
+
+
+def apurar_batidas_dia(funcionario, data_atual_obj: date, batidas_turno: List[datetime], noturno_ativo: bool,
+                       intervalo_auto: bool, intervalo_minutos: int, warnings_sistema: list,
+                       tabela_minutos: TabelaMinutos = None, domingo_util: bool = False) -> tuple:
+    """
+    NOVO v8.4: Pareamento e relógio de UM dia com batidas (comum aos dois motores de cálculo).
+    NOVO v9.1: Recebe os turnos já montados por montar_turnos (datetimes reais, saída
+    de madrugada no dia seguinte); não reordena mais as batidas do dia.
+    
+    Args:
+        tabela_minutos: classificação por minuto do período (NOVO v8.5); sem ela, monta a do dia
+        domingo_util: se True, minutos de domingo não contam como descanso
+    
+    Returns:
+        (batidas_str, entrada_1, saida_1, entrada_2, saida_2, ocorrencias, alerta,
+         total_segundos, noturno_segundos, noturno_base_minutos, descanso_segundos)
+        descanso_segundos: parte do relógio que cai em feriado (ou domingo não útil),
+        mesmo quando o turno só atravessa a meia-noite para esse dia.
+    """
+    if tabela_minutos is None:
+        tabela_minutos = TabelaMinutos(data_atual_obj, data_atual_obj)
+    entrada_1 = None
+    saida_1 = None
+    entrada_2 = None
+    saida_2 = None
+    ocorrencias = ""
+    alerta = False
+    
+    horarios = list(batidas_turno)
+    batidas_str = " → ".join([f"{h.hour:02d}:{h.minute:02d}" for h in horarios])
+    
+    # Validação: Batidas ímpares
+    if len(horarios) % 2 != 0:
+        warning_msg = f"⚠️ {funcionario} em {data_atual_obj}: Batida ímpar ({len(horarios)} registros)"
+        warnings_sistema.append(warning_msg)
+    
+    # Intervalo Automático - CRÍTICO v4.6: SÓ APLICA SE EXATAMENTE 2 BATIDAS
+    # NUNCA sobrescreve quando já existem 4 batidas reais!
+    num_batidas_original = len(horarios)
+    
+    if num_batidas_original == 2 and intervalo_auto:
+        entrada, saida = horarios[0], horarios[1]
+        meio_dia = datetime.combine(data_atual_obj, dt_time(12, 0))
+        
+        # Só aplica se a jornada cruza o meio-dia
+        # NOVO v9.1: e se o intervalo inteiro cabe no turno (saída 12:07 não vira par 13:00 -> 12:07)
+        fim_almoco = meio_dia + timedelta(minutes=intervalo_minutos)
+        if entrada < meio_dia and fim_almoco < saida:
+            horarios = [entrada, meio_dia, fim_almoco, saida]
+            print(f"   ⚙️ Intervalo automático aplicado: {meio_dia.strftime('%H:%M')}-{fim_almoco.strftime('%H:%M')}")
+    
+    # Se já tem 4+ batidas, NUNCA modifica (prioridade aos dados reais)
+    elif num_batidas_original >= 4:
+        print(f"   ✅ Preservando {num_batidas_original} batidas reais (intervalo automático desabilitado)")
+    
+    # DISTRIBUIÇÃO DAS BATIDAS
+    num_batidas = len(horarios)
+    
+    if num_batidas == 2:
+        entrada_1 = horarios[0].time()
+        saida_2 = horarios[1].time()
+        
+    elif num_batidas == 3:
+        entrada_1 = horarios[0].time()
+        saida_1 = horarios[1].time()
+        entrada_2 = horarios[2].time()
+        ocorrencias = "BATIDA INCOMPLETA"
+        alerta = True
+        
+    elif num_batidas >= 4:
+        entrada_1 = horarios[0].time()
+        saida_1 = horarios[1].time()
+        entrada_2 = horarios[2].time()
+        saida_2 = horarios[3].time()
+        
+        if num_batidas > 4:
+            ocorrencias = f"BATIDAS EXTRAS ({num_batidas})"
+    
+    # CÁLCULO DE HORAS REFATORADO v3.5: BASE INTEGRAL NOTURNA
+    # ========================================================
+    # INOVAÇÃO: A coluna "Adicional Noturno" agora exibe a BASE INTEGRAL
+    # (horas reais noturnas * 1.142857) e não apenas o bônus.
+    # 
+    # Exemplo: 2h reais noturnas = 2 * 1.142857 = 2.285714h = 02:17:08
+    
+    total_segundos_clock = 0                # Relógio puro (sem nenhuma redução)
+    base_integral_noturna_segundos = 0.0   # BASE INTEGRAL (horas * 1.142857)
+    minutos_noturno_reais = 0.0            # Rastreamento de minutos reais
+    descanso_segundos = 0                  # NOVO v8.5: Relógio em domingo/feriado (por minuto)
+    
+    # Processa pares sequencialmente
+    for i in range(0, len(horarios) - 1, 2):
+        entrada_par = horarios[i]
+        saida_par = horarios[i + 1]
+        
+        tempo_real_par = (saida_par - entrada_par) // UM_SEGUNDO
+        total_segundos_clock += tempo_real_par
+        
+        # NOVO v8.5: Classificação do par por consulta à tabela de minutos
+        # (a prorrogação noturna se mede pela noite em que o turno começou, horarios[0])
+        minutos_noturno_inteiros, minutos_domingo, minutos_feriado, minutos_comuns = tabela_minutos.contar(
+            entrada_par, saida_par, horarios[0])
+        minutos_descanso = minutos_feriado if domingo_util else minutos_feriado + minutos_domingo
+        if minutos_descanso and minutos_descanso == minutos_feriado + minutos_domingo + minutos_comuns:
+            descanso_segundos += tempo_real_par  # Par inteiro no descanso: exato em segundos
+        elif minutos_descanso:
+            descanso_segundos += min(minutos_descanso * 60, tempo_real_par)  # Virada de dia
+        
+        # Se noturno ativo, calcula APENAS os minutos na janela [22:00-05:00] (+ prorrogação)
+        if noturno_ativo:
+            
+            if minutos_noturno_inteiros > 0:
+                minutos_noturno_reais += minutos_noturno_inteiros
+                
+                # Converte minutos reais em segundos reduzidos via fator 1.142857
+                # BASE INTEGRAL = minutos_reais * 60 * 1.142857
+                FATOR_REDUCAO_EXATO = 1.142857142857143
+                seg_reduzido = minutos_noturno_inteiros * 60 * FATOR_REDUCAO_EXATO
+                base_integral_noturna_segundos += seg_reduzido
+    
+    # Total Trabalhado é APENAS o relógio real (PROIBIDO somar ganho noturno)
+    total_trabalhado = total_segundos_clock
+    
+    # HOTFIX v6.0: Adicional Noturno é o tempo REAL (relógio), NÃO reduzido
+    # O sistema de folha do contador é que aplica o fator 1.1428
+    # Isso bate com o Fechamento Exemplar que mostra 2:03 em vez de 2:19
+    if noturno_ativo and minutos_noturno_reais > 0:
+        adicional_noturno = int(minutos_noturno_reais) * 60  # REAL
+    else:
+        adicional_noturno = 0
+    
+    # Validação: Intervalo intrajornada < 1h (Art. 71 CLT)
+    if len(horarios) >= 4:
+        intervalo = horarios[2] - horarios[1]
+        if intervalo < timedelta(hours=1):
+            warning_msg = f"⚠️ {funcionario} em {data_atual_obj}: Intervalo < 1h ({intervalo.total_seconds()/60:.0f}min) - Risco Art. 71"
+            warnings_sistema.append(warning_msg)
+    
+    # noturno_base_minutos: minutos reais noturno (float) para o resumo do frontend
+    return (batidas_str, entrada_1, saida_1, entrada_2, saida_2, ocorrencias, alerta,
+            total_trabalhado, adicional_noturno, minutos_noturno_reais, descanso_segundos)
+
+
+# ===== NOVO v8.4: MOTOR DE CÁLCULO VETORIZADO (NumPy) =====
+# settings["motor_calculo"] = "numpy" (ou env MOTOR_CALCULO=numpy como padrão).
+# O pareamento de batidas continua por turno (montar_turnos + apurar_batidas_dia); todo o resto - meta,
+# classificação do dia, tolerância VTD, status manuais, apuração semanal 44h e totais -
+# é feito em arrays sobre TODOS os dias de TODOS os funcionários de uma vez.
+# O motor Python (padrão) é a referência: os dois devem dar resultados idênticos.
+
+MOTOR_CALCULO_PADRAO = os.getenv("MOTOR_CALCULO", "python").lower()
+
+STATUS_MOTOR = ["Normal", "Extra", "Incompleto", "Extra 100%", "Feriado", "Folga", "Falta"]
+(ST_NORMAL, ST_EXTRA, ST_INCOMPLETO, ST_EXTRA_100, ST_FERIADO, ST_FOLGA, ST_FALTA) = range(7)
+
+# Status manuais (overrides) por efeito no cálculo
+(OVR_NENHUM, OVR_ABONO, OVR_ATESTADO, OVR_DESCANSO, OVR_FALTA, OVR_OUTRO) = range(6)
+TIPOS_OVERRIDE = {"ABONO": OVR_ABONO, "ATESTADO": OVR_ATESTADO, "FOLGA": OVR_DESCANSO,
+                  "FERIADO": OVR_DESCANSO, "DSR": OVR_DESCANSO, "FALTA": OVR_FALTA}
+
+
+def calcular_relatorio_vetorizado(batidas_indexadas: dict, settings: dict, status_overrides: dict,
+                                  calendario: CalendarioEscala, feriados_set: set, escala_tipo: str,
+                                  sabado_util: bool, domingo_util: bool,
+                                  jornada_padrao: int, jornada_sabado: int, tolerancia: int,
+                                  noturno_ativo: bool, intervalo_auto: bool, intervalo_minutos: int,
+                                  warnings_sistema: list, tabela_minutos: TabelaMinutos):
+    """
+    Motor NumPy do calcular_relatorio (mesmo retorno: relatorio_diario, resumo_preview, totais_semanais).
+    
+    Args:
+        calendario: metas do período (compilar_calendario_escala), mesmo do motor Python
+        jornada_padrao/jornada_sabado/tolerancia: em segundos
+    """
+    funcionarios = list(batidas_indexadas)
+    data_min = min(min(dias) for dias in batidas_indexadas.values())
+    data_max = max(max(dias) for dias in batidas_indexadas.values())
+    n_datas = (data_max - data_min).days + 1
+    
+    # --- Eixo de datas (calculado uma vez por data, não por funcionário-dia) ---
+    datas = [data_min + timedelta(days=i) for i in range(n_datas)]
+    dia_semana_data = np.array([d.weekday() for d in datas], dtype=np.int8)
+    semana_iso_data = np.array([d.isocalendar()[1] for d in datas], dtype=np.int64)
+    feriado_data = np.array([d in feriados_set for d in datas], dtype=bool)
+    meta_data = calendario.metas[(data_min - calendario.data_inicio).days:][:n_datas]
+    iso_datas = [d.isoformat() for d in datas] if status_overrides else None
+    
+    # --- Fase 1 (por dia com batidas): pareamento e relógio ---
+    idx_funcionario, idx_data, tem_batidas, total, noturno, descanso, override = [], [], [], [], [], [], []
+    apuracoes = []        # Tupla de apurar_batidas_dia (ou None sem batidas)
+    status_forcados = []  # String do status manual (ou None)
+    
+    for f, funcionario in enumerate(funcionarios):
+        batidas_por_dia = batidas_indexadas[funcionario]
+        inicio = (min(batidas_por_dia) - data_min).days
+        fim = (max(batidas_por_dia) - data_min).days
+        for i in range(inicio, fim + 1):
+            data_atual_obj = datas[i]
+            idx_funcionario.append(f)
+            idx_data.append(i)
+            
+            status_forcado = status_overrides.get(f"{funcionario}|{iso_datas[i]}") if iso_datas else None
+            status_forcados.append(status_forcado or None)
+            override.append(TIPOS_OVERRIDE.get(status_forcado, OVR_OUTRO) if status_forcado else OVR_NENHUM)
+            
+            batidas_turno = batidas_por_dia.get(data_atual_obj)
+            if batidas_turno:
+                apuracao = apurar_batidas_dia(
+                    funcionario, data_atual_obj, batidas_turno, noturno_ativo,
+                    intervalo_auto, intervalo_minutos, warnings_sistema,
+                    tabela_minutos, domingo_util
+                )
+                apuracoes.append(apuracao)
+                tem_batidas.append(True)
+                total.append(apuracao[7])
+                noturno.append(apuracao[8])
+                descanso.append(apuracao[10])
+            else:
+                apuracoes.append(None)
+                tem_batidas.append(False)
+                total.append(0)
+                noturno.append(0)
+                descanso.append(0)
+    
+    # --- Fase 2 (vetorizada): classificação, meta, tolerância, overrides ---
+    idx_f = np.array(idx_funcionario, dtype=np.int64)
+    idx_d = np.array(idx_data, dtype=np.int64)
+    tem = np.array(tem_batidas, dtype=bool)
+    T = np.array(total, dtype=np.int64)
+    noturno_s = np.array(noturno, dtype=np.int64)
+    D = np.array(descanso, dtype=np.int64)  # Relógio em domingo/feriado (tabela de minutos)
+    C = T - D                               # Relógio em dia comum
+    ovr = np.array(override, dtype=np.int8)
+    n = len(T)
+    
+    dia_semana = dia_semana_data[idx_d]
+    feriado = feriado_data[idx_d]
+    meta = meta_data[idx_d].copy()
+    domingo = dia_semana == 6
+    sabado = dia_semana == 5
+    dom_fer_nao_util = feriado | (domingo & (not domingo_util))
+    
+    normais = np.zeros(n, dtype=np.int64)
+    a_dever = np.zeros(n, dtype=np.int64)
+    extras_comuns = np.zeros(n, dtype=np.int64)
+    extras_100 = np.zeros(n, dtype=np.int64)
+    status = np.full(n, ST_NORMAL, dtype=np.int8)
+    alerta = np.array([a[6] if a else False for a in apuracoes], dtype=bool)
+    
+    # Com batidas: domingo/feriado não útil -> 100%
+    grupo_100 = tem & dom_fer_nao_util
+    # Com batidas: sábado não útil na 5x2 -> 100%
+    grupo_sab_100 = tem & ~grupo_100 & sabado & ((not sabado_util) and escala_tipo == 'clt_5x2_padrao')
+    # Com batidas: sábado útil (sem tolerância VTD) e dias úteis (com tolerância VTD)
+    grupo_sab = tem & ~grupo_100 & sabado & ~grupo_sab_100
+    grupo_util = tem & ~grupo_100 & ~sabado
+    
+    zera = grupo_100 | grupo_sab_100
+    meta[zera] = 0
+    extras_100[grupo_sab_100] = T[grupo_sab_100]
+    extras_100[grupo_100] = D[grupo_100]
+    extras_comuns[grupo_100] = C[grupo_100]  # Virada da meia-noite para dia comum
+    status[grupo_100] = np.where(T[grupo_100] > 0, ST_EXTRA_100, ST_FERIADO)
+    status[grupo_sab_100] = np.where(T[grupo_sab_100] > 0, ST_EXTRA_100, ST_FOLGA)
+    
+    com_meta = grupo_sab | grupo_util
+    acima = C > meta
+    extras_100[com_meta] = D[com_meta]
+    normais[com_meta] = np.minimum(C, meta)[com_meta]
+    extras_comuns[com_meta & acima] = (C - meta)[com_meta & acima]
+    a_dever[com_meta & ~acima] = (meta - C)[com_meta & ~acima]
+    
+    status[grupo_sab] = np.where(acima, ST_EXTRA, np.where(a_dever > 0, ST_INCOMPLETO, ST_NORMAL))[grupo_sab]
+    
+    # Dias úteis: tolerância Art. 58 §1º (VTD) - mesma regra de aplicar_tolerancia_clt (10 min)
+    vtd = C - meta
+    desconta = vtd > 10 * 60
+    abona = vtd < -10 * 60
+    status_util = np.where(acima, ST_EXTRA, np.where(a_dever > tolerancia, ST_INCOMPLETO, ST_NORMAL))
+    status_util = np.where(desconta, ST_INCOMPLETO,
+                           np.where(abona, ST_EXTRA,
+                                    np.where(status_util == ST_INCOMPLETO, ST_INCOMPLETO, ST_NORMAL)))
+    status[grupo_util] = status_util[grupo_util]
+    alerta[grupo_util] = desconta[grupo_util]
+    
+    # Sem batidas: DSR/feriado, sábado não útil ou falta
+    sem_dsr_feriado = ~tem & (feriado | domingo)
+    sem_dsr = ~tem & ~sem_dsr_feriado & sabado & (not sabado_util)
+    sem_folga_ciclo = ~tem & ~sem_dsr_feriado & ~sem_dsr & (meta == 0) & escala_eh_ciclica(escala_tipo)
+    sem_falta = ~tem & ~sem_dsr_feriado & ~sem_dsr & ~sem_folga_ciclo
+    jornada_dia = np.where(sabado, jornada_sabado, jornada_padrao)
+    meta[sem_dsr_feriado | sem_dsr] = 0
+    status[sem_dsr_feriado | sem_dsr | sem_folga_ciclo] = ST_FOLGA
+    status[sem_falta] = ST_FALTA
+    a_dever[sem_falta] = jornada_dia[sem_falta]
+    alerta[sem_falta] = True
+    
+    # Status manual (efeito numérico; textos ficam para a montagem da saída)
+    perdoa = (ovr == OVR_ABONO) | (ovr == OVR_ATESTADO) | (ovr == OVR_DESCANSO)
+    a_dever[perdoa] = 0
+    alerta[perdoa] = False
+    falta_manual = ovr == OVR_FALTA
+    a_dever[falta_manual & ~tem] = jornada_dia[falta_manual & ~tem]
+    alerta[falta_manual] = True
+    
+    saldo = extras_comuns + extras_100 - a_dever
+    
+    # --- Apuração semanal (semana ISO por funcionário) e totais ---
+    n_func = len(funcionarios)
+    chave_semana = idx_f * 54 + semana_iso_data[idx_d]
+    tamanho = n_func * 54
+    
+    def somar(chaves, valores, tamanho_saida):
+        # bincount soma em float64: exato para inteiros < 2**53
+        return np.rint(np.bincount(chaves, weights=valores, minlength=tamanho_saida)).astype(np.int64)
+    
+    total_semana = somar(chave_semana, T, tamanho)
+    dom_fer_semana = somar(chave_semana, D, tamanho)
+    uteis_semana = total_semana - dom_fer_semana
+    extras_50_acum_semana = somar(chave_semana, np.where(extras_comuns > 0, extras_comuns, 0), tamanho)
+    
+    extra_tipo = settings.get('extra_tipo', settings.get('regra_extra', 'semanal'))
+    jornada_semanal = int(settings.get('jornada_semanal_minutos', 2640)) * 60
+    debug_mode = settings.get('debug_calculo', True)
+    
+    if extra_tipo == 'diaria':
+        extras_50_semana = extras_50_acum_semana
+    else:
+        excedente = np.maximum(0, total_semana - jornada_semanal)
+        extras_50_semana = np.minimum(np.maximum(0, excedente - dom_fer_semana), uteis_semana)
+    
+    extras_50_func = extras_50_semana.reshape(n_func, 54).sum(axis=1).tolist()
+    extras_100_func = dom_fer_semana.reshape(n_func, 54).sum(axis=1).tolist()
+    normais_func = somar(idx_f, normais, n_func).tolist()
+    a_dever_func = somar(idx_f, a_dever, n_func).tolist()
+    
+    # Validação: Semanas com > 44h trabalhadas
+    for chave in np.nonzero(total_semana > 44 * 3600)[0].tolist():
+        warnings_sistema.append(
+            f"⚠️ {funcionarios[chave // 54]} (semana {chave % 54}): {format_segundos(int(total_semana[chave]))} > 44h - Risco trabalhista"
+        )
+    
+    # --- Fase 3: saída (DiaApurado + preview), tipos Python nativos ---
+    relatorio_diario = []
+    resumo_preview = []
+    totais_semanais = {}
+    
+    colunas = zip(
+        idx_f.tolist(), idx_d.tolist(), tem.tolist(), meta.tolist(), T.tolist(), noturno_s.tolist(),
+        normais.tolist(), a_dever.tolist(), extras_comuns.tolist(), extras_100.tolist(), saldo.tolist(),
+        status.tolist(), alerta.tolist(), ovr.tolist(), sem_dsr.tolist(), sem_falta.tolist(),
+        sem_folga_ciclo.tolist(), apuracoes, status_forcados
+    )
+    dias_preview_func = [[] for _ in funcionarios]
+    
+    for (f, i, tem_dia, meta_dia, total_dia, noturno_dia, normais_dia, a_dever_dia, ec_dia, e100_dia,
+         saldo_dia, status_dia, alerta_dia, ovr_dia, dsr_dia, falta_dia, folga_ciclo_dia,
+         apuracao, status_forcado) in colunas:
+        data_atual_obj = datas[i]
+        dia_semana_num = data_atual_obj.weekday()
+        
+        if apuracao:
+            batidas_str, entrada_1, saida_1, entrada_2, saida_2, ocorrencias = apuracao[:6]
+            noturno_base_minutos = apuracao[9]
+        else:
+            entrada_1 = saida_1 = entrada_2 = saida_2 = None
+            noturno_base_minutos = 0
+            if falta_dia:
+                batidas_str, ocorrencias = "Falta", "FALTA NÃO JUSTIFICADA"
+            elif folga_ciclo_dia:
+                batidas_str, ocorrencias = "", "FOLGA ESCALA"
+            else:
+                batidas_str, ocorrencias = "", ("DSR" if dsr_dia else "DSR/FERIADO")
+        
+        status_texto = STATUS_MOTOR[status_dia]
+        if status_forcado:
+            status_texto = status_forcado
+            if ovr_dia == OVR_ABONO:
+                ocorrencias = "ABONADO"
+            elif ovr_dia == OVR_ATESTADO:
+                ocorrencias = "ATESTADO MÉDICO"
+                if not tem_dia:
+                    batidas_str = "Atestado"
+            elif ovr_dia == OVR_DESCANSO:
+                ocorrencias = status_forcado.upper()
+                if not tem_dia:
+                    batidas_str = status_forcado.title()
+            elif ovr_dia == OVR_FALTA:
+                ocorrencias = "FALTA"
+        
+        relatorio_diario.append(DiaApurado(
+            data_atual_obj, funcionarios[f], DIAS_SEMANA.get(dia_semana_num, ''),
+            entrada_1, saida_1, entrada_2, saida_2,
+            meta_dia, total_dia, noturno_dia, normais_dia, a_dever_dia, ec_dia, e100_dia,
+            ocorrencias
+        ))
+        
+        if data_atual_obj in feriados_set:
+            tipo_dia_str = "feriado"
+        elif dia_semana_num == 6:
+            tipo_dia_str = "descanso"
+        elif dia_semana_num == 5:
+            tipo_dia_str = "sabado"
+        else:
+            tipo_dia_str = "normal"
+        
+        dias_preview_func[f].append({
+            "data": f"{data_atual_obj.day:02d}/{data_atual_obj.month:02d}",
+            "dia_semana": DIAS_SEMANA.get(dia_semana_num, '')[:3],
+            "batidas": batidas_str,
+            "total": format_segundos(total_dia),
+            "noturno_base": noturno_base_minutos,
+            "batidas_4cols": {
+                "entrada_1": f"{entrada_1.hour:02d}:{entrada_1.minute:02d}" if entrada_1 else None,
+                "saida_1": f"{saida_1.hour:02d}:{saida_1.minute:02d}" if saida_1 else None,
+                "entrada_2": f"{entrada_2.hour:02d}:{entrada_2.minute:02d}" if entrada_2 else None,
+                "saida_2": f"{saida_2.hour:02d}:{saida_2.minute:02d}" if saida_2 else None
+            },
+            "saldo": format_segundos(saldo_dia),
+            "status": status_texto,
+            "alerta": alerta_dia,
+            "tipo_dia": tipo_dia_str,
+            "meta_minutos": int(meta_dia / 60),
+            "banco_horas_informativo": True
+        })
+    
+    modo_label = "DIÁRIA" if extra_tipo == 'diaria' else "SEMANAL"
+    for f, funcionario in enumerate(funcionarios):
+        extras_50_total = extras_50_func[f]
+        extras_100_total = extras_100_func[f]
+        totais_semanais[funcionario] = {
+            "extra50": timedelta(seconds=extras_50_total),
+            "extra100": timedelta(seconds=extras_100_total)
+        }
+        if debug_mode:
+            e50_h = extras_50_total / 3600
+            e100_h = extras_100_total / 3600
+            print(f"\n📊 APURAÇÃO {modo_label} - {funcionario}")
+            print(f"  ✅ RESULTADO: Extra 50% = {e50_h:.2f}h | Extra 100% = {e100_h:.2f}h | Total Extras = {e50_h + e100_h:.2f}h")
+        
+        saldo_final = extras_50_total + extras_100_total - a_dever_func[f]
+        resumo_preview.append({
+            "funcionario": funcionario,
+            "normais": format_segundos(normais_func[f]).replace("+", ""),
+            "dever": format_segundos(a_dever_func[f]).replace("+", ""),
+            "extras_comuns": format_segundos(extras_50_total).replace("+", ""),
+            "extras_100": format_segundos(extras_100_total).replace("+", ""),
+            "saldo": format_segundos(saldo_final),
+            "dias": dias_preview_func[f],
+            "aviso_saldo": f"Extras calculados com apuração {'DIÁRIA (sem compensação)' if extra_tipo == 'diaria' else 'SEMANAL (44h CLT)'}.",
+            "saldo_eh_informativo": True,
+            "versao_calculo": "v6.1-configuravel",
+            "extra_tipo": extra_tipo,
+            "escala_tipo": escala_tipo  # NOVO v8.7: escala pode variar por funcionário
+        })
+    
+    return relatorio_diario, resumo_preview, totais_semanais
+
+
+def _calcular_relatorio_escala(batidas_indexadas: dict, settings: dict, status_overrides: dict,
+                               periodo: Optional[tuple] = None):
+    """
+    Núcleo do calcular_relatorio para funcionários que compartilham a MESMA configuração
+    de escala (settings já resolvidos por resolver_escalas_funcionarios).
+    
+    periodo: (data_min, data_max) do upload inteiro. Grupos/partes de funcionários usam o
+    mesmo período (feriados, tabela de minutos e início de ciclo) que um processamento único.
+    """
+    warnings_sistema = []  # Rastreia alertas de risco trabalhista
+        
+    # Extrai configurações com validação segura
+    jornada_minutos = settings.get('jornada_minutos', 480)
+    
+    # Validação: garante que jornada_minutos é um número válido
+    try:
+        jornada_minutos = int(jornada_minutos) if jornada_minutos else 480
+        if jornada_minutos <= 0 or jornada_minutos > 1440:  # Máximo 24h
+            jornada_minutos = 480
+    except (ValueError, TypeError):
+        jornada_minutos = 480  # Fallback para padrão
+    
+    tolerancia = settings.get('tolerancia', 10)
+    try:
+        tolerancia = int(tolerancia) if tolerancia else 10
+        if tolerancia < 0 or tolerancia > 60:
+            tolerancia = 10
+    except (ValueError, TypeError):
+        tolerancia = 10
+    
+    intervalo_auto = settings.get('intervalo_auto', False)
+    intervalo_minutos = settings.get('intervalo_minutos', 60)
+    try:
+        intervalo_minutos = int(intervalo_minutos) if intervalo_minutos else 60
+        if intervalo_minutos < 0 or intervalo_minutos > 480:
+            intervalo_minutos = 60
+    except (ValueError, TypeError):
+        intervalo_minutos = 60
+    sabado_util = settings.get('sabado_util', True)
+    domingo_util = settings.get('domingo_util', False)
+    noturno_ativo = settings.get('noturno_ativo', False)
+    escala_tipo = settings.get('escala_tipo', 'clt_5x2_padrao')  # Para ciclos
+    data_inicio_escala = settings.get('data_inicio_escala')  # Para clt_12x36
+    
+    # NOTA v8.8: feriados_set é montado APÓS carregar os dados, para os anos do período do arquivo
+            
+    # NOVO v8.3: Núcleo em segundos inteiros (timedelta só na saída)
+    JORNADA_PADRAO = jornada_minutos * 60
+    
+    # NOVO v8.6: Início do ciclo lido UMA vez (escalas cíclicas: 12x36, 5x1, 24x48)
+    data_init = parse_data_inicio_escala(data_inicio_escala) if escala_eh_ciclica(escala_tipo) else None
+    
+    JORNADA_SABADO = 4 * 3600 if sabado_util else 0
+    TOLERANCIA = tolerancia * 60
+    
+    if periodo is not None:
+        data_min_periodo, data_max_periodo = periodo
+    else:
+        data_min_periodo = min(min(dias) for dias in batidas_indexadas.values())
+        data_max_periodo = max(max(dias) for dias in batidas_indexadas.values())
+    
+    # NOVO v8.8: Feriados de TODOS os anos do período (nacionais/móveis, município, empresa e manuais)
+    indice_feriados = feriados_do_periodo(settings, data_min_periodo, data_max_periodo)
+    feriados_set = indice_feriados.datas
+    
+    if feriados_set:
+        print(f"[FERIADOS] {len(feriados_set)} feriado(s) configurado(s) para {data_min_periodo.year}-{data_max_periodo.year}")
+    
+    # NOVO v8.5: Classificação por minuto (noturno/domingo/feriado) do período inteiro, uma vez
+    tabela_minutos = TabelaMinutos(data_min_periodo, data_max_periodo, feriados_set)
+    
+    # NOVO v8.6: Meta de cada dia do período compilada do catálogo (uma consulta por dia)
+    calendario = compilar_calendario_escala(
+        escala_tipo, data_min_periodo, data_max_periodo, frozenset(feriados_set), data_init
+    )
+    
+    # NOVO v9.1: Turnos montados sobre o período inteiro (uma varredura por funcionário).
+    # Padrão: turno máximo cobre a maior meta da escala (24x48) com folga para extras.
+    turno_max_horas = settings.get('turno_max_horas')
+    try:
+        turno_max_horas = float(turno_max_horas) if turno_max_horas else None
+        if turno_max_horas is not None and not 1 <= turno_max_horas <= 48:
+            turno_max_horas = None
+    except (ValueError, TypeError):
+        turno_max_horas = None
+    if turno_max_horas is None:
+        turno_max_horas = max(TURNO_MAX_HORAS, int(calendario.metas.max(initial=0)) / 3600 + 2)
+    
+    descanso_min_horas = settings.get('descanso_min_horas')
+    try:
+        descanso_min_horas = float(descanso_min_horas) if descanso_min_horas else TURNO_DESCANSO_MIN_HORAS
+        if not 0 < descanso_min_horas <= 24:
+            descanso_min_horas = TURNO_DESCANSO_MIN_HORAS
+    except (ValueError, TypeError):
+        descanso_min_horas = TURNO_DESCANSO_MIN_HORAS
+    
+    # A partir daqui: {funcionario: {data_inicio_turno: [datetime, ...]}}
+    batidas_indexadas = {
+        funcionario: montar_turnos(batidas_por_dia, turno_max_horas, descanso_min_horas)
+        for funcionario, batidas_por_dia in batidas_indexadas.items()
+    }
+    
+    # --- SOBRESCRITA DE META PELA ESCALA (Enterprise Fix) ---
+    meta_sobrescrita = False
+    if escala_tipo in CATALOGO_JORNADAS_CLT:
+        escala_info = CATALOGO_JORNADAS_CLT[escala_tipo]
+        if escala_tipo == 'clt_6x1_com':
+            jornada_minutos = 440
+            meta_sobrescrita = True
+        elif escala_tipo == 'clt_5x2_padrao':
+            jornada_minutos = 480
+            meta_sobrescrita = True
+        print(f"[ESCALA] Escala Ativa: {escala_info['nome']} | Meta: {jornada_minutos}min {'(AUTO)' if meta_sobrescrita else ''}")
+
+    if noturno_ativo:
+        print(f"[NOTURNO] Adicional Noturno: ATIVO (redução Art. 73 aplicada)")
+    
+    # NOVO v8.4: Motor vetorizado (mesma semântica, arrays sobre todos os funcionário-dias)
+    if str(settings.get('motor_calculo') or MOTOR_CALCULO_PADRAO).lower() == 'numpy':
+        return calcular_relatorio_vetorizado(
+            batidas_indexadas, settings, status_overrides, calendario, feriados_set, escala_tipo, sabado_util, domingo_util,
+            JORNADA_PADRAO, JORNADA_SABADO, TOLERANCIA,
+            noturno_ativo, intervalo_auto, intervalo_minutos, warnings_sistema, tabela_minutos
+        )
+    
+    relatorio_diario = []
+    resumo_preview = []
+    UM_DIA = timedelta(days=1)
+    
+    # NOVO v6.1: Dicionário para armazenar totais semanais por funcionário
+    # Será usado pelo gerar_excel() para códigos contábeis 150/200
+    totais_semanais = {}
+    
+    for funcionario, batidas_por_dia in batidas_indexadas.items():
+        min_date = min(batidas_por_dia)
+        max_date = max(batidas_por_dia)
+        
+        dias_preview = []
+        horas_trabalhadas_semana = {}  # Rastreador semanal para warning 44h
+        
+        # NOVO v6.0: Estrutura para apuração semanal de extras
+        dados_semana = {}  # {num_semana: {'horas_uteis': td, 'horas_dom_fer': td, 'total': td}}
+        
+        # NOVO v8.2: Acumuladores dos totais (antes: DataFrame refeito por funcionário)
+        soma_normais = 0
+        soma_a_dever = 0
+        soma_extras_comuns = 0
+        soma_extras_100 = 0
+        soma_noturno = 0
+        
+        data_atual_obj = min_date - UM_DIA
+        while data_atual_obj < max_date:
+            data_atual_obj += UM_DIA
+            dia_semana_num = data_atual_obj.weekday()
+            num_semana = data_atual_obj.isocalendar()[1]
+            
+            # Chave para override
+            override_key = f"{funcionario}|{data_atual_obj.isoformat()}"
+            status_forcado = status_overrides.get(override_key)
+            
+            batidas_turno = batidas_por_dia.get(data_atual_obj)
+            
+            # Variáveis de cálculo (segundos inteiros - NOVO v8.3)
+            normais = 0
+            a_dever = 0
+            extras_comuns = 0
+            extras_100 = 0
+            total_trabalhado = 0
+            adicional_noturno = 0  # NOVO: Tracking de hora noturna
+            noturno_base_minutos = 0  # NOVO v3.5: Minutos reais noturno para resumo
+            descanso = 0  # NOVO v8.5: Parte do relógio em domingo/feriado (inclui virada de dia)
+            
+            # Batidas Separadas
+            entrada_1 = None
+            saida_1 = None
+            entrada_2 = None
+            saida_2 = None
+            
+            batidas_lista = []
+            batidas_str = ""
+            alerta = False
+            status = "Normal"
+            ocorrencias = ""
+            
+            # 1. Processamento Matemático das Batidas
+            if batidas_turno:
+                (batidas_str, entrada_1, saida_1, entrada_2, saida_2, ocorrencias, alerta,
+                 total_trabalhado, adicional_noturno, noturno_base_minutos, descanso) = apurar_batidas_dia(
+                    funcionario, data_atual_obj, batidas_turno, noturno_ativo,
+                    intervalo_auto, intervalo_minutos, warnings_sistema,
+                    tabela_minutos, domingo_util
+                )
+                # Relógio que cai em dia comum (o de domingo/feriado é sempre 100%)
+                trabalhado_comum = total_trabalhado - descanso
+                batidas_lista = batidas_turno
+                
+                # INICIALIZAÇÃO CRÍTICA v4.0: meta_dia deve estar disponível em TODOS os caminhos
+                meta_dia = calendario.meta(data_atual_obj)
+                
+                # Classificação Automática
+                eh_feriado = data_atual_obj in feriados_set
+                eh_domingo = dia_semana_num == 6
+                eh_sabado = dia_semana_num == 5
+                
+                # CRÍTICO v4.7: Ajusta meta_dia para ZERO em dias não úteis
+                # Isso evita que a fórmula Excel calcule faltas em domingos/feriados
+                if eh_feriado or (eh_domingo and not domingo_util):
+                    print(f"   🎄 FERIADO DETECTADO: {data_atual_obj} | extras_100={timedelta(seconds=total_trabalhado)}")
+                    meta_dia = 0  # ZERO meta em feriados/domingos não úteis
+                    extras_100 = descanso
+                    # NOVO v8.5: O que passa da meia-noite para um dia comum é extra comum
+                    extras_comuns = trabalhado_comum
+                    normais = 0  # BUGFIX v6.3: Zera explicitamente normais
+                    status = "Extra 100%" if total_trabalhado > 0 else "Feriado"
+                elif eh_sabado:
+                    # HOTFIX v6.0: Sábado USA a meta da escala (7h20 para 6x1), NÃO 4h fixo
+                    # meta_dia já foi calculada corretamente por calcular_meta_dinamica_escala
+                    # Apenas zera se sabado_util=False E escala 5x2
+                    if not sabado_util and escala_tipo == 'clt_5x2_padrao':
+                        meta_dia = 0
+                        extras_100 = total_trabalhado
+                        extras_comuns = 0  # BUGFIX v6.3: Zera explicitamente
+                        normais = 0  # BUGFIX v6.3: Zera explicitamente
+                        status = "Extra 100%" if total_trabalhado > 0 else "Folga"
+                    else:
+                        # Sábado útil: usa meta_dia da escala (ex: 440min para 6x1)
+                        extras_100 = descanso
+                        normais = min(trabalhado_comum, meta_dia)
+                        if trabalhado_comum > meta_dia:
+                            extras_comuns = trabalhado_comum - meta_dia
+                            status = "Extra"
+                        else:
+                            a_dever = meta_dia - trabalhado_comum
+                            status = "Incompleto" if a_dever > 0 else "Normal"
+                else:
+                    # Ajusta meta dinamicamente baseada no tipo de escala (já inicializado acima)
+                    # meta_dia já foi calculada na inicialização crítica v4.0
+                    
+                    # NOVO v8.5: Turno que entra num domingo/feriado -> essa parte é 100%
+                    extras_100 = descanso
+                    normais = min(trabalhado_comum, meta_dia)
+                    if trabalhado_comum > meta_dia:
+                        extras_comuns = trabalhado_comum - meta_dia
+                        status = "Extra"
+                    else:
+                        a_dever = meta_dia - trabalhado_comum
+                        status = "Incompleto" if a_dever > TOLERANCIA else "Normal"
+                        alerta = a_dever > TOLERANCIA
+                    
+                    # INTEGRAÇÃO v4.1: Aplica tolerância Art. 58 §1º (VTD)
+                    vtd_minutos = (trabalhado_comum - meta_dia) / 60.0
+                    minutos_abonados, minutos_descontados, obs_vtd = aplicar_tolerancia_clt(vtd_minutos)
+                    
+                    if minutos_descontados > 0:
+                        # VTD positivo e > 10min: desconta integral
+                        status = "Incompleto"
+                        alerta = True
+                    elif minutos_abonados > 0:
+                        # VTD negativo e < -10min: abona integral
+                        status = "Extra"
+                        alerta = False
+                    elif abs(vtd_minutos) <= 10:
+                        # VTD dentro da tolerância: normal
+                        status = "Normal" if status != "Incompleto" else "Incompleto"
+                        alerta = False
+
+            else:
+                # Sem batidas - INICIALIZA meta_dia para garantir que está definida
+                meta_dia = calendario.meta(data_atual_obj)
+                
+                if data_atual_obj in feriados_set or dia_semana_num == 6:
+                    status = "Folga"
+                    meta_dia = 0  # Zera meta em feriados/domingos
+                    ocorrencias = "DSR/FERIADO"
+                elif dia_semana_num == 5 and not sabado_util:
+                    status = "Folga"
+                    meta_dia = 0
+                    ocorrencias = "DSR"
+                elif meta_dia == 0 and escala_eh_ciclica(escala_tipo):
+                    # NOVO v8.6: Dia de folga do ciclo (12x36, 5x1, 24x48) não é falta
+                    status = "Folga"
+                    ocorrencias = "FOLGA ESCALA"
+                else:
+                    status = "Falta"
+                    a_dever = JORNADA_SABADO if (dia_semana_num == 5) else JORNADA_PADRAO
+                    alerta = True
+                    batidas_str = "Falta"
+                    ocorrencias = "FALTA NÃO JUSTIFICADA"
+
+            # 2. APLICAÇÃO DE STATUS MANUAL
+            if status_forcado:
+                status = status_forcado
+                
+                if status == 'ABONO':
+                    print(f" ��️ Aplicando ABONO em {data_atual_obj}: Zerando dívida de {timedelta(seconds=a_dever)}")
+                    a_dever = 0
+                    alerta = False
+                    ocorrencias = "ABONADO"
+                    
+                elif status == 'ATESTADO':
+                    a_dever = 0
+                    alerta = False
+                    ocorrencias = "ATESTADO MÉDICO"
+                    if not batidas_lista:
+                        batidas_str = "Atestado"
+                
+                elif status in ['FOLGA', 'FERIADO', 'DSR']:
+                    a_dever = 0
+                    alerta = False
+                    ocorrencias = status.upper()
+                    if not batidas_lista:
+                        batidas_str = status.title()
+                
+                elif status == 'FALTA':
+                    if not batidas_lista:
+                        a_dever = JORNADA_SABADO if (dia_semana_num == 5) else JORNADA_PADRAO
+                    alerta = True
+                    ocorrencias = "FALTA"
+
+            # Calcula saldo final do dia
+            saldo_dia = extras_comuns + extras_100 - a_dever
+            
+            # Rastreador semanal
+            if num_semana not in horas_trabalhadas_semana:
+                horas_trabalhadas_semana[num_semana] = 0
+            horas_trabalhadas_semana[num_semana] += total_trabalhado
+            
+            # NOVO v6.0: Coletar dados para apuração semanal de extras
+            if num_semana not in dados_semana:
+                dados_semana[num_semana] = {
+                    'horas_uteis': 0,
+                    'horas_dom_fer': 0,
+                    'total': 0,
+                    'extras_50_acumulado': 0  # NOVO v6.1: Para modo diário
+                }
+            
+            # Classificar horas: domingo/feriado vs dias úteis
+            # NOVO v8.5: Por minuto (tabela), não pela data de início do turno
+            dados_semana[num_semana]['horas_dom_fer'] += descanso
+            dados_semana[num_semana]['horas_uteis'] += total_trabalhado - descanso
+            # NOVO v6.1: Acumula extras diárias (para modo 'diaria')
+            # Só acumula excedentes positivos, nunca faltas
+            if extras_comuns > 0:
+                dados_semana[num_semana]['extras_50_acumulado'] += extras_comuns
+            dados_semana[num_semana]['total'] += total_trabalhado
+            
+            soma_normais += normais
+            soma_a_dever += a_dever
+            soma_extras_comuns += extras_comuns
+            soma_extras_100 += extras_100
+            soma_noturno += adicional_noturno
+            
+            # Monta registro para Excel (NOVO v8.3: registro compacto em segundos)
+            relatorio_diario.append(DiaApurado(
+                data_atual_obj,
+                funcionario,
+                DIAS_SEMANA.get(dia_semana_num, ''),
+                entrada_1,
+                saida_1,
+                entrada_2,
+                saida_2,
+                meta_dia,  # NOVO v4.0: Coluna Meta para cada dia
+                total_trabalhado,
+                adicional_noturno,  # NOVO
+                normais,
+                a_dever,
+                extras_comuns,
+                extras_100,
+                ocorrencias
+            ))
+            
+            # Preview (mantém string para o frontend)
+            # ATUALIZADO v4.0: Adicionado tipo_dia, meta_minutos, banco_horas_informativo
+            tipo_dia_str = "normal"
+            if data_atual_obj in feriados_set:
+                tipo_dia_str = "feriado"
+            elif dia_semana_num == 6:  # Domingo
+                tipo_dia_str = "descanso"
+            elif dia_semana_num == 5:  # Sábado
+                tipo_dia_str = "sabado"
+            
+            dias_preview.append({
+                "data": f"{data_atual_obj.day:02d}/{data_atual_obj.month:02d}",
+                "dia_semana": DIAS_SEMANA.get(dia_semana_num, '')[:3],
+                "batidas": batidas_str,
+                "total": format_segundos(total_trabalhado),
+                "noturno_base": noturno_base_minutos,
+                "batidas_4cols": {
+                    "entrada_1": f"{entrada_1.hour:02d}:{entrada_1.minute:02d}" if entrada_1 else None,
+                    "saida_1": f"{saida_1.hour:02d}:{saida_1.minute:02d}" if saida_1 else None,
+                    "entrada_2": f"{entrada_2.hour:02d}:{entrada_2.minute:02d}" if entrada_2 else None,
+                    "saida_2": f"{saida_2.hour:02d}:{saida_2.minute:02d}" if saida_2 else None
+                },
+                "saldo": format_segundos(saldo_dia),
+                "status": status,
+                "alerta": alerta,
+                # NOVOS CAMPOS v4.0
+                "tipo_dia": tipo_dia_str,
+                "meta_minutos": int(meta_dia / 60),
+                "banco_horas_informativo": True  # Flag de segurança
+            })
+        
+        # Validação: Semanas com > 44h trabalhadas
+        for num_semana, horas in horas_trabalhadas_semana.items():
+            if horas > 44 * 3600:
+                warning_msg = f"⚠️ {funcionario} (semana {num_semana}): {format_segundos(horas)} > 44h - Risco trabalhista"
+                warnings_sistema.append(warning_msg)
+        
+        # Totais - NOVO v6.0: Apuração Semanal de Extras
+        # Lê configuração de regra de cálculo (NOVO v6.1: extra_tipo)
+        # Compatibilidade: suporta tanto 'extra_tipo' (novo) quanto 'regra_extra' (legado)
+        extra_tipo = settings.get('extra_tipo', settings.get('regra_extra', 'semanal'))
+        jornada_semanal_minutos = settings.get('jornada_semanal_minutos', 2640)  # 44h default
+        
+        if dados_semana:
+            # v6.1: Apuração configurável (diária ou semanal)
+            debug_mode = settings.get('debug_calculo', True)  # Default True para rollout
+            
+            modo_label = "DIÁRIA" if extra_tipo == 'diaria' else "SEMANAL"
+            if debug_mode:
+                print(f"\n📊 APURAÇÃO {modo_label} - {funcionario}")
+            
+            extras_50_total, extras_100_total = calcular_extras_semanal(
+                dados_semana, 
+                jornada_semanal_minutos,
+                extra_tipo=extra_tipo,  # NOVO v6.1
+                debug=debug_mode
+            )
+            
+            totals = {
+                "Normais": soma_normais,
+                "A Dever": soma_a_dever,
+                "Extras Comum": extras_50_total,
+                "Extras 100%": extras_100_total,
+                "Noturno": soma_noturno,
+            }
+            
+            # NOVO v6.1: Armazena totais semanais para uso no Excel
+            # IMPORTANTE: Estes valores já vêm da apuração semanal CLT (44h),
+            # a mesma usada no preview JSON. NÃO recalcular no Excel.
+            totais_semanais[funcionario] = {
+                "extra50": timedelta(seconds=extras_50_total),
+                "extra100": timedelta(seconds=extras_100_total)
+            }
+            
+            # Log de resultado (controlado por debug_mode)
+            if debug_mode:
+                e50_h = extras_50_total / 3600
+                e100_h = extras_100_total / 3600
+                print(f"  ✅ RESULTADO: Extra 50% = {e50_h:.2f}h | Extra 100% = {e100_h:.2f}h | Total Extras = {e50_h + e100_h:.2f}h")
+        else:
+            # Modo diário (legado)
+            totals = {
+                "Normais": soma_normais,
+                "A Dever": soma_a_dever,
+                "Extras Comum": soma_extras_comuns,
+                "Extras 100%": soma_extras_100,
+                "Noturno": soma_noturno,
+            }
+        
+        saldo_final = totals["Extras Comum"] + totals["Extras 100%"] - totals["A Dever"]
+        
+        resumo_preview.append({
+            "funcionario": funcionario,
+            "normais": format_segundos(totals["Normais"]).replace("+", ""),
+            "dever": format_segundos(totals["A Dever"]).replace("+", ""),
+            "extras_comuns": format_segundos(totals["Extras Comum"]).replace("+", ""),
+            "extras_100": format_segundos(totals["Extras 100%"]).replace("+", ""),
+            "saldo": format_segundos(saldo_final),
+            "dias": dias_preview,
+            # CAMPOS v6.1 - Apuração Configurável
+            "aviso_saldo": f"Extras calculados com apuração {'DIÁRIA (sem compensação)' if extra_tipo == 'diaria' else 'SEMANAL (44h CLT)'}.",
+            "saldo_eh_informativo": True,
+            "versao_calculo": "v6.1-configuravel",
+            "extra_tipo": extra_tipo,
+            "escala_tipo": escala_tipo  # NOVO v8.7: escala pode variar por funcionário
+        })
+        
+    return relatorio_diario, resumo_preview, totais_semanais
+
+
+# ===== NOVO v8.7: ESCALA POR FUNCIONÁRIO (EQUIPES MISTAS NUM ÚNICO PROCESSAMENTO) =====
+# settings['escalas_funcionarios'] = {"NOME": "grupo" | {campos}}
+# settings['grupos_escala'] = {"grupo": {campos}}
+# Campos não informados herdam os settings gerais do upload.
+
+CAMPOS_ESCALA_FUNCIONARIO = (
+    'escala_tipo', 'data_inicio_escala', 'jornada_minutos', 'jornada_semanal_minutos',
+    'sabado_util', 'domingo_util', 'tolerancia', 'intervalo_auto', 'intervalo_minutos',
+    'noturno_ativo', 'extra_tipo', 'municipio', 'feriados', 'feriados_nacionais',
+    'turno_max_horas', 'descanso_min_horas'
+)
+
+
+def _chave_nome_funcionario(nome: str) -> str:
+    return ' '.join(_normalizar_rotulo(str(nome)).split())
+
+
+def resolver_escalas_funcionarios(funcionarios: list, settings: dict) -> List[tuple]:
+    """
+    NOVO v8.7: Agrupa os funcionários pela configuração de escala efetiva.
+    
+    O nome no mapeamento é comparado sem acentos/maiúsculas/espaços extras.
+    
+    Returns:
+        [(settings_efetivos, [funcionarios])] na ordem da primeira aparição.
+        Sem mapeamento: um único grupo com os settings originais.
+    """
+    mapeamento = settings.get('escalas_funcionarios') or {}
+    grupos_escala = settings.get('grupos_escala') or {}
+    if not mapeamento:
+        return [(settings, list(funcionarios))]
+    
+    por_nome = {_chave_nome_funcionario(nome): valor for nome, valor in mapeamento.items()}
+    grupos = {}
+    for funcionario in funcionarios:
+        valor = por_nome.get(_chave_nome_funcionario(funcionario))
+        if isinstance(valor, str):
+            if valor not in grupos_escala:
+                print(f"⚠️ Grupo de escala '{valor}' não definido ({funcionario}): usando configuração geral")
+            valor = grupos_escala.get(valor)
+        sobrescritas = {k: v for k, v in (valor or {}).items() if k in CAMPOS_ESCALA_FUNCIONARIO}
+        chave = json.dumps(sobrescritas, sort_keys=True, default=str)
+        if chave not in grupos:
+            grupos[chave] = ({**settings, **sobrescritas}, [])
+        grupos[chave][1].append(funcionario)
+    return list(grupos.values())
+
+
+# ===== NOVO v8.9: CÁLCULO PARALELO POR FUNCIONÁRIO =====
+# Depois de agrupadas as batidas, o mês de cada funcionário é independente (dias, semanas,
+# calcular_extras_semanal, preview). Uploads grandes são divididos em partes equilibradas
+# (por funcionário-dias) e apurados em processos separados; o merge segue a ordem original.
+# settings['calculo_paralelo'] = false desliga por requisição; o nº de processos vem só do .env.
+
+CALCULO_PARALELO_PROCESSOS = int(os.getenv("CALCULO_PARALELO_PROCESSOS", "0"))  # 0 = desligado (por processo de cálculo)
+CALCULO_PARALELO_MIN_FUNCIONARIOS = int(os.getenv("CALCULO_PARALELO_MIN_FUNCIONARIOS", "200"))
+
+_paralelo_pool: Optional[ProcessPoolExecutor] = None
+_paralelo_pool_processos = 0
+
+
+def _processos_calculo_paralelo(settings: dict, n_funcionarios: int) -> int:
+    """Nº de processos para o cálculo (<= 1: apuração sequencial no processo atual)."""
+    # O cliente só liga/desliga; a quantidade é do servidor, limitada aos núcleos da máquina
+    if not settings.get('calculo_paralelo', True):
+        return 0
+    if n_funcionarios < max(2, CALCULO_PARALELO_MIN_FUNCIONARIOS):
+        return 0
+    # Workers de job são daemonic e não podem abrir processos filhos: apuram no próprio processo
+    if multiprocessing.current_process().daemon:
+        return 0
+    processos = min(os.cpu_count() or 1, CALCULO_PARALELO_PROCESSOS)
+    return min(processos, n_funcionarios)
+
+
+def dividir_funcionarios_equilibrado(batidas_indexadas: dict, funcionarios: list, n_partes: int) -> List[list]:
+    """
+    Divide os funcionários em até n_partes com carga parecida (maior primeiro, parte mais leve).
+    
+    Carga = dias do período do funcionário + batidas. Determinístico: empates pela ordem
+    original, e cada parte mantém os funcionários na ordem de entrada.
+    """
+    cargas = []
+    for posicao, funcionario in enumerate(funcionarios):
+        dias = batidas_indexadas[funcionario]
+        carga = (max(dias) - min(dias)).days + 1 + sum(len(horas) for horas in dias.values())
+        cargas.append((-carga, posicao))
+    cargas.sort()
+    
+    partes = [(0, i, []) for i in range(max(1, min(n_partes, len(funcionarios))))]
+    for carga_negativa, posicao in cargas:
+        carga_parte, i, posicoes = heapq.heappop(partes)
+        posicoes.append(posicao)
+        heapq.heappush(partes, (carga_parte - carga_negativa, i, posicoes))
+    
+    return [[funcionarios[p] for p in sorted(posicoes)] for _, _, posicoes in sorted(partes, key=lambda x: x[1]) if posicoes]
+
+
+CAMPOS_HORARIO_DIA = ('entrada_1', 'saida_1', 'entrada_2', 'saida_2')
+CAMPOS_SEGUNDOS_DIA = ('meta_s', 'total_s', 'noturno_s', 'normais_s', 'a_dever_s', 'extras_comuns_s', 'extras_100_s')
+
+
+def compactar_relatorio(relatorio_diario: List[DiaApurado]) -> tuple:
+    """
+    [DiaApurado, ...] -> colunas (textos internados + arrays de inteiros).
+    
+    O pickle de milhares de DiaApurado (date/time/str por linha) custava quase o mesmo
+    que a própria apuração; em colunas o retorno da parte é uma fração disso.
+    """
+    textos, indice_textos = [], {}
+    
+    def internar(texto):
+        indice = indice_textos.get(texto)
+        if indice is None:
+            indice = indice_textos[texto] = len(textos)
+            textos.append(texto)
+        return indice
+    
+    rotulos = array('i')  # funcionario, dia_semana, ocorrencias
+    dias = array('i')
+    horarios = array('i')  # segundos do dia; -1 = sem batida
+    segundos = array('q')
+    for dia in relatorio_diario:
+        rotulos.append(internar(dia.funcionario))
+        rotulos.append(internar(dia.dia_semana))
+        rotulos.append(internar(dia.ocorrencias))
+        dias.append(dia.data.toordinal())
+        for campo in CAMPOS_HORARIO_DIA:
+            hora = getattr(dia, campo)
+            horarios.append(-1 if hora is None else hora.hour * 3600 + hora.minute * 60 + hora.second)
+        for campo in CAMPOS_SEGUNDOS_DIA:
+            segundos.append(getattr(dia, campo))
+    return textos, rotulos, dias, horarios, segundos
+
+
+def expandir_relatorio(pacote: tuple) -> List[DiaApurado]:
+    """Inverso de compactar_relatorio (reaproveita os objetos date/time repetidos)."""
+    textos, rotulos, dias, horarios, segundos = pacote
+    datas = {dia: date.fromordinal(dia) for dia in set(dias)}
+    horas = {segundo: dt_time(segundo // 3600, segundo % 3600 // 60, segundo % 60)
+             for segundo in set(horarios) if segundo >= 0}
+    horas[-1] = None
+    
+    # Mesmo iterador repetido no zip = colunas consecutivas de cada linha
+    it_rotulos = map(textos.__getitem__, rotulos)
+    it_horas = map(horas.__getitem__, horarios)
+    it_segundos = iter(segundos)
+    return [
+        DiaApurado(datas[dia], funcionario, dia_semana, *linha[:11], ocorrencias)
+        for dia, funcionario, dia_semana, ocorrencias, *linha in zip(
+            dias, it_rotulos, it_rotulos, it_rotulos,
+            *([it_horas] * len(CAMPOS_HORARIO_DIA)), *([it_segundos] * len(CAMPOS_SEGUNDOS_DIA))
+        )
+    ]
+
+
+def _calcular_parte_relatorio(batidas_parte: dict, settings: dict, status_overrides: dict, periodo: tuple):
+    return _calcular_relatorio_escala(batidas_parte, settings, status_overrides, periodo)
+
+
+def _calcular_parte_relatorio_compacto(batidas_parte: dict, settings: dict, status_overrides: dict, periodo: tuple):
+    # Executado no processo do pool paralelo. O preview só tem tipos JSON: marshal (mesmo
+    # interpretador nos dois lados) desserializa bem mais rápido que pickle/json.
+    relatorio_parte, resumo_parte, totais_parte = _calcular_parte_relatorio(
+        batidas_parte, settings, status_overrides, periodo
+    )
+    return compactar_relatorio(relatorio_parte), marshal.dumps(resumo_parte), totais_parte
+
+
+def _obter_pool_paralelo(processos: int) -> ProcessPoolExecutor:
+    global _paralelo_pool, _paralelo_pool_processos
+    if _paralelo_pool is None or _paralelo_pool_processos != processos:
+        if _paralelo_pool is not None:
+            _paralelo_pool.shutdown(wait=False)
+        # spawn: mesmo motivo do pool de cálculo (sem herdar threads do processo pai)
+        _paralelo_pool = ProcessPoolExecutor(
+            max_workers=processos,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+        _paralelo_pool_processos = processos
+    return _paralelo_pool
+
+
+def parar_pool_paralelo() -> None:
+    global _paralelo_pool
+    if _paralelo_pool is not None:
+        _paralelo_pool.shutdown(wait=False, cancel_futures=True)
+        _paralelo_pool = None
+
+
+def calcular_relatorio(dados_brutos: RegistrosPonto, settings: dict, status_overrides: dict = None):
+    """
+    REFATORADO v4.0 (PontoSync Critical Fix)
+    
+    ===========================================
+    RESPONSABILIDADES (FONTE ÚNICA DE VERDADE):
+    ===========================================
+    - Calcular tempo trabalhado em minutos/horas
+    - Aplicar tolerância CLT (Art. 58)
+    - Aplicar redução de hora noturna (Art. 73)
+    - Gerar dados para preview e Excel
+    
+    ===========================================
+    NÃO FAZ (deixado para o contador):
+    ===========================================
+    - Calcular valor financeiro de extras
+    - Decidir sobre compensação de banco de horas
+    - Interpretar regras de convenção coletiva
+    - Decidir juridicamente sobre DSR
+    
+    ===========================================
+    TRADE-OFFS ACEITOS (v4.0):
+    ===========================================
+    - Saldo é informativo apenas (banco_horas_informativo=True)
+    - Percentuais de extra são fixos (50%/100%) e ocultados da UI
+    - Frontend não recalcula - apenas renderiza
+    
+    Defaults quando sem configuração:
+    - jornada_minutos: 480 (8h)
+    - tolerancia: 10 minutos
+    - escala_tipo: clt_5x2_padrao
+    """
+    if status_overrides is None:
+        status_overrides = {}
+    
+    # NOVO v8.2: Índice (funcionário, data) -> batidas montado em uma única passada
+    # NOVO v9.0: dados_brutos é um RegistrosPonto (lista de dicts antiga ainda é aceita)
+    # NOVO v6.2: Detecta ano a partir dos DADOS DO ARQUIVO, não do sistema
+    # Isso corrige o bug onde feriados de dezembro/2025 viravam janeiro/2026
+    batidas_indexadas, ano_detectado = indexar_batidas(dados_brutos)
+    if not batidas_indexadas:
+        return None, []
+    
+    print(f"[DATA] Ano detectado dos dados: {ano_detectado}")
+    
+    # NOVO v8.7: Uma passada por configuração de escala; parsing/indexação feitos uma vez só
+    grupos = resolver_escalas_funcionarios(list(batidas_indexadas), settings)
+    processos = _processos_calculo_paralelo(settings, len(batidas_indexadas))
+    if len(grupos) == 1 and processos <= 1:
+        return _calcular_relatorio_escala(batidas_indexadas, grupos[0][0], status_overrides)
+    
+    # Período do upload inteiro: cada grupo/parte apura igual a um processamento único
+    periodo = (
+        min(min(dias) for dias in batidas_indexadas.values()),
+        max(max(dias) for dias in batidas_indexadas.values()),
+    )
+    
+    partes = []
+    for settings_grupo, funcionarios in grupos:
+        print(f"[ESCALA] Grupo {settings_grupo.get('escala_tipo', 'clt_5x2_padrao')}: {len(funcionarios)} funcionário(s)")
+        if processos > 1:
+            # NOVO v8.9: Cada grupo dividido proporcionalmente ao seu tamanho
+            n_partes = max(1, round(processos * len(funcionarios) / len(batidas_indexadas)))
+            for parte in dividir_funcionarios_equilibrado(batidas_indexadas, funcionarios, n_partes):
+                partes.append((settings_grupo, parte))
+        else:
+            partes.append((settings_grupo, funcionarios))
+    
+    def argumentos_parte(settings_parte, funcionarios):
+        batidas_parte = {f: batidas_indexadas[f] for f in funcionarios}
+        overrides_parte = {
+            chave: valor for chave, valor in status_overrides.items()
+            if chave.rsplit('|', 1)[0] in batidas_parte
+        }
+        return batidas_parte, settings_parte, overrides_parte, periodo
+    
+    if processos > 1:
+        print(f"[PARALELO] {len(batidas_indexadas)} funcionário(s) em {len(partes)} parte(s), {processos} processo(s)")
+        try:
+            pool = _obter_pool_paralelo(processos)
+            futuros = [pool.submit(_calcular_parte_relatorio_compacto, *argumentos_parte(*parte)) for parte in partes]
+            resultados = []
+            for futuro in futuros:  # Ordem de submissão, não de término: merge determinístico
+                relatorio_compacto, resumo_bytes, totais_parte = futuro.result()
+                resultados.append((expandir_relatorio(relatorio_compacto), marshal.loads(resumo_bytes), totais_parte))
+        except BrokenProcessPool:
+            print("[ERRO] Pool do cálculo paralelo quebrado; apurando sequencialmente")
+            parar_pool_paralelo()
+            resultados = [_calcular_parte_relatorio(*argumentos_parte(*parte)) for parte in partes]
+    else:
+        resultados = [_calcular_parte_relatorio(*argumentos_parte(*parte)) for parte in partes]
+    
+    dias_por_funcionario = {}
+    preview_por_funcionario = {}
+    totais_semanais = {}
+    for relatorio_parte, resumo_parte, totais_parte in resultados:
+        for dia in relatorio_parte:
+            dias_por_funcionario.setdefault(dia.funcionario, []).append(dia)
+        for resumo in resumo_parte:
+            preview_por_funcionario[resumo["funcionario"]] = resumo
+        totais_semanais.update(totais_parte)
+    
+    # Mesma ordem de funcionários de um processamento com escala única e sequencial
+    relatorio_diario = [dia for f in batidas_indexadas for dia in dias_por_funcionario[f]]
+    resumo_preview = [preview_por_funcionario[f] for f in batidas_indexadas]
+    totais_semanais = {f: totais_semanais[f] for f in batidas_indexadas}
+    return relatorio_diario, resumo_preview, totais_semanais
+
+def _texto_duracao_hash(segundos: int) -> str:
+    # Mesmo texto de str(pd.Timedelta): "0 days 08:00:00" / "-1 days +23:00:00"
+    dias, resto = divmod(segundos, 86400)
+    sinal = "+" if dias < 0 else ""
+    return f"{dias} days {sinal}{resto // 3600:02d}:{resto % 3600 // 60:02d}:{resto % 60:02d}"
+
+
+def _dados_hash_integridade(posicoes_dias: List[tuple]) -> dict:
+    """
+    Conteúdo hasheado no rodapé: {coluna: {posição: valor}}, o mesmo que
+    DataFrame.to_dict() gerava antes da v8.3 (o hash dos espelhos não muda).
+    """
+    dados = {}
+    for coluna, (atributo, duracao) in DiaApurado.COLUNAS.items():
+        valores = {}
+        for posicao, dia in posicoes_dias:
+            valor = getattr(dia, atributo)
+            valores[posicao] = _texto_duracao_hash(valor) if duracao else valor
+        dados[coluna] = valores
+    return dados
+
+
+# ===== FUNÇÃO REFATORADA: GERAR EXCEL PROFISSIONAL =====
+# NOVO v9.2: Escrita em streaming (openpyxl write_only). Cada linha é gravada no XML
+# temporário da planilha assim que montada; a memória não cresce com o nº de funcionários.
+# Em write_only a ordem importa: larguras, congelamento e altura da linha vêm ANTES das linhas.
+
+ESPELHO_CABECALHOS = ['Data', 'Dia', 'Ent. 1', 'Sai. 1', 'Ent. 2', 'Sai. 2',
+                      'Meta', 'Total', 'Noturno', 'Normais', 'Faltas', 'Extra 50%', 'Extra 100%', 'Ocorrências']
+
+ESPELHO_LARGURAS = {
+    'A': 12,  # Data
+    'B': 8,   # Dia
+    'C': 9,   # Ent. 1
+    'D': 9,   # Sai. 1
+    'E': 9,   # Ent. 2
+    'F': 9,   # Sai. 2
+    'G': 10,  # Meta (NOVO)
+    'H': 10,  # Total
+    'I': 10,  # Noturno
+    'J': 10,  # Normais
+    'K': 10,  # Faltas
+    'L': 11,  # Extra 50%
+    'M': 11,  # Extra 100%
+    'N': 25   # Ocorrências
+}
+
+ESPELHO_LINHA_INICIAL = 7  # Primeira linha de dados (1-5 cabeçalho, 6 títulos das colunas)
+
+
+# ===== NOVO v9.3: REGISTRO DE ESTILOS NOMEADOS + MODELO DO ESPELHO =====
+# Os estilos são definidos uma vez por processo e entram no workbook como NamedStyle:
+# cada célula só aponta para o nome, e a tabela de estilos do .xlsx fica com ~30 entradas
+# qualquer que seja o nº de linhas. O NamedStyle guarda índices do workbook ao qual foi
+# vinculado, por isso o registro guarda as definições e cada workbook cria os seus.
+
+@lru_cache(maxsize=1)
+def _registro_estilos_espelho() -> dict:
+    """Definições dos estilos do espelho (nome -> atributos do NamedStyle)."""
+    borda = Border(
+        left=Side(style='thin', color='BDC3C7'),
+        right=Side(style='thin', color='BDC3C7'),
+        top=Side(style='thin', color='BDC3C7'),
+        bottom=Side(style='thin', color='BDC3C7')
+    )
+    borda_grossa = Border(
+        top=Side(style='thick', color='1ABC9C'),
+        bottom=Side(style='thick', color='1ABC9C'),
+        left=Side(style='thick', color='1ABC9C'),
+        right=Side(style='thick', color='1ABC9C')
+    )
+    centro = Alignment(horizontal='center')
+    centro_meio = Alignment(horizontal='center', vertical='center')
+    direita = Alignment(horizontal='right')
+    
+    def solido(cor):
+        return PatternFill(start_color=cor, end_color=cor, fill_type='solid')
+    
+    zebra = solido('F8F9FA')
+    duracao = '[h]:mm:ss'
+    
+    def estilo(font=DEFAULT_FONT, fill=None, border=DEFAULT_BORDER, alignment=None, number_format='General'):
+        return {'font': font, 'fill': fill, 'border': border, 'alignment': alignment, 'number_format': number_format}
+    
+    registro = {
+        # Cabeçalho
+        'espelho_empresa': estilo(Font(name='Arial', size=14, bold=True, color='FFFFFF'), solido('2C3E50'), alignment=centro_meio),
+        'espelho_cnpj': estilo(Font(name='Arial', size=10, color='FFFFFF'), solido('34495E'), alignment=centro_meio),
+        'espelho_titulo': estilo(Font(name='Arial', size=12, bold=True), alignment=centro_meio),
+        'espelho_periodo': estilo(Font(name='Arial', size=10, italic=True), alignment=centro_meio),
+        'espelho_cabecalho': estilo(Font(name='Arial', size=10, bold=True, color='FFFFFF'), solido('1ABC9C'), borda, centro_meio),
+        
+        # Rodapé (totais, saldo, códigos contábeis, aviso, hash, assinaturas)
+        'espelho_total_rotulo': estilo(Font(bold=True, size=11), alignment=direita),
+        'espelho_total': estilo(Font(bold=True, size=11), solido('E8F8F5'), borda, centro, duracao),
+        'espelho_saldo_rotulo': estilo(Font(bold=True, size=11, color='1ABC9C'), alignment=direita),
+        'espelho_saldo': estilo(Font(bold=True, size=13, color='1ABC9C'), border=borda_grossa, alignment=centro, number_format=duracao),
+        'espelho_codigos_titulo': estilo(Font(bold=True, size=11, color='FFFFFF'), solido('34495E'), alignment=centro_meio),
+        'espelho_codigos_cabecalho': estilo(Font(bold=True, size=10), solido('BDC3C7'), borda, centro),
+        'espelho_codigo': estilo(Font(bold=True, color='2C3E50'), border=borda, alignment=centro),
+        'espelho_codigo_descricao': estilo(border=borda),
+        'espelho_codigo_horas': estilo(border=borda, alignment=centro, number_format=duracao),
+        'espelho_codigo_decimal': estilo(Font(bold=True, color='27AE60'), border=borda, alignment=centro, number_format='0.00'),
+        'espelho_noturno_titulo': estilo(Font(bold=True, size=9, italic=True, color='7F8C8D'), solido('ECF0F1'), borda, centro_meio),
+        'espelho_codigo_noturno': estilo(Font(bold=True, color='7F8C8D'), border=borda, alignment=centro),
+        'espelho_noturno_decimal': estilo(Font(bold=True, color='D68910'), border=borda, alignment=centro, number_format='0.00'),
+        'espelho_aviso': estilo(Font(size=8, italic=True, color='7F8C8D'), alignment=Alignment(wrap_text=True, horizontal='left')),
+        'espelho_hash': estilo(Font(size=7, color='95A5A6', name='Courier New'), alignment=centro),
+        'espelho_assinatura': estilo(Font(size=9, bold=True), alignment=centro),
+    }
+    
+    # Linhas de dados: cada estilo tem a variante zebrada (o zebrado prevalece sobre os destaques)
+    dados = {
+        'espelho_texto': estilo(border=borda, alignment=centro),
+        'espelho_fim_semana': estilo(fill=solido('ECF0F1'), border=borda, alignment=centro),
+        'espelho_hora': estilo(border=borda, alignment=centro, number_format='HH:MM'),
+        'espelho_duracao': estilo(border=borda, alignment=centro, number_format=duracao),
+        'espelho_noturno': estilo(Font(bold=True, color='D68910'), solido('FEF5E7'), borda, centro, duracao),
+        'espelho_faltas': estilo(Font(color='C0392B', bold=True), border=borda, alignment=centro, number_format=duracao),
+        'espelho_ocorrencia': estilo(Font(size=8), border=borda, alignment=Alignment(horizontal='left', wrap_text=True)),
+    }
+    for nome, atributos in dados.items():
+        registro[nome] = atributos
+        registro[f'{nome}_zebra'] = dict(atributos, fill=zebra)
+    return registro
+
+
+def _vincular_estilos_espelho(wb: Workbook):
+    """Registra no workbook os NamedStyle do espelho (cópias próprias, ver acima)."""
+    for nome, atributos in _registro_estilos_espelho().items():
+        wb.add_named_style(NamedStyle(name=nome, **atributos))
+
+
+@lru_cache(maxsize=32)
+def _modelo_espelho(empresa_nome: str, empresa_cnpj: str) -> dict:
+    """
+    Partes fixas do espelho de uma empresa, montadas uma vez por processo.
+    
+    Cada linha: (posição, {coluna: (valor, estilo)}, altura, mesclas [(coluna_ini, coluna_fim)])
+    - 'cabecalho': posição = número da linha
+    - 'rodape': posição relativa à linha de TOTAIS
+    Valores None são preenchidos por funcionário (período, fórmulas, códigos, hash).
+    """
+    cabecalho = (
+        (1, {1: (empresa_nome.upper(), 'espelho_empresa')}, 25, (('A', 'M'),)),
+        (2, {1: (f"CNPJ: {empresa_cnpj}", 'espelho_cnpj')}, 20, (('A', 'M'),)),
+        (3, {1: ("ESPELHO DE PONTO - REGISTRO DE HORÁRIOS", 'espelho_titulo')}, 22, (('A', 'M'),)),
+        (4, {1: (None, 'espelho_periodo')}, 18, (('A', 'M'),)),
+        (5, {}, 10, ()),
+        (6, {col_idx: (header, 'espelho_cabecalho') for col_idx, header in enumerate(ESPELHO_CABECALHOS, start=1)}, 20, ()),
+    )
+    
+    rodape = (
+        # TOTAIS: fórmulas SUM de G (Meta) a M (Extra 100%)
+        (0, {1: ("TOTAIS:", 'espelho_total_rotulo'), **{col_idx: (None, 'espelho_total') for col_idx in range(7, 14)}}, None, ()),
+        # Saldo Final (Extra Comum + Extra 100% - Faltas)
+        (1, {1: ("SALDO HORAS EXCEDENTES (Informativo 1:1):", 'espelho_saldo_rotulo'), 12: (None, 'espelho_saldo')},
+         None, (('A', 'B'), ('L', 'M'))),
+        # Códigos contábeis (padrão fechamento de folha)
+        (3, {1: ("RESUMO PARA FECHAMENTO DE FOLHA (CÓDIGOS CONTÁBEIS)", 'espelho_codigos_titulo')}, 22, (('A', 'N'),)),
+        (4, {col_idx: (header, 'espelho_codigos_cabecalho')
+             for col_idx, header in enumerate(['Código', 'Descrição', 'Horas (HH:MM)', 'Horas Decimais'], start=1)}, None, ()),
+        (5, {1: ("150", 'espelho_codigo'), 2: ("Horas Extras 50% (Dias Úteis)", 'espelho_codigo_descricao'),
+             3: (None, 'espelho_codigo_horas'), 4: (None, 'espelho_codigo_decimal')}, None, ()),
+        (6, {1: ("200", 'espelho_codigo'), 2: ("Horas Extras 100% (Domingos/Feriados)", 'espelho_codigo_descricao'),
+             3: (None, 'espelho_codigo_horas'), 4: (None, 'espelho_codigo_decimal')}, None, ()),
+        # Código 25 - Adicional Noturno — SEÇÃO SEPARADA (INFORMATIVO)
+        # CORREÇÃO v6.0: Noturno é ATRIBUTO, não TEMPO somável.
+        (8, {1: ("INFORMATIVO — ADICIONAL NOTURNO (não soma em horas)", 'espelho_noturno_titulo')}, 18, (('A', 'D'),)),
+        (9, {1: ("25", 'espelho_codigo_noturno'), 2: ("Base Noturna (atributo financeiro)", 'espelho_codigo_descricao'),
+             3: (None, 'espelho_codigo_horas'), 4: (None, 'espelho_noturno_decimal')}, None, ()),
+        # Aviso legal (simplificado)
+        (11, {1: ("Códigos 150 e 200 = horas para pagamento. "
+                  "Código 25 = base para adicional noturno (não soma em horas trabalhadas). "
+                  "Saldo 1:1 é informativo.", 'espelho_aviso')}, 20, (('A', 'N'),)),
+        # Hash de integridade
+        (13, {1: (None, 'espelho_hash')}, None, (('A', 'N'),)),
+        # Assinaturas
+        (16, {1: ("_" * 40, None), 8: ("_" * 40, None)}, None, (('A', 'E'), ('H', 'L'))),
+        (17, {1: ("ASSINATURA DO FUNCIONÁRIO", 'espelho_assinatura'), 8: ("ASSINATURA DO GESTOR", 'espelho_assinatura')}, None, ()),
+    )
+    
+    return {'cabecalho': cabecalho, 'rodape': rodape}
+
+
+# Estilos das colunas de dados A..N (sem/com zebrado). B e I mudam conforme o dia.
+ESTILOS_LINHA_ESPELHO = {
+    zebrada: tuple(f'{nome}_zebra' if zebrada else nome for nome in (
+        'espelho_texto', 'espelho_texto',                                   # A: Data, B: Dia
+        'espelho_hora', 'espelho_hora', 'espelho_hora', 'espelho_hora',     # C-F: Batidas
+        'espelho_duracao', 'espelho_duracao', 'espelho_duracao',            # G: Meta, H: Total, I: Noturno
+        'espelho_duracao', 'espelho_faltas', 'espelho_duracao', 'espelho_duracao',  # J: Normais, K: Faltas, L/M: Extras
+        'espelho_ocorrencia'                                                # N: Ocorrências
+    ))
+    for zebrada in (False, True)
+}
+
+
+# NOVO v9.6: Nomes de planilha/arquivo por funcionário. O Excel limita a planilha a 31
+# caracteres (sem \ / ? * [ ] :) e não diferencia maiúsculas; com funcionario[:31], nomes
+# com o mesmo prefixo colidiam (o openpyxl anexava um dígito: 32 caracteres, arquivo inválido)
+# e um "/" no nome derrubava a geração inteira.
+_CARACTERES_INVALIDOS_PLANILHA = re.compile(r"[\\/?*\[\]:]")
+_CARACTERES_INVALIDOS_ARQUIVO = re.compile(r'[\\/:*?"<>|\x00-\x1f]')
+
+
+def nome_unico(base: str, usados: set, limite: int) -> str:
+    """Corta base em limite caracteres; repetido (sem diferenciar maiúsculas) ganha ' (2)', ' (3)'..."""
+    nome = base[:limite]
+    numero = 1
+    while nome.lower() in usados:
+        numero += 1
+        sufixo = f" ({numero})"
+        nome = base[:limite - len(sufixo)].rstrip() + sufixo
+    usados.add(nome.lower())
+    return nome
+
+
+def nome_planilha_espelho(funcionario: str, usados: set) -> str:
+    base = _CARACTERES_INVALIDOS_PLANILHA.sub("_", funcionario).strip("' ") or "Funcionario"
+    return nome_unico(base, usados, 31)
+
+
+def nome_arquivo_espelho(funcionario: str, usados: set) -> str:
+    base = _CARACTERES_INVALIDOS_ARQUIVO.sub("_", funcionario).strip(". ") or "Funcionario"
+    return nome_unico(base, usados, 100) + ".xlsx"
+
+
+def _celula(ws, valor, estilo: str) -> WriteOnlyCell:
+    cell = WriteOnlyCell(ws, value=valor)
+    cell.style = estilo
+    return cell
+
+
+class _EscritorPlanilha:
+    """Grava as linhas de uma planilha write_only em ordem, completando as linhas vazias."""
+    
+    def __init__(self, ws):
+        self.ws = ws
+        self.proxima = 1
+    
+    def linha(self, numero: int, celulas: dict, altura: Optional[float] = None, mesclas: tuple = ()):
+        """celulas: {coluna (1..14): valor ou WriteOnlyCell}; mesclas: [(coluna_ini, coluna_fim)]"""
+        while self.proxima < numero:
+            self.ws.append([])
+            self.proxima += 1
+        if altura is not None:
+            self.ws.row_dimensions[numero].height = altura
+        for coluna_ini, coluna_fim in mesclas:
+            self.ws.merged_cells.add(f'{coluna_ini}{numero}:{coluna_fim}{numero}')
+        self.ws.append([celulas.get(coluna) for coluna in range(1, max(celulas, default=0) + 1)])
+        self.proxima += 1
+    
+    def linha_modelo(self, numero: int, linha_modelo: tuple, valores: dict = None):
+        """Grava uma linha do modelo; valores: {coluna: valor} do funcionário"""
+        _, celulas_modelo, altura, mesclas = linha_modelo
+        celulas = {}
+        for coluna, (valor, estilo) in celulas_modelo.items():
+            if valores and coluna in valores:
+                valor = valores[coluna]
+            celulas[coluna] = _celula(self.ws, valor, estilo) if estilo else valor
+        self.linha(numero, celulas, altura, mesclas)
+
+
+def gerar_excel(relatorio_diario: List[DiaApurado], settings: dict = None, totais_semanais: dict = None,
+                destino=None) -> io.BytesIO:
+    """
+    Gera arquivo Excel profissional estilo "Espelho de Ponto" do Departamento Pessoal.
+    
+    MUDANÇAS CRÍTICAS:
+    - Batidas separadas em 4 colunas (Ent.1, Sai.1, Ent.2, Sai.2)
+    - Valores numéricos reais (float) com formatação [h]:mm:ss
+    - Fórmulas SUM no rodapé
+    - Design profissional (cabeçalho, bordas, zebrado)
+    - Hash SHA-256 de integridade
+    
+    NOVO v6.1: Códigos contábeis 150/200 usam totais semanais do backend
+    (mesma apuração CLT 44h do preview JSON)
+    
+    NOVO v8.3: Lê os DiaApurado (segundos inteiros) direto, sem DataFrame
+    
+    NOVO v9.2: Workbook write_only (streaming).
+    destino: arquivo/caminho onde gravar (padrão: BytesIO retornado).
+    Larguras, impressão e assinatura do gestor agora valem para TODAS as planilhas
+    (antes só a última recebia, por indentação).
+    
+    NOVO v9.3: Cabeçalho/rodapé vêm do modelo da empresa e as células usam os
+    estilos nomeados do registro; por planilha só entram os dados e os campos do funcionário.
+    
+    NOVO v9.6: Nome da planilha via nome_planilha_espelho (sem colisão nos 31 caracteres)
+    """
+    # Agrupa por funcionário (ordem alfabética) e ordena os dias por data
+    # (posição no relatório entra no hash de integridade, como o índice do antigo DataFrame)
+    dias_por_funcionario = {}
+    for posicao, dia in enumerate(relatorio_diario):
+        dias_por_funcionario.setdefault(dia.funcionario, []).append((posicao, dia))
+    
+    return _gravar_espelhos(dias_por_funcionario, settings, totais_semanais, destino)
 
-            # 2. APLICAÇÃO DE STATUS MANUAL
-            if status_forcado:
-                status = status_forcado
-                
-                if status == 'ABONO':
-                    print(f" ��️ Aplicando ABONO em {data_atual_obj}: Zerando dívida de {a_dever}")
-                    a_dever = timedelta(0)
-                    alerta = False
-                    ocorrencias = "ABONADO"
-                    
-                elif status == 'ATESTADO':
-                    a_dever = timedelta(0)
-                    alerta = False
-                    ocorrencias = "ATESTADO MÉDICO"
-                    if not batidas_lista:
-                        batidas_str = "Atestado"
-                
-                elif status in ['FOLGA', 'FERIADO', 'DSR']:
-                    a_dever = timedelta(0)
-                    alerta = False
-                    ocorrencias = status.upper()
-                    if not batidas_lista:
-                        batidas_str = status.title()
-                
-                elif status == 'FALTA':
-                    if not batidas_lista:
-                        a_dever = JORNADA_SABADO if (dia_semana_num == 5) else JORNADA_PADRAO
-                    alerta = True
-                    ocorrencias = "FALTA"
 
-            # Calcula saldo final do dia
-            saldo_dia = extras_comuns + extras_100 - a_dever
+def _gravar_espelhos(dias_por_funcionario: dict, settings: dict, totais_semanais: dict, destino=None) -> io.BytesIO:
+    """{funcionario: [(posição no relatório, DiaApurado), ...]} -> workbook com uma planilha por funcionário"""
+    if settings is None:
+        settings = {}
+    if totais_semanais is None:
+        totais_semanais = {}
+    
+    output = io.BytesIO() if destino is None else destino
+    wb = Workbook(write_only=True)
+    _vincular_estilos_espelho(wb)
+    
+    modelo = _modelo_espelho(settings.get('empresa_nome', 'EMPRESA LTDA'),
+                             settings.get('empresa_cnpj', '00.000.000/0000-00'))
+    nomes_usados = set()
+    
+    for funcionario in sorted(dias_por_funcionario):
+        posicoes_dias = sorted(dias_por_funcionario[funcionario], key=lambda item: item[1].data)
+        dias_funcionario = [dia for _, dia in posicoes_dias]
+        
+        # Cria planilha
+        ws = wb.create_sheet(title=nome_planilha_espelho(funcionario, nomes_usados))
+        
+        # --- AJUSTE DE LARGURAS DAS COLUNAS / IMPRESSÃO (antes das linhas em write_only) ---
+        for col_letter, width in ESPELHO_LARGURAS.items():
+            ws.column_dimensions[col_letter].width = width
+        
+        # Configurações de impressão (Paisagem, A4)
+        ws.page_setup.orientation = Worksheet.ORIENTATION_LANDSCAPE
+        ws.page_setup.paperSize = Worksheet.PAPERSIZE_A4
+        ws.page_setup.fitToPage = True
+        ws.page_setup.fitToHeight = 0
+        ws.page_setup.fitToWidth = 1
+        
+        # Margens
+        ws.page_margins.left = 0.5
+        ws.page_margins.right = 0.5
+        ws.page_margins.top = 0.75
+        ws.page_margins.bottom = 0.75
+        
+        # Congela painéis (cabeçalho)
+        ws.freeze_panes = 'A7'
+        
+        escritor = _EscritorPlanilha(ws)
+        
+        # --- CABEÇALHO PROFISSIONAL (linhas 1-6 do modelo; linha 4 = período e funcionário) ---
+        min_date = dias_funcionario[0].data
+        max_date = dias_funcionario[-1].data
+        valores_cabecalho = {
+            4: {1: f"Período: {min_date.strftime('%d/%m/%Y')} a {max_date.strftime('%d/%m/%Y')} | Funcionário: {funcionario.upper()}"}
+        }
+        for linha_modelo in modelo['cabecalho']:
+            escritor.linha_modelo(linha_modelo[0], linha_modelo, valores_cabecalho.get(linha_modelo[0]))
+        
+        # --- DADOS (A partir da linha 7) ---
+        start_row = ESPELHO_LINHA_INICIAL
+        
+        for row_num, row_data in enumerate(dias_funcionario, start=start_row):
+            # Zebrado (linhas alternadas) - vale para as 14 colunas
+            zebrada = (row_num - start_row) % 2 == 1
+            estilos = ESTILOS_LINHA_ESPELHO[zebrada]
             
-            # Rastreador semanal
-            if num_semana not in horas_trabalhadas_semana:
-                horas_trabalhadas_semana[num_semana] = timedelta(0)
-            horas_trabalhadas_semana[num_semana] += total_trabalhado
+            # Coluna B: Dia da Semana (Texto) - destaque para finais de semana
+            dia_semana_abrev = row_data.dia_semana[:3].upper()
+            estilo_dia = estilos[1]
+            if not zebrada and dia_semana_abrev in ['SÁB', 'DOM']:
+                estilo_dia = 'espelho_fim_semana'
             
-            # NOVO v6.0: Coletar dados para apuração semanal de extras
-            if num_semana not in dados_semana:
-                dados_semana[num_semana] = {
-                    'horas_uteis': timedelta(0),
-                    'horas_dom_fer': timedelta(0),
-                    'total': timedelta(0),
-                    'extras_50_acumulado': timedelta(0)  # NOVO v6.1: Para modo diário
-                }
+            linha_dados = [
+                # Coluna A: Data (Texto)
+                _celula(ws, row_data.data.strftime('%d/%m/%Y'), estilos[0]),
+                _celula(ws, dia_semana_abrev, estilo_dia),
+            ]
             
-            # Classificar horas: domingo/feriado vs dias úteis
-            eh_dom_fer_para_semana = (data_atual_obj in feriados_set) or (dia_semana_num == 6 and not domingo_util)
-            if eh_dom_fer_para_semana:
-                dados_semana[num_semana]['horas_dom_fer'] += total_trabalhado
-            else:
-                dados_semana[num_semana]['horas_uteis'] += total_trabalhado
-                # NOVO v6.1: Acumula extras diárias (para modo 'diaria')
-                # Só acumula excedentes positivos, nunca faltas
-                if extras_comuns > timedelta(0):
-                    dados_semana[num_semana]['extras_50_acumulado'] += extras_comuns
-            dados_semana[num_semana]['total'] += total_trabalhado
+            # Colunas C-F: Batidas (Valores Numéricos de Tempo)
+            for col_idx, valor_time in enumerate(
+                (row_data.entrada_1, row_data.saida_1, row_data.entrada_2, row_data.saida_2), start=2
+            ):
+                if valor_time is not None:
+                    # Converte datetime.time para fração de dia do Excel
+                    linha_dados.append(_celula(ws, time_to_excel_time(valor_time), estilos[col_idx]))
+                else:
+                    linha_dados.append(_celula(ws, None, estilos[0]))
             
-            # Monta registro para Excel (ESTRUTURA ATUALIZADA)
-            relatorio_diario.append({
-                "Data": data_atual_obj,
-                "Funcionário": funcionario,
-                "Dia da Semana": DIAS_SEMANA.get(dia_semana_num, ''),
-                "Entrada 1": entrada_1,
-                "Saída 1": saida_1,
-                "Entrada 2": entrada_2,
-                "Saída 2": saida_2,
-                "Meta": meta_dia,  # NOVO v4.0: Coluna Meta para cada dia
-                "Total Trabalhado": total_trabalhado,
-                "Adicional Noturno": adicional_noturno,  # NOVO
-                "Horas Normais": normais,
-                "Horas a Dever": a_dever,
-                "Horas Extras (Comum)": extras_comuns,
-                "Horas Extras (100%)": extras_100,
-                "Ocorrências": ocorrencias
-            })
+            # Coluna G: Meta Diária (NOVO v4.0)
+            linha_dados.append(_celula(ws, segundos_to_excel_time(row_data.meta_s), estilos[6]))
             
-            # Preview (mantém string para o frontend)
-            # ATUALIZADO v4.0: Adicionado tipo_dia, meta_minutos, banco_horas_informativo
-            tipo_dia_str = "normal"
-            if data_atual_obj in feriados_set:
-                tipo_dia_str = "feriado"
-            elif dia_semana_num == 6:  # Domingo
-                tipo_dia_str = "descanso"
-            elif dia_semana_num == 5:  # Sábado
-                tipo_dia_str = "sabado"
+            # Coluna H: Total Trabalhado - FÓRMULA DINÂMICA RESILIENTE (v4.8)
+            # NOVA FÓRMULA v4.8: Usa COUNT() para evitar #VALUE! quando células vazias
+            # Formato: IF(COUNT(range)<2, 0, cálculo_normal)
+            # Se contador apagar uma batida, mostra 0 em vez de erro
             
-            dias_preview.append({
-                "data": data_atual_obj.strftime("%d/%m"),
-                "dia_semana": DIAS_SEMANA.get(dia_semana_num, '')[:3],
-                "batidas": batidas_str,
-                "total": format_td(total_trabalhado),
-                "noturno_base": noturno_base_minutos,
-                "batidas_4cols": {
-                    "entrada_1": entrada_1.strftime("%H:%M") if entrada_1 else None,
-                    "saida_1": saida_1.strftime("%H:%M") if saida_1 else None,
-                    "entrada_2": entrada_2.strftime("%H:%M") if entrada_2 else None,
-                    "saida_2": saida_2.strftime("%H:%M") if saida_2 else None
-                },
-                "saldo": format_td(saldo_dia),
-                "status": status,
-                "alerta": alerta,
-                # NOVOS CAMPOS v4.0
-                "tipo_dia": tipo_dia_str,
-                "meta_minutos": int(meta_dia.total_seconds() / 60),
-                "banco_horas_informativo": True  # Flag de segurança
-            })
-        
-        # Validação: Semanas com > 44h trabalhadas
-        for num_semana, horas in horas_trabalhadas_semana.items():
-            if horas > timedelta(hours=44):
-                warning_msg = f"⚠️ {funcionario} (semana {num_semana}): {format_td(horas)} > 44h - Risco trabalhista"
-                warnings_sistema.append(warning_msg)
-        
-        # Totais - NOVO v6.0: Apuração Semanal de Extras
-        df_func = pd.DataFrame([r for r in relatorio_diario if r["Funcionário"] == funcionario])
-        
-        # Lê configuração de regra de cálculo (NOVO v6.1: extra_tipo)
-        # Compatibilidade: suporta tanto 'extra_tipo' (novo) quanto 'regra_extra' (legado)
-        extra_tipo = settings.get('extra_tipo', settings.get('regra_extra', 'semanal'))
-        jornada_semanal_minutos = settings.get('jornada_semanal_minutos', 2640)  # 44h default
-        
-        if dados_semana:
-            # v6.1: Apuração configurável (diária ou semanal)
-            debug_mode = settings.get('debug_calculo', True)  # Default True para rollout
+            # Primeiro turno: C=Entrada1, D=Saída1
+            # Segundo turno: E=Entrada2, F=Saída2
+            formula_turno1 = f"IF(COUNT(C{row_num}:D{row_num})<2,0,IF(D{row_num}<C{row_num},D{row_num}+1-C{row_num},D{row_num}-C{row_num}))"
+            formula_turno2 = f"IF(COUNT(E{row_num}:F{row_num})<2,0,IF(F{row_num}<E{row_num},F{row_num}+1-E{row_num},F{row_num}-E{row_num}))"
             
-            modo_label = "DIÁRIA" if extra_tipo == 'diaria' else "SEMANAL"
-            if debug_mode:
-                print(f"\n📊 APURAÇÃO {modo_label} - {funcionario}")
+            # Combina os dois turnos
+            linha_dados.append(_celula(ws, f"={formula_turno1}+{formula_turno2}", estilos[7]))
             
-            extras_50_total, extras_100_total = calcular_extras_semanal(
-                dados_semana, 
-                jornada_semanal_minutos,
-                extra_tipo=extra_tipo,  # NOVO v6.1
-                debug=debug_mode
-            )
+            # Coluna I: Adicional Noturno (Deslocado de H para I - Art. 73 CLT)
+            # Destaque visual para hora noturna
+            valor_noturno = row_data.noturno_s
+            estilo_noturno = estilos[8]
+            if valor_noturno > 0:
+                estilo_noturno = 'espelho_noturno_zebra' if zebrada else 'espelho_noturno'
+            linha_dados.append(_celula(ws, segundos_to_excel_time(valor_noturno), estilo_noturno))
             
-            totals = {
-                "Normais": df_func["Horas Normais"].sum() if not df_func.empty else timedelta(),
-                "A Dever": df_func["Horas a Dever"].sum() if not df_func.empty else timedelta(),
-                "Extras Comum": extras_50_total,
-                "Extras 100%": extras_100_total,
-                "Noturno": df_func["Adicional Noturno"].sum() if not df_func.empty else timedelta(),
-            }
+            # Colunas J-M: valores do backend (v6.3) - cálculo CLT que trata feriados,
+            # escalas, abonos e atestados; Extra 50% sem dupla contagem com a coluna 100%
+            # K (Faltas) em vermelho
+            linha_dados.append(_celula(ws, segundos_to_excel_time(row_data.normais_s), estilos[9]))
+            linha_dados.append(_celula(ws, segundos_to_excel_time(row_data.a_dever_s), estilos[10]))
+            linha_dados.append(_celula(ws, segundos_to_excel_time(row_data.extras_comuns_s), estilos[11]))
+            linha_dados.append(_celula(ws, segundos_to_excel_time(row_data.extras_100_s), estilos[12]))
             
-            # NOVO v6.1: Armazena totais semanais para uso no Excel
-            # IMPORTANTE: Estes valores já vêm da apuração semanal CLT (44h),
-            # a mesma usada no preview JSON. NÃO recalcular no Excel.
-            totais_semanais[funcionario] = {
-                "extra50": extras_50_total,
-                "extra100": extras_100_total
-            }
+            # Coluna N: Ocorrências (Texto) - DESLOCADA PARA 14
+            linha_dados.append(_celula(ws, row_data.ocorrencias, estilos[13]))
             
-            # Log de resultado (controlado por debug_mode)
-            if debug_mode:
-                e50_h = extras_50_total.total_seconds() / 3600
-                e100_h = extras_100_total.total_seconds() / 3600
-                print(f"  ✅ RESULTADO: Extra 50% = {e50_h:.2f}h | Extra 100% = {e100_h:.2f}h | Total Extras = {e50_h + e100_h:.2f}h")
+            ws.append(linha_dados)
+            escritor.proxima += 1
+        
+        last_data_row = start_row + len(dias_funcionario) - 1
+        
+        # --- RODAPÉ (modelo) COM TOTAIS, CÓDIGOS CONTÁBEIS E HASH ---
+        total_row = last_data_row + 2
+        
+        # IMPORTANTE v6.1:
+        # Os códigos 150/200 já vêm da apuração semanal CLT (44h),
+        # a mesma usada no preview JSON.
+        # NÃO usar fórmulas Excel que referenciam soma diária para evitar divergências.
+        func_totais = totais_semanais.get(funcionario, {})
+        extra50 = func_totais.get('extra50', timedelta())
+        extra100 = func_totais.get('extra100', timedelta())
+        
+        # Gera hash SHA-256 dos dados
+        dados_str = json.dumps(_dados_hash_integridade(posicoes_dias), sort_keys=True, default=str)
+        hash_value = hashlib.sha256(dados_str.encode()).hexdigest()[:16]
+        
+        valores_rodape = {
+            # Fórmulas SUM para cada coluna de tempo (G=Meta ... M=Extra 100%)
+            0: {col_idx: f"=SUM({col_letter}{start_row}:{col_letter}{last_data_row})"
+                for col_idx, col_letter in enumerate('GHIJKLM', start=7)},
+            1: {12: f"=L{total_row}+M{total_row}-K{total_row}"},
+            5: {3: timedelta_to_excel_time(extra50), 4: extra50.total_seconds() / 3600},
+            6: {3: timedelta_to_excel_time(extra100), 4: extra100.total_seconds() / 3600},
+            # Referência ao total de Noturno (horas e decimal)
+            9: {3: f"=I{total_row}", 4: f"=I{total_row}*24"},
+            13: {1: f"�� Hash de Integridade: {hash_value.upper()}"},
+        }
+        for linha_modelo in modelo['rodape']:
+            escritor.linha_modelo(total_row + linha_modelo[0], linha_modelo, valores_rodape.get(linha_modelo[0]))
+        
+        # Fecha a planilha: grava o rodapé XML e libera o buffer antes do próximo funcionário
+        ws.close()
+    
+    wb.save(output)
+    if destino is None:
+        output.seek(0)
+    return output
+
+
+# ===== NOVO v8.0: EXTRAÇÃO/RESPOSTA COMPARTILHADAS (/converter e fila de jobs) =====
+
+async def extrair_registros_arquivo(filename: str, arquivo, progresso=None) -> RegistrosPonto:
+    """
+    Extrai as batidas de um arquivo enviado (TXT, PDF ou imagem).
+    
+    Args:
+        filename: Nome original (a extensão decide o leitor)
+        arquivo: Arquivo binário aberto (UploadFile.file ou arquivo salvo do job)
+        progresso: Checkpoint do job (opcional), repassado aos leitores com Gemini
+    
+    Extensões não suportadas retornam um RegistrosPonto vazio.
+    """
+    nome = filename.lower()
+    
+    if nome.endswith('.txt'):
+        # NOVO v7.0: Streaming direto do upload (sem decodificar o arquivo inteiro)
+        # Em caso de erro no meio do arquivo, nenhum registro parcial é devolvido
+        return carregar_txt(arquivo, origem=filename)
+    
+    if nome.endswith('.pdf'):
+        return await processar_pdf_com_gemini(arquivo.read(), filename, progresso)
+    
+    if nome.endswith(('.jpg', '.jpeg', '.png')):
+        return await processar_imagem_com_gemini(arquivo.read(), filename, progresso)
+    
+    return RegistrosPonto()
+
+
+# ===== NOVO v9.4: RESULTADOS PARA DOWNLOAD (xlsx em disco, fora do JSON) =====
+# O Excel ia em base64 dentro do JSON do /converter e do /recalcular: +33% no tráfego,
+# três cópias em memória (BytesIO, bytes, str) e o navegador ainda reenviava o base64
+# no /recalcular. Agora o JSON leva só o preview + o id; GET /resultados/{id} envia o
+# arquivo em streaming.
+#
+# NOVO v9.5: Excel sob demanda. O cálculo só registra o relatório apurado em
+# RESULTADOS_DIR/<id>/, onde id = hash do conteúdo (relatorio_diario + settings +
+# totais_semanais); o xlsx é gerado no primeiro download. Cada edição no /recalcular
+# custa só o cálculo, e um resultado idêntico reaproveita o registro e o Excel já gerado.
+# Os Excels prontos formam um cache LRU (RESULTADOS_CACHE_MAX); a data de modificação
+# da pasta marca o último uso (cálculo ou download).
+
+RESULTADOS_DIR = os.getenv("RESULTADOS_DIR", os.path.join(tempfile.gettempdir(), "pontosync_resultados"))
+RESULTADOS_RETENCAO_H = float(os.getenv("RESULTADOS_RETENCAO_H", "24"))  # LGPD: mesmo prazo dos jobs (desde o último uso)
+RESULTADOS_CACHE_MAX = int(os.getenv("RESULTADOS_CACHE_MAX", "64"))      # Excels prontos mantidos em disco (LRU)
+RESULTADOS_INTERVALO_LIMPEZA_S = 600.0
+RESULTADO_DADOS = "relatorio.pkl"
+RESULTADO_EXCEL = "espelho.xlsx"
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+_RESULTADO_ID_VALIDO = re.compile(r"^[0-9a-f]{32}$")
+_NOME_DOWNLOAD_VALIDO = re.compile(r"^[\w\-]{1,100}\.xlsx$")
+_resultados_proxima_limpeza = 0.0
+
+
+def hash_resultado(pacote: tuple, settings: dict, totais_semanais: dict) -> str:
+    """Hash do conteúdo apurado (relatório compactado + settings + totais semanais)."""
+    textos, *colunas = pacote
+    sha = hashlib.sha256(marshal.dumps(textos))
+    for coluna in colunas:
+        sha.update(coluna.tobytes())
+    sha.update(json.dumps(settings, sort_keys=True, default=str).encode())
+    sha.update(json.dumps(totais_semanais, sort_keys=True, default=str).encode())
+    return sha.hexdigest()[:32]
+
+
+def registrar_resultado(relatorio: List[DiaApurado], settings: dict, totais_semanais: dict) -> str:
+    """Guarda o relatório apurado (sem gerar o Excel). Retorna o id (hash do conteúdo)."""
+    global _resultados_proxima_limpeza
+    if time.monotonic() >= _resultados_proxima_limpeza:
+        resultados_limpar_expirados()
+        _resultados_proxima_limpeza = time.monotonic() + RESULTADOS_INTERVALO_LIMPEZA_S
+    
+    pacote = compactar_relatorio(relatorio)
+    arquivo_id = hash_resultado(pacote, settings, totais_semanais)
+    pasta = os.path.join(RESULTADOS_DIR, arquivo_id)
+    caminho = os.path.join(pasta, RESULTADO_DADOS)
+    
+    if os.path.exists(caminho):
+        # Resultado idêntico a um já registrado: reaproveita (inclusive o Excel, se pronto)
+        os.utime(pasta)
+        return arquivo_id
+    
+    os.makedirs(pasta, exist_ok=True)
+    # Grava em .parcial e renomeia: quem lê nunca vê um arquivo pela metade
+    parcial = f"{caminho}.{uuid.uuid4().hex}.parcial"
+    with open(parcial, "wb") as destino:
+        pickle.dump((pacote, settings, totais_semanais), destino, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(parcial, caminho)
+    return arquivo_id
+
+
+def gerar_excel_resultado(arquivo_id: str) -> Optional[str]:
+    """Gera (se ainda não existir) o Excel de um resultado registrado. Retorna o caminho ou None."""
+    pasta = os.path.join(RESULTADOS_DIR, arquivo_id)
+    caminho = os.path.join(pasta, RESULTADO_EXCEL)
+    if os.path.exists(caminho):
+        return caminho
+    
+    try:
+        with open(os.path.join(pasta, RESULTADO_DADOS), "rb") as f:
+            pacote, settings, totais_semanais = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    
+    # Gera Excel PROFISSIONAL - NOVO v6.1: passa totais semanais para códigos 150/200
+    parcial = f"{caminho}.{uuid.uuid4().hex}.parcial"
+    with open(parcial, "wb") as destino:
+        gerar_excel(expandir_relatorio(pacote), settings, totais_semanais, destino=destino)
+    os.replace(parcial, caminho)
+    
+    _resultados_limitar_cache()
+    return caminho
+
+
+def _resultados_limitar_cache() -> None:
+    """LRU: mantém só os RESULTADOS_CACHE_MAX Excels usados mais recentemente."""
+    prontos = []
+    for arquivo_id in os.listdir(RESULTADOS_DIR):
+        pasta = os.path.join(RESULTADOS_DIR, arquivo_id)
+        try:
+            info = os.stat(pasta)
+        except OSError:
+            continue
+        if os.path.exists(os.path.join(pasta, RESULTADO_EXCEL)):
+            prontos.append((info.st_mtime, info.st_atime, pasta))
+    
+    prontos.sort(reverse=True)
+    for mtime, atime, pasta in prontos[max(1, RESULTADOS_CACHE_MAX):]:
+        try:
+            os.remove(os.path.join(pasta, RESULTADO_EXCEL))
+            # Remover o arquivo muda o mtime da pasta: restaura (a retenção conta do último uso)
+            os.utime(pasta, (atime, mtime))
+        except OSError:
+            continue
+
+
+def localizar_excel_resultado(arquivo_id: str) -> Optional[str]:
+    """Caminho do Excel já gerado (marcando o uso no LRU), ou None."""
+    pasta = os.path.join(RESULTADOS_DIR, arquivo_id)
+    caminho = os.path.join(pasta, RESULTADO_EXCEL)
+    if not os.path.exists(caminho):
+        return None
+    os.utime(pasta)
+    return caminho
+
+
+@lru_cache(maxsize=256)
+def etag_resultado(caminho: str, mtime_ns: int, tamanho: int) -> str:
+    """ETag forte (SHA-256 do conteúdo); a chave inclui mtime/tamanho do arquivo."""
+    sha = hashlib.sha256()
+    with open(caminho, "rb") as f:
+        for bloco in iter(lambda: f.read(TXT_CHUNK_BYTES), b""):
+            sha.update(bloco)
+    return f'"{sha.hexdigest()[:32]}"'
+
+
+def resultados_limpar_expirados() -> None:
+    """LGPD: remove os resultados sem uso há mais de RESULTADOS_RETENCAO_H."""
+    limite = time.time() - RESULTADOS_RETENCAO_H * 3600
+    try:
+        pastas = os.listdir(RESULTADOS_DIR)
+    except FileNotFoundError:
+        return
+    removidos = 0
+    for arquivo_id in pastas:
+        pasta = os.path.join(RESULTADOS_DIR, arquivo_id)
+        try:
+            if os.path.getmtime(pasta) < limite:
+                shutil.rmtree(pasta, ignore_errors=True)
+                removidos += 1
+        except OSError:
+            continue
+    if removidos:
+        print(f"[LIMPEZA] {removidos} resultado(s) expirado(s) removido(s)")
+
+
+def gerar_resposta_conversao(dados_consolidados: RegistrosPonto, settings_dict: dict) -> dict:
+    """Calcula e registra o relatório: {"preview", "filename", "arquivo_id", "download_url"}"""
+    if not dados_consolidados:
+        raise ValueError("Nenhum dado válido foi encontrado nos arquivos enviados.")
+    
+    # Calcula com a função isolada (sem overrides no primeiro processamento)
+    resultado = calcular_e_registrar(dados_consolidados, settings_dict, status_overrides=None)
+    
+    if resultado is None:
+        raise ValueError("Não foi possível calcular o relatório.")
+    
+    return montar_resposta_excel(*resultado, prefixo="Espelho_Ponto")
+
+
+def montar_resposta_excel(preview: list, arquivo_id: str, prefixo: str) -> dict:
+    filename = f"{prefixo}_{datetime.now().strftime('%Y-%m-%d_%H%M')}.xlsx"
+    return {
+        "preview": preview,
+        "filename": filename,
+        "arquivo_id": arquivo_id,
+        "download_url": f"/resultados/{arquivo_id}?filename={filename}",
+        # NOVO v9.6: um espelho por funcionário (ZIP)
+        "zip_url": f"/resultados/{arquivo_id}/zip?filename={prefixo}_Funcionarios.zip"
+    }
+
+
+# ===== NOVO v8.1: CÁLCULO E EXCEL FORA DO EVENT LOOP (POOL DE PROCESSOS) =====
+# calcular_relatorio/gerar_excel são CPU puro: rodando dentro da rota async, uma empresa
+# grande travava todas as outras requisições do worker (inclusive o health check).
+# Entrada: RegistrosPonto (nomes internados + arrays de inteiros); saída: preview
+# (JSON) + id do resultado registrado em disco (v9.5). Nenhum DataFrame atravessa o limite entre processos.
+# O Excel (v9.5: só no download) roda no mesmo pool e disputa as mesmas vagas.
+
+CALCULO_PROCESSOS = int(os.getenv("CALCULO_PROCESSOS", str(min(4, os.cpu_count() or 1))))  # 0 = thread
+CALCULO_MAX_FILA = int(os.getenv("CALCULO_MAX_FILA", "8"))  # Cálculos aguardando além dos em execução
+CALCULO_ESPERA_MAXIMA_S = float(os.getenv("CALCULO_ESPERA_MAXIMA_S", "60"))  # Espera por vaga na fila
+
+_calculo_pool: Optional[ProcessPoolExecutor] = None
+_calculo_vagas = asyncio.Semaphore(max(1, CALCULO_PROCESSOS) + CALCULO_MAX_FILA)
+
+
+def calcular_e_registrar(dados: RegistrosPonto, settings: dict, status_overrides: dict = None) -> Optional[tuple]:
+    """calcular_relatorio + registrar_resultado. Retorna (preview, arquivo_id) ou None se não houver relatório."""
+    resultado = calcular_relatorio(dados, settings, status_overrides=status_overrides)
+    relatorio = resultado[0]
+    if not relatorio:
+        return None
+    _, preview, totais_semanais = resultado
+    
+    return preview, registrar_resultado(relatorio, settings, totais_semanais)
+
+
+def _obter_pool_calculo() -> ProcessPoolExecutor:
+    global _calculo_pool
+    if _calculo_pool is None:
+        # spawn: o filho não herda threads/event loop do uvicorn nem os clientes gRPC do Gemini
+        _calculo_pool = ProcessPoolExecutor(
+            max_workers=CALCULO_PROCESSOS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _calculo_pool
+
+
+async def executar_no_pool_calculo(funcao, *args):
+    """
+    Roda funcao(*args) no pool de cálculo sem bloquear o event loop.
+    
+    No máximo CALCULO_PROCESSOS tarefas rodam ao mesmo tempo e CALCULO_MAX_FILA aguardam;
+    além disso a requisição espera até CALCULO_ESPERA_MAXIMA_S e recebe 503.
+    """
+    from fastapi import HTTPException
+    
+    global _calculo_pool
+    try:
+        await asyncio.wait_for(_calculo_vagas.acquire(), timeout=CALCULO_ESPERA_MAXIMA_S)
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=503,
+            detail="Servidor ocupado com outros cálculos. Tente novamente em instantes."
+        )
+    
+    try:
+        if CALCULO_PROCESSOS <= 0:
+            return await asyncio.to_thread(funcao, *args)
+        
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(_obter_pool_calculo(), funcao, *args)
+        except BrokenProcessPool:
+            # Um processo do pool morreu (ex: OOM): recria o pool para as próximas requisições
+            print("[ERRO] Pool de cálculo quebrado; recriando")
+            _calculo_pool = None
+            raise
+    finally:
+        _calculo_vagas.release()
+
+
+async def calcular_e_registrar_async(dados: RegistrosPonto, settings: dict, status_overrides: dict = None) -> Optional[tuple]:
+    """Versão não bloqueante de calcular_e_registrar para as rotas."""
+    # O pickle do RegistrosPonto leva só as colunas (~11 bytes por batida)
+    if not isinstance(dados, RegistrosPonto):
+        dados = RegistrosPonto.de_registros(dados)
+    return await executar_no_pool_calculo(calcular_e_registrar, dados, settings, status_overrides)
+
+
+# ===== NOVO v9.6: EXPORTAÇÃO ZIP (UM ESPELHO POR FUNCIONÁRIO) =====
+# Para coleta de assinaturas o DP quer um arquivo por funcionário. Cada espelho é gerado
+# num processo do pool de cálculo e entra no ZIP assim que fica pronto (ordem de término).
+# No máximo CALCULO_PROCESSOS espelhos ficam em andamento: a memória de pico é de um
+# espelho por processo e o tempo total cai com o nº de núcleos.
+
+_NOME_ZIP_VALIDO = re.compile(r"^[\w\-]{1,100}\.zip$")
+
+
+def carregar_espelhos_funcionarios(arquivo_id: str) -> Optional[tuple]:
+    """
+    Lê um resultado registrado e separa por funcionário (ordem alfabética).
+    
+    Retorna ([(funcionario, nome do arquivo, pacote, posições), ...], settings, totais_semanais)
+    ou None se o resultado não existir. As posições no relatório completo vão junto para
+    o hash de integridade de cada espelho ser o mesmo do workbook com todos.
+    """
+    pasta = os.path.join(RESULTADOS_DIR, arquivo_id)
+    try:
+        with open(os.path.join(pasta, RESULTADO_DADOS), "rb") as f:
+            pacote, settings, totais_semanais = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    os.utime(pasta)
+    
+    dias_por_funcionario = {}
+    for posicao, dia in enumerate(expandir_relatorio(pacote)):
+        dias_por_funcionario.setdefault(dia.funcionario, []).append((posicao, dia))
+    
+    nomes_usados = set()
+    partes = [
+        (
+            funcionario,
+            nome_arquivo_espelho(funcionario, nomes_usados),
+            compactar_relatorio([dia for _, dia in posicoes_dias]),
+            array('i', [posicao for posicao, _ in posicoes_dias])
+        )
+        for funcionario, posicoes_dias in sorted(dias_por_funcionario.items())
+    ]
+    return partes, settings, totais_semanais
+
+
+def gerar_excel_funcionario(funcionario: str, pacote: tuple, posicoes: array, settings: dict,
+                            totais_funcionario: dict) -> bytes:
+    """Espelho (.xlsx) de um único funcionário. Executado no pool de cálculo."""
+    posicoes_dias = list(zip(posicoes, expandir_relatorio(pacote)))
+    return _gravar_espelhos({funcionario: posicoes_dias}, settings, {funcionario: totais_funcionario}).getvalue()
+
+
+class _SaidaZip(io.RawIOBase):
+    """Destino do ZipFile em streaming (não posicionável): guarda o que foi escrito até retirar()."""
+    
+    def __init__(self):
+        super().__init__()
+        self._partes = []
+    
+    def writable(self) -> bool:
+        return True
+    
+    def write(self, dados) -> int:
+        self._partes.append(bytes(dados))
+        return len(dados)
+    
+    def retirar(self) -> bytes:
+        dados = b"".join(self._partes)
+        self._partes.clear()
+        return dados
+
+
+class ExportacaoZip:
+    """
+    Gera o ZIP em pedaços de bytes (gerar()): cada espelho entra assim que o pool termina de gerá-lo.
+    
+    Cada espelho ocupa uma vaga de _calculo_vagas do envio até o processo TERMINAR: um espelho
+    abandonado (cliente desconectou) segue rodando no pool e só então devolve a vaga. A primeira
+    vaga vem de reservar(); as demais (até CALCULO_PROCESSOS espelhos em paralelo) só são tomadas
+    se estiverem livres na hora, sem passar na frente de quem espera. encerrar() devolve o que
+    sobrar, mesmo que gerar() nunca tenha começado.
+    """
+    
+    def __init__(self, partes: list, settings: dict, totais_semanais: dict):
+        self.fila = deque(partes)
+        self.settings = settings
+        self.totais_semanais = totais_semanais
+        self.vagas_livres = 0   # Vagas ocupadas sem espelho em geração
+        self.em_andamento = {}  # futuro asyncio -> (futuro do executor, nome do arquivo)
+        self._loop = asyncio.get_running_loop()
+        self._threads: Optional[ThreadPoolExecutor] = None
+    
+    async def reservar(self) -> bool:
+        """Espera a primeira vaga (até CALCULO_ESPERA_MAXIMA_S). False = servidor ocupado."""
+        try:
+            await asyncio.wait_for(_calculo_vagas.acquire(), timeout=CALCULO_ESPERA_MAXIMA_S)
+        except asyncio.TimeoutError:
+            return False
+        self.vagas_livres += 1
+        return True
+    
+    def _enviar(self, funcionario, nome_arquivo, pacote, posicoes):
+        argumentos = (funcionario, pacote, posicoes, self.settings, self.totais_semanais.get(funcionario, {}))
+        if CALCULO_PROCESSOS <= 0:
+            if self._threads is None:
+                self._threads = ThreadPoolExecutor(max_workers=1)
+            executor = self._threads
         else:
-            # Modo diário (legado)
-            totals = {
-                "Normais": df_func["Horas Normais"].sum() if not df_func.empty else timedelta(),
-                "A Dever": df_func["Horas a Dever"].sum() if not df_func.empty else timedelta(),
-                "Extras Comum": df_func["Horas Extras (Comum)"].sum() if not df_func.empty else timedelta(),
-                "Extras 100%": df_func["Horas Extras (100%)"].sum() if not df_func.empty else timedelta(),
-                "Noturno": df_func["Adicional Noturno"].sum() if not df_func.empty else timedelta(),
-            }
-        
-        saldo_final = totals["Extras Comum"] + totals["Extras 100%"] - totals["A Dever"]
+            executor = _obter_pool_calculo()
+        # submit (e não run_in_executor): o futuro do executor diz quando o processo terminou de fato
+        futuro = executor.submit(gerar_excel_funcionario, *argumentos)
+        self.vagas_livres -= 1
+        self.em_andamento[asyncio.wrap_future(futuro)] = (futuro, nome_arquivo)
+    
+    async def _preencher(self):
+        while self.fila and len(self.em_andamento) < max(1, CALCULO_PROCESSOS):
+            if not self.vagas_livres:
+                if _calculo_vagas.locked():
+                    break  # Sem vaga livre: segue só com as que já tem
+                await _calculo_vagas.acquire()  # Há vaga: retorna sem esperar
+                self.vagas_livres += 1
+            self._enviar(*self.fila.popleft())
+        # Vaga sem espelho (fila no fim ou limite de paralelos): devolve para os outros cálculos
+        self._devolver_livres()
+    
+    def _devolver_livres(self):
+        for _ in range(self.vagas_livres):
+            _calculo_vagas.release()
+        self.vagas_livres = 0
+    
+    async def gerar(self):
+        global _calculo_pool
+        saida = _SaidaZip()
+        try:
+            # xlsx já é comprimido: ZIP_STORED não gasta CPU recomprimindo
+            with zipfile.ZipFile(saida, "w", compression=zipfile.ZIP_STORED) as arquivo_zip:
+                await self._preencher()
+                
+                while self.em_andamento:
+                    prontos, _ = await asyncio.wait(self.em_andamento, return_when=asyncio.FIRST_COMPLETED)
+                    for futuro in prontos:
+                        _, nome_arquivo = self.em_andamento.pop(futuro)
+                        self.vagas_livres += 1  # Processo terminou: a vaga volta para a exportação
+                        arquivo_zip.writestr(nome_arquivo, futuro.result())
+                    await self._preencher()
+                    yield saida.retirar()
+            
+            # Diretório central do ZIP (escrito no fechamento)
+            yield saida.retirar()
+        except BrokenProcessPool:
+            print("[ERRO] Pool de cálculo quebrado durante exportação ZIP; recriando")
+            _calculo_pool = None
+            raise
+        except Exception as e:
+            print(f"[ERRO] Exportação ZIP interrompida: {e}")
+            raise
+        finally:
+            self.encerrar()
+    
+    def encerrar(self):
+        """Devolve as vagas livres agora e a de cada espelho em andamento quando ele terminar (idempotente)."""
+        self._devolver_livres()
+        loop = self._loop
         
-        resumo_preview.append({
-            "funcionario": funcionario,
-            "normais": format_td(totals["Normais"]).replace("+", ""),
-            "dever": format_td(totals["A Dever"]).replace("+", ""),
-            "extras_comuns": format_td(totals["Extras Comum"]).replace("+", ""),
-            "extras_100": format_td(totals["Extras 100%"]).replace("+", ""),
-            "saldo": format_td(saldo_final),
-            "dias": dias_preview,
-            # CAMPOS v6.1 - Apuração Configurável
-            "aviso_saldo": f"Extras calculados com apuração {'DIÁRIA (sem compensação)' if extra_tipo == 'diaria' else 'SEMANAL (44h CLT)'}.",
-            "saldo_eh_informativo": True,
-            "versao_calculo": "v6.1-configuravel",
-            "extra_tipo": extra_tipo
-        })
+        def devolver_vaga(_):
+            try:
+                loop.call_soon_threadsafe(_calculo_vagas.release)
+            except RuntimeError:
+                pass  # Event loop já encerrado (shutdown)
         
-    return relatorio_diario, resumo_preview, totais_semanais
+        for futuro_async, (futuro, _) in self.em_andamento.items():
+            futuro.cancel()  # Só cancela o que ainda não começou; o que está rodando vai até o fim
+            futuro.add_done_callback(devolver_vaga)
+            futuro_async.add_done_callback(lambda f: f.cancelled() or f.exception())  # Resultado descartado
+        self.em_andamento.clear()
+        if self._threads is not None:
+            self._threads.shutdown(wait=False, cancel_futures=True)
+            self._threads = None
 
-# ===== FUNÇÃO REFATORADA: GERAR EXCEL PROFISSIONAL =====
-def gerar_excel(relatorio_diario: List[dict], settings: dict = None, totais_semanais: dict = None) -> io.BytesIO:
+
+class RespostaZip(StreamingResponse):
+    """StreamingResponse de uma ExportacaoZip: encerra a exportação mesmo se o corpo nunca começar."""
+    
+    def __init__(self, exportacao: ExportacaoZip, **kwargs):
+        self.exportacao = exportacao
+        super().__init__(exportacao.gerar(), **kwargs)
+    
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # Cliente que desconecta antes do primeiro pedaço: o gerador nem começou e seu
+            # finally não roda; as vagas são devolvidas aqui
+            await self.body_iterator.aclose()
+            self.exportacao.encerrar()
+
+
+@app.on_event("shutdown")
+def parar_pool_calculo():
+    global _calculo_pool
+    if _calculo_pool is not None:
+        _calculo_pool.shutdown(wait=False, cancel_futures=True)
+        _calculo_pool = None
+    parar_pool_paralelo()
+
+
+# ===== NOVO v8.0: FILA DE JOBS DURÁVEL (SQLite + PROCESSOS WORKER) =====
+# POST /jobs salva os arquivos e retorna um job_id na hora; processos worker drenam a
+# fila (SQLite em modo WAL) e gravam cada página concluída. Se um worker morrer, o job
+# volta para a fila após JOBS_HEARTBEAT_TIMEOUT_S e recomeça da última página salva.
+
+JOBS_ATIVO = os.getenv("JOBS_ATIVO", "1") not in ("0", "false", "False", "")
+JOBS_DIR = os.getenv("JOBS_DIR", os.path.join(tempfile.gettempdir(), "pontosync_jobs"))
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", os.path.join(JOBS_DIR, "jobs.sqlite3"))
+JOBS_WORKERS = int(os.getenv("JOBS_WORKERS", "2"))              # Processos worker por processo da API
+JOBS_MAX_TENTATIVAS = int(os.getenv("JOBS_MAX_TENTATIVAS", "3"))  # Execuções antes de marcar erro
+JOBS_RETENCAO_H = float(os.getenv("JOBS_RETENCAO_H", "24"))      # LGPD: resultados apagados depois disso
+JOBS_HEARTBEAT_S = 10.0
+JOBS_HEARTBEAT_TIMEOUT_S = 60.0  # Job "processando" sem sinal há mais tempo que isso é retomado
+JOBS_INTERVALO_POLL_S = 1.0
+JOBS_INTERVALO_LIMPEZA_S = 600.0
+
+JOBS_STATUS_FINAIS = ("concluido", "erro")
+
+_JOBS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    criado_em REAL NOT NULL,
+    atualizado_em REAL NOT NULL,
+    heartbeat REAL,
+    worker_pid INTEGER,
+    tentativas INTEGER NOT NULL DEFAULT 0,
+    settings TEXT NOT NULL,
+    consentimento TEXT,
+    erro TEXT,
+    resultado TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, criado_em);
+CREATE TABLE IF NOT EXISTS job_arquivos (
+    job_id TEXT NOT NULL,
+    indice INTEGER NOT NULL,
+    nome TEXT NOT NULL,
+    caminho TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pendente',
+    paginas_total INTEGER,
+    paginas_feitas INTEGER NOT NULL DEFAULT 0,
+    erro TEXT,
+    PRIMARY KEY (job_id, indice)
+);
+CREATE TABLE IF NOT EXISTS job_paginas (
+    job_id TEXT NOT NULL,
+    arquivo INTEGER NOT NULL,
+    pagina INTEGER NOT NULL,
+    dados TEXT,
+    PRIMARY KEY (job_id, arquivo, pagina)
+);
+"""
+
+_jobs_schema_pronto = False
+
+
+def jobs_conectar() -> sqlite3.Connection:
+    """Abre uma conexão com a fila (uma por operação; o SQLite serializa as escritas)."""
+    global _jobs_schema_pronto
+    os.makedirs(os.path.dirname(JOBS_DB_PATH) or ".", exist_ok=True)
+    conn = sqlite3.connect(JOBS_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    if not _jobs_schema_pronto:
+        conn.executescript(_JOBS_SCHEMA)
+        _jobs_schema_pronto = True
+    return conn
+
+
+def jobs_criar(job_id: str, arquivos: List[tuple], settings: str, consentimento: str) -> None:
     """
-    Gera arquivo Excel profissional estilo "Espelho de Ponto" do Departamento Pessoal.
+    Enfileira um job. Os arquivos já devem estar salvos em JOBS_DIR/<job_id>.
     
-    MUDANÇAS CRÍTICAS:
-    - Batidas separadas em 4 colunas (Ent.1, Sai.1, Ent.2, Sai.2)
-    - Valores numéricos reais (float) com formatação [h]:mm:ss
-    - Fórmulas SUM no rodapé
-    - Design profissional (cabeçalho, bordas, zebrado)
-    - Hash SHA-256 de integridade
+    Args:
+        arquivos: [(nome_original, caminho), ...] na ordem de envio
+    """
+    agora = time.time()
+    conn = jobs_conectar()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            "INSERT INTO jobs (id, status, criado_em, atualizado_em, settings, consentimento) "
+            "VALUES (?, 'pendente', ?, ?, ?, ?)",
+            (job_id, agora, agora, settings, consentimento)
+        )
+        conn.executemany(
+            "INSERT INTO job_arquivos (job_id, indice, nome, caminho) VALUES (?, ?, ?, ?)",
+            [(job_id, indice, nome, caminho) for indice, (nome, caminho) in enumerate(arquivos)]
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def jobs_reservar_proximo() -> Optional[str]:
+    """
+    Reserva atomicamente o job pendente mais antigo (ou um órfão sem heartbeat).
     
-    NOVO v6.1: Códigos contábeis 150/200 usam totais semanais do backend
-    (mesma apuração CLT 44h do preview JSON)
+    Vários workers (e vários processos da API) podem chamar ao mesmo tempo:
+    o BEGIN IMMEDIATE garante que cada job é entregue a um único worker.
     """
-    if settings is None:
-        settings = {}
-    if totais_semanais is None:
-        totais_semanais = {}
+    agora = time.time()
+    conn = jobs_conectar()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        # Órfãos que já esgotaram as tentativas não voltam para a fila
+        conn.execute(
+            "UPDATE jobs SET status = 'erro', atualizado_em = ?, "
+            "erro = 'Processamento interrompido repetidamente. Envie os arquivos novamente.' "
+            "WHERE status = 'processando' AND heartbeat < ? AND tentativas >= ?",
+            (agora, agora - JOBS_HEARTBEAT_TIMEOUT_S, JOBS_MAX_TENTATIVAS)
+        )
+        linha = conn.execute(
+            "SELECT id, status FROM jobs WHERE status = 'pendente' "
+            "OR (status = 'processando' AND heartbeat < ?) ORDER BY criado_em LIMIT 1",
+            (agora - JOBS_HEARTBEAT_TIMEOUT_S,)
+        ).fetchone()
+        if linha is None:
+            conn.execute("COMMIT")
+            return None
+        conn.execute(
+            "UPDATE jobs SET status = 'processando', worker_pid = ?, heartbeat = ?, "
+            "atualizado_em = ?, tentativas = tentativas + 1 WHERE id = ?",
+            (os.getpid(), agora, agora, linha["id"])
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
     
-    df_calculado = pd.DataFrame(relatorio_diario)
-    
-    output = io.BytesIO()
-    wb = Workbook()
-    
-    # Remove planilha padrão
-    if 'Sheet' in wb.sheetnames:
-        del wb['Sheet']
-    
-    if not df_calculado.empty:
-        df_calculado.sort_values(by=['Funcionário', 'Data'], inplace=True)
-        
-        for funcionario in df_calculado["Funcionário"].unique():
-            df_funcionario = df_calculado[df_calculado["Funcionário"] == funcionario].copy()
-            
-            # Cria planilha
-            ws = wb.create_sheet(title=funcionario[:31])
-            
-            # --- CABEÇALHO PROFISSIONAL ---
-            empresa_nome = settings.get('empresa_nome', 'EMPRESA LTDA')
-            empresa_cnpj = settings.get('empresa_cnpj', '00.000.000/0000-00')
-            
-            # Linha 1: Nome da Empresa (Fundo Escuro)
-            ws.merge_cells('A1:M1')
-            cell_empresa = ws['A1']
-            cell_empresa.value = empresa_nome.upper()
-            cell_empresa.font = Font(name='Arial', size=14, bold=True, color='FFFFFF')
-            cell_empresa.fill = PatternFill(start_color='2C3E50', end_color='2C3E50', fill_type='solid')
-            cell_empresa.alignment = Alignment(horizontal='center', vertical='center')
-            ws.row_dimensions[1].height = 25
-            
-            # Linha 2: CNPJ
-            ws.merge_cells('A2:M2')
-            cell_cnpj = ws['A2']
-            cell_cnpj.value = f"CNPJ: {empresa_cnpj}"
-            cell_cnpj.font = Font(name='Arial', size=10, color='FFFFFF')
-            cell_cnpj.fill = PatternFill(start_color='34495E', end_color='34495E', fill_type='solid')
-            cell_cnpj.alignment = Alignment(horizontal='center', vertical='center')
-            ws.row_dimensions[2].height = 20
-            
-            # Linha 3: Título Espelho de Ponto
-            ws.merge_cells('A3:M3')
-            cell_titulo = ws['A3']
-            cell_titulo.value = "ESPELHO DE PONTO - REGISTRO DE HORÁRIOS"
-            cell_titulo.font = Font(name='Arial', size=12, bold=True)
-            cell_titulo.alignment = Alignment(horizontal='center', vertical='center')
-            ws.row_dimensions[3].height = 22
-            
-            # Linha 4: Período e Funcionário
-            min_date = df_funcionario['Data'].min()
-            max_date = df_funcionario['Data'].max()
-            ws.merge_cells('A4:M4')
-            cell_periodo = ws['A4']
-            cell_periodo.value = f"Período: {min_date.strftime('%d/%m/%Y')} a {max_date.strftime('%d/%m/%Y')} | Funcionário: {funcionario.upper()}"
-            cell_periodo.font = Font(name='Arial', size=10, italic=True)
-            cell_periodo.alignment = Alignment(horizontal='center', vertical='center')
-            ws.row_dimensions[4].height = 18
-            
-            # Linha 5: Espaço
-            ws.row_dimensions[5].height = 10
-            
-            # --- CABEÇALHOS DA TABELA (Linha 6) ---
-            headers = ['Data', 'Dia', 'Ent. 1', 'Sai. 1', 'Ent. 2', 'Sai. 2', 
-                      'Meta', 'Total', 'Noturno', 'Normais', 'Faltas', 'Extra 50%', 'Extra 100%', 'Ocorrências']
-            
-            thin_border = Border(
-                left=Side(style='thin', color='BDC3C7'),
-                right=Side(style='thin', color='BDC3C7'),
-                top=Side(style='thin', color='BDC3C7'),
-                bottom=Side(style='thin', color='BDC3C7')
-            )
-            
-            for col_idx, header in enumerate(headers, start=1):
-                cell = ws.cell(row=6, column=col_idx, value=header)
-                cell.font = Font(name='Arial', size=10, bold=True, color='FFFFFF')
-                cell.fill = PatternFill(start_color='1ABC9C', end_color='1ABC9C', fill_type='solid')
-                cell.alignment = Alignment(horizontal='center', vertical='center')
-                cell.border = thin_border
-            
-            ws.row_dimensions[6].height = 20
-            
-            # --- DADOS (A partir da linha 7) ---
-            start_row = 7
-            
-            for idx, row_data in df_funcionario.iterrows():
-                row_num = start_row + (idx - df_funcionario.index[0])
-                
-                # Coluna A: Data (Texto)
-                ws.cell(row=row_num, column=1, value=row_data['Data'].strftime('%d/%m/%Y'))
-                ws.cell(row=row_num, column=1).alignment = Alignment(horizontal='center')
-                ws.cell(row=row_num, column=1).border = thin_border
-                
-                # Coluna B: Dia da Semana (Texto)
-                dia_semana_abrev = row_data['Dia da Semana'][:3].upper()
-                cell_dia = ws.cell(row=row_num, column=2, value=dia_semana_abrev)
-                cell_dia.alignment = Alignment(horizontal='center')
-                cell_dia.border = thin_border
-                
-                # Destaque para finais de semana
-                if dia_semana_abrev in ['SÁB', 'DOM']:
-                    cell_dia.fill = PatternFill(start_color='ECF0F1', end_color='ECF0F1', fill_type='solid')
-                
-                # Colunas C-F: Batidas (Valores Numéricos de Tempo)
-                batidas_cols = [
-                    ('Entrada 1', 3),
-                    ('Saída 1', 4),
-                    ('Entrada 2', 5),
-                    ('Saída 2', 6)
-                ]
-                
-                for col_name, col_idx in batidas_cols:
-                    valor_time = row_data.get(col_name)
-                    cell = ws.cell(row=row_num, column=col_idx)
-                    
-                    if valor_time is not None:
-                        # Converte datetime.time para fração de dia do Excel
-                        cell.value = time_to_excel_time(valor_time)
-                        cell.number_format = 'HH:MM'
-                    else:
-                        cell.value = None
-                    
-                    cell.alignment = Alignment(horizontal='center')
-                    cell.border = thin_border
-                
-                # Coluna G: Meta Diária (NOVO v4.0)
-                cell_meta = ws.cell(row=row_num, column=7)
-                valor_meta = row_data.get('Meta', timedelta(0))
-                cell_meta.value = timedelta_to_excel_time(valor_meta)
-                cell_meta.number_format = '[h]:mm:ss'
-                cell_meta.alignment = Alignment(horizontal='center')
-                cell_meta.border = thin_border
-                
-                # Coluna H: Total Trabalhado - FÓRMULA DINÂMICA RESILIENTE (v4.8)
-                cell_total = ws.cell(row=row_num, column=8)
-                
-                # NOVA FÓRMULA v4.8: Usa COUNT() para evitar #VALUE! quando células vazias
-                # Formato: IF(COUNT(range)<2, 0, cálculo_normal)
-                # Se contador apagar uma batida, mostra 0 em vez de erro
-                
-                # Primeiro turno: C=Entrada1, D=Saída1
-                # Segundo turno: E=Entrada2, F=Saída2
-                formula_turno1 = f"IF(COUNT(C{row_num}:D{row_num})<2,0,IF(D{row_num}<C{row_num},D{row_num}+1-C{row_num},D{row_num}-C{row_num}))"
-                formula_turno2 = f"IF(COUNT(E{row_num}:F{row_num})<2,0,IF(F{row_num}<E{row_num},F{row_num}+1-E{row_num},F{row_num}-E{row_num}))"
-                
-                # Combina os dois turnos
-                cell_total.value = f"={formula_turno1}+{formula_turno2}"
-                
-                cell_total.number_format = '[h]:mm:ss'
-                cell_total.alignment = Alignment(horizontal='center')
-                cell_total.border = thin_border
-                
-                # Coluna I: Adicional Noturno (Deslocado de H para I - Art. 73 CLT)
-                cell_noturno = ws.cell(row=row_num, column=9)
-                valor_noturno = row_data.get('Adicional Noturno', timedelta(0))
-                cell_noturno.value = timedelta_to_excel_time(valor_noturno)
-                cell_noturno.number_format = '[h]:mm:ss'
-                cell_noturno.alignment = Alignment(horizontal='center')
-                cell_noturno.border = thin_border
-                # Destaque visual para hora noturna
-                if valor_noturno > timedelta(0):
-                    cell_noturno.fill = PatternFill(start_color='FEF5E7', end_color='FEF5E7', fill_type='solid')
-                    cell_noturno.font = Font(bold=True, color='D68910')
-                
-                # Colunas J-M: Horas com FÓRMULAS DINÂMICAS (CRÍTICO v4.6)
-                # J = Horas Normais: MIN(Total, Meta)
-                # K = Horas a Dever (Faltas): MAX(0, Meta - Total)
-                # L = Horas Extras 50%: MAX(0, Total - Meta)
-                # M = Horas Extras 100%: Calculado separadamente (DSR, feriados)
-                
-                # Coluna J: Horas Normais - VALOR DO BACKEND v6.3
-                # Consistência: Usa cálculo CLT do backend que trata feriados/escalas corretamente
-                cell_normais = ws.cell(row=row_num, column=10)
-                valor_normais = row_data.get('Horas Normais', timedelta(0))
-                cell_normais.value = timedelta_to_excel_time(valor_normais)
-                cell_normais.number_format = '[h]:mm:ss'
-                cell_normais.alignment = Alignment(horizontal='center')
-                cell_normais.border = thin_border
-                
-                # Coluna K: Horas a Dever (Faltas) - VALOR DO BACKEND v6.3
-                # Consistência: Usa cálculo CLT do backend que trata abonos/atestados corretamente
-                cell_faltas = ws.cell(row=row_num, column=11)
-                valor_faltas = row_data.get('Horas a Dever', timedelta(0))
-                cell_faltas.value = timedelta_to_excel_time(valor_faltas)
-                cell_faltas.number_format = '[h]:mm:ss'
-                cell_faltas.alignment = Alignment(horizontal='center')
-                cell_faltas.border = thin_border
-                cell_faltas.font = Font(color='C0392B', bold=True)  # Vermelho para faltas
-                
-                # Coluna L: Horas Extras 50% - FÓRMULA CORRIGIDA v6.3 (Anti-Duplicação)
-                # BUG FIX: Quando Meta=0 (feriado/domingo), a fórmula antiga contava
-                # todo o tempo trabalhado como 50%, mesmo já estando na coluna 100%.
-                # SOLUÇÃO: Subtrai o valor de 100% para evitar dupla contagem.
-                # Fórmula: MAX(0, Total - Meta - Extras100)
-                cell_extra50 = ws.cell(row=row_num, column=12)
-                valor_extra50 = row_data.get('Horas Extras (Comum)', timedelta(0))
-                cell_extra50.value = timedelta_to_excel_time(valor_extra50)  # Usa valor do backend
-                cell_extra50.number_format = '[h]:mm:ss'
-                cell_extra50.alignment = Alignment(horizontal='center')
-                cell_extra50.border = thin_border
-                
-                # Coluna M: Horas Extras 100% - VALOR ESTÁTICO (cálculo complexo de DSR/feriados)
-                cell_extra100 = ws.cell(row=row_num, column=13)
-                valor_extra100 = row_data.get('Horas Extras (100%)', timedelta(0))
-                cell_extra100.value = timedelta_to_excel_time(valor_extra100)
-                cell_extra100.number_format = '[h]:mm:ss'
-                cell_extra100.alignment = Alignment(horizontal='center')
-                cell_extra100.border = thin_border
-                
-                # Coluna N: Ocorrências (Texto) - DESLOCADA PARA 14
-                cell_ocorr = ws.cell(row=row_num, column=14, value=row_data.get('Ocorrências', ''))
-                cell_ocorr.alignment = Alignment(horizontal='left', wrap_text=True)
-                cell_ocorr.font = Font(size=8)
-                cell_ocorr.border = thin_border
-                
-                # Zebrado (linhas alternadas)
-                if (row_num - start_row) % 2 == 1:
-                    for col in range(1, 15):  # Aumentado para 15 (incluindo coluna Meta)
-                        ws.cell(row=row_num, column=col).fill = PatternFill(
-                            start_color='F8F9FA', end_color='F8F9FA', fill_type='solid'
-                        )
-            
-            last_data_row = start_row + len(df_funcionario) - 1
-            
-            # --- RODAPÉ COM TOTAIS (Fórmulas) ---
-            total_row = last_data_row + 2
-            
-            ws.cell(row=total_row, column=1, value="TOTAIS:")
-            ws.cell(row=total_row, column=1).font = Font(bold=True, size=11)
-            ws.cell(row=total_row, column=1).alignment = Alignment(horizontal='right')
-            
-            # Fórmulas SUM para cada coluna de tempo - DESLOCADAS UMA COLUNA (incluindo Meta)
-            formulas_cols = [
-                (7, 'G'),   # Meta
-                (8, 'H'),   # Total
-                (9, 'I'),   # Noturno
-                (10, 'J'),   # Normais
-                (11, 'K'),  # Faltas
-                (12, 'L'),  # Extra 50%
-                (13, 'M')   # Extra 100%
-            ]
-            
-            for col_idx, col_letter in formulas_cols:
-                cell = ws.cell(row=total_row, column=col_idx)
-                cell.value = f"=SUM({col_letter}{start_row}:{col_letter}{last_data_row})"
-                cell.number_format = '[h]:mm:ss'
-                cell.font = Font(bold=True, size=11)
-                cell.alignment = Alignment(horizontal='center')
-                cell.border = thin_border
-                cell.fill = PatternFill(start_color='E8F8F5', end_color='E8F8F5', fill_type='solid')
-            
-            # Saldo Final (Extra Comum + Extra 100% - Faltas)
-            saldo_row = total_row + 1
-            ws.merge_cells(f'A{saldo_row}:B{saldo_row}')
-            cell_saldo_label = ws.cell(row=saldo_row, column=1, value="SALDO HORAS EXCEDENTES (Informativo 1:1):")
-            cell_saldo_label.font = Font(bold=True, size=11, color='1ABC9C')
-            cell_saldo_label.alignment = Alignment(horizontal='right')
-            
-            ws.merge_cells(f'L{saldo_row}:M{saldo_row}')
-            cell_saldo_valor = ws.cell(row=saldo_row, column=12)  # DESLOCADO: era 11, agora 12
-            cell_saldo_valor.value = f"=L{total_row}+M{total_row}-K{total_row}"  # Extra 50% + 100% - Faltas
-            cell_saldo_valor.number_format = '[h]:mm:ss'
-            cell_saldo_valor.font = Font(bold=True, size=13, color='1ABC9C')
-            cell_saldo_valor.alignment = Alignment(horizontal='center')
-            cell_saldo_valor.border = Border(
-                top=Side(style='thick', color='1ABC9C'),
-                bottom=Side(style='thick', color='1ABC9C'),
-                left=Side(style='thick', color='1ABC9C'),
-                right=Side(style='thick', color='1ABC9C')
+    if linha["status"] == "processando":
+        print(f"[JOB] {linha['id']} retomado (worker anterior sem heartbeat)")
+    return linha["id"]
+
+
+def jobs_heartbeat(job_id: str) -> None:
+    conn = jobs_conectar()
+    try:
+        conn.execute("UPDATE jobs SET heartbeat = ? WHERE id = ? AND worker_pid = ?",
+                     (time.time(), job_id, os.getpid()))
+    finally:
+        conn.close()
+
+
+def jobs_finalizar(job_id: str, status: str, resultado: Optional[dict] = None, erro: Optional[str] = None) -> None:
+    """Grava o desfecho do job e apaga os arquivos enviados (não são mais necessários)."""
+    conn = jobs_conectar()
+    try:
+        conn.execute(
+            "UPDATE jobs SET status = ?, resultado = ?, erro = ?, atualizado_em = ?, heartbeat = NULL WHERE id = ?",
+            (status, json.dumps(resultado) if resultado is not None else None, erro, time.time(), job_id)
+        )
+        conn.execute("DELETE FROM job_paginas WHERE job_id = ?", (job_id,))
+    finally:
+        conn.close()
+    shutil.rmtree(os.path.join(JOBS_DIR, job_id), ignore_errors=True)
+
+
+def jobs_status(job_id: str) -> Optional[dict]:
+    """Estado do job com progresso por arquivo e por página (sem o resultado)."""
+    conn = jobs_conectar()
+    try:
+        job = conn.execute(
+            "SELECT id, status, criado_em, atualizado_em, tentativas, erro FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        if job is None:
+            return None
+        arquivos = conn.execute(
+            "SELECT nome, status, paginas_total, paginas_feitas, erro FROM job_arquivos "
+            "WHERE job_id = ? ORDER BY indice", (job_id,)
+        ).fetchall()
+    finally:
+        conn.close()
+    
+    arquivos = [dict(arquivo) for arquivo in arquivos]
+    # Progresso geral: cada arquivo pesa igual; dentro dele, pela fração de páginas
+    fracoes = []
+    for arquivo in arquivos:
+        if arquivo["status"] in ("concluido", "erro"):
+            fracoes.append(1.0)
+        elif arquivo["paginas_total"]:
+            fracoes.append(min(1.0, arquivo["paginas_feitas"] / arquivo["paginas_total"]))
+        else:
+            fracoes.append(0.0)
+    progresso = 1.0 if job["status"] in JOBS_STATUS_FINAIS else (sum(fracoes) / len(fracoes) if fracoes else 0.0)
+    
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "progresso": round(progresso * 100, 1),
+        "arquivos": arquivos,
+        "tentativas": job["tentativas"],
+        "erro": job["erro"],
+        "criado_em": datetime.fromtimestamp(job["criado_em"]).isoformat(timespec="seconds"),
+        "atualizado_em": datetime.fromtimestamp(job["atualizado_em"]).isoformat(timespec="seconds")
+    }
+
+
+def jobs_resultado(job_id: str) -> Optional[tuple]:
+    """(status, resultado dict ou None, erro) do job, ou None se não existir."""
+    conn = jobs_conectar()
+    try:
+        job = conn.execute("SELECT status, resultado, erro FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+    if job is None:
+        return None
+    return job["status"], json.loads(job["resultado"]) if job["resultado"] else None, job["erro"]
+
+
+def jobs_limpar_expirados() -> None:
+    """LGPD: remove jobs (e arquivos) mais antigos que JOBS_RETENCAO_H."""
+    limite = time.time() - JOBS_RETENCAO_H * 3600
+    conn = jobs_conectar()
+    try:
+        expirados = [linha["id"] for linha in conn.execute(
+            "SELECT id FROM jobs WHERE atualizado_em < ? AND status IN ('concluido', 'erro', 'pendente')", (limite,)
+        )]
+        for job_id in expirados:
+            conn.execute("DELETE FROM job_paginas WHERE job_id = ?", (job_id,))
+            conn.execute("DELETE FROM job_arquivos WHERE job_id = ?", (job_id,))
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+    finally:
+        conn.close()
+    for job_id in expirados:
+        shutil.rmtree(os.path.join(JOBS_DIR, job_id), ignore_errors=True)
+    if expirados:
+        print(f"[JOB] {len(expirados)} job(s) expirado(s) removido(s)")
+
+
+class ProgressoArquivoJob:
+    """
+    Checkpoint de um arquivo do job: páginas concluídas (JSON extraído) e contadores.
+    
+    Passado para processar_pdf_com_gemini/processar_imagem_com_gemini, que pulam as
+    páginas já salvas e gravam cada página assim que termina.
+    """
+    
+    def __init__(self, job_id: str, indice: int):
+        self.job_id = job_id
+        self.indice = indice
+    
+    def paginas_prontas(self) -> dict:
+        conn = jobs_conectar()
+        try:
+            linhas = conn.execute(
+                "SELECT pagina, dados FROM job_paginas WHERE job_id = ? AND arquivo = ?",
+                (self.job_id, self.indice)
+            ).fetchall()
+        finally:
+            conn.close()
+        return {linha["pagina"]: json.loads(linha["dados"]) if linha["dados"] else None for linha in linhas}
+    
+    def definir_total(self, total: int) -> None:
+        self._atualizar_arquivo("paginas_total = ?", (total,))
+    
+    def pagina_concluida(self, pagina: int, json_data: Optional[dict]) -> None:
+        conn = jobs_conectar()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT OR REPLACE INTO job_paginas (job_id, arquivo, pagina, dados) VALUES (?, ?, ?, ?)",
+                (self.job_id, self.indice, pagina, json.dumps(json_data) if json_data is not None else None)
             )
-            
-            # --- CÓDIGOS CONTÁBEIS (PADRÃO FECHAMENTO DE FOLHA) ---
-            codigos_row = saldo_row + 2
-            
-            # Cabeçalho da seção
-            ws.merge_cells(f'A{codigos_row}:N{codigos_row}')
-            cell_cod_header = ws.cell(row=codigos_row, column=1, value="RESUMO PARA FECHAMENTO DE FOLHA (CÓDIGOS CONTÁBEIS)")
-            cell_cod_header.font = Font(bold=True, size=11, color='FFFFFF')
-            cell_cod_header.fill = PatternFill(start_color='34495E', end_color='34495E', fill_type='solid')
-            cell_cod_header.alignment = Alignment(horizontal='center', vertical='center')
-            ws.row_dimensions[codigos_row].height = 22
-            
-            # Linha de cabeçalhos das colunas
-            cod_header_row = codigos_row + 1
-            headers_cod = ['Código', 'Descrição', 'Horas (HH:MM)', 'Horas Decimais']
-            for col_idx, header in enumerate(headers_cod, start=1):
-                cell = ws.cell(row=cod_header_row, column=col_idx, value=header)
-                cell.font = Font(bold=True, size=10)
-                cell.fill = PatternFill(start_color='BDC3C7', end_color='BDC3C7', fill_type='solid')
-                cell.alignment = Alignment(horizontal='center')
-                cell.border = thin_border
-            
-            # IMPORTANTE v6.1:
-            # Os valores abaixo já vêm da apuração semanal CLT (44h),
-            # a mesma usada no preview JSON.
-            # NÃO usar fórmulas Excel que referenciam soma diária para evitar divergências.
-            
-            # Obtém totais semanais do backend (ou fallback para timedelta zero)
-            func_totais = totais_semanais.get(funcionario, {})
-            extras_50_semanal = func_totais.get("extra50", timedelta())
-            extras_100_semanal = func_totais.get("extra100", timedelta())
-            
-            # Código 150 - Extra 50% (Dias Úteis) - VALOR SEMANAL CLT
-            cod150_row = cod_header_row + 1
-            ws.cell(row=cod150_row, column=1, value="150").alignment = Alignment(horizontal='center')
-            ws.cell(row=cod150_row, column=2, value="Horas Extras 50% (Dias Úteis)")
-            cell_150_horas = ws.cell(row=cod150_row, column=3)
-            cell_150_horas.value = timedelta_to_excel_time(extras_50_semanal)  # Valor semanal CLT
-            cell_150_horas.number_format = '[h]:mm:ss'
-            cell_150_horas.alignment = Alignment(horizontal='center')
-            cell_150_decimal = ws.cell(row=cod150_row, column=4)
-            cell_150_decimal.value = extras_50_semanal.total_seconds() / 3600  # Decimal semanal
-            cell_150_decimal.number_format = '0.00'
-            cell_150_decimal.alignment = Alignment(horizontal='center')
-            
-            # Código 200 - Extra 100% (Domingos/Feriados) - VALOR SEMANAL CLT
-            cod200_row = cod150_row + 1
-            ws.cell(row=cod200_row, column=1, value="200").alignment = Alignment(horizontal='center')
-            ws.cell(row=cod200_row, column=2, value="Horas Extras 100% (Domingos/Feriados)")
-            cell_200_horas = ws.cell(row=cod200_row, column=3)
-            cell_200_horas.value = timedelta_to_excel_time(extras_100_semanal)  # Valor semanal CLT
-            cell_200_horas.number_format = '[h]:mm:ss'
-            cell_200_horas.alignment = Alignment(horizontal='center')
-            cell_200_decimal = ws.cell(row=cod200_row, column=4)
-            cell_200_decimal.value = extras_100_semanal.total_seconds() / 3600  # Decimal semanal
-            cell_200_decimal.number_format = '0.00'
-            cell_200_decimal.alignment = Alignment(horizontal='center')
-            
-            # Código 25 - Adicional Noturno — SEÇÃO SEPARADA (INFORMATIVO)
-            # ============================================================
-            # CORREÇÃO v6.0: Noturno é ATRIBUTO, não TEMPO somável.
-            # Separar visualmente para evitar que usuário some incorretamente.
-            # ============================================================
-            
-            # Linha de separação visual
-            noturno_header_row = cod200_row + 2
-            ws.merge_cells(f'A{noturno_header_row}:D{noturno_header_row}')
-            cell_noturno_header = ws.cell(row=noturno_header_row, column=1)
-            cell_noturno_header.value = "INFORMATIVO — ADICIONAL NOTURNO (não soma em horas)"
-            cell_noturno_header.font = Font(bold=True, size=9, italic=True, color='7F8C8D')
-            cell_noturno_header.fill = PatternFill(start_color='ECF0F1', end_color='ECF0F1', fill_type='solid')
-            cell_noturno_header.alignment = Alignment(horizontal='center', vertical='center')
-            cell_noturno_header.border = thin_border
-            ws.row_dimensions[noturno_header_row].height = 18
-            
-            # Código 25 - Dados
-            cod25_row = noturno_header_row + 1
-            ws.cell(row=cod25_row, column=1, value="25").alignment = Alignment(horizontal='center')
-            ws.cell(row=cod25_row, column=2, value="Base Noturna (atributo financeiro)")
-            cell_25_horas = ws.cell(row=cod25_row, column=3)
-            cell_25_horas.value = f"=I{total_row}"  # Referência ao total de Noturno
-            cell_25_horas.number_format = '[h]:mm:ss'
-            cell_25_horas.alignment = Alignment(horizontal='center')
-            cell_25_decimal = ws.cell(row=cod25_row, column=4)
-            cell_25_decimal.value = f"=I{total_row}*24"  # Noturno em decimal
-            cell_25_decimal.number_format = '0.00'
-            cell_25_decimal.alignment = Alignment(horizontal='center')
-            
-            # Aplicar bordas em todas as células dos códigos (150 e 200 apenas)
-            for row in range(cod_header_row, cod200_row + 1):
-                for col in range(1, 5):
-                    ws.cell(row=row, column=col).border = thin_border
-            
-            # Bordas para seção noturno
-            for col in range(1, 5):
-                ws.cell(row=cod25_row, column=col).border = thin_border
-            
-            # Destaque visual para códigos de TEMPO (150 e 200)
-            for row in [cod150_row, cod200_row]:
-                ws.cell(row=row, column=1).font = Font(bold=True, color='2C3E50')
-                ws.cell(row=row, column=4).font = Font(bold=True, color='27AE60')
-            
-            # Destaque visual diferenciado para noturno (cor mais suave)
-            ws.cell(row=cod25_row, column=1).font = Font(bold=True, color='7F8C8D')
-            ws.cell(row=cod25_row, column=4).font = Font(bold=True, color='D68910')
-            
-            # --- AVISO LEGAL (SIMPLIFICADO) ---
-            aviso_row = cod25_row + 2
-            ws.merge_cells(f'A{aviso_row}:N{aviso_row}')
-            cell_aviso = ws.cell(row=aviso_row, column=1)
-            cell_aviso.value = (
-                "Códigos 150 e 200 = horas para pagamento. "
-                "Código 25 = base para adicional noturno (não soma em horas trabalhadas). "
-                "Saldo 1:1 é informativo."
+            conn.execute(
+                "UPDATE job_arquivos SET paginas_feitas = (SELECT COUNT(*) FROM job_paginas "
+                "WHERE job_id = ? AND arquivo = ?) WHERE job_id = ? AND indice = ?",
+                (self.job_id, self.indice, self.job_id, self.indice)
             )
-            cell_aviso.font = Font(size=8, italic=True, color='7F8C8D')
-            cell_aviso.alignment = Alignment(wrap_text=True, horizontal='left')
-            ws.row_dimensions[aviso_row].height = 20
-            
-            # --- HASH DE INTEGRIDADE ---
-            hash_row = aviso_row + 2
-            
-            # Gera hash SHA-256 dos dados
-            dados_str = json.dumps(df_funcionario.to_dict(), sort_keys=True, default=str)
-            hash_value = hashlib.sha256(dados_str.encode()).hexdigest()[:16]
-            
-            ws.merge_cells(f'A{hash_row}:N{hash_row}')  # DESLOCADO: era M, agora N
-            cell_hash = ws.cell(row=hash_row, column=1)
-            cell_hash.value = f"�� Hash de Integridade: {hash_value.upper()}"
-            cell_hash.font = Font(size=7, color='95A5A6', name='Courier New')
-            cell_hash.alignment = Alignment(horizontal='center')
-            
-            # --- ASSINATURAS ---
-            assinatura_row = hash_row + 3
-            
-            ws.merge_cells(f'A{assinatura_row}:E{assinatura_row}')
-            ws.cell(row=assinatura_row, column=1, value="_" * 40)
-            ws.cell(row=assinatura_row + 1, column=1, value="ASSINATURA DO FUNCIONÁRIO")
-            ws.cell(row=assinatura_row + 1, column=1).font = Font(size=9, bold=True)
-            ws.cell(row=assinatura_row + 1, column=1).alignment = Alignment(horizontal='center')
-            ws.merge_cells(f'H{assinatura_row}:L{assinatura_row}')
-        ws.cell(row=assinatura_row, column=8, value="_" * 40)
-        ws.cell(row=assinatura_row + 1, column=8, value="ASSINATURA DO GESTOR")
-        ws.cell(row=assinatura_row + 1, column=8).font = Font(size=9, bold=True)
-        ws.cell(row=assinatura_row + 1, column=8).alignment = Alignment(horizontal='center')
-        
-        # --- AJUSTE DE LARGURAS DAS COLUNAS ---
-        column_widths = {
-            'A': 12,  # Data
-            'B': 8,   # Dia
-            'C': 9,   # Ent. 1
-            'D': 9,   # Sai. 1
-            'E': 9,   # Ent. 2
-            'F': 9,   # Sai. 2
-            'G': 10,  # Meta (NOVO)
-            'H': 10,  # Total
-            'I': 10,  # Noturno
-            'J': 10,  # Normais
-            'K': 10,  # Faltas
-            'L': 11,  # Extra 50%
-            'M': 11,  # Extra 100%
-            'N': 25   # Ocorrências
-        }
-        
-        for col_letter, width in column_widths.items():
-            ws.column_dimensions[col_letter].width = width
-        
-        # Configurações de impressão (Paisagem, A4)
-        ws.page_setup.orientation = ws.ORIENTATION_LANDSCAPE
-        ws.page_setup.paperSize = ws.PAPERSIZE_A4
-        ws.page_setup.fitToPage = True
-        ws.page_setup.fitToHeight = 0
-        ws.page_setup.fitToWidth = 1
-        
-        # Margens
-        ws.page_margins.left = 0.5
-        ws.page_margins.right = 0.5
-        ws.page_margins.top = 0.75
-        ws.page_margins.bottom = 0.75
-        
-        # Congela painéis (cabeçalho)
-        ws.freeze_panes = 'A7'
+            conn.execute("UPDATE jobs SET heartbeat = ?, atualizado_em = ? WHERE id = ?",
+                         (time.time(), time.time(), self.job_id))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
     
-    wb.save(output)
-    output.seek(0)
-    return output
+    def finalizar(self, status: str, erro: Optional[str] = None) -> None:
+        self._atualizar_arquivo("status = ?, erro = ?", (status, erro))
+    
+    def _atualizar_arquivo(self, campos: str, valores: tuple) -> None:
+        conn = jobs_conectar()
+        try:
+            conn.execute(f"UPDATE job_arquivos SET {campos} WHERE job_id = ? AND indice = ?",
+                         valores + (self.job_id, self.indice))
+        finally:
+            conn.close()
+
+
+async def executar_job(job_id: str) -> None:
+    """Processa um job reservado: extrai os arquivos (com checkpoint), calcula e grava o resultado."""
+    conn = jobs_conectar()
+    try:
+        job = conn.execute("SELECT settings FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        arquivos = conn.execute(
+            "SELECT indice, nome, caminho, status FROM job_arquivos WHERE job_id = ? ORDER BY indice", (job_id,)
+        ).fetchall()
+    finally:
+        conn.close()
+    
+    settings_dict = json.loads(job["settings"])
+    print(f"\n{'='*70}")
+    print(f"[JOB] {job_id}: {len(arquivos)} arquivo(s) (worker {os.getpid()})")
+    print(f"{'='*70}\n")
+    
+    dados_consolidados = RegistrosPonto()
+    for arquivo in arquivos:
+        progresso = ProgressoArquivoJob(job_id, arquivo["indice"])
+        if arquivo["status"] == "erro":
+            continue  # Mesmo comportamento do /converter: arquivo com erro é ignorado
+        try:
+            progresso.finalizar("processando")
+            with open(arquivo["caminho"], "rb") as f:
+                dados_consolidados.estender(await extrair_registros_arquivo(arquivo["nome"], f, progresso))
+            progresso.finalizar("concluido")
+        except Exception as e:
+            print(f"[AVISO] Erro ao processar {arquivo['nome']}: {e}")
+            progresso.finalizar("erro", str(e))
+    
+    try:
+        resultado = gerar_resposta_conversao(dados_consolidados, settings_dict)
+    except ValueError as e:
+        print(f"❌ [JOB] {job_id} (ValueError): {e}")
+        jobs_finalizar(job_id, "erro", erro=str(e))
+        return
+    
+    jobs_finalizar(job_id, "concluido", resultado)
+    print(f"[JOB] {job_id} concluído: {resultado['filename']}")
+
+
+def _worker_jobs_heartbeat(job_id: str, parar: threading.Event) -> None:
+    # Mantém o job "vivo" durante etapas longas sem páginas novas (cálculo, Excel)
+    while not parar.wait(JOBS_HEARTBEAT_S):
+        try:
+            jobs_heartbeat(job_id)
+        except sqlite3.Error as e:
+            print(f"[AVISO] Heartbeat do job {job_id} falhou: {e}")
+
+
+def worker_jobs(numero: int) -> None:
+    """Loop de um processo worker: reserva, executa e finaliza jobs até o processo pai sair."""
+    pai = os.getppid()
+    print(f"[JOB] Worker #{numero} iniciado (pid {os.getpid()})")
+    proxima_limpeza = 0.0
+    
+    while os.getppid() == pai:
+        try:
+            if time.monotonic() >= proxima_limpeza:
+                proxima_limpeza = time.monotonic() + JOBS_INTERVALO_LIMPEZA_S
+                jobs_limpar_expirados()
+            
+            job_id = jobs_reservar_proximo()
+            if job_id is None:
+                time.sleep(JOBS_INTERVALO_POLL_S)
+                continue
+            
+            parar = threading.Event()
+            threading.Thread(target=_worker_jobs_heartbeat, args=(job_id, parar), daemon=True).start()
+            try:
+                asyncio.run(executar_job(job_id))
+            except Exception as e:
+                print(f"[ERRO] Job {job_id} falhou: {e}")
+                traceback.print_exc()
+                jobs_finalizar(
+                    job_id, "erro",
+                    erro="Ocorreu um erro interno ao processar os cálculos. Por favor, tente novamente mais tarde."
+                )
+            finally:
+                parar.set()
+        except sqlite3.Error as e:
+            print(f"[AVISO] Fila de jobs indisponível: {e}")
+            time.sleep(JOBS_INTERVALO_POLL_S * 5)
+
+
+_JOBS_PROCESSOS: List[multiprocessing.Process] = []
+
+
+@app.on_event("startup")
+def iniciar_workers_jobs():
+    if not JOBS_ATIVO or JOBS_WORKERS <= 0:
+        return
+    jobs_conectar().close()  # Cria o schema antes de subir os workers
+    contexto = multiprocessing.get_context("spawn")  # Sem herdar event loop/threads do uvicorn
+    for numero in range(1, JOBS_WORKERS + 1):
+        processo = contexto.Process(target=worker_jobs, args=(numero,), daemon=True, name=f"pontosync-job-{numero}")
+        processo.start()
+        _JOBS_PROCESSOS.append(processo)
+
+
+@app.on_event("shutdown")
+def parar_workers_jobs():
+    # Jobs interrompidos aqui são retomados pelo próximo worker (heartbeat expira)
+    for processo in _JOBS_PROCESSOS:
+        processo.terminate()
+    for processo in _JOBS_PROCESSOS:
+        processo.join(timeout=5)
+    _JOBS_PROCESSOS.clear()
 
 
 # ===== ROTAS DA API =====
@@ -2166,13 +5373,13 @@ async def root():
     elif num_keys == 1:
         gemini_status = "✅ 1 chave configurada"
     else:
-        gemini_status = f"✅ {num_keys} chaves configuradas (fallback automático)"
+        gemini_status = f"✅ {num_keys} chaves configuradas (escalonamento por cota)"
     
     return {
         "status": "online",
         "versao": "2.2 - Múltiplas Chaves API",
         "gemini_api": gemini_status,
-        "modelo": "gemini-2.5-flash",
+        "modelo": GEMINI_MODELO_NOME,
         "formatos_suportados": ["TXT", "PDF", "JPG", "PNG"],
         "recursos": {
             "jornada_noturna": "✅ Suportada",
@@ -2183,8 +5390,14 @@ async def root():
             "batidas_separadas": "✅ 4 colunas editáveis",
             "formulas_excel": "✅ Totais dinâmicos",
             "status_opcoes": "FALTA, ATESTADO, FOLGA, DSR, FERIADO, ABONO",
-            "multi_api_keys": f"✅ Suporte a {num_keys} chave(s) com fallback automático"
+            "multi_api_keys": f"✅ Suporte a {num_keys} chave(s) com escalonamento por cota",
+            "pdf_camada_texto": "✅ PDFs digitais lidos sem IA" if PDF_CAMADA_TEXTO_ATIVA else "Desativado",
+            "cache_extracao": "✅ Cache em disco por conteúdo (SHA-256)" if GEMINI_CACHE_ATIVO else "Desativado",
+            "fila_jobs": f"✅ Rota /jobs ({JOBS_WORKERS} worker(s), retomada por página)" if JOBS_ATIVO else "Desativado",
+            "download_excel": "✅ Rota /resultados/{id} (gerado sob demanda, cache LRU, streaming com ETag)",
+            "zip_por_funcionario": "✅ Rota /resultados/{id}/zip (um espelho por funcionário, gerados em paralelo)"
         },
+        "chaves_api": GEMINI_POOL.status(),
         "status_explicacoes": {
             "FALTA": "Dia não trabalhado sem justificativa",
             "ATESTADO": "Dia abonado por atestado médico",
@@ -2196,6 +5409,23 @@ async def root():
     }
 
 
+@app.get("/feriados")
+async def listar_feriados(ano_inicio: int, ano_fim: Optional[int] = None, municipio: str = "",
+                          nacionais: bool = True, empresa_cnpj: str = ""):
+    """NOVO v8.8: Feriados que o cálculo aplicará para os anos/localidade (conferência no frontend)"""
+    ano_fim = ano_fim or ano_inicio
+    if not 1900 <= ano_inicio <= ano_fim <= ano_inicio + 10:
+        return JSONResponse({"erro": "Intervalo de anos inválido (máximo 10 anos)."}, status_code=400)
+    indice = compilar_feriados(ano_inicio, ano_fim, nacionais,
+                               _chave_localidade(municipio), _chave_cnpj(empresa_cnpj))
+    return JSONResponse({
+        "feriados": [
+            {"data": d.strftime('%d/%m/%Y'), "nome": indice.nome(d)}
+            for d in sorted(indice.datas)
+        ]
+    })
+
+
 @app.post("/converter")
 async def converter_cartao_ponto(
     files: List[UploadFile] = File(...),
@@ -2217,54 +5447,33 @@ async def converter_cartao_ponto(
         print(f"{'='*70}\n")
         
         # Processa todos os arquivos
-        dados_consolidados = []
+        dados_consolidados = RegistrosPonto()
         
         for arquivo in files:
-            filename = arquivo.filename.lower()
-            
             try:
-                if filename.endswith('.txt'):
-                    conteudo = arquivo.file.read().decode("utf-8")
-                    arquivo.file.seek(0)
-                    dados = processar_txt(conteudo)
-                    dados_consolidados.extend(dados)
-                    
-                elif filename.endswith('.pdf'):
-                    pdf_bytes = arquivo.file.read()
-                    arquivo.file.seek(0)
-                    dados = processar_pdf_com_gemini(pdf_bytes, arquivo.filename)
-                    dados_consolidados.extend(dados)
-                    
-                elif filename.endswith(('.jpg', '.jpeg', '.png')):
-                    img_bytes = arquivo.file.read()
-                    arquivo.file.seek(0)
-                    dados = processar_imagem_com_gemini(img_bytes, arquivo.filename)
-                    dados_consolidados.extend(dados)
-                    
+                dados_consolidados.estender(await extrair_registros_arquivo(arquivo.filename, arquivo.file))
             except Exception as e:
                 print(f"[AVISO] Erro ao processar {arquivo.filename}: {e}")
                 continue
+            finally:
+                arquivo.file.seek(0)
         
         if not dados_consolidados:
             raise ValueError("Nenhum dado válido foi encontrado nos arquivos enviados.")
         
-        # Calcula com a função isolada (sem overrides no primeiro processamento)
-        relatorio, preview, totais_semanais = calcular_relatorio(dados_consolidados, settings_dict, status_overrides=None)
+        print(f"[DATA] {len(dados_consolidados)} batida(s) por origem: {dados_consolidados.contagem_por_origem()}")
         
-        if not relatorio:
-            raise ValueError("Não foi possível calcular o relatório.")
+        # NOVO v8.1: Cálculo no pool de processos (event loop livre); v9.5: Excel só no download
+        resultado = await calcular_e_registrar_async(dados_consolidados, settings_dict, status_overrides=None)
         
-        # Gera Excel PROFISSIONAL - NOVO v6.1: passa totais semanais para códigos 150/200
-        arquivo_excel = gerar_excel(relatorio, settings_dict, totais_semanais)
-        encoded_file = base64.b64encode(arquivo_excel.getvalue()).decode('utf-8')
-        filename = f"Espelho_Ponto_{datetime.now().strftime('%Y-%m-%d_%H%M')}.xlsx"
+        if resultado is None:
+            raise ValueError("Não foi possível calcular o relatório.")
         
-        return JSONResponse({
-            "preview": preview,
-            "file": encoded_file,
-            "filename": filename
-        })
+        return JSONResponse(montar_resposta_excel(*resultado, prefixo="Espelho_Ponto"))
     
+    except HTTPException as e:
+        print(f"[AVISO] {e.detail}")
+        return JSONResponse({"erro": e.detail}, status_code=e.status_code)
     except ValueError as e:
         print(f"❌ ERRO CRÍTICO (ValueError): {e}")
         return JSONResponse({"erro": str(e)}, status_code=400)
@@ -2300,8 +5509,8 @@ async def recalcular_com_edicoes(payload: dict):
         if not dados_corrigidos or not settings:
             raise ValueError("Payload incompleto: faltam 'dados_corrigidos' ou 'configuracoes'")
         
-        # Reconstrói a lista de batidas a partir do JSON editado
-        dados_reconstruidos = []
+        # Reconstrói as batidas a partir do JSON editado (NOVO v9.0: direto nas colunas)
+        dados_reconstruidos = RegistrosPonto()
         status_overrides = {}
         
         ano_base_detectado = None  # Detectar ano dos dados
@@ -2403,14 +5612,9 @@ async def recalcular_com_edicoes(payload: dict):
                                 warnings.append(warning_msg)
                                 continue
                     
-                    # Se conseguiu processar horários, adiciona à lista
-                    if horarios:
-                        for hor in horarios:
-                            dados_reconstruidos.append({
-                                "nome": funcionario,
-                                "data": data_completa,
-                                "hora": hor.time()
-                            })
+                    # Se conseguiu processar horários, adiciona ao armazém
+                    for hor in horarios:
+                        dados_reconstruidos.adicionar(funcionario, data_completa, hor.time(), origem="edicao")
                 
                 except ValueError as ve:
                     # ROBUSTEZ: Log detalhado de erro ao parsear data
@@ -2429,31 +5633,25 @@ async def recalcular_com_edicoes(payload: dict):
         if warnings:
             print(f"[AVISO] Total de warnings durante processamento: {len(warnings)}")
         
-        # Recalcula PASSANDO OS OVERRIDES
-        relatorio, preview, totais_semanais = calcular_relatorio(dados_reconstruidos, settings, status_overrides=status_overrides)
+        # Recalcula PASSANDO OS OVERRIDES - NOVO v8.1: no pool de processos
+        resultado = await calcular_e_registrar_async(dados_reconstruidos, settings, status_overrides=status_overrides)
         
-        if relatorio is None:
+        if resultado is None:
             raise ValueError("Não foi possível recalcular.")
         
-        # Gera novo Excel PROFISSIONAL - NOVO v6.1: passa totais semanais para códigos 150/200
-        arquivo_excel = gerar_excel(relatorio, settings, totais_semanais)
-        encoded_file = base64.b64encode(arquivo_excel.getvalue()).decode('utf-8')
-        filename = f"Espelho_Recalculado_{datetime.now().strftime('%Y-%m-%d_%H%M')}.xlsx"
-        
-        print(f"[OK] Recálculo concluído: {filename}\n")
-        
         # ROBUSTEZ: Inclui warnings na resposta JSON para o frontend
-        response_data = {
-            "preview": preview,
-            "file": encoded_file,
-            "filename": filename
-        }
+        response_data = montar_resposta_excel(*resultado, prefixo="Espelho_Recalculado")
+        
+        print(f"[OK] Recálculo concluído: {response_data['filename']}\n")
         
         if warnings:
             response_data["warnings"] = warnings
         
         return JSONResponse(response_data)
     
+    except HTTPException as e:
+        print(f"[AVISO] {e.detail}")
+        return JSONResponse({"erro": e.detail, "warnings": warnings}, status_code=e.status_code)
     except ValueError as e:
         print(f"[ERRO] ERRO CRÍTICO (ValueError): {e}")
         import traceback
@@ -2477,3 +5675,166 @@ async def recalcular_com_edicoes(payload: dict):
             }, 
             status_code=500
         )
+
+
+@app.get("/resultados/{arquivo_id}")
+async def baixar_resultado(arquivo_id: str, request: Request, filename: str = "Espelho_Ponto.xlsx"):
+    """
+    NOVO v9.4: Download do Excel de um resultado do /converter, /recalcular ou job.
+    
+    Envia o arquivo em streaming com Content-Length e ETag (If-None-Match -> 304).
+    NOVO v9.5: o Excel é gerado aqui, no primeiro pedido (pool de cálculo), e fica em cache.
+    """
+    if not _RESULTADO_ID_VALIDO.match(arquivo_id):
+        return JSONResponse({"erro": "Arquivo não encontrado (ou expirado)."}, status_code=404)
+    if not _NOME_DOWNLOAD_VALIDO.match(filename):
+        filename = "Espelho_Ponto.xlsx"
+    
+    caminho = await asyncio.to_thread(localizar_excel_resultado, arquivo_id)
+    if caminho is None:
+        try:
+            caminho = await executar_no_pool_calculo(gerar_excel_resultado, arquivo_id)
+        except HTTPException as e:
+            return JSONResponse({"erro": e.detail}, status_code=e.status_code)
+        if caminho is None:
+            return JSONResponse({"erro": "Arquivo não encontrado (ou expirado)."}, status_code=404)
+    
+    info = os.stat(caminho)
+    etag = await asyncio.to_thread(etag_resultado, caminho, info.st_mtime_ns, info.st_size)
+    cabecalhos = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=cabecalhos)
+    
+    return FileResponse(caminho, media_type=XLSX_MEDIA_TYPE, filename=filename,
+                        headers=cabecalhos, stat_result=info)
+
+
+@app.get("/resultados/{arquivo_id}/zip")
+async def baixar_resultado_zip(arquivo_id: str, filename: str = "Espelho_Ponto_Funcionarios.zip"):
+    """
+    NOVO v9.6: ZIP com um espelho (.xlsx) por funcionário, para coleta de assinaturas.
+    
+    Os espelhos são gerados em paralelo no pool de cálculo e enviados conforme ficam prontos
+    (sem Content-Length: o tamanho só é conhecido no fim). A exportação ocupa uma vaga da fila
+    por espelho em geração; a primeira é esperada aqui (503 se não vagar a tempo).
+    """
+    if not _RESULTADO_ID_VALIDO.match(arquivo_id):
+        return JSONResponse({"erro": "Arquivo não encontrado (ou expirado)."}, status_code=404)
+    if not _NOME_ZIP_VALIDO.match(filename):
+        filename = "Espelho_Ponto_Funcionarios.zip"
+    
+    carregado = await asyncio.to_thread(carregar_espelhos_funcionarios, arquivo_id)
+    if carregado is None:
+        return JSONResponse({"erro": "Arquivo não encontrado (ou expirado)."}, status_code=404)
+    
+    exportacao = ExportacaoZip(*carregado)
+    if not await exportacao.reservar():
+        return JSONResponse({"erro": "Servidor ocupado com outros cálculos. Tente novamente em instantes."},
+                            status_code=503)
+    
+    print(f"[ZIP] Exportando {len(carregado[0])} espelho(s) do resultado {arquivo_id}")
+    return RespostaZip(exportacao, media_type="application/zip",
+                       headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+# ===== NOVO v8.0: ROTAS DA FILA DE JOBS =====
+def _jobs_salvar_uploads(job_id: str, files: List[UploadFile]) -> List[tuple]:
+    pasta = os.path.join(JOBS_DIR, job_id)
+    os.makedirs(pasta, exist_ok=True)
+    arquivos = []
+    for indice, arquivo in enumerate(files):
+        # Nome em disco derivado do índice (o nome original só fica no banco)
+        extensao = os.path.splitext(arquivo.filename or "")[1].lower()[:8]
+        caminho = os.path.join(pasta, f"{indice:03d}{extensao}")
+        with open(caminho, "wb") as destino:
+            shutil.copyfileobj(arquivo.file, destino, TXT_CHUNK_BYTES)
+        arquivos.append((arquivo.filename or f"arquivo_{indice + 1}", caminho))
+    return arquivos
+
+
+@app.post("/jobs")
+async def criar_job_conversao(
+    files: List[UploadFile] = File(...),
+    settings: str = Form(...),
+    consent_metadata: str = Form(...)
+):
+    """
+    Enfileira a conversão (mesmos campos do /converter) e retorna o job_id na hora.
+    
+    Acompanhe em GET /jobs/{job_id} (ou /jobs/{job_id}/eventos) e busque o
+    resultado (mesmo formato do /converter) em GET /jobs/{job_id}/resultado.
+    """
+    if not JOBS_ATIVO:
+        return JSONResponse({"erro": "Fila de jobs desativada. Use a rota /converter."}, status_code=503)
+    
+    try:
+        settings_dict = json.loads(settings)
+        consent_dict = json.loads(consent_metadata)
+    except json.JSONDecodeError as e:
+        return JSONResponse({"erro": f"Settings inválidos: {e}"}, status_code=400)
+    
+    job_id = uuid.uuid4().hex
+    try:
+        arquivos = await asyncio.to_thread(_jobs_salvar_uploads, job_id, files)
+        await asyncio.to_thread(jobs_criar, job_id, arquivos, json.dumps(settings_dict), json.dumps(consent_dict))
+    except Exception as e:
+        print(f"[ERRO] Falha ao enfileirar job: {e}")
+        shutil.rmtree(os.path.join(JOBS_DIR, job_id), ignore_errors=True)
+        return JSONResponse(
+            {"erro": "Ocorreu um erro interno ao enfileirar os arquivos. Por favor, tente novamente mais tarde."},
+            status_code=500
+        )
+    
+    print(f"[JOB] {job_id} enfileirado: {len(arquivos)} arquivo(s), consentimento LGPD {consent_dict.get('timestamp')}")
+    return JSONResponse({
+        "job_id": job_id,
+        "status": "pendente",
+        "status_url": f"/jobs/{job_id}",
+        "resultado_url": f"/jobs/{job_id}/resultado"
+    }, status_code=202)
+
+
+@app.get("/jobs/{job_id}")
+async def consultar_job(job_id: str):
+    """Status e progresso (por arquivo e por página) de um job"""
+    status = await asyncio.to_thread(jobs_status, job_id)
+    if status is None:
+        return JSONResponse({"erro": "Job não encontrado (ou expirado)."}, status_code=404)
+    return JSONResponse(status)
+
+
+@app.get("/jobs/{job_id}/eventos")
+async def acompanhar_job(job_id: str):
+    """Server-Sent Events: envia o status a cada mudança até o job terminar"""
+    async def eventos():
+        anterior = None
+        while True:
+            status = await asyncio.to_thread(jobs_status, job_id)
+            if status is None:
+                yield f"event: erro\ndata: {json.dumps({'erro': 'Job não encontrado (ou expirado).'})}\n\n"
+                return
+            atual = json.dumps(status, ensure_ascii=False)
+            if atual != anterior:
+                yield f"data: {atual}\n\n"
+                anterior = atual
+            if status["status"] in JOBS_STATUS_FINAIS:
+                return
+            await asyncio.sleep(JOBS_INTERVALO_POLL_S)
+    
+    return StreamingResponse(eventos(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/jobs/{job_id}/resultado")
+async def resultado_job(job_id: str):
+    """Resultado do job no mesmo formato do /converter (202 enquanto não termina)"""
+    resultado = await asyncio.to_thread(jobs_resultado, job_id)
+    if resultado is None:
+        return JSONResponse({"erro": "Job não encontrado (ou expirado)."}, status_code=404)
+    
+    status, dados, erro = resultado
+    if status == "concluido":
+        return JSONResponse(dados)
+    if status == "erro":
+        return JSONResponse({"erro": erro}, status_code=400)
+    return JSONResponse({"job_id": job_id, "status": status}, status_code=202)
@@ -0,0 +1,569 @@
+"""
+Testes do motor de cálculo (python -m pytest -q, na pasta backend).
+"""
+import multiprocessing
+import pickle
+import random
+from datetime import date, datetime, time as dt_time, timedelta
+
+import pytest
+
+import backend
+
+
+def registros_mes(n_funcionarios: int = 4, inicio: date = date(2024, 3, 1), dias: int = 28) -> backend.RegistrosPonto:
+    """Jornada comercial (08-12 / 13-17 ou 18) de segunda a sábado para n funcionários"""
+    registros = backend.RegistrosPonto()
+    for f in range(n_funcionarios):
+        nome = f"FUNC{f:02d}"
+        saida = dt_time(17 + f % 2, 5 * f % 60)
+        for d in range(dias):
+            dia = inicio + timedelta(days=d)
+            if dia.weekday() == 6:
+                continue
+            for hora in (dt_time(8, 0), dt_time(12, 0), dt_time(13, 0), saida):
+                registros.adicionar(nome, dia, hora, 'teste')
+    return registros
+
+
+def registros_de(batidas: list) -> backend.RegistrosPonto:
+    """[(nome, datetime), ...] -> RegistrosPonto"""
+    registros = backend.RegistrosPonto()
+    for nome, momento in batidas:
+        registros.adicionar(nome, momento.date(), momento.time(), 'teste')
+    return registros
+
+
+def registros_variados(n_funcionarios: int = 12, inicio: date = date(2024, 11, 1), dias: int = 45,
+                       semente: int = 1) -> backend.RegistrosPonto:
+    """
+    Mês e meio misturando perfis: comercial, sem almoço, saída esquecida (batida ímpar),
+    hora extra à noite e noturno 22:00 -> 06:00 (atravessa a meia-noite), com faltas aleatórias.
+    """
+    aleatorio = random.Random(semente)
+    registros = backend.RegistrosPonto()
+    for f in range(n_funcionarios):
+        nome = f"FUNC{f:03d}"
+        perfil = f % 5
+        for d in range(dias):
+            dia = inicio + timedelta(days=d)
+            sorteio = aleatorio.random()
+            if sorteio < 0.08:
+                continue
+            if perfil == 4:
+                if dia.weekday() == 6 and sorteio < 0.5:
+                    continue
+                entrada = datetime.combine(dia, dt_time(21 + aleatorio.randint(0, 1), aleatorio.randint(0, 59)))
+                saida = datetime.combine(dia + timedelta(days=1), dt_time(5 + aleatorio.randint(0, 1), aleatorio.randint(0, 59)))
+                registros.adicionar(nome, entrada.date(), entrada.time())
+                registros.adicionar(nome, saida.date(), saida.time())
+                continue
+            if dia.weekday() == 6 and sorteio > 0.2:
+                continue
+            horas = [dt_time(7 + aleatorio.randint(0, 2), aleatorio.randint(0, 59), aleatorio.randint(0, 59))]
+            if perfil != 2:
+                horas += [dt_time(12, aleatorio.randint(0, 30)), dt_time(13, aleatorio.randint(0, 30))]
+            if not (perfil == 3 and sorteio < 0.15):
+                horas.append(dt_time(17 + aleatorio.randint(0, 2), aleatorio.randint(0, 59)))
+            if perfil == 1 and sorteio > 0.9:
+                horas += [dt_time(22, 30), dt_time(23, 45)]
+            for hora in horas:
+                registros.adicionar(nome, dia, hora)
+    return registros
+
+
+# Combinações de escala/regras que exercitam os dois motores
+SETTINGS_CALCULO = [
+    {},
+    {'escala_tipo': 'clt_6x1_com', 'sabado_util': True, 'noturno_ativo': True, 'feriados': ['15/11', '20/11', '25/12']},
+    {'escala_tipo': 'clt_5x2_padrao', 'sabado_util': False, 'intervalo_auto': True, 'intervalo_minutos': 60,
+     'extra_tipo': 'diaria', 'feriados': ['02/11']},
+    {'escala_tipo': 'clt_5x2_comp', 'tolerancia': 5, 'noturno_ativo': True, 'domingo_util': True},
+    {'escala_tipo': 'clt_parcial_30h', 'jornada_minutos': 360, 'noturno_ativo': True},
+    {'escala_tipo': 'clt_12x36', 'noturno_ativo': True, 'data_inicio_escala': '2024-10-30'},
+    {'escala_tipo': 'estagio_6h', 'jornada_minutos': 'abc', 'tolerancia': 99},
+]
+
+
+def resumo_dias(relatorio: list) -> list:
+    return [
+        (dia.funcionario, dia.data, dia.meta_s, dia.total_s, dia.noturno_s, dia.normais_s,
+         dia.a_dever_s, dia.extras_comuns_s, dia.extras_100_s, dia.ocorrencias)
+        for dia in relatorio
+    ]
+
+
+# ===== ÍNDICE DE BATIDAS E TOTAIS ACUMULADOS (v8.2) =====
+
+def test_indexar_batidas_remove_duplicatas_e_mantem_ordem():
+    dados = [
+        {"nome": "BETO", "data": date(2024, 3, 5), "hora": dt_time(8, 0)},
+        {"nome": "ANA", "data": date(2024, 3, 5), "hora": dt_time(17, 0)},
+        {"nome": "ANA", "data": date(2024, 3, 5), "hora": dt_time(8, 0)},
+        {"nome": "BETO", "data": date(2024, 3, 5), "hora": dt_time(8, 0)},  # duplicata exata
+        {"nome": "ANA", "data": date(2023, 12, 31), "hora": dt_time(8, 0)},
+    ]
+    indice, ano = backend.indexar_batidas(dados)
+
+    assert list(indice) == ["BETO", "ANA"]
+    assert indice["BETO"] == {date(2024, 3, 5): [dt_time(8, 0)]}
+    # Batidas do dia na ordem do arquivo (a ordenação é do montar_turnos)
+    assert indice["ANA"][date(2024, 3, 5)] == [dt_time(17, 0), dt_time(8, 0)]
+    assert ano == 2024  # Moda das datas
+
+
+def test_totais_do_preview_somam_os_dias():
+    relatorio, preview, _ = backend.calcular_relatorio(registros_mes(n_funcionarios=3), {})
+
+    for resumo in preview:
+        dias = [dia for dia in relatorio if dia.funcionario == resumo["funcionario"]]
+        assert len(resumo["dias"]) == len(dias)
+        assert resumo["normais"] == backend.format_segundos(sum(dia.normais_s for dia in dias)).replace("+", "")
+        assert resumo["dever"] == backend.format_segundos(sum(dia.a_dever_s for dia in dias)).replace("+", "")
+
+
+# ===== DIA APURADO EM SEGUNDOS INTEIROS (v8.3) =====
+
+def test_dia_apurado_devolve_colunas_antigas_em_timedelta():
+    dia = backend.DiaApurado(
+        date(2024, 3, 4), "ANA", "Segunda-feira", dt_time(8, 0), dt_time(12, 0), dt_time(13, 0), dt_time(17, 30),
+        28800, 30600, 0, 28800, 0, 1800, 0, ""
+    )
+
+    assert dia["Funcionário"] == "ANA"
+    assert dia["Horas Normais"] == timedelta(hours=8)
+    assert dia["Horas Extras (Comum)"] == timedelta(minutes=30)
+    assert dia.get("Coluna inexistente", "padrão") == "padrão"
+    assert list(dia.para_dict()) == list(backend.DiaApurado.COLUNAS)
+    with pytest.raises(AttributeError):
+        dia.outro_campo = 1  # __slots__
+
+
+def test_format_segundos():
+    assert backend.format_segundos(0) == "00:00"
+    assert backend.format_segundos(29 * 60 + 31) == "+00:30"  # Arredonda pelos segundos
+    assert backend.format_segundos(-90 * 60) == "-01:30"
+    assert backend.format_segundos(176 * 3600) == "+176:00"
+    assert backend.format_td(timedelta(hours=-1)) == "-01:00"
+
+
+# ===== MOTOR VETORIZADO (v8.4) =====
+
+@pytest.mark.parametrize("settings", SETTINGS_CALCULO)
+def test_motor_numpy_igual_ao_motor_python(settings):
+    registros = registros_variados()
+    overrides = {"FUNC000|2024-11-05": "ATESTADO", "FUNC001|2024-11-12": "FALTA", "FUNC003|2024-11-20": "FOLGA"}
+
+    relatorio_py, preview_py, totais_py = backend.calcular_relatorio(
+        registros, dict(settings, motor_calculo='python'), dict(overrides))
+    relatorio_np, preview_np, totais_np = backend.calcular_relatorio(
+        registros, dict(settings, motor_calculo='numpy'), dict(overrides))
+
+    assert [dia.para_dict() for dia in relatorio_np] == [dia.para_dict() for dia in relatorio_py]
+    assert preview_np == preview_py
+    assert totais_np == totais_py
+
+
+# ===== TABELA DE MINUTOS: NOTURNO, DOMINGO E FERIADO (v8.5) =====
+
+@pytest.mark.parametrize("entrada, saida, inicio_turno, esperado", [
+    # (noturno, domingo, feriado, comum) em minutos; 04/03/2024 é segunda-feira
+    (datetime(2024, 3, 5, 0, 30), datetime(2024, 3, 5, 4, 0), None, (210, 0, 0, 210)),    # Madrugada: só até a saída
+    (datetime(2024, 3, 5, 3, 0), datetime(2024, 3, 5, 8, 0), None, (120, 0, 0, 300)),     # Entrou de madrugada: sem prorrogação
+    (datetime(2024, 3, 4, 21, 0), datetime(2024, 3, 5, 7, 0), None, (540, 0, 0, 600)),    # Súmula 60, II: 05:00-07:00 noturno
+    (datetime(2024, 3, 4, 8, 0), datetime(2024, 3, 4, 17, 0), None, (0, 0, 0, 540)),
+    (datetime(2024, 3, 9, 22, 0), datetime(2024, 3, 10, 6, 0), None, (480, 360, 0, 120)),  # Sábado -> domingo
+    # Segundo par do turno 22:00-02:00 + 03:00-06:00: prorroga pela noite em que o turno começou
+    (datetime(2024, 3, 5, 3, 0), datetime(2024, 3, 5, 6, 0), datetime(2024, 3, 4, 22, 0), (180, 0, 0, 180)),
+    (datetime(2024, 3, 4, 13, 0), datetime(2024, 3, 4, 18, 0), datetime(2024, 3, 4, 8, 0), (0, 0, 0, 300)),
+])
+def test_tabela_minutos_classifica_o_par(entrada, saida, inicio_turno, esperado):
+    tabela = backend.TabelaMinutos(date(2024, 3, 1), date(2024, 3, 31))
+    assert tabela.contar(entrada, saida, inicio_turno) == esperado
+
+
+def test_tabela_minutos_feriado_no_domingo_conta_como_feriado():
+    tabela = backend.TabelaMinutos(date(2024, 3, 1), date(2024, 3, 31), {date(2024, 3, 10)})
+    assert tabela.contar(datetime(2024, 3, 9, 22, 0), datetime(2024, 3, 10, 6, 0)) == (480, 0, 360, 120)
+
+
+def test_adicional_noturno_estrito_com_virada_de_dia():
+    # Saída "menor" que a entrada: o par termina no dia seguinte
+    assert backend.calcular_adicional_noturno_estrito(datetime(2024, 3, 4, 22, 0), datetime(2024, 3, 4, 5, 0)) == 420
+
+
+@pytest.mark.parametrize("motor", ["python", "numpy"])
+def test_turno_noturno_com_pausa_de_madrugada_prorroga(motor):
+    # 22:00-02:00 + 03:00-06:00: 240 + 120 noturnos e 05:00-06:00 prorrogado (Súmula 60, II)
+    registros = registros_de([("ANA", datetime(2024, 3, 4, 22, 0)), ("ANA", datetime(2024, 3, 5, 2, 0)),
+                              ("ANA", datetime(2024, 3, 5, 3, 0)), ("ANA", datetime(2024, 3, 5, 6, 0))])
+    relatorio, _, _ = backend.calcular_relatorio(registros, {'noturno_ativo': True, 'motor_calculo': motor})
+
+    assert len(relatorio) == 1
+    assert relatorio[0].total_s == 7 * 3600
+    assert relatorio[0].noturno_s == 7 * 3600
+
+
+@pytest.mark.parametrize("motor", ["python", "numpy"])
+def test_turno_noturno_que_entra_no_domingo(motor):
+    # Sábado 22:00 -> domingo 06:00: as 6h de domingo são extra 100%, o noturno prorroga até 06:00
+    registros = registros_de([("ANA", datetime(2024, 3, 2, 22, 0)), ("ANA", datetime(2024, 3, 3, 6, 0))])
+    relatorio, _, totais = backend.calcular_relatorio(registros, {'noturno_ativo': True, 'motor_calculo': motor})
+
+    assert len(relatorio) == 1
+    dia = relatorio[0]
+    assert dia.data == date(2024, 3, 2)
+    assert dia.total_s == 8 * 3600
+    assert dia.noturno_s == 8 * 3600
+    assert dia.normais_s == 2 * 3600
+    assert dia.extras_100_s == 6 * 3600
+    assert totais["ANA"]["extra100"] == timedelta(hours=6)
+
+
+@pytest.mark.parametrize("motor", ["python", "numpy"])
+def test_turno_noturno_que_entra_no_feriado(motor):
+    # Terça 30/04 22:00 -> 01/05 (feriado) 06:00
+    registros = registros_de([("ANA", datetime(2024, 4, 30, 22, 0)), ("ANA", datetime(2024, 5, 1, 6, 0))])
+    settings = {'noturno_ativo': True, 'feriados': ['01/05'], 'motor_calculo': motor}
+    dia = backend.calcular_relatorio(registros, settings)[0][0]
+
+    assert dia.data == date(2024, 4, 30)
+    assert dia.normais_s == 2 * 3600
+    assert dia.extras_100_s == 6 * 3600
+
+
+# ===== CALENDÁRIO DE METAS DAS ESCALAS (v8.6) =====
+
+def metas_em_minutos(calendario, inicio: date, dias: int) -> list:
+    return [calendario.meta(inicio + timedelta(days=d)) // 60 for d in range(dias)]
+
+
+def test_calendario_12x36_ancorado_na_data_de_inicio():
+    # 28/02 plantão, 29/02 (bissexto) folga, 01/03 plantão...
+    calendario = backend.compilar_calendario_escala(
+        'clt_12x36', date(2024, 3, 1), date(2024, 3, 6), frozenset(), date(2024, 2, 28))
+    assert metas_em_minutos(calendario, date(2024, 3, 1), 6) == [720, 0, 720, 0, 720, 0]
+
+
+def test_calendario_ciclico_nao_depende_do_inicio_do_periodo():
+    ancora = date(2024, 2, 28)
+    mes = backend.compilar_calendario_escala('clt_24x48', date(2024, 3, 1), date(2024, 3, 31), frozenset(), ancora)
+    quinzena = backend.compilar_calendario_escala('clt_24x48', date(2024, 3, 16), date(2024, 3, 31), frozenset(), ancora)
+    assert metas_em_minutos(quinzena, date(2024, 3, 16), 16) == metas_em_minutos(mes, date(2024, 3, 16), 16)
+
+
+def test_calendario_estagio_6h():
+    # Antes caía no padrão de 8h de segunda a sábado
+    calendario = backend.compilar_calendario_escala('estagio_6h', date(2024, 3, 4), date(2024, 3, 10))
+    assert metas_em_minutos(calendario, date(2024, 3, 4), 7) == [360, 360, 360, 360, 360, 0, 0]
+
+
+def test_calendario_feriado_tem_meta_zero_e_fica_em_cache():
+    argumentos = ('clt_5x2_padrao', date(2024, 4, 29), date(2024, 5, 3), frozenset({date(2024, 5, 1)}))
+    calendario = backend.compilar_calendario_escala(*argumentos)
+    assert metas_em_minutos(calendario, date(2024, 4, 29), 5) == [480, 480, 0, 480, 480]
+    assert backend.compilar_calendario_escala(*argumentos) is calendario
+
+
+@pytest.mark.parametrize("data_inicio", ['2024-02-28', '28/02/2024', date(2024, 2, 28)])
+def test_meta_dinamica_aceita_data_de_inicio_em_texto_ou_date(data_inicio):
+    assert backend.calcular_meta_dinamica_escala('clt_12x36', 4, date(2024, 3, 1), data_inicio) == timedelta(hours=12)
+    assert backend.calcular_meta_dinamica_escala('clt_12x36', 5, date(2024, 3, 2), data_inicio) == timedelta(0)
+
+
+@pytest.mark.parametrize("motor", ["python", "numpy"])
+def test_folga_da_escala_12x36_nao_e_falta(motor):
+    batidas = []
+    for dia in (4, 6, 8):
+        batidas += [("ANA", datetime(2024, 3, dia, 7, 0)), ("ANA", datetime(2024, 3, dia, 19, 0))]
+    settings = {'escala_tipo': 'clt_12x36', 'data_inicio_escala': '04/03/2024', 'motor_calculo': motor}
+    relatorio = backend.calcular_relatorio(registros_de(batidas), settings)[0]
+
+    assert [(dia.data.day, dia.meta_s // 3600, dia.normais_s // 3600, dia.a_dever_s) for dia in relatorio] == [
+        (4, 12, 12, 0), (5, 0, 0, 0), (6, 12, 12, 0), (7, 0, 0, 0), (8, 12, 12, 0)]
+    assert {dia.ocorrencias for dia in relatorio if dia.data.day in (5, 7)} == {"FOLGA ESCALA"}
+
+
+# ===== ESCALA POR FUNCIONÁRIO (v8.7) =====
+
+def test_escalas_por_funcionario_iguais_a_processamentos_separados():
+    registros = registros_variados(n_funcionarios=6)
+    grupos = {
+        'seguranca': {'escala_tipo': 'clt_12x36', 'data_inicio_escala': '2024-10-30', 'noturno_ativo': True},
+        'estagio': {'escala_tipo': 'estagio_6h'},
+    }
+    settings = {
+        'escala_tipo': 'clt_6x1_com', 'feriados': ['15/11'], 'grupos_escala': grupos,
+        # Nome comparado sem maiúsculas/espaços extras; dict direto também vale
+        'escalas_funcionarios': {'func004': 'seguranca', ' Func001 ': 'estagio', 'FUNC002': {'tolerancia': 5}},
+    }
+    relatorio, preview, totais = backend.calcular_relatorio(registros, settings)
+
+    config_por_funcionario = {'FUNC004': grupos['seguranca'], 'FUNC001': grupos['estagio'], 'FUNC002': {'tolerancia': 5}}
+    assert [resumo["funcionario"] for resumo in preview] == [f"FUNC{f:03d}" for f in range(6)]
+    for resumo in preview:
+        funcionario = resumo["funcionario"]
+        separado = backend.RegistrosPonto.de_registros([r for r in registros if r["nome"] == funcionario])
+        settings_separado = {'escala_tipo': 'clt_6x1_com', 'feriados': ['15/11'],
+                             **config_por_funcionario.get(funcionario, {})}
+        relatorio_sep, preview_sep, totais_sep = backend.calcular_relatorio(separado, settings_separado)
+
+        assert resumo == preview_sep[0]
+        assert resumo_dias([dia for dia in relatorio if dia.funcionario == funcionario]) == resumo_dias(relatorio_sep)
+        assert totais[funcionario] == totais_sep[funcionario]
+
+
+# ===== MOTOR DE FERIADOS (v8.8) =====
+
+def test_calcular_pascoa():
+    assert backend.calcular_pascoa(2024) == date(2024, 3, 31)
+    assert backend.calcular_pascoa(2025) == date(2025, 4, 20)
+
+
+def test_compilar_feriados_moveis_e_vigencia():
+    feriados = backend.compilar_feriados(2024, 2025)
+
+    assert feriados.nome(date(2024, 2, 13)) == "Carnaval"
+    assert date(2024, 3, 29) in feriados      # Paixão de Cristo
+    assert date(2024, 5, 30) in feriados      # Corpus Christi
+    assert date(2025, 6, 19) in feriados
+    assert date(2025, 1, 1) in feriados
+    assert date(2024, 11, 20) in feriados
+    assert date(2023, 11, 20) not in backend.compilar_feriados(2023, 2023)  # Lei 14.759/2023
+    assert backend.compilar_feriados(2024, 2025) is feriados  # Cache
+
+
+def test_compilar_feriados_municipio_e_lista_manual():
+    feriados = backend.compilar_feriados(2024, 2025, nacionais=False, municipio='sao_paulo_sp',
+                                         extras=('10/06', '15/03/2025', 'CARNAVAL_SEGUNDA', 'inválido'))
+
+    assert date(2024, 1, 25) in feriados and date(2025, 1, 25) in feriados
+    assert date(2024, 5, 30) in feriados      # Corpus Christi pela lista municipal
+    assert date(2024, 6, 10) in feriados and date(2025, 6, 10) in feriados
+    assert date(2025, 3, 15) in feriados and date(2024, 3, 15) not in feriados
+    assert date(2024, 2, 12) in feriados      # Carnaval (segunda-feira)
+    assert date(2024, 12, 25) not in feriados  # Sem os nacionais
+
+    # "29/02" num intervalo 2023-2024: 2023 não tem o dia, mas 2024 continua valendo
+    bissexto = backend.compilar_feriados(2023, 2024, nacionais=False, extras=('29/02',))
+    assert date(2024, 2, 29) in bissexto and len(bissexto) == 1
+
+
+@pytest.mark.parametrize("valor, esperado", [("false", False), ("0", False), ("", False), (False, False),
+                                             ("true", True), ("1", True), (True, True)])
+def test_feriados_nacionais_aceita_flag_em_texto(valor, esperado):
+    feriados = backend.feriados_do_periodo({'feriados_nacionais': valor}, date(2024, 12, 1), date(2024, 12, 31))
+    assert (date(2024, 12, 25) in feriados) is esperado
+
+
+@pytest.mark.parametrize("settings", [{'feriados': ['01/01']}, {'feriados_nacionais': True}])
+def test_feriado_do_ano_seguinte_num_periodo_dezembro_janeiro(settings):
+    batidas = []
+    for dia in (date(2024, 12, 30), date(2024, 12, 31), date(2025, 1, 1), date(2025, 1, 2)):
+        batidas += [("ANA", datetime.combine(dia, dt_time(8, 0))), ("ANA", datetime.combine(dia, dt_time(17, 0)))]
+    relatorio = backend.calcular_relatorio(registros_de(batidas), settings)[0]
+
+    assert [(dia.data, dia.meta_s, dia.extras_100_s) for dia in relatorio] == [
+        (date(2024, 12, 30), 28800, 0), (date(2024, 12, 31), 28800, 0),
+        (date(2025, 1, 1), 0, 32400), (date(2025, 1, 2), 28800, 0)]
+
+
+# ===== CÁLCULO PARALELO (v8.9) =====
+
+@pytest.fixture
+def paralelo_ligado(monkeypatch):
+    monkeypatch.setattr(backend, "CALCULO_PARALELO_PROCESSOS", 2)
+    monkeypatch.setattr(backend, "CALCULO_PARALELO_MIN_FUNCIONARIOS", 2)
+    monkeypatch.setattr(backend.os, "cpu_count", lambda: 2)
+    yield
+    backend.parar_pool_paralelo()
+
+
+def test_cliente_so_liga_e_desliga_o_paralelo(paralelo_ligado, monkeypatch):
+    assert backend._processos_calculo_paralelo({}, 10) == 2
+    assert backend._processos_calculo_paralelo({'calculo_paralelo': True}, 10) == 2
+    assert backend._processos_calculo_paralelo({'calculo_paralelo': 64}, 10) == 2  # Nº do cliente é ignorado
+    assert backend._processos_calculo_paralelo({'calculo_paralelo': False}, 10) == 0
+    assert backend._processos_calculo_paralelo({}, 1) == 0
+    monkeypatch.setattr(backend.os, "cpu_count", lambda: 1)
+    assert backend._processos_calculo_paralelo({}, 10) == 1  # Limitado aos núcleos
+
+
+def test_dividir_funcionarios_equilibrado():
+    indice, _ = backend.indexar_batidas(registros_variados(n_funcionarios=11))
+    funcionarios = list(indice)
+    partes = backend.dividir_funcionarios_equilibrado(indice, funcionarios, 3)
+
+    assert len(partes) == 3
+    assert sorted(f for parte in partes for f in parte) == sorted(funcionarios)
+    for parte in partes:
+        assert parte == sorted(parte, key=funcionarios.index)  # Ordem de entrada dentro da parte
+    assert partes == backend.dividir_funcionarios_equilibrado(indice, funcionarios, 3)
+    # Mais partes que funcionários: uma parte por funcionário, nenhuma vazia
+    assert sorted(backend.dividir_funcionarios_equilibrado(indice, funcionarios[:2], 5)) == [[funcionarios[0]], [funcionarios[1]]]
+
+
+def test_compactar_e_expandir_relatorio():
+    relatorio = backend.calcular_relatorio(registros_variados(n_funcionarios=5), {'noturno_ativo': True})[0]
+    expandido = backend.expandir_relatorio(backend.compactar_relatorio(relatorio))
+    assert [dia.para_dict() for dia in expandido] == [dia.para_dict() for dia in relatorio]
+
+
+@pytest.mark.parametrize("settings", [
+    {'noturno_ativo': True},
+    {'escala_tipo': 'clt_6x1_com', 'motor_calculo': 'numpy',
+     'escalas_funcionarios': {'FUNC004': {'escala_tipo': 'clt_12x36', 'data_inicio_escala': '2024-10-30'}}},
+])
+def test_paralelo_igual_ao_sequencial(paralelo_ligado, settings):
+    registros = registros_variados(n_funcionarios=9)
+    overrides = {"FUNC000|2024-11-05": "ATESTADO", "FUNC007|2024-11-12": "FALTA"}
+
+    relatorio_seq, preview_seq, totais_seq = backend.calcular_relatorio(
+        registros, dict(settings, calculo_paralelo=False), dict(overrides))
+    relatorio_par, preview_par, totais_par = backend.calcular_relatorio(registros, settings, dict(overrides))
+
+    assert backend._paralelo_pool is not None  # Passou mesmo pelo pool
+    assert [dia.para_dict() for dia in relatorio_par] == [dia.para_dict() for dia in relatorio_seq]
+    assert preview_par == preview_seq
+    assert list(totais_par.items()) == list(totais_seq.items())
+
+
+def _apurar_no_processo_filho(registros, fila):
+    try:
+        relatorio, _, _ = backend.calcular_relatorio(registros, {})
+        fila.put(("ok", resumo_dias(relatorio)))
+    except Exception as e:
+        fila.put(("erro", repr(e)))
+
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="precisa de fork")
+def test_paralelo_em_worker_daemonic_apura_sequencial(paralelo_ligado):
+    # Workers de job são daemonic: abrir o pool paralelo neles levantava AssertionError
+    registros = registros_mes()
+    esperado = resumo_dias(backend.calcular_relatorio(registros, {'calculo_paralelo': False})[0])
+
+    contexto = multiprocessing.get_context("fork")
+    fila = contexto.Queue()
+    processo = contexto.Process(target=_apurar_no_processo_filho, args=(registros, fila), daemon=True)
+    processo.start()
+    status, resultado = fila.get(timeout=60)
+    processo.join(timeout=10)
+
+    assert status == "ok", resultado
+    assert resultado == esperado
+
+
+# ===== ARMAZÉM COLUNAR DE BATIDAS (v9.0) =====
+
+def test_registros_ponto_ida_e_volta_pelo_formato_antigo():
+    dados = [
+        {"nome": "ANA", "data": date(2024, 3, 4), "hora": dt_time(8, 0, 15)},
+        {"nome": "BETO", "data": datetime(2024, 3, 4, 0, 0), "hora": dt_time(22, 59, 59)},
+        {"nome": "ANA", "data": date(2024, 3, 4), "hora": dt_time(17, 0)},
+    ]
+    registros = backend.RegistrosPonto.de_registros(dados, origem='edição')
+
+    assert len(registros) == 3
+    assert registros.nomes == ["ANA", "BETO"]
+    assert list(registros) == [dict(d, data=date(2024, 3, 4)) for d in dados]
+    assert registros.contagem_por_origem() == {'edição': 3}
+
+
+def test_registros_ponto_estender_remapeia_ids():
+    primeiro = registros_de([("ANA", datetime(2024, 3, 4, 8, 0))])
+    segundo = backend.RegistrosPonto()
+    segundo.adicionar("BETO", date(2024, 3, 4), dt_time(9, 0), 'outro.txt')
+    segundo.adicionar("ANA", date(2024, 3, 4), dt_time(17, 0), 'outro.txt')
+    primeiro.estender(segundo)
+
+    assert [(r["nome"], r["hora"]) for r in primeiro] == [("ANA", dt_time(8, 0)), ("BETO", dt_time(9, 0)), ("ANA", dt_time(17, 0))]
+    assert primeiro.contagem_por_origem() == {'teste': 1, 'outro.txt': 2}
+
+
+def test_registros_ponto_pickle_leva_so_as_colunas():
+    registros = registros_variados(n_funcionarios=3)
+    copia = pickle.loads(pickle.dumps(registros))
+
+    assert list(copia) == list(registros)
+    assert copia.indexar() == registros.indexar()
+    copia.adicionar("FUNC000", date(2024, 12, 20), dt_time(8, 0))  # Ids internados refeitos no unpickle
+    assert copia.nomes == registros.nomes
+
+
+def test_carregar_txt_grava_nas_colunas():
+    txt = (
+        "001 ANA 04.03.2024 08:00:15 X\n"
+        "linha sem data\n"
+        "002 BETO 04/03/2024 22:00:00\n"
+        "001 ANA 04-03-2024 17:00:00 X\n"
+        "001 ANA 31.02.2024 08:00:00 X\n"  # Data inválida: ignorada
+    ).encode()
+    registros = backend.carregar_txt(txt, chunk_bytes=16)
+
+    assert [(r["nome"], r["data"], r["hora"]) for r in registros] == [
+        ("ANA", date(2024, 3, 4), dt_time(8, 0, 15)),
+        ("BETO", date(2024, 3, 4), dt_time(22, 0)),
+        ("ANA", date(2024, 3, 4), dt_time(17, 0)),
+    ]
+    assert backend.processar_txt(txt.decode()).indexar() == registros.indexar()
+
+
+# ===== TURNOS NUMA VARREDURA LINEAR (v9.1) =====
+
+def batidas_por_dia(*momentos: datetime) -> dict:
+    por_dia = {}
+    for momento in momentos:
+        por_dia.setdefault(momento.date(), []).append(momento.time())
+    return por_dia
+
+
+def test_montar_turnos_noturno_fica_no_dia_da_entrada():
+    # Saída 06:00 não é mais cortada às 05:00 para o dia seguinte
+    turnos = backend.montar_turnos(batidas_por_dia(
+        datetime(2024, 3, 5, 6, 0), datetime(2024, 3, 4, 22, 0),  # Fora de ordem no arquivo
+        datetime(2024, 3, 5, 22, 10), datetime(2024, 3, 6, 6, 5),
+    ))
+    assert turnos == {
+        date(2024, 3, 4): [datetime(2024, 3, 4, 22, 0), datetime(2024, 3, 5, 6, 0)],
+        date(2024, 3, 5): [datetime(2024, 3, 5, 22, 10), datetime(2024, 3, 6, 6, 5)],
+    }
+
+
+def test_montar_turnos_descanso_e_duracao_maxima():
+    turnos = backend.montar_turnos(batidas_por_dia(
+        datetime(2024, 3, 4, 8, 0), datetime(2024, 3, 4, 12, 0),
+        datetime(2024, 3, 4, 13, 0), datetime(2024, 3, 4, 17, 0),    # Almoço de 1h: mesmo turno
+        datetime(2024, 3, 4, 23, 0), datetime(2024, 3, 5, 1, 0),     # 6h de descanso: outro turno, mesma data
+        datetime(2024, 3, 6, 8, 0),                                  # Batida avulsa (sem par)
+        datetime(2024, 3, 7, 8, 0), datetime(2024, 3, 7, 12, 0), datetime(2024, 3, 7, 13, 0),  # Ímpar
+    ), turno_max_horas=20, descanso_min_horas=6)
+
+    assert turnos[date(2024, 3, 4)] == [
+        datetime(2024, 3, 4, 8, 0), datetime(2024, 3, 4, 12, 0), datetime(2024, 3, 4, 13, 0),
+        datetime(2024, 3, 4, 17, 0), datetime(2024, 3, 4, 23, 0), datetime(2024, 3, 5, 1, 0),
+    ]
+    assert turnos[date(2024, 3, 6)] == [datetime(2024, 3, 6, 8, 0)]
+    assert turnos[date(2024, 3, 7)] == [datetime(2024, 3, 7, 8, 0), datetime(2024, 3, 7, 12, 0)]
+
+
+def test_montar_turnos_entrada_esquecida_nao_junta_dias():
+    # Entrada sem saída: a batida do dia seguinte passaria de turno_max_horas
+    turnos = backend.montar_turnos(batidas_por_dia(
+        datetime(2024, 3, 4, 8, 0), datetime(2024, 3, 5, 8, 0), datetime(2024, 3, 5, 17, 0),
+    ), turno_max_horas=20)
+    assert turnos == {
+        date(2024, 3, 4): [datetime(2024, 3, 4, 8, 0)],
+        date(2024, 3, 5): [datetime(2024, 3, 5, 8, 0), datetime(2024, 3, 5, 17, 0)],
+    }
+
+
+@pytest.mark.parametrize("saida, esperado", [
+    (dt_time(12, 7), (None, None, 4 * 3600 + 7 * 60)),                  # Intervalo não cabe: sem par 13:00 -> 12:07
+    (dt_time(17, 0), (dt_time(12, 0), dt_time(13, 0), 8 * 3600)),
+])
+def test_intervalo_automatico_so_quando_cabe_no_turno(saida, esperado):
+    registros = registros_de([("ANA", datetime(2024, 3, 4, 8, 0)), ("ANA", datetime.combine(date(2024, 3, 4), saida))])
+    dia = backend.calcular_relatorio(registros, {'intervalo_auto': True, 'intervalo_minutos': 60})[0][0]
+
+    assert (dia.saida_1, dia.entrada_2, dia.total_s) == esperado
+    assert dia.saida_2 == saida
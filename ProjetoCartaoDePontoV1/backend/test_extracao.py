@@ -0,0 +1,361 @@
+"""
+Testes da extração de PDFs e fotos: chaves e cota do Gemini, cache, lotes e camada de texto
+(python -m pytest -q, na pasta backend).
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import time
+
+import pytest
+
+import backend
+
+
+# ===== POOL DE CHAVES GEMINI E COTA COMPARTILHADA (v7.3) =====
+
+def reservar_no_processo(argumentos) -> int:
+    """Executado em outro processo: quantas das `tentativas` reservas a chave aceitou."""
+    arquivo_cota, rpm, tentativas = argumentos
+    chave = backend.ChaveGemini(1, None, rpm, 0, arquivo_cota)
+    return sum(chave.reservar(1) for _ in range(tentativas))
+
+
+@pytest.fixture
+def arquivo_cota(tmp_path):
+    return str(tmp_path / "cota" / "chave.json")
+
+
+def test_cota_da_chave_e_dividida_entre_processos(arquivo_cota):
+    # Dois processos com a mesma chave (RPM 3) não passam de 3 chamadas no minuto
+    with multiprocessing.get_context("spawn").Pool(2) as pool:
+        aceitas = pool.map(reservar_no_processo, [(arquivo_cota, 3, 5)] * 2)
+    assert sum(aceitas) == 3
+
+
+def test_cota_compartilhada_entre_instancias(arquivo_cota):
+    worker_1 = backend.ChaveGemini(1, None, 2, 0, arquivo_cota)
+    worker_2 = backend.ChaveGemini(1, None, 2, 0, arquivo_cota)
+
+    assert worker_1.reservar(1) and worker_1.reservar(1)
+    assert worker_2.espera(1) > 0
+    assert not worker_2.reservar(1)
+    assert worker_2.em_voo == 0 and worker_1.em_voo == 2  # Chamadas em voo são por processo
+
+
+def test_circuit_breaker_compartilhado(arquivo_cota):
+    worker_1 = backend.ChaveGemini(1, None, 100, 0, arquivo_cota)
+    worker_2 = backend.ChaveGemini(1, None, 100, 0, arquivo_cota)
+
+    assert worker_1.registrar_429() == backend.GEMINI_COOLDOWN_BASE_S
+    status = worker_2.status()
+    assert not status["saudavel"] and status["erros_429_recentes"] == 1
+    assert worker_2.espera(1) > 0
+
+    # O segundo 429 (em qualquer processo) dobra o cooldown
+    assert worker_2.registrar_429() == 2 * backend.GEMINI_COOLDOWN_BASE_S
+    worker_1.registrar_sucesso()
+    assert worker_2.status()["erros_429_recentes"] == 2
+    assert worker_2.falhas_consecutivas == 0
+
+
+def test_limite_zero_e_sem_limite():
+    chave = backend.ChaveGemini(1, None, 0, 0)
+    for _ in range(1000):
+        assert chave.reservar(10 ** 6)
+        chave.liberar()
+    assert chave.espera(10 ** 6) == 0
+    assert chave.balde_rpm.folga() == 1.0
+
+
+def test_limite_negativo_e_rejeitado(monkeypatch):
+    monkeypatch.setenv("GEMINI_API_KEY_2_RPM", "-1")
+    with pytest.raises(ValueError):
+        backend._limite_chave_env(2, "RPM", 10)
+    monkeypatch.setenv("GEMINI_API_KEY_RPM", "0")
+    assert backend._limite_chave_env(1, "RPM", 10) == 0
+
+
+def test_pool_escolhe_a_chave_menos_carregada_e_respeita_o_prazo(tmp_path):
+    ocupada = backend.ChaveGemini(1, None, 10, 0, str(tmp_path / "1.json"))
+    livre = backend.ChaveGemini(2, None, 10, 0, str(tmp_path / "2.json"))
+    ocupada.em_voo = 2
+    pool = backend.PoolChavesGemini([ocupada, livre])
+
+    assert asyncio.run(pool.adquirir(1, time.monotonic() + 1)) is livre
+
+    ocupada.registrar_429()
+    livre.registrar_429()
+    with pytest.raises(TimeoutError):
+        asyncio.run(pool.adquirir(1, time.monotonic() + 0.5))
+
+
+@pytest.fixture
+def ambiente_sem_chaves(monkeypatch):
+    for nome in list(backend.os.environ):
+        if nome.startswith("GEMINI_API_KEY"):
+            monkeypatch.delenv(nome)
+    return monkeypatch
+
+
+def test_carregar_chaves_ordena_e_ignora_duplicadas(ambiente_sem_chaves):
+    ambiente_sem_chaves.setenv("GEMINI_API_KEY_10", "chave-c")
+    ambiente_sem_chaves.setenv("GEMINI_API_KEY", "chave-a")
+    ambiente_sem_chaves.setenv("GEMINI_API_KEY_2", "chave-b")
+    ambiente_sem_chaves.setenv("GEMINI_API_KEY_3", "chave-a")
+    ambiente_sem_chaves.setenv("GEMINI_API_KEY_4", "  ")
+
+    assert backend.carregar_chaves_gemini_env() == [(1, "chave-a"), (2, "chave-b"), (10, "chave-c")]
+
+
+def test_carregar_chaves_rejeita_numero_repetido(ambiente_sem_chaves):
+    ambiente_sem_chaves.setenv("GEMINI_API_KEY", "chave-a")
+    ambiente_sem_chaves.setenv("GEMINI_API_KEY_1", "chave-b")
+    with pytest.raises(ValueError, match="#1"):
+        backend.carregar_chaves_gemini_env()
+
+
+# ===== CACHE DE EXTRAÇÃO GEMINI (v7.1) =====
+
+@pytest.fixture
+def cache_gemini(tmp_path, monkeypatch):
+    monkeypatch.setattr(backend, "GEMINI_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(backend, "GEMINI_CACHE_ATIVO", True)
+    return tmp_path / "cache"
+
+
+def resposta_gemini(texto: str):
+    class Resposta:
+        text = texto
+    return Resposta()
+
+
+def test_chave_do_cache_depende_do_conteudo_prompt_e_contexto():
+    chave = backend.cache_gemini_chave(b"pixels", "prompt", "10x10:L")
+
+    assert chave == backend.cache_gemini_chave(b"pixels", "prompt", "10x10:L")
+    assert chave != backend.cache_gemini_chave(b"pixels", "outro prompt", "10x10:L")
+    assert chave != backend.cache_gemini_chave(b"pixels", "prompt", "20x5:L")
+    assert chave != backend.cache_gemini_chave(b"outros", "prompt", "10x10:L")
+
+
+def test_cache_grava_le_e_expira(cache_gemini, monkeypatch):
+    chave = backend.cache_gemini_chave(b"pagina", "prompt")
+    assert backend.cache_gemini_ler(chave) is None
+
+    backend.cache_gemini_gravar(chave, {"registros": [{"data": "01/03/2024"}]})
+    assert backend.cache_gemini_ler(chave) == {"registros": [{"data": "01/03/2024"}]}
+    assert not list(cache_gemini.rglob("*.tmp"))  # Gravação atômica não deixa sobras
+
+    # Sem uso há mais que a retenção: miss e o arquivo sai do disco
+    caminho = backend._cache_gemini_caminho(chave)
+    antigo = time.time() - backend.GEMINI_CACHE_RETENCAO_H * 3600 - 60
+    os.utime(caminho, (antigo, antigo))
+    assert backend.cache_gemini_ler(chave) is None
+    assert not os.path.exists(caminho)
+
+
+def test_cache_desativado_nao_grava(cache_gemini, monkeypatch):
+    monkeypatch.setattr(backend, "GEMINI_CACHE_ATIVO", False)
+    chave = backend.cache_gemini_chave(b"pagina", "prompt")
+    backend.cache_gemini_gravar(chave, {"registros": []})
+    assert backend.cache_gemini_ler(chave) is None
+    assert not cache_gemini.exists()
+
+
+def test_limpeza_do_cache_remove_expirados_e_os_menos_usados(cache_gemini, monkeypatch):
+    monkeypatch.setattr(backend, "GEMINI_CACHE_MAX_MB", 2.5 / 1024)  # 2,5 KB
+    chaves = [backend.cache_gemini_chave(bytes([i]), "prompt") for i in range(4)]
+    agora = time.time()
+    for idade, chave in zip((10 * 86400, 300, 200, 100), chaves):
+        backend.cache_gemini_gravar(chave, {"texto": "x" * 1000})
+        os.utime(backend._cache_gemini_caminho(chave), (agora - idade, agora - idade))
+
+    backend.cache_gemini_limpar(forcar=True)
+
+    restantes = [os.path.exists(backend._cache_gemini_caminho(chave)) for chave in chaves]
+    assert restantes == [False, False, True, True]  # Expirado + o menos usado (tamanho)
+
+
+def test_extracao_consulta_o_cache_antes_do_gemini(cache_gemini, monkeypatch):
+    chamadas = []
+
+    async def gemini_falso(prompt, img, tokens_estimados=None):
+        chamadas.append(prompt)
+        return resposta_gemini('```json\n{"registros": []}\n```' if len(chamadas) > 1 else "sem json")
+
+    monkeypatch.setattr(backend, "call_gemini_safe", gemini_falso)
+    extrair = lambda: asyncio.run(backend.extrair_json_gemini("prompt", None, b"pagina", "página 1", "1x1:L"))
+
+    assert extrair() is None          # Resposta inválida não vai para o cache
+    assert extrair() == {"registros": []}
+    assert extrair() == {"registros": []}
+    assert len(chamadas) == 2         # A terceira veio do cache
+
+
+# ===== CAMADA DE TEXTO DE PDF DIGITAL (v7.4) =====
+
+def pagina_espelho(documento, nome: str, periodo: str, linhas: list, cabecalho: bool = True):
+    """Espelho tabular como os gerados por software de REP: Data | Dia | 4 batidas | Total | Extras."""
+    pagina = documento.new_page(width=842, height=595)
+    pagina.insert_text((40, 40), "EMPRESA MODELO LTDA   CNPJ: 00.000.000/0001-00", fontsize=10)
+    pagina.insert_text((40, 60), f"Nome: {nome}", fontsize=10)
+    pagina.insert_text((400, 60), "CPF: 123.456.789-00", fontsize=10)
+    pagina.insert_text((40, 80), periodo, fontsize=10)
+    colunas = [40, 110, 170, 230, 290, 350, 420, 490]
+    if cabecalho:
+        for x, rotulo in zip(colunas, ["Data", "Dia", "Entrada", "Saída", "Entrada", "Saída", "Total", "Extras"]):
+            pagina.insert_text((x, 110), rotulo, fontsize=9)
+    y = 125
+    for data, batidas in linhas:
+        for x, valor in zip(colunas, [data, "Seg", *batidas, "08:00", "00:30"]):
+            if valor:
+                pagina.insert_text((x, y), valor, fontsize=9)
+        y += 14
+    return pagina
+
+
+def ler_pagina(nome: str, periodo: str, linhas: list, cabecalho: bool = True):
+    documento = backend.fitz.open()
+    try:
+        return backend.extrair_pagina_camada_texto(pagina_espelho(documento, nome, periodo, linhas, cabecalho))
+    finally:
+        documento.close()
+
+
+JORNADA = ["08:00", "12:00", "13:00", "17:05"]
+
+
+def test_camada_texto_le_o_espelho_tabular():
+    linhas = [(f"{dia:02d}/11/2024", JORNADA) for dia in range(1, 6)]
+    linhas.append(("06/11/2024", ["08:00", "12:00", "", ""]))  # Meio período
+    json_pagina = ler_pagina("JOÃO DA SILVA", "Período: 01/11/2024 a 30/11/2024", linhas)
+
+    assert json_pagina["funcionario"] == "JOÃO DA SILVA"  # Para antes do "CPF:"
+    assert (json_pagina["mes"], json_pagina["ano"]) == ("11", "2024")
+    assert json_pagina["origem"] == "camada_texto"
+    assert len(json_pagina["registros"]) == 6
+    # Total e extras (mesmo formato HH:MM) não viram batidas
+    assert json_pagina["registros"][0] == {"data": "01/11/2024", "entrada": "08:00:00", "saida_almoco": "12:00:00",
+                                           "retorno_almoco": "13:00:00", "saida": "17:05:00"}
+    assert json_pagina["registros"][5] == {"data": "06/11/2024", "entrada": "08:00:00", "saida_almoco": "12:00:00"}
+
+
+def test_camada_texto_data_so_com_dia_usa_o_periodo_do_cabecalho():
+    linhas = [(f"{dia:02d}", JORNADA) for dia in (21, 25, 31, 1, 5, 20)]
+    json_pagina = ler_pagina("MARIA SOUZA", "Período: 21/10/2024 a 20/11/2024", linhas)
+
+    assert [r["data"] for r in json_pagina["registros"]] == [
+        "21/10/2024", "25/10/2024", "31/10/2024", "01/11/2024", "05/11/2024", "20/11/2024"]
+    assert (json_pagina["mes"], json_pagina["ano"]) == ("10", "2024")
+
+
+def test_camada_texto_dia_e_mes_na_virada_do_ano():
+    linhas = [(data, JORNADA) for data in ("26/12", "30/12", "02/01", "03/01")]
+    json_pagina = ler_pagina("MARIA SOUZA", "Período: 26/12/2024 a 25/01/2025", linhas)
+
+    assert [r["data"] for r in json_pagina["registros"]] == ["26/12/2024", "30/12/2024", "02/01/2025", "03/01/2025"]
+
+
+@pytest.mark.parametrize("texto, esperado", [
+    ("Período: 21/10/2024 a 20/11/2024", (21, (10, 2024), (11, 2024))),
+    ("Competência: NOVEMBRO/2024", (1, (11, 2024), (11, 2024))),
+    ("Mês de referência: março de 2024", (1, (3, 2024), (3, 2024))),
+    ("Ref. 11/2024", (1, (11, 2024), (11, 2024))),
+    ("Sem período", None),
+])
+def test_periodo_do_cabecalho(texto, esperado):
+    assert backend._extrair_periodo(texto) == esperado
+
+
+def test_camada_texto_sem_layout_reconhecivel_cai_para_o_gemini():
+    linhas = [(f"{dia:02d}/11/2024", JORNADA) for dia in range(1, 6)]
+    assert ler_pagina("SEM CABEÇALHO", "Período: 01/11/2024 a 30/11/2024", linhas, cabecalho=False) is None
+    assert ler_pagina("POUCAS LINHAS", "Período: 01/11/2024 a 30/11/2024", linhas[:2]) is None
+    assert ler_pagina("", "Período: 01/11/2024 a 30/11/2024", linhas) is None  # Sem nome do funcionário
+
+    documento = backend.fitz.open()
+    documento.new_page().insert_text((72, 72), "scan")  # Sem camada de texto útil
+    assert backend.extrair_pagina_camada_texto(documento[0]) is None
+    documento.close()
+
+
+def test_pdf_digital_e_lido_sem_chamar_o_gemini(monkeypatch):
+    async def gemini_proibido(*argumentos, **opcoes):
+        raise AssertionError("Gemini chamado para uma página com camada de texto")
+
+    monkeypatch.setattr(backend, "call_gemini_safe", gemini_proibido)
+    documento = backend.fitz.open()
+    pagina_espelho(documento, "ANA", "Período: 01/11/2024 a 30/11/2024",
+                   [(f"{dia:02d}/11/2024", JORNADA) for dia in range(4, 9)])
+    pagina_espelho(documento, "BETO", "Período: 01/11/2024 a 30/11/2024",
+                   [(f"{dia:02d}/11/2024", JORNADA) for dia in range(4, 7)])
+    pdf = documento.tobytes()
+    documento.close()
+
+    registros = asyncio.run(backend.processar_pdf_com_gemini(pdf, "espelhos.pdf"))
+
+    assert len(registros) == 8 * 4
+    assert sorted(set(registros.nomes[i] for i in registros.funcionario)) == ["ANA", "BETO"]
+
+
+# ===== LOTES DE PÁGINAS NUMA REQUISIÇÃO (v7.7) =====
+
+@pytest.mark.parametrize("itens, esperado", [
+    ([{"pagina": 2, "f": "B"}, {"pagina": 1, "f": "A"}, {"pagina": "3", "f": "C"}], ["A", "B", "C"]),  # Fora de ordem
+    ([{"pagina": 1, "f": "A"}, {"pagina": 2, "f": "B"}, {"pagina": 2, "f": "B2"}], ["A", None, None]),  # Repetida
+    ([{"f": "A"}, {"pagina": "x", "f": "B"}, {"pagina": 4, "f": "D"}, {"pagina": 0}, "lixo"], [None, None, None]),
+    ([{"pagina": 3, "f": "C"}], [None, None, "C"]),  # Omitidas
+])
+def test_separar_resposta_lote_so_aceita_pagina_valida_e_unica(itens, esperado):
+    por_pagina = backend.separar_resposta_lote({"paginas": itens}, 3)
+    assert [item and item["f"] for item in por_pagina] == esperado
+
+
+@pytest.mark.parametrize("json_lote", [None, {}, {"paginas": "1"}, {"registros": []}])
+def test_separar_resposta_lote_invalida(json_lote):
+    assert backend.separar_resposta_lote(json_lote, 2) == [None, None]
+
+
+def test_planejar_lotes_respeita_paginas_e_tokens(monkeypatch):
+    monkeypatch.setattr(backend, "GEMINI_LOTE_MAX_PAGINAS", 3)
+    monkeypatch.setattr(backend, "GEMINI_LOTE_MAX_TOKENS", backend.GEMINI_TOKENS_PROMPT + 10000)
+
+    paginas = [(0, 3000), (1, 3000), (2, 3000), (3, 3000), (4, 9000), (5, 12000), (6, 1000)]
+    assert backend.planejar_lotes(paginas) == [[0, 1, 2], [3], [4], [5], [6]]  # Página grande demais vai sozinha
+
+
+def test_lote_reextrai_sozinha_a_pagina_duvidosa_e_usa_o_cache(cache_gemini, monkeypatch):
+    documento_fitz = backend.fitz.open()
+    for numero in range(3):
+        documento_fitz.new_page().insert_text((72, 72 + 40 * numero), f"cartão escaneado {numero + 1}", fontsize=20)
+    documento = backend.DocumentoPDF(documento_fitz.tobytes())
+    documento_fitz.close()
+
+    chamadas = []
+
+    async def gemini_falso(prompt, img, tokens_estimados=None):
+        chamadas.append(len(img) if isinstance(img, list) else 1)
+        if isinstance(img, list):
+            # Página 2 veio duas vezes: não dá para saber qual é a certa
+            return resposta_gemini(json.dumps({"paginas": [
+                {"pagina": 3, "funcionario": "CARLA", "registros": []},
+                {"pagina": 1, "funcionario": "ANA", "registros": []},
+                {"pagina": 2, "funcionario": "BETO", "registros": []},
+                {"pagina": 2, "funcionario": "ANA", "registros": []},
+            ]}))
+        return resposta_gemini('{"funcionario": "BETO", "registros": []}')
+
+    monkeypatch.setattr(backend, "call_gemini_safe", gemini_falso)
+    extrair = lambda: asyncio.run(backend._extrair_lote_pdf(documento, [0, 1, 2], asyncio.Semaphore(1)))
+    try:
+        resultados = extrair()
+        assert chamadas == [3, 1]  # Um lote + a página 2 sozinha
+        assert {n: json_data["funcionario"] for n, json_data in resultados.items()} == {0: "ANA", 1: "BETO", 2: "CARLA"}
+        assert all("pagina" not in json_data for json_data in resultados.values())
+
+        assert extrair() == resultados
+        assert chamadas == [3, 1]  # Tudo do cache: páginas do lote e a extraída sozinha
+    finally:
+        documento.fechar()
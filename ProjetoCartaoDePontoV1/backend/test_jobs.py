@@ -0,0 +1,176 @@
+"""
+Testes da fila de jobs durável (python -m pytest -q, na pasta backend).
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import backend
+
+
+@pytest.fixture
+def fila(tmp_path, monkeypatch):
+    """Fila de jobs num JOBS_DB_PATH temporário (schema criado do zero)."""
+    monkeypatch.setattr(backend, "JOBS_DIR", str(tmp_path / "jobs"))
+    monkeypatch.setattr(backend, "JOBS_DB_PATH", str(tmp_path / "jobs" / "jobs.sqlite3"))
+    monkeypatch.setattr(backend, "RESULTADOS_DIR", str(tmp_path / "resultados"))
+    monkeypatch.setattr(backend, "_jobs_schema_pronto", False)
+    return tmp_path
+
+
+def criar_job(job_id: str, arquivos: list = (), settings: dict = None) -> str:
+    backend.jobs_criar(job_id, list(arquivos), json.dumps(settings or {}), "{}")
+    return job_id
+
+
+def coluna_job(job_id: str, coluna: str):
+    conn = backend.jobs_conectar()
+    try:
+        return conn.execute(f"SELECT {coluna} FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def envelhecer_heartbeat(job_id: str) -> None:
+    """Simula um worker que morreu: heartbeat mais antigo que JOBS_HEARTBEAT_TIMEOUT_S."""
+    conn = backend.jobs_conectar()
+    try:
+        conn.execute("UPDATE jobs SET heartbeat = ? WHERE id = ?",
+                     (time.time() - backend.JOBS_HEARTBEAT_TIMEOUT_S - 1, job_id))
+    finally:
+        conn.close()
+
+
+def reservar_todos(caminho_db: str) -> list:
+    """Executado em outro processo: reserva jobs até a fila esvaziar."""
+    backend.JOBS_DB_PATH = caminho_db
+    reservados = []
+    while (job_id := backend.jobs_reservar_proximo()) is not None:
+        reservados.append(job_id)
+    return reservados
+
+
+# ===== RESERVA, RETOMADA E TENTATIVAS (v8.0) =====
+
+def test_reserva_entrega_cada_job_a_um_unico_worker(fila):
+    jobs = [criar_job(f"job{i:02d}") for i in range(12)]
+
+    # Dois processos worker disputando a mesma fila
+    with multiprocessing.get_context("spawn").Pool(2) as pool:
+        por_worker = pool.map(reservar_todos, [backend.JOBS_DB_PATH] * 2)
+
+    reservados = por_worker[0] + por_worker[1]
+    assert sorted(reservados) == jobs  # Nenhum job perdido nem entregue duas vezes
+    assert all(coluna_job(job_id, "tentativas") == 1 for job_id in jobs)
+
+
+def test_reserva_pela_ordem_de_chegada(fila):
+    primeiro = criar_job("primeiro")
+    segundo = criar_job("segundo")
+
+    assert backend.jobs_reservar_proximo() == primeiro
+    assert backend.jobs_reservar_proximo() == segundo
+    assert backend.jobs_reservar_proximo() is None  # Em processamento com heartbeat em dia
+    assert coluna_job(primeiro, "status") == "processando"
+    assert coluna_job(primeiro, "worker_pid") == os.getpid()
+
+
+def test_job_sem_heartbeat_e_retomado(fila):
+    job_id = criar_job("orfao")
+    assert backend.jobs_reservar_proximo() == job_id
+
+    envelhecer_heartbeat(job_id)
+    assert backend.jobs_reservar_proximo() == job_id
+    assert coluna_job(job_id, "status") == "processando"
+    assert coluna_job(job_id, "tentativas") == 2
+
+    # Heartbeat em dia: o job continua com o worker atual
+    backend.jobs_heartbeat(job_id)
+    assert backend.jobs_reservar_proximo() is None
+
+
+def test_job_que_esgota_as_tentativas_vira_erro(fila, monkeypatch):
+    monkeypatch.setattr(backend, "JOBS_MAX_TENTATIVAS", 2)
+    job_id = criar_job("instavel")
+
+    for _ in range(2):
+        assert backend.jobs_reservar_proximo() == job_id
+        envelhecer_heartbeat(job_id)
+
+    assert backend.jobs_reservar_proximo() is None
+    status = backend.jobs_status(job_id)
+    assert status["status"] == "erro"
+    assert status["tentativas"] == 2
+    assert "interrompido repetidamente" in status["erro"]
+    assert backend.jobs_resultado(job_id)[0] == "erro"
+
+
+# ===== CHECKPOINT POR PÁGINA E PROGRESSO =====
+
+def test_checkpoint_por_pagina_e_progresso(fila):
+    pasta = os.path.join(backend.JOBS_DIR, "paginas")
+    os.makedirs(pasta)
+    job_id = criar_job("paginas", [("a.pdf", os.path.join(pasta, "0.pdf")), ("b.pdf", os.path.join(pasta, "1.pdf"))])
+    progresso = backend.ProgressoArquivoJob(job_id, 0)
+    progresso.definir_total(4)
+    progresso.pagina_concluida(0, {"registros": []})
+    progresso.pagina_concluida(2, None)  # Página sem dados também conta como feita
+
+    assert progresso.paginas_prontas() == {0: {"registros": []}, 2: None}
+    status = backend.jobs_status(job_id)
+    assert status["progresso"] == 25.0  # Metade do primeiro de dois arquivos
+    assert status["arquivos"][0]["paginas_feitas"] == 2
+
+    backend.jobs_finalizar(job_id, "concluido", {"ok": True})
+    assert progresso.paginas_prontas() == {}  # Checkpoints apagados com o job finalizado
+    assert not os.path.exists(pasta)
+    assert backend.jobs_resultado(job_id) == ("concluido", {"ok": True}, None)
+    assert backend.jobs_status(job_id)["progresso"] == 100.0
+
+
+def test_limpeza_remove_so_jobs_expirados_fora_de_processamento(fila, monkeypatch):
+    antigo = criar_job("antigo")
+    em_andamento = criar_job("em_andamento")
+    recente = criar_job("recente")
+    backend.jobs_finalizar(antigo, "concluido", {})
+    assert backend.jobs_reservar_proximo() == em_andamento
+    conn = backend.jobs_conectar()
+    try:
+        conn.execute("UPDATE jobs SET atualizado_em = ? WHERE id IN (?, ?)", (0, antigo, em_andamento))
+    finally:
+        conn.close()
+
+    backend.jobs_limpar_expirados()
+
+    assert backend.jobs_status(antigo) is None
+    assert backend.jobs_status(em_andamento)["status"] == "processando"
+    assert backend.jobs_status(recente)["status"] == "pendente"
+
+
+# ===== ROTAS E EXECUÇÃO =====
+
+def test_job_txt_de_ponta_a_ponta(fila):
+    linhas = []
+    for dia in range(4, 9):
+        for hora in ("08:00:00", "12:00:00", "13:00:00", "17:00:00"):
+            linhas.append(f"001 ANA {dia:02d}.03.2024 {hora}")
+    cliente = TestClient(backend.app)  # Sem "with": o teste faz o papel do worker
+
+    resposta = cliente.post("/jobs", files=[("files", ("ponto.txt", "\n".join(linhas).encode(), "text/plain"))],
+                            data={"settings": "{}", "consent_metadata": "{}"})
+    job_id = resposta.json()["job_id"]
+    assert cliente.get(f"/jobs/{job_id}/resultado").status_code == 202
+
+    assert backend.jobs_reservar_proximo() == job_id
+    asyncio.run(backend.executar_job(job_id))
+
+    assert cliente.get(f"/jobs/{job_id}").json()["status"] == "concluido"
+    resultado = cliente.get(f"/jobs/{job_id}/resultado").json()
+    assert [f["funcionario"] for f in resultado["preview"]] == ["ANA"]
+    assert len(resultado["preview"][0]["dias"]) == 5
+    assert cliente.get("/jobs/inexistente").status_code == 404
@@ -0,0 +1,225 @@
+"""
+Testes dos resultados registrados e dos downloads (python -m pytest -q, na pasta backend).
+"""
+import asyncio
+import io
+import os
+import threading
+import time
+import zipfile
+from datetime import date, time as dt_time, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+from openpyxl import load_workbook
+
+import backend
+
+
+def registrar_mes(nomes=("ANA", "BETO", "CARLA"), inicio: date = date(2024, 3, 1), dias: int = 14) -> str:
+    """Registra a jornada 08-12 / 13-17 (segunda a sábado) dos funcionários; retorna o arquivo_id."""
+    registros = backend.RegistrosPonto()
+    for nome in nomes:
+        for d in range(dias):
+            dia = inicio + timedelta(days=d)
+            if dia.weekday() == 6:
+                continue
+            for hora in (dt_time(8, 0), dt_time(12, 0), dt_time(13, 0), dt_time(17, 0)):
+                registros.adicionar(nome, dia, hora, 'teste')
+    _, arquivo_id = backend.calcular_e_registrar(registros, {})
+    return arquivo_id
+
+
+@pytest.fixture
+def resultados(tmp_path, monkeypatch):
+    """Pasta de resultados temporária, cálculo em thread e fila de vagas nova."""
+    monkeypatch.setattr(backend, "RESULTADOS_DIR", str(tmp_path))
+    monkeypatch.setattr(backend, "CALCULO_PROCESSOS", 0)
+    monkeypatch.setattr(backend, "_calculo_vagas", asyncio.Semaphore(3))
+    return tmp_path
+
+
+@pytest.fixture
+def cliente(resultados):
+    return TestClient(backend.app)  # Sem "with": não sobe os workers de jobs
+
+
+# ===== DOWNLOAD DO RESULTADO (v9.4) =====
+
+def test_converter_devolve_link_e_nao_o_arquivo(cliente):
+    linhas = [f"001 ANA {dia:02d}.03.2024 {hora}" for dia in range(4, 9)
+              for hora in ("08:00:00", "12:00:00", "13:00:00", "17:00:00")]
+    resposta = cliente.post("/converter", files=[("files", ("ponto.txt", "\n".join(linhas).encode(), "text/plain"))],
+                            data={"settings": "{}", "consent_metadata": "{}"})
+
+    dados = resposta.json()
+    assert resposta.status_code == 200
+    assert "file" not in dados  # Antes: xlsx em base64 dentro do JSON
+    assert dados["download_url"] == f"/resultados/{dados['arquivo_id']}?filename={dados['filename']}"
+    download = cliente.get(dados["download_url"])
+    assert download.status_code == 200
+    assert download.headers["content-type"] == backend.XLSX_MEDIA_TYPE
+    assert load_workbook(io.BytesIO(download.content)).sheetnames == ["ANA"]
+
+
+def test_download_com_etag_e_304(cliente):
+    arquivo_id = registrar_mes()
+    resposta = cliente.get(f"/resultados/{arquivo_id}?filename=Meu_Espelho.xlsx")
+
+    assert resposta.status_code == 200
+    assert int(resposta.headers["content-length"]) == len(resposta.content)
+    assert 'filename="Meu_Espelho.xlsx"' in resposta.headers["content-disposition"]
+    etag = resposta.headers["etag"]
+
+    repetida = cliente.get(f"/resultados/{arquivo_id}", headers={"If-None-Match": etag})
+    assert repetida.status_code == 304
+    assert repetida.content == b""
+    assert cliente.get(f"/resultados/{arquivo_id}", headers={"If-None-Match": '"outro"'}).status_code == 200
+
+
+def test_download_saneia_o_nome_e_rejeita_ids_invalidos(cliente):
+    arquivo_id = registrar_mes(nomes=("ANA",))
+    resposta = cliente.get(f"/resultados/{arquivo_id}", params={"filename": "../../etc/passwd"})
+    assert 'filename="Espelho_Ponto.xlsx"' in resposta.headers["content-disposition"]
+
+    assert cliente.get("/resultados/" + "0" * 32).status_code == 404    # Expirado/inexistente
+    assert cliente.get("/resultados/..%2F..%2Fsegredo").status_code == 404
+
+
+# ===== EXCEL SOB DEMANDA E CACHE DE RESULTADOS (v9.5) =====
+
+def test_excel_so_e_gerado_no_primeiro_download(cliente, resultados):
+    arquivo_id = registrar_mes()
+    excel = resultados / arquivo_id / backend.RESULTADO_EXCEL
+    assert (resultados / arquivo_id / backend.RESULTADO_DADOS).exists()
+    assert not excel.exists()
+
+    primeiro = cliente.get(f"/resultados/{arquivo_id}")
+    assert excel.exists()
+    gerado_em = excel.stat().st_mtime_ns
+    segundo = cliente.get(f"/resultados/{arquivo_id}")
+    assert segundo.content == primeiro.content
+    assert excel.stat().st_mtime_ns == gerado_em  # Servido do disco, não gerado de novo
+
+
+def test_resultado_identico_reaproveita_o_registro(resultados):
+    arquivo_id = registrar_mes()
+    caminho = backend.gerar_excel_resultado(arquivo_id)
+
+    assert registrar_mes() == arquivo_id
+    assert backend.localizar_excel_resultado(arquivo_id) == caminho
+    assert registrar_mes(nomes=("ANA", "BETO")) != arquivo_id  # Conteúdo diferente, id diferente
+
+
+def test_cache_de_excels_mantem_so_os_mais_recentes(resultados, monkeypatch):
+    monkeypatch.setattr(backend, "RESULTADOS_CACHE_MAX", 1)
+    antigo = registrar_mes(nomes=("ANA",))
+    backend.gerar_excel_resultado(antigo)
+    os.utime(resultados / antigo, (time.time() - 60, time.time() - 60))
+
+    recente = registrar_mes(nomes=("BETO",))
+    backend.gerar_excel_resultado(recente)
+
+    assert backend.localizar_excel_resultado(antigo) is None       # Excel saiu do cache...
+    assert (resultados / antigo / backend.RESULTADO_DADOS).exists()  # ...o resultado continua
+    assert backend.localizar_excel_resultado(recente) is not None
+    assert backend.gerar_excel_resultado(antigo) is not None       # E é regerado no próximo download
+
+
+def test_resultados_sem_uso_expiram(resultados):
+    antigo = registrar_mes(nomes=("ANA",))
+    recente = registrar_mes(nomes=("BETO",))
+    limite = time.time() - backend.RESULTADOS_RETENCAO_H * 3600 - 60
+    os.utime(resultados / antigo, (limite, limite))
+
+    backend.resultados_limpar_expirados()
+
+    assert not (resultados / antigo).exists()
+    assert (resultados / recente).exists()
+    assert backend.gerar_excel_resultado(antigo) is None
+
+
+# ===== EXPORTAÇÃO ZIP (v9.6) =====
+
+def test_zip_tem_um_espelho_por_funcionario(cliente):
+    arquivo_id = registrar_mes()
+    resposta = cliente.get(f"/resultados/{arquivo_id}/zip?filename=Espelhos.zip")
+
+    assert resposta.status_code == 200
+    assert resposta.headers["content-type"] == "application/zip"
+    assert 'filename="Espelhos.zip"' in resposta.headers["content-disposition"]
+    arquivo_zip = zipfile.ZipFile(io.BytesIO(resposta.content))
+    assert arquivo_zip.testzip() is None
+    assert sorted(arquivo_zip.namelist()) == ["ANA.xlsx", "BETO.xlsx", "CARLA.xlsx"]
+    for nome in arquivo_zip.namelist():
+        assert len(load_workbook(io.BytesIO(arquivo_zip.read(nome))).sheetnames) == 1
+    assert backend._calculo_vagas._value == 3  # Todas as vagas devolvidas
+
+
+def test_zip_de_resultado_inexistente(cliente):
+    assert cliente.get("/resultados/" + "a" * 32 + "/zip").status_code == 404
+    assert cliente.get("/resultados/nao-e-um-id/zip").status_code == 404
+
+
+def test_zip_servidor_ocupado_responde_503(cliente, monkeypatch):
+    arquivo_id = registrar_mes(nomes=("ANA",))
+    monkeypatch.setattr(backend, "_calculo_vagas", asyncio.Semaphore(0))
+    monkeypatch.setattr(backend, "CALCULO_ESPERA_MAXIMA_S", 0.05)
+
+    assert cliente.get(f"/resultados/{arquivo_id}/zip").status_code == 503
+
+
+def test_zip_cliente_desconectado_antes_do_corpo_devolve_a_vaga(resultados):
+    partes, settings, totais = backend.carregar_espelhos_funcionarios(registrar_mes())
+
+    async def enviar(mensagem):
+        raise OSError("cliente desconectou")
+
+    async def receber():
+        await asyncio.Event().wait()
+
+    async def cenario():
+        exportacao = backend.ExportacaoZip(partes, settings, totais)
+        assert await exportacao.reservar()
+        assert backend._calculo_vagas._value == 2
+        resposta = backend.RespostaZip(exportacao, media_type="application/zip")
+        with pytest.raises(Exception):
+            await resposta({"type": "http"}, receber, enviar)
+
+    asyncio.run(cenario())
+    assert backend._calculo_vagas._value == 3
+
+
+def test_zip_espelho_abandonado_so_devolve_a_vaga_ao_terminar(resultados, monkeypatch):
+    partes, settings, totais = backend.carregar_espelhos_funcionarios(registrar_mes())
+    liberar = threading.Event()
+    gerar_excel_funcionario = backend.gerar_excel_funcionario
+
+    def gerar_lento(*argumentos):
+        liberar.wait(10)
+        return gerar_excel_funcionario(*argumentos)
+
+    monkeypatch.setattr(backend, "gerar_excel_funcionario", gerar_lento)
+
+    async def cenario():
+        exportacao = backend.ExportacaoZip(partes, settings, totais)
+        assert await exportacao.reservar()
+        gerador = exportacao.gerar()
+        primeiro_pedaco = asyncio.ensure_future(gerador.__anext__())
+        await asyncio.sleep(0.05)  # Primeiro espelho em geração
+
+        primeiro_pedaco.cancel()  # Cliente desconectou no meio
+        with pytest.raises(asyncio.CancelledError):
+            await primeiro_pedaco
+        await gerador.aclose()
+        # O espelho em andamento não para com o cancelamento: a vaga dele continua ocupada
+        assert backend._calculo_vagas._value == 2
+
+        liberar.set()
+        for _ in range(100):
+            if backend._calculo_vagas._value == 3:
+                break
+            await asyncio.sleep(0.02)
+        assert backend._calculo_vagas._value == 3
+
+    asyncio.run(cenario())